@@ -0,0 +1,466 @@
+"""Archive tier for the threads of finished books.
+
+A completed book's discussions and reviews are almost never written again,
+but their posts, comments and likes would otherwise stay in the busiest
+tables (and their indexes) for good. Once a book has been completed, with
+nothing posted, commented, liked or rated for ``ARCHIVE_AFTER_DAYS``, the
+periodic ``books.archive`` job moves those rows into one ``book_archives``
+row and deletes them from the live tables:
+
+- ``discussions``: each thread's posts in order, every post with its
+  comments and likes, as zlib-compressed JSON;
+- ``reviews``: each rating's likes and comments (with their likes), the same way;
+- ``counts``: posts per thread, for the thread list, and rows per table.
+
+The discussion rows (thread titles) and the ratings themselves stay live,
+so links, averages and the club page work as before. Pages for an archived
+book render from the snapshot with the same templates.
+
+Writing to an archived book's threads brings them back: a write wrapped in
+``live(book, fn)`` first moves the snapshot's rows back into the live
+tables, with their original ids, in the same transaction as the write. The
+book is archived again once it has been quiet for ``ARCHIVE_AFTER_DAYS``.
+Archiving and restoring both start by updating the book's row, so they
+hold its lock (SQLite's write lock) while rows move and never interleave
+with each other or with a write to the book's threads.
+
+    python -m app.archive                  # archive every book that is due now
+    python -m app.archive --restore 42     # move book 42's threads back
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+import zlib
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from sqlalchemy import DateTime, bindparam, delete, insert, or_, select, update
+
+from .database import SessionLocal
+from .jobs import job
+from .metrics import registry
+from .models import (
+    Book, BookArchive, Discussion, DiscussionComment, DiscussionCommentLike, DiscussionPost, DiscussionPostLike,
+    Member, Rating, ReviewComment, ReviewCommentLike, ReviewLike
+)
+
+logger = logging.getLogger("bookclub.archive")
+
+ARCHIVE_ENABLED = os.getenv("ARCHIVE_ENABLED", "on").lower() in ("1", "on", "true", "yes")
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", "3600"))
+
+FORMAT_VERSION = 1
+
+# Archives are written once and read many times, so spend the time on a smaller row
+COMPRESSION_LEVEL = 9
+
+# (model, joins leading to the book, the column that names the book), parents before children
+ARCHIVED_TABLES = [
+    (DiscussionPost, [(Discussion, DiscussionPost.discussion_id == Discussion.id)], Discussion.book_id),
+    (DiscussionPostLike, [
+        (DiscussionPost, DiscussionPostLike.post_id == DiscussionPost.id),
+        (Discussion, DiscussionPost.discussion_id == Discussion.id)
+    ], Discussion.book_id),
+    (DiscussionComment, [
+        (DiscussionPost, DiscussionComment.post_id == DiscussionPost.id),
+        (Discussion, DiscussionPost.discussion_id == Discussion.id)
+    ], Discussion.book_id),
+    (DiscussionCommentLike, [
+        (DiscussionComment, DiscussionCommentLike.comment_id == DiscussionComment.id),
+        (DiscussionPost, DiscussionComment.post_id == DiscussionPost.id),
+        (Discussion, DiscussionPost.discussion_id == Discussion.id)
+    ], Discussion.book_id),
+    (ReviewLike, [(Rating, ReviewLike.rating_id == Rating.id)], Rating.book_id),
+    (ReviewComment, [(Rating, ReviewComment.rating_id == Rating.id)], Rating.book_id),
+    (ReviewCommentLike, [
+        (ReviewComment, ReviewCommentLike.comment_id == ReviewComment.id),
+        (Rating, ReviewComment.rating_id == Rating.id)
+    ], Rating.book_id),
+]
+
+archive_total = registry.counter(
+    "bookclub_book_archives_total", "Books whose threads were archived or restored", ("action",)
+)
+
+
+def datetime_columns(model) -> list:
+    return [column.name for column in model.__table__.columns if isinstance(column.type, DateTime)]
+
+
+def ids_query(model, joins: list, book_column):
+    """SELECT of the ids of one archived table's rows that belong to the book_id parameter"""
+    query = select(model.id)
+    for target, condition in joins:
+        query = query.join(target, condition)
+    return query.where(book_column == bindparam("book_id"))
+
+
+DATETIME_COLUMNS = {model: datetime_columns(model) for model, _, _ in ARCHIVED_TABLES}
+
+# Built once: archiving runs them for every book
+READ_QUERIES = {
+    model: select(*model.__table__.columns).where(model.id.in_(ids_query(model, joins, book_column))).order_by(model.id)
+    for model, joins, book_column in ARCHIVED_TABLES
+}
+DELETE_STATEMENTS = {
+    model: delete(model).where(model.id.in_(ids_query(model, joins, book_column)))
+    .execution_options(synchronize_session=False)
+    for model, joins, book_column in ARCHIVED_TABLES
+}
+
+
+def dump_row(model, row: dict) -> dict:
+    for name in DATETIME_COLUMNS[model]:
+        if row[name] is not None:
+            row[name] = row[name].isoformat()
+    return row
+
+
+def load_row(model, data: dict) -> dict:
+    """A row's columns from the snapshot, without the children nested in it"""
+    row = {column.name: data.get(column.name) for column in model.__table__.columns}
+    for name in DATETIME_COLUMNS[model]:
+        if row[name] is not None:
+            row[name] = datetime.fromisoformat(row[name])
+    return row
+
+
+def encode(data) -> bytes:
+    return json.dumps(data, separators=(",", ":")).encode()
+
+
+def decompress(blob: bytes):
+    return json.loads(zlib.decompress(blob))
+
+
+def read_rows(db, book_id: int, model) -> list:
+    """Every row of one archived table that belongs to the book, in id order"""
+    keys = [column.name for column in model.__table__.columns]
+    return [dump_row(model, dict(zip(keys, row))) for row in db.execute(READ_QUERIES[model], {"book_id": book_id})]
+
+
+def nest(parents: dict, children: list, key: str, field: str):
+    """Append each child row to the list field of the parent row it points at"""
+    for child in children:
+        parents[str(child[key])][field].append(child)
+
+
+def build_snapshot(db, book_id: int, rating_ids: list) -> tuple:
+    """(discussions, reviews, counts, latest activity) for the book's live rows"""
+    rows = {model: read_rows(db, book_id, model) for model, _, _ in ARCHIVED_TABLES}
+    posts, comments, review_comments = rows[DiscussionPost], rows[DiscussionComment], rows[ReviewComment]
+
+    for row in posts + comments + review_comments:
+        row["likes"] = []
+    post_map = {str(post["id"]): post for post in posts}
+    for post in posts:
+        post["comments"] = []
+    nest(post_map, rows[DiscussionPostLike], "post_id", "likes")
+    nest({str(comment["id"]): comment for comment in comments}, rows[DiscussionCommentLike], "comment_id", "likes")
+    nest(post_map, comments, "post_id", "comments")
+
+    ratings = {str(rating_id): {"likes": [], "comments": []} for rating_id in rating_ids}
+    nest({str(comment["id"]): comment for comment in review_comments}, rows[ReviewCommentLike], "comment_id", "likes")
+    nest(ratings, rows[ReviewLike], "rating_id", "likes")
+    nest(ratings, review_comments, "rating_id", "comments")
+
+    threads = {}
+    for post in posts:
+        threads.setdefault(str(post["discussion_id"]), []).append(post)
+
+    author_ids = {post["author_id"] for post in posts} | {comment["author_id"] for comment in comments}
+    author_ids |= {comment["member_id"] for comment in review_comments}
+    names = {
+        str(member_id): name for member_id, name in
+        db.execute(select(Member.id, Member.display_name).where(Member.id.in_(author_ids)))
+    } if author_ids else {}
+
+    latest = max((row["created_at"] for table in rows.values() for row in table if row["created_at"]), default=None)
+    counts = {
+        "posts": {discussion_id: len(thread) for discussion_id, thread in threads.items()},
+        "rows": {model.__tablename__: len(table) for model, table in rows.items()},
+    }
+    discussions = {"members": names, "threads": threads}
+    reviews = {"members": names, "ratings": ratings}
+    return discussions, reviews, counts, latest and datetime.fromisoformat(latest)
+
+
+def archive_book(db, book_id: int, now: datetime = None, after_days: float = ARCHIVE_AFTER_DAYS) -> dict:
+    """Move a completed book's threads into book_archives if they have been quiet long enough
+
+    Commits; returns {"rows", "bytes", "stored"}, or None (and changes
+    nothing) when the book is not completed, already archived or still active.
+    """
+    now = now or datetime.utcnow()
+    cutoff = now - timedelta(days=after_days)
+    # Claim the book first: the update holds its row (SQLite's write lock) until the rows have moved
+    claimed = db.execute(
+        update(Book)
+        .where(Book.id == book_id, Book.status == "completed", Book.archived_at.is_(None))
+        .values(archived_at=now)
+        .returning(Book.completed_at)
+        .execution_options(synchronize_session=False)
+    ).first()
+    if claimed is None or (claimed.completed_at and claimed.completed_at > cutoff):
+        db.rollback()
+        return None
+
+    ratings = db.execute(select(Rating.id, Rating.updated_at).where(Rating.book_id == book_id)).all()
+    discussions, reviews, counts, latest = build_snapshot(db, book_id, [rating.id for rating in ratings])
+    activity = [at for at in [latest] + [rating.updated_at for rating in ratings] if at is not None]
+    if activity and max(activity) > cutoff:
+        db.rollback()
+        return None
+
+    discussions, reviews = encode(discussions), encode(reviews)
+    archive = BookArchive(
+        book_id=book_id,
+        format=FORMAT_VERSION,
+        discussions=zlib.compress(discussions, COMPRESSION_LEVEL),
+        reviews=zlib.compress(reviews, COMPRESSION_LEVEL),
+        counts=json.dumps(counts),
+        size=len(discussions) + len(reviews),
+        archived_at=now
+    )
+    db.add(archive)
+    # Children first, so no foreign key points at a deleted row in between
+    for model, _, _ in reversed(ARCHIVED_TABLES):
+        db.execute(DELETE_STATEMENTS[model], {"book_id": book_id})
+    db.commit()
+
+    archive_total.inc("archived")
+    return {
+        "rows": sum(counts["rows"].values()),
+        "bytes": archive.size,
+        "stored": len(archive.discussions) + len(archive.reviews),
+    }
+
+
+def restore(db, book_id: int) -> bool:
+    """Move an archived book's threads back into the live tables; False if the book was not archived
+
+    Does not commit: run it in the transaction of the write that needs the rows.
+    """
+    # Lock the book's row, as archiving does, and read whether it is archived
+    archived_at = db.execute(
+        update(Book)
+        .where(Book.id == book_id)
+        .values(archived_at=Book.archived_at)
+        .returning(Book.archived_at)
+        .execution_options(synchronize_session=False)
+    ).scalar()
+    if archived_at is None:
+        return False
+
+    archive = db.execute(
+        select(BookArchive.id, BookArchive.discussions, BookArchive.reviews).where(BookArchive.book_id == book_id)
+    ).first()
+    rows = {model: [] for model, _, _ in ARCHIVED_TABLES}
+    if archive is not None:
+        # Members who left since archiving take their posts, comments and likes with them,
+        # and everything hanging off those
+        members = set(db.scalars(
+            select(Member.id).join(Book, Book.club_id == Member.club_id).where(Book.id == book_id)
+        ))
+
+        def kept(comments: list, author_key: str) -> list:
+            """The comments whose author is still a member and whose parent was kept, parents first"""
+            kept_ids, result = set(), []
+            for comment in sorted(comments, key=lambda comment: comment["id"]):
+                parent_id = comment.get("parent_comment_id")
+                if comment[author_key] in members and (parent_id is None or parent_id in kept_ids):
+                    kept_ids.add(comment["id"])
+                    result.append(comment)
+            return result
+
+        def likes(records: list) -> list:
+            return [like for like in records if like["member_id"] in members]
+
+        for thread in decompress(archive.discussions)["threads"].values():
+            for post in thread:
+                if post["author_id"] not in members:
+                    continue
+                rows[DiscussionPost].append(load_row(DiscussionPost, post))
+                rows[DiscussionPostLike].extend(load_row(DiscussionPostLike, like) for like in likes(post["likes"]))
+                for comment in kept(post["comments"], "author_id"):
+                    rows[DiscussionComment].append(load_row(DiscussionComment, comment))
+                    rows[DiscussionCommentLike].extend(
+                        load_row(DiscussionCommentLike, like) for like in likes(comment["likes"])
+                    )
+        # Reviews deleted since archiving take their likes and comments with them
+        ratings = decompress(archive.reviews)["ratings"]
+        live = {str(rating_id) for rating_id in db.scalars(select(Rating.id).where(Rating.book_id == book_id))}
+        for rating_id, review in ratings.items():
+            if rating_id not in live:
+                continue
+            rows[ReviewLike].extend(load_row(ReviewLike, like) for like in likes(review["likes"]))
+            for comment in kept(review["comments"], "member_id"):
+                rows[ReviewComment].append(load_row(ReviewComment, comment))
+                rows[ReviewCommentLike].extend(load_row(ReviewCommentLike, like) for like in likes(comment["likes"]))
+
+        # Parents first; a reply always has a higher id than the comment it answers
+        for model, _, _ in ARCHIVED_TABLES:
+            if rows[model]:
+                db.execute(insert(model), sorted(rows[model], key=lambda row: row["id"]))
+        db.execute(delete(BookArchive).where(BookArchive.id == archive.id))
+
+    db.execute(
+        update(Book).where(Book.id == book_id).values(archived_at=None).execution_options(synchronize_session=False)
+    )
+    archive_total.inc("restored")
+    return True
+
+
+def live(book: Book, fn):
+    """The write fn, made to restore the book's archived threads first if the book is completed"""
+    if book.status != "completed":
+        return fn
+    book_id = book.id
+
+    def write(db):
+        restore(db, book_id)
+        return fn(db)
+    return write
+
+
+def due_books(db, now: datetime, after_days: float = ARCHIVE_AFTER_DAYS) -> list:
+    """Ids of completed books that are not archived and were completed long enough ago"""
+    cutoff = now - timedelta(days=after_days)
+    return db.scalars(
+        select(Book.id)
+        .where(
+            Book.status == "completed",
+            Book.archived_at.is_(None),
+            or_(Book.completed_at.is_(None), Book.completed_at <= cutoff)
+        )
+        .order_by(Book.id)
+    ).all()
+
+
+def archive_due_books(db, now: datetime = None, after_days: float = ARCHIVE_AFTER_DAYS) -> dict:
+    """Archive every book that is due, one transaction each; returns totals"""
+    now = now or datetime.utcnow()
+    book_ids = due_books(db, now, after_days)
+    db.commit()
+    stats = {"books": 0, "rows": 0, "bytes": 0, "stored": 0}
+    for book_id in book_ids:
+        result = archive_book(db, book_id, now, after_days)
+        if result is None:
+            continue
+        stats["books"] += 1
+        for key, value in result.items():
+            stats[key] += value
+    return stats
+
+
+def read(db, book_id: int, column):
+    """One decompressed part of the book's archive, or None if it has none"""
+    blob = db.scalar(select(column).where(BookArchive.book_id == book_id))
+    return decompress(blob) if blob is not None else None
+
+
+def post_counts(db, book_id: int) -> dict:
+    """{discussion id: posts} for an archived book, or None if it has no archive"""
+    counts = db.scalar(select(BookArchive.counts).where(BookArchive.book_id == book_id))
+    if counts is None:
+        return None
+    return {int(discussion_id): count for discussion_id, count in json.loads(counts)["posts"].items()}
+
+
+def author(names: dict, member_id: int) -> SimpleNamespace:
+    return SimpleNamespace(display_name=names.get(str(member_id), ""))
+
+
+def comment_records(model, like_model, comments: list, names: dict, author_key: str, field: str) -> list:
+    """Archived comments as objects shaped like the ORM rows, each with its replies attached"""
+    records = []
+    for comment in comments:
+        record = SimpleNamespace(**load_row(model, comment))
+        setattr(record, field, author(names, comment[author_key]))
+        record.likes = [SimpleNamespace(**load_row(like_model, like)) for like in comment["likes"]]
+        record.child_comments = []
+        records.append(record)
+    by_id = {record.id: record for record in records}
+    for record in records:
+        if record.parent_comment_id in by_id:
+            by_id[record.parent_comment_id].child_comments.append(record)
+    return records
+
+
+def thread(db, book_id: int, discussion_id: int) -> list:
+    """An archived discussion's posts, shaped like the DiscussionPost rows the thread page walks
+
+    None if the book has no archive (it was restored in the meantime).
+    """
+    data = read(db, book_id, BookArchive.discussions)
+    if data is None:
+        return None
+    names = data["members"]
+    posts = []
+    for post in data["threads"].get(str(discussion_id), []):
+        record = SimpleNamespace(**load_row(DiscussionPost, post))
+        record.author = author(names, post["author_id"])
+        record.likes = [SimpleNamespace(**load_row(DiscussionPostLike, like)) for like in post["likes"]]
+        record.comments = comment_records(
+            DiscussionComment, DiscussionCommentLike, post["comments"], names, "author_id", "author"
+        )
+        posts.append(record)
+    return posts
+
+
+def reviews(db, book_id: int) -> dict:
+    """{rating id: (likes, comments)} for an archived book, shaped like the rows the reviews page walks
+
+    None if the book has no archive (it was restored in the meantime).
+    """
+    data = read(db, book_id, BookArchive.reviews)
+    if data is None:
+        return None
+    names = data["members"]
+    return {
+        int(rating_id): (
+            [SimpleNamespace(**load_row(ReviewLike, like)) for like in review["likes"]],
+            comment_records(ReviewComment, ReviewCommentLike, review["comments"], names, "member_id", "member"),
+        )
+        for rating_id, review in data["ratings"].items()
+    }
+
+
+@job("books.archive", max_attempts=3, concurrency=1, every=ARCHIVE_INTERVAL if ARCHIVE_ENABLED else None)
+def archive_books():
+    """Archive the threads of every completed book that has gone quiet"""
+    if not ARCHIVE_ENABLED:
+        return
+    with SessionLocal() as db:
+        stats = archive_due_books(db)
+    if stats["books"]:
+        logger.info("Archived %d books: %d rows, %d bytes stored as %d",
+                    stats["books"], stats["rows"], stats["bytes"], stats["stored"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--days", type=float, default=ARCHIVE_AFTER_DAYS,
+                        help=f"archive books quiet for this many days (default: {ARCHIVE_AFTER_DAYS:g})")
+    parser.add_argument("--restore", type=int, metavar="BOOK_ID", help="move one book's threads back instead")
+    args = parser.parse_args()
+
+    with SessionLocal() as db:
+        if args.restore is not None:
+            if not restore(db, args.restore):
+                sys.exit(f"Book {args.restore} is not archived")
+            db.commit()
+            print(f"Restored book {args.restore}")
+            return
+        started = time.perf_counter()
+        stats = archive_due_books(db, after_days=args.days)
+    print(f"Archived {stats['books']} books in {time.perf_counter() - started:.1f}s: "
+          f"{stats['rows']} rows, {stats['bytes']} bytes stored as {stats['stored']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""Fingerprinted, precompressed static assets.
+
+``python -m app.assets`` copies each stylesheet and script to
+``app/static/dist`` under a content-hashed name, writes ``.gz`` (and, when
+the optional ``brotli`` package is installed, ``.br``) variants next to it,
+and records the mapping in ``manifest.json``. Templates link assets through
+``asset_url()``, which falls back to the unhashed file when no build exists.
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+
+try:
+    import brotli
+except ImportError:  # Optional: gzip variants only
+    brotli = None
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+DIST_DIR = os.path.join(STATIC_DIR, "dist")
+MANIFEST_PATH = os.path.join(DIST_DIR, "manifest.json")
+
+# Source files that are not served directly
+SOURCE_ONLY = {"css/input.css"}
+ASSET_DIRECTORIES = ("css", "js")
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+# (encoding, file suffix), best first
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+
+def source_assets() -> list:
+    """Paths relative to the static directory of everything the build fingerprints"""
+    paths = []
+    for directory in ASSET_DIRECTORIES:
+        for root, _, files in os.walk(os.path.join(STATIC_DIR, directory)):
+            for name in sorted(files):
+                path = os.path.relpath(os.path.join(root, name), STATIC_DIR).replace(os.sep, "/")
+                if path not in SOURCE_ONLY:
+                    paths.append(path)
+    return sorted(paths)
+
+
+def fingerprint(path: str, content: bytes) -> str:
+    """css/custom.css -> css/custom.<hash>.css"""
+    stem, extension = os.path.splitext(path)
+    return f"{stem}.{hashlib.sha256(content).hexdigest()[:12]}{extension}"
+
+
+def build() -> dict:
+    """Write hashed and compressed copies of every asset; return the manifest"""
+    shutil.rmtree(DIST_DIR, ignore_errors=True)
+    manifest = {}
+    for path in source_assets():
+        with open(os.path.join(STATIC_DIR, path), "rb") as handle:
+            content = handle.read()
+        hashed = fingerprint(path, content)
+        target = os.path.join(DIST_DIR, hashed)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+
+        with open(target, "wb") as handle:
+            handle.write(content)
+        # mtime=0 keeps the gzip output byte-for-byte reproducible
+        with open(target + ".gz", "wb") as handle:
+            handle.write(gzip.compress(content, compresslevel=9, mtime=0))
+        if brotli is not None:
+            with open(target + ".br", "wb") as handle:
+                handle.write(brotli.compress(content, quality=11))
+
+        manifest[path] = hashed
+
+    with open(MANIFEST_PATH, "w") as handle:
+        json.dump(manifest, handle, indent=2, sort_keys=True)
+    _manifest.clear()
+    _manifest.update(manifest)
+    return manifest
+
+
+def load_manifest() -> dict:
+    try:
+        with open(MANIFEST_PATH) as handle:
+            return json.load(handle)
+    except (OSError, ValueError):
+        return {}
+
+
+_manifest = load_manifest()
+
+
+def asset_url(path: str) -> str:
+    """URL of a static asset, fingerprinted when the build has been run"""
+    hashed = _manifest.get(path)
+    if hashed is None:
+        return f"/static/{path}"
+    return f"/static/dist/{hashed}"
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """Serves the .br/.gz variant a client accepts, and caches fingerprinted files forever"""
+
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200):
+        request_headers = Headers(scope=scope)
+        fingerprinted = os.path.abspath(full_path).startswith(DIST_DIR + os.sep)
+        headers = {"Cache-Control": IMMUTABLE if fingerprinted else REVALIDATE}
+
+        path, encoding = str(full_path), None
+        if fingerprinted:
+            headers["Vary"] = "Accept-Encoding"
+            accepted = {
+                value.split(";")[0].strip()
+                for value in request_headers.get("accept-encoding", "").lower().split(",")
+                if not value.replace(" ", "").endswith(";q=0")
+            }
+            for candidate, suffix in ENCODINGS:
+                if candidate in accepted and os.path.isfile(path + suffix):
+                    path, encoding = path + suffix, candidate
+                    headers["Content-Encoding"] = candidate
+                    break
+
+        response = FileResponse(
+            path,
+            status_code=status_code,
+            headers=headers,
+            media_type=mimetypes.guess_type(str(full_path))[0] or "text/plain",
+            # Passing a stat result makes ETag/Last-Modified available for the 304 check
+            stat_result=stat_result if encoding is None else os.stat(path)
+        )
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
+
+if __name__ == "__main__":
+    built = build()
+    print(f"Built {len(built)} assets into {os.path.relpath(DIST_DIR)}"
+          f"{'' if brotli is not None else ' (gzip only; install brotli for .br variants)'}")
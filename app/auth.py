@@ -0,0 +1,275 @@
+"""Signed membership tokens.
+
+A browser carries one ``member_token`` cookie listing every club membership
+it holds (member id, club id, admin flag, display name and revocation
+epoch), signed with SECRET_KEY. Requests are authenticated from the cookie
+alone; the only database read is each member's epoch, fetched once per
+process and then served from memory.
+
+Leaving a club, promotion and demotion bump ``Member.token_epoch``. A claim
+carrying an older epoch is refreshed from the database, or dropped if the
+member is gone, and the corrected cookie is sent back with the response.
+Other workers hear of the change through the invalidation bus.
+"""
+import hashlib
+import os
+import threading
+
+from fastapi import HTTPException, Request
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+from . import tracing
+from .invalidation import bus
+from .metrics import record_cache
+from .models import Member
+
+SECRET_KEY = os.getenv("SECRET_KEY", "change-this-secret-key")
+COOKIE_NAME = "member_token"
+TOKEN_MAX_AGE = 30 * 24 * 60 * 60  # 30 days
+# Keeps the cookie well under the 4KB browsers accept
+MAX_MEMBERSHIPS = 50
+
+# Pre-token cookie, still accepted and upgraded on first use
+LEGACY_COOKIE_NAME = "session_id"
+
+_serializer = URLSafeTimedSerializer(SECRET_KEY, salt="bookclub.member-token")
+
+
+class Membership:
+    """One club membership as claimed by the token"""
+    __slots__ = ("id", "club_id", "is_admin", "display_name", "epoch", "key")
+
+    def __init__(self, id: int, club_id: int, is_admin: bool, display_name: str, epoch: int, key: str):
+        self.id = id
+        self.club_id = club_id
+        self.is_admin = bool(is_admin)
+        self.display_name = display_name
+        self.epoch = epoch
+        self.key = key
+
+    @classmethod
+    def from_member(cls, member: Member) -> "Membership":
+        return cls(
+            member.id, member.club_id, member.is_admin, member.display_name,
+            member.token_epoch or 0, member_key(member.session_id)
+        )
+
+    @property
+    def version(self) -> tuple:
+        return self.club_id, self.epoch, self.key
+
+
+def member_key(session_id: str) -> str:
+    """Short digest of the member's secret, so a recycled member id never matches an old claim"""
+    return hashlib.sha256(session_id.encode()).hexdigest()[:12]
+
+
+class EpochCache:
+    """(club id, epoch, key) per member id as last read from the database; None once deleted"""
+
+    def __init__(self):
+        self._versions: dict[int, tuple] = {}
+        self._lock = threading.Lock()
+        # Bumped by every invalidation, so a read that raced one is not cached
+        self._generation = 0
+
+    def get(self, db, member_id: int):
+        fresh = bus.fresh
+        with self._lock:
+            cached = fresh and member_id in self._versions
+            version = self._versions.get(member_id) if cached else None
+            generation = self._generation
+        record_cache("token_epoch", cached)
+        if cached:
+            return version
+        row = db.query(Member.club_id, Member.token_epoch, Member.session_id).filter(Member.id == member_id).first()
+        version = (row.club_id, row.token_epoch or 0, member_key(row.session_id)) if row else None
+        with self._lock:
+            if fresh and generation == self._generation:
+                self._versions[member_id] = version
+        return version
+
+    def forget(self, member_id: int):
+        with self._lock:
+            self._generation += 1
+            self._versions.pop(member_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._versions.clear()
+
+
+epochs = EpochCache()
+bus.subscribe("member", epochs.forget, epochs.clear)
+
+
+def encode_token(memberships) -> str:
+    return _serializer.dumps([
+        [claim.id, claim.club_id, int(claim.is_admin), claim.display_name, claim.epoch, claim.key]
+        for claim in list(memberships)[-MAX_MEMBERSHIPS:]
+    ])
+
+
+def decode_token(token: str) -> dict:
+    """{club_id: Membership} from a token; empty if it is missing, forged or expired"""
+    try:
+        rows = _serializer.loads(token, max_age=TOKEN_MAX_AGE)
+    except BadSignature:
+        return {}
+    claims = {}
+    for member_id, club_id, is_admin, display_name, epoch, key in rows:
+        claims[club_id] = Membership(member_id, club_id, is_admin, display_name, epoch, key)
+    return claims
+
+
+def memberships(request: Request) -> dict:
+    """Claims from the request's token, decoded once per request"""
+    state = request.state
+    if not hasattr(state, "memberships"):
+        token = request.cookies.get(COOKIE_NAME)
+        state.memberships = decode_token(token) if token else {}
+    return state.memberships
+
+
+def _reissue(request: Request):
+    """Ask TokenRefreshMiddleware to send the updated token with the response"""
+    request.state.member_token = encode_token(memberships(request).values())
+
+
+def find_member(request: Request, db, club_id: int):
+    """The viewer's membership in a club, or None"""
+    claims = memberships(request)
+    claim = claims.get(club_id)
+
+    if claim is None:
+        legacy_session = request.cookies.get(LEGACY_COOKIE_NAME)
+        if not legacy_session:
+            return None
+        with tracing.span("get_current_member", legacy=True):
+            member = db.query(Member).filter(
+                Member.session_id == legacy_session,
+                Member.club_id == club_id
+            ).first()
+        if not member:
+            return None
+        claim = claims[club_id] = Membership.from_member(member)
+        _reissue(request)
+        return claim
+
+    with tracing.span("get_current_member"):
+        version = epochs.get(db, claim.id)
+    if version == claim.version:
+        return claim
+
+    # Revoked or changed since the token was issued
+    del claims[club_id]
+    _reissue(request)
+    if version is None or version[0] != club_id or version[2] != claim.key:
+        return None
+    with tracing.span("get_current_member", refresh=True):
+        member = db.query(Member).filter(Member.id == claim.id).first()
+    if member is None:
+        return None
+    claim = claims[club_id] = Membership.from_member(member)
+    _reissue(request)
+    return claim
+
+
+def get_current_member(request: Request, db, club_id: int) -> Membership:
+    """Get current authenticated member of a club"""
+    member = find_member(request, db, club_id)
+    if member is None:
+        if not memberships(request) and not request.cookies.get(LEGACY_COOKIE_NAME):
+            raise HTTPException(status_code=401, detail="Not authenticated")
+        raise HTTPException(status_code=403, detail="Not a member of this club")
+    return member
+
+
+def member_ids(request: Request, db) -> list:
+    """Ids of every membership the viewer holds, for pages spanning clubs"""
+    claims = memberships(request)
+    ids = []
+    for club_id in list(claims):
+        claim = find_member(request, db, club_id)
+        if claim is not None:
+            ids.append(claim.id)
+
+    legacy_session = request.cookies.get(LEGACY_COOKIE_NAME)
+    if legacy_session:
+        member = db.query(Member).filter(Member.session_id == legacy_session).first()
+        if member and member.club_id not in claims:
+            claims[member.club_id] = Membership.from_member(member)
+            ids.append(member.id)
+            _reissue(request)
+    return ids
+
+
+def grant(request: Request, response, member: Member):
+    """Add a membership to the viewer's token and set it on the response"""
+    claims = memberships(request)
+    claims.pop(member.club_id, None)
+    claims[member.club_id] = Membership.from_member(member)
+    set_token_cookie(response, encode_token(claims.values()))
+
+
+def drop(request: Request, response, club_id: int):
+    """Remove a club from the viewer's token and set it on the response"""
+    claims = memberships(request)
+    claims.pop(club_id, None)
+    set_token_cookie(response, encode_token(claims.values()))
+
+
+def revoke(db, member: Member):
+    """Commit pending changes and invalidate tokens already issued for the member"""
+    member.token_epoch = (member.token_epoch or 0) + 1
+    db.commit()
+    # Only after the commit, so a concurrent request cannot cache the old epoch again
+    bus.publish("member", member.id)
+
+
+def forget(member_id: int):
+    """Drop a deleted member's cached epoch in every worker; call after committing the delete"""
+    bus.publish("member", member_id)
+
+
+def set_token_cookie(response, token: str):
+    response.set_cookie(
+        key=COOKIE_NAME,
+        value=token,
+        httponly=True,
+        samesite="lax",
+        max_age=TOKEN_MAX_AGE
+    )
+    # The token supersedes the old per-membership cookie
+    response.delete_cookie(LEGACY_COOKIE_NAME)
+
+
+class TokenRefreshMiddleware:
+    """Sends a re-signed token when a request corrected or upgraded its claims"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_token(message):
+            if message["type"] == "http.response.start":
+                token = scope.get("state", {}).get("member_token")
+                if token is not None:
+                    headers = list(message.get("headers", []))
+                    if not any(name == b"set-cookie" and value.startswith(COOKIE_NAME.encode() + b"=")
+                               for name, value in headers):
+                        headers.append((b"set-cookie", (
+                            f"{COOKIE_NAME}={token}; HttpOnly; Max-Age={TOKEN_MAX_AGE}; Path=/; SameSite=lax"
+                        ).encode()))
+                        headers.append((b"set-cookie", (
+                            f'{LEGACY_COOKIE_NAME}=""; expires=Thu, 01 Jan 1970 00:00:00 GMT; Max-Age=0; Path=/'
+                        ).encode()))
+                    message = dict(message, headers=headers)
+            await send(message)
+
+        await self.app(scope, receive, send_with_token)
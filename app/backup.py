@@ -0,0 +1,109 @@
+"""Online backup of the SQLite database while the app keeps running.
+
+Copies the live database with SQLite's backup API a few hundred pages at a
+time, pausing between steps so the copy does not starve requests of disk.
+The source connection holds one read transaction for the whole copy, so the
+backup is a consistent snapshot of the moment it started; the database runs
+in WAL mode, so that read transaction never blocks writers, and the copy
+never restarts because of them. The copy is written next to the destination
+and renamed into place once it passes ``PRAGMA quick_check``, so a file at
+the destination is always a complete backup.
+
+    python -m app.backup                         # data/backups/bookclub-<UTC time>.db
+    python -m app.backup /backups/bookclub.db --keep 7
+
+PostgreSQL has its own tools for this (``pg_dump``, base backups).
+"""
+import argparse
+import glob
+import os
+import sqlite3
+import sys
+import time
+from datetime import datetime
+
+from .database import DATABASE_URL
+
+BACKUP_DIR = os.getenv("BACKUP_DIR", "./data/backups")
+# Pages (4 KiB by default) copied per step, and the pause between steps
+BACKUP_PAGES_PER_STEP = int(os.getenv("BACKUP_PAGES_PER_STEP", "256"))
+BACKUP_STEP_SLEEP_MS = float(os.getenv("BACKUP_STEP_SLEEP_MS", "5"))
+
+
+def sqlite_path(url: str = DATABASE_URL) -> str:
+    if not url.startswith("sqlite:///"):
+        raise ValueError("Online backup only supports SQLite databases; use pg_dump for PostgreSQL")
+    return url[len("sqlite:///"):]
+
+
+def backup(source: str, destination: str, pages: int = BACKUP_PAGES_PER_STEP,
+           sleep: float = BACKUP_STEP_SLEEP_MS / 1000, progress=None) -> dict:
+    """Copy the database at source to destination; returns {"pages", "seconds", "bytes"}"""
+    started = time.perf_counter()
+    partial = destination + ".partial"
+    if os.path.exists(partial):
+        os.remove(partial)
+
+    source_db = sqlite3.connect(source, timeout=30, isolation_level=None)
+    target_db = sqlite3.connect(partial, isolation_level=None)
+    try:
+        # WAL lets the read transaction below pin a snapshot without holding up writers
+        source_db.execute("PRAGMA journal_mode=WAL")
+        source_db.execute("BEGIN")
+        total = source_db.execute("PRAGMA page_count").fetchone()[0]
+        source_db.backup(target_db, pages=pages, sleep=sleep, progress=progress)
+        source_db.execute("COMMIT")
+
+        # A self-contained file: no -wal or -shm beside it
+        target_db.execute("PRAGMA journal_mode=DELETE")
+        check = target_db.execute("PRAGMA quick_check").fetchone()[0]
+        if check != "ok":
+            raise RuntimeError(f"Backup failed its integrity check: {check}")
+    except BaseException:
+        target_db.close()
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    finally:
+        source_db.close()
+    target_db.close()
+
+    os.replace(partial, destination)
+    return {
+        "pages": total,
+        "seconds": round(time.perf_counter() - started, 2),
+        "bytes": os.path.getsize(destination),
+    }
+
+
+def prune(directory: str, keep: int) -> list:
+    """Delete all but the newest keep backups made with the default name"""
+    backups = sorted(glob.glob(os.path.join(directory, "bookclub-*.db")))
+    removed = backups[:-keep] if keep > 0 else []
+    for path in removed:
+        os.remove(path)
+    return removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("destination", nargs="?", help=f"backup file (default: {BACKUP_DIR}/bookclub-<time>.db)")
+    parser.add_argument("--keep", type=int, default=0,
+                        help=f"afterwards delete all but this many backups in {BACKUP_DIR} (default: keep all)")
+    args = parser.parse_args()
+
+    try:
+        source = sqlite_path()
+    except ValueError as exc:
+        sys.exit(str(exc))
+    destination = args.destination or os.path.join(BACKUP_DIR, f"bookclub-{datetime.utcnow():%Y%m%d-%H%M%S}.db")
+    os.makedirs(os.path.dirname(os.path.abspath(destination)), exist_ok=True)
+
+    result = backup(source, destination)
+    print(f"Backed up {source} to {destination}: {result['bytes']} bytes in {result['seconds']}s")
+    for path in prune(BACKUP_DIR, args.keep):
+        print(f"Removed old backup {path}")
+
+
+if __name__ == "__main__":
+    main()
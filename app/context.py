@@ -0,0 +1,44 @@
+"""Per-request state shared by the instrumentation middleware and DB hooks."""
+from contextvars import ContextVar
+
+
+class RequestContext:
+    """What we know about the request currently being served"""
+    __slots__ = ("scope", "request_id", "queries", "db_seconds")
+
+    def __init__(self, scope: dict):
+        self.scope = scope
+        self.request_id = None
+        self.queries = 0
+        self.db_seconds = 0.0
+
+    @property
+    def method(self) -> str:
+        return self.scope.get("method", "WS")
+
+    @property
+    def route(self) -> str:
+        """Route template (e.g. /clubs/{code}) rather than the raw path"""
+        route = self.scope.get("route")
+        if route is not None:
+            return route.path
+        if self.scope.get("path", "").startswith("/static/"):
+            return "/static"
+        return "unmatched"
+
+
+_current: ContextVar = ContextVar("request_context", default=None)
+
+
+def current_request() -> RequestContext:
+    """The request being served, or None outside of a request"""
+    return _current.get()
+
+
+def begin_request(scope: dict):
+    """Start tracking a request; returns a token for end_request"""
+    return _current.set(RequestContext(scope))
+
+
+def end_request(token):
+    _current.reset(token)
@@ -1,16 +1,57 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, delete, event, inspect, text
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.schema import CreateTable
 import os
 
+from . import tracing
+
 # Get database URL from environment or use default SQLite
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./data/bookclub.db")
+if DATABASE_URL.startswith("postgres://"):
+    # Heroku-style URLs; SQLAlchemy only knows the postgresql:// scheme
+    DATABASE_URL = "postgresql://" + DATABASE_URL[len("postgres://"):]
+
+# PostgreSQL connection pool and server-side limits
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "5000"))
+DB_IDLE_IN_TRANSACTION_TIMEOUT_MS = int(os.getenv("DB_IDLE_IN_TRANSACTION_TIMEOUT_MS", "60000"))
+
+
+def engine_options(url: str) -> dict:
+    """create_engine() arguments for the database behind the URL"""
+    if url.startswith("sqlite"):
+        return {"connect_args": {"check_same_thread": False}}
+    if url.startswith("postgresql"):
+        return {
+            "pool_size": DB_POOL_SIZE,
+            "max_overflow": DB_MAX_OVERFLOW,
+            "pool_timeout": DB_POOL_TIMEOUT,
+            # Replace connections the server or a proxy closed while idle
+            "pool_pre_ping": True,
+            "pool_recycle": DB_POOL_RECYCLE,
+            "connect_args": {
+                "application_name": "bookclub",
+                # A runaway query or a forgotten transaction cannot hold a connection forever
+                "options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS} "
+                           f"-c idle_in_transaction_session_timeout={DB_IDLE_IN_TRANSACTION_TIMEOUT_MS}",
+            },
+        }
+    return {}
+
 
 # Create engine
-engine = create_engine(
-    DATABASE_URL,
-    connect_args={"check_same_thread": False} if "sqlite" in DATABASE_URL else {}
-)
+engine = create_engine(DATABASE_URL, **engine_options(DATABASE_URL))
+
+if engine.dialect.name == "sqlite":
+    @event.listens_for(engine, "connect")
+    def use_wal(dbapi_connection, connection_record):
+        """Readers see a snapshot and never block writers, so exports and backups can run on a live database"""
+        dbapi_connection.execute("PRAGMA journal_mode=WAL")
 
 # Create session factory
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
@@ -18,9 +59,140 @@ SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 # Create base class for models
 Base = declarative_base()
 
+def add_missing_columns():
+    """Add columns introduced after a table was created; they must be nullable or have a server default"""
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(engine.dialect)}"
+                if column.server_default is not None:
+                    ddl += f" DEFAULT {column.server_default.arg}"
+                if not column.nullable:
+                    ddl += " NOT NULL"
+                conn.execute(text(ddl))
+
+def add_autoincrement():
+    """Rebuild SQLite tables created before their models asked for AUTOINCREMENT
+
+    Without it SQLite hands out the highest id again once its row is
+    deleted. Each table is copied into a new one with the same rows and
+    ids; create_indexes() then recreates its indexes.
+    """
+    if engine.dialect.name != "sqlite":
+        return
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables or not table.dialect_options["sqlite"]["autoincrement"]:
+                continue
+            created = conn.execute(
+                text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"), {"name": table.name}
+            ).scalar()
+            if "AUTOINCREMENT" in created.upper():
+                continue
+            # Copy into a new table and swap it in, so other tables' foreign keys still name this one
+            rebuilt = f"{table.name}_rebuilt"
+            ddl = str(CreateTable(table).compile(engine)).strip()
+            conn.execute(text(ddl.replace(f"CREATE TABLE {table.name} ", f"CREATE TABLE {rebuilt} ", 1)))
+            columns = ", ".join(
+                column["name"] for column in inspector.get_columns(table.name) if column["name"] in table.c
+            )
+            conn.execute(text(f"INSERT INTO {rebuilt} ({columns}) SELECT {columns} FROM {table.name}"))
+            conn.execute(text(f"DROP TABLE {table.name}"))
+            conn.execute(text(f"ALTER TABLE {rebuilt} RENAME TO {table.name}"))
+
+def create_indexes():
+    """Create indexes added to models after their tables already existed"""
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            # Partial unique indexes only cover some rows; leave the rest alone
+            partial = any(value is not None for key, value in index.dialect_kwargs.items() if key.endswith("_where"))
+            if index.unique and not partial:
+                remove_duplicates(table, [column.name for column in index.columns])
+            index.create(bind=engine, checkfirst=True)
+
+def remove_duplicates(table, columns: list):
+    """Merge each group of rows that a new unique index would reject into its oldest row
+
+    Rows in other tables that point at a removed duplicate are moved to the
+    row that is kept. Tables are processed parents first, so duplicates this
+    creates in a child are merged when the child's own index is created.
+    """
+    name = table.name
+    key = ", ".join(columns)
+    same_key = " AND ".join(f"kept.{column} = duplicate.{column}" for column in columns)
+    duplicates = f"SELECT id FROM {name} WHERE id NOT IN (SELECT MIN(id) FROM {name} GROUP BY {key})"
+    with engine.begin() as conn:
+        for child in Base.metadata.sorted_tables:
+            for foreign_key in child.foreign_keys:
+                if foreign_key.column.table is not table or foreign_key.column.name != "id":
+                    continue
+                column = foreign_key.parent.name
+                conn.execute(text(
+                    f"UPDATE {child.name} SET {column} = ("
+                    f"SELECT MIN(kept.id) FROM {name} kept JOIN {name} duplicate ON {same_key} "
+                    f"WHERE duplicate.id = {child.name}.{column}"
+                    f") WHERE {column} IN ({duplicates})"
+                ))
+        conn.execute(text(f"DELETE FROM {name} WHERE id IN ({duplicates})"))
+
+def insert_on_conflict(model):
+    """INSERT that supports ON CONFLICT and RETURNING on the configured database"""
+    if engine.dialect.name == "postgresql":
+        return postgresql.insert(model)
+    if engine.dialect.name == "sqlite":
+        return sqlite.insert(model)
+    raise NotImplementedError(f"ON CONFLICT is not supported on {engine.dialect.name}")
+
+def insert_once(db, model, **keys) -> bool:
+    """Add the row with these unique keys unless it exists; True if this call added it
+
+    Commit afterwards even when nothing was added: on SQLite the statement
+    takes the write lock regardless and holds it until the transaction ends.
+    """
+    inserted = db.execute(
+        insert_on_conflict(model)
+        .values(**keys)
+        .on_conflict_do_nothing(index_elements=list(keys))
+        .returning(model.id)
+    ).first()
+    return inserted is not None
+
+def delete_once(db, model, **keys) -> bool:
+    """Delete the row with these unique keys; True if this call deleted it"""
+    deleted = db.execute(delete(model).filter_by(**keys).returning(model.id)).first()
+    return deleted is not None
+
+def toggle(db, model, **keys) -> bool:
+    """Add the row with these unique keys, or delete it if it exists; True if it now exists
+
+    Every call changes the state exactly once, even when concurrent calls for
+    the same keys race it: if the row vanishes between the insert and the
+    delete, the insert is tried again.
+    """
+    for _ in range(10):
+        if insert_once(db, model, **keys):
+            return True
+        if delete_once(db, model, **keys):
+            return False
+    raise RuntimeError(f"{model.__tablename__} row kept changing during toggle()")
+
 # Dependency to get database session
 def get_db():
-    db = SessionLocal()
+    with tracing.span("get_db"):
+        db = SessionLocal()
     try:
         yield db
     finally:
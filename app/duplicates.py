@@ -0,0 +1,301 @@
+"""Finding an open suggestion that is the same book as a new one.
+
+Titles and authors are folded before they are compared: accents, case and
+punctuation are dropped, a subtitle (after ``:``, ``;``, ``(`` or a dash)
+and a leading article are ignored, and ``Tolkien, J.R.R.`` is read as
+``J.R.R. Tolkien``. ISBNs are stored as ISBN-13, so an ISBN-10 and the
+ISBN-13 of the same edition are equal.
+
+A suggestion is the same book as an open one when their ISBNs are equal,
+or when their authors' surnames (nearly) agree, their titles carry the
+same numbers (``Book 2`` is not ``Book 3``) and the trigrams of their
+folded titles have a Jaccard similarity of at least ``TITLE_SIMILARITY``,
+which lets small typos through.
+
+Each worker keeps a trigram index of the open suggestions of the clubs it
+has taken suggestions for. A lookup first reads the club's suggestions
+added since the index last looked (one indexed query, usually returning
+nothing). Titles are filed only under their rarest trigrams, as many as a
+match must share one of (prefix filtering, with trigrams ranked by how
+many of the club's titles had them when the index was built), and a lookup
+probes the new title's rarest trigrams the same way, so it compares a
+handful of candidates however long the backlog is. Books that were
+selected or vetoed since stay in the index until a merge into them fails;
+indexes are rebuilt after ``INDEX_MAX_AGE`` seconds, which also re-ranks
+trigrams and picks up suggestions committed out of id order on
+PostgreSQL.
+
+A duplicate is merged into the open suggestion by adding its weight, so
+random selection counts it as suggested twice.
+"""
+import math
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter, OrderedDict, namedtuple
+from difflib import SequenceMatcher
+
+from sqlalchemy import bindparam, func, select, update
+
+from .metrics import record_cache
+from .models import Book
+
+TITLE_SIMILARITY = 0.6
+
+# Authors whose surnames are this similar are taken to be the same (typos, transliterations)
+SURNAME_SIMILARITY = 0.8
+
+# Clubs whose index each worker keeps, and how long before one is read again from scratch
+INDEX_CACHE_SIZE = 1000
+INDEX_MAX_AGE = float(os.getenv("DUPLICATE_INDEX_MAX_AGE", "600"))
+
+ARTICLES = {"the", "a", "an"}
+SUFFIXES = {"jr", "sr", "ii", "iii", "iv", "phd"}
+
+# What a title or author is compared by
+Key = namedtuple("Key", "isbn grams numbers surname")
+
+# A club's open suggestions after a book id, built once since it runs with every suggestion
+ADDED_SINCE = (
+    select(Book.id, Book.title, Book.author, Book.isbn)
+    .where(Book.club_id == bindparam("club_id"), Book.id > bindparam("last_id"),
+           Book.status == "suggested", Book.vetoed == False)
+    .order_by(Book.id)
+)
+
+
+def canonical_isbn(text: str):
+    """The ISBN-13 for an ISBN-10 or ISBN-13 (hyphens and spaces allowed), None if empty; ValueError if invalid"""
+    digits = re.sub(r"[\s-]", "", text or "").upper()
+    if not digits:
+        return None
+    if re.fullmatch(r"\d{9}[\dX]", digits):
+        if sum((10 - position) * (10 if char == "X" else int(char)) for position, char in enumerate(digits)) % 11:
+            raise ValueError("Not a valid ISBN")
+        digits = "978" + digits[:9]
+        return digits + str(-sum(int(char) * (3 if position % 2 else 1) for position, char in enumerate(digits)) % 10)
+    if re.fullmatch(r"97[89]\d{10}", digits):
+        if sum(int(char) * (3 if position % 2 else 1) for position, char in enumerate(digits)) % 10:
+            raise ValueError("Not a valid ISBN")
+        return digits
+    raise ValueError("Not a valid ISBN")
+
+
+def fold(text: str) -> str:
+    """Lower case ASCII words separated by single spaces"""
+    text = unicodedata.normalize("NFKD", text or "").replace("&", " and ")
+    text = "".join(char for char in text if not unicodedata.combining(char)).lower()
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", text.replace("'", "")).split())
+
+
+def title_key(title: str) -> str:
+    """The folded title without its subtitle or a leading article"""
+    words = fold(re.split(r"\s*[:;(\[]|\s+[-–—]+\s+", title or "", maxsplit=1)[0]).split() or fold(title).split()
+    if len(words) > 1 and words[0] in ARTICLES:
+        words = words[1:]
+    return " ".join(words)
+
+
+def surname(author: str) -> str:
+    """The folded surname of the (first) author, reading "Last, First" as "First Last" """
+    first = re.split(r"\s+(?:and|&)\s+|;", author or "", maxsplit=1)[0]
+    if first.count(",") == 1:
+        last, given = first.split(",")
+        if fold(given) not in SUFFIXES:
+            first = f"{given} {last}"
+    words = [word for word in fold(first).split() if word not in SUFFIXES]
+    return words[-1] if words else ""
+
+
+def trigrams(text: str) -> frozenset:
+    """Trigrams of each word padded with two spaces in front and one behind"""
+    grams = set()
+    for word in text.split():
+        padded = f"  {word} "
+        grams.update(padded[index:index + 3] for index in range(len(padded) - 2))
+    return frozenset(grams)
+
+
+def key(title: str, author: str, isbn: str = None) -> Key:
+    """What a book is compared by; isbn must already be canonical"""
+    folded = title_key(title)
+    return Key(isbn or None, trigrams(folded), frozenset(re.findall(r"\d+", folded)), surname(author))
+
+
+def similarity(a: frozenset, b: frozenset) -> float:
+    """Jaccard similarity of two trigram sets"""
+    if not a or not b:
+        return 0.0
+    shared = len(a & b)
+    return shared / (len(a) + len(b) - shared)
+
+
+def same_book(a: Key, b: Key) -> bool:
+    """Whether two keys are the same book"""
+    if a.isbn and a.isbn == b.isbn:
+        return True
+    if a.numbers != b.numbers or similarity(a.grams, b.grams) < TITLE_SIMILARITY:
+        return False
+    if a.surname == b.surname:
+        return True
+    return bool(a.surname and b.surname) and \
+        SequenceMatcher(None, a.surname, b.surname).ratio() >= SURNAME_SIMILARITY
+
+
+class SuggestionIndex:
+    """A club's open suggestions by ISBN and by the rarest trigrams of their titles"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.built_at = time.monotonic()
+        self.last_id = 0
+        self.keys = {}
+        self.masks = {}
+        self.isbns = {}
+        self.postings = {}
+        # Trigram: (rank, bit); rarest first when the index was built, unseen ones before them all
+        self.grams = {}
+
+    def rank(self, keys: list):
+        """Rank trigrams by how many of these keys have them; fixed for the index's life"""
+        frequency = Counter(gram for book_key in keys for gram in book_key.grams)
+        self.grams = {}
+        for gram in sorted(frequency, key=lambda gram: (frequency[gram], gram)):
+            self.grams[gram] = (len(self.grams), len(self.grams))
+
+    def encode(self, grams: frozenset) -> tuple:
+        """The title's trigrams rarest first, and a mask with a bit set for each"""
+        ranked = []
+        for gram in grams:
+            if gram not in self.grams:
+                self.grams[gram] = (-len(self.grams), len(self.grams))
+            ranked.append((self.grams[gram], gram))
+        ranked.sort()
+        mask = 0
+        for (_, bit), _ in ranked:
+            mask |= 1 << bit
+        return [gram for _, gram in ranked], mask
+
+    @staticmethod
+    def prefix(ranked: list) -> list:
+        """The rarest trigrams of a title, as many as another title it matches must share one of
+
+        A title with at least TITLE_SIMILARITY of the trigrams of both shares
+        ceil(t * |grams|) of each one's, so the two prefixes of
+        |grams| - ceil(t * |grams|) + 1 trigrams in the same order overlap.
+        """
+        return ranked[:len(ranked) - math.ceil(TITLE_SIMILARITY * len(ranked) - 1e-9) + 1]
+
+    def add(self, book_id: int, book_key: Key):
+        ranked, self.masks[book_id] = self.encode(book_key.grams)
+        self.keys[book_id] = book_key
+        if book_key.isbn:
+            self.isbns.setdefault(book_key.isbn, book_id)
+        for gram in self.prefix(ranked):
+            self.postings.setdefault(gram, set()).add(book_id)
+
+    def discard(self, book_id: int):
+        book_key = self.keys.pop(book_id, None)
+        if book_key is None:
+            return
+        del self.masks[book_id]
+        if self.isbns.get(book_key.isbn) == book_id:
+            del self.isbns[book_key.isbn]
+        for gram in self.prefix(self.encode(book_key.grams)[0]):
+            self.postings[gram].discard(book_id)
+
+    def matches(self, book_key: Key) -> list:
+        """Ids of the books that are the same book, the closest title first"""
+        found = {}
+        if book_key.isbn in self.isbns:
+            found[self.isbns[book_key.isbn]] = 2.0
+
+        ranked, mask = self.encode(book_key.grams)
+        candidates = set()
+        for gram in self.prefix(ranked):
+            candidates.update(self.postings.get(gram, ()))
+        size = len(ranked)
+        for book_id in candidates:
+            # Count shared trigrams on the masks before comparing the keys
+            other = self.keys[book_id]
+            shared = (mask & self.masks[book_id]).bit_count()
+            if book_id not in found and shared >= TITLE_SIMILARITY * (size + len(other.grams) - shared) - 1e-9 \
+                    and same_book(book_key, other):
+                found[book_id] = similarity(book_key.grams, other.grams)
+        return sorted(found, key=lambda book_id: (-found[book_id], book_id))
+
+
+class IndexCache:
+    """Suggestion indexes per club id, least recently used dropped first"""
+
+    def __init__(self, size: int = INDEX_CACHE_SIZE):
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+        self.size = size
+
+    def get(self, club_id: int):
+        """The club's index and whether it was already kept"""
+        with self._lock:
+            index = self._indexes.get(club_id)
+            hit = index is not None and time.monotonic() - index.built_at < INDEX_MAX_AGE
+            if not hit:
+                index = self._indexes[club_id] = SuggestionIndex()
+            self._indexes.move_to_end(club_id)
+            while len(self._indexes) > self.size:
+                self._indexes.popitem(last=False)
+            return index, hit
+
+    def discard(self, club_id: int, book_id: int):
+        with self._lock:
+            index = self._indexes.get(club_id)
+        if index is not None:
+            with index.lock:
+                index.discard(book_id)
+
+
+indexes = IndexCache()
+
+
+def matches(db, club_id: int, title: str, author: str, isbn: str = None) -> list:
+    """Ids of the club's open suggestions that are the same book, the closest first; isbn must be canonical"""
+    index, hit = indexes.get(club_id)
+    record_cache("suggestion_index", hit)
+    with index.lock:
+        # Suggestions added since the index last looked
+        added = []
+        for book_id, book_title, book_author, book_isbn in db.execute(
+            ADDED_SINCE, {"club_id": club_id, "last_id": index.last_id}
+        ):
+            try:
+                book_isbn = canonical_isbn(book_isbn)
+            except ValueError:
+                # Stored before ISBNs were checked
+                book_isbn = None
+            added.append((book_id, key(book_title, book_author, book_isbn)))
+        if not index.last_id:
+            index.rank([book_key for _, book_key in added])
+        for book_id, book_key in added:
+            index.add(book_id, book_key)
+            index.last_id = book_id
+        return index.matches(key(title, author, isbn))
+
+
+def merge(db, club_id: int, book_ids: list, isbn: str = None):
+    """Add one suggestion's weight to the first of these books still open; its id, or None"""
+    for book_id in book_ids:
+        merged = db.scalar(
+            update(Book)
+            .where(Book.id == book_id, Book.status == "suggested", Book.vetoed == False)
+            .values(
+                weight=func.coalesce(Book.weight, 1.0) + 1.0,
+                isbn=func.coalesce(func.nullif(Book.isbn, ""), isbn),
+            )
+            .returning(Book.id)
+        )
+        if merged:
+            return merged
+        # Selected or vetoed since the index saw it
+        indexes.discard(club_id, book_id)
+    return None
@@ -0,0 +1,306 @@
+"""Fan-out for live page updates (Server-Sent Events and WebSockets).
+
+Each worker keeps its own subscribers. Once ``relay_through(bus)`` is
+called, every event published in one worker is also handed to the other
+workers over the invalidation bus (``app/invalidation.py``) and delivered
+to their subscribers when it reaches them. Events are sent from a thread of
+the worker's own, in batches, and only while there are other workers.
+"""
+import asyncio
+import json
+import multiprocessing
+import os
+import queue
+import threading
+from functools import partial
+
+from starlette.websockets import WebSocket
+
+# Messages buffered per subscriber before it is considered a slow consumer
+SUBSCRIBER_QUEUE_SIZE = int(os.getenv("EVENTS_QUEUE_SIZE", "32"))
+
+# Idle streams send a comment line this often so dead connections are noticed
+KEEPALIVE_SECONDS = 15
+
+# A WebSocket that cannot take a message within this time is dropped
+WEBSOCKET_SEND_TIMEOUT = float(os.getenv("WEBSOCKET_SEND_TIMEOUT", "5"))
+
+# What live events are sent as on the invalidation bus, at most this many per message
+RELAY_KIND = "live_event"
+RELAY_BATCH = 100
+
+# Workers serving the app. Shared memory set before the master forks, which
+# app.server keeps up to date; other servers are taken at WEB_CONCURRENCY
+worker_count = multiprocessing.RawValue("i", max(1, int(os.getenv("WEB_CONCURRENCY") or 1)))
+
+
+class Subscription:
+    """A single listener on a topic"""
+    __slots__ = ("topic", "queue", "loop")
+
+    def __init__(self, topic: str, maxsize: int):
+        self.topic = topic
+        self.queue = asyncio.Queue(maxsize)
+        self.loop = asyncio.get_running_loop()
+
+
+class EventBroker:
+    """Fan out small JSON events to every subscriber of a topic.
+
+    Each subscriber owns a bounded queue. A subscriber whose queue is full
+    when an event arrives is evicted: its queue is cleared and it receives a
+    final ``None`` so the stream ends and the browser reconnects with fresh
+    state, instead of the broker buffering without limit.
+    """
+
+    def __init__(self, queue_size: int = SUBSCRIBER_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._topics: dict[str, set[Subscription]] = {}
+        # Called with every published event to hand it to the other workers
+        self.relay = None
+
+    def subscribe(self, topic: str) -> Subscription:
+        """Register a new subscriber for a topic"""
+        subscription = Subscription(topic, self.queue_size)
+        self._topics.setdefault(topic, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        """Remove a subscriber, dropping the topic once it is empty"""
+        subscribers = self._topics.get(subscription.topic)
+        if subscribers is None:
+            return
+        subscribers.discard(subscription)
+        if not subscribers:
+            del self._topics[subscription.topic]
+
+    def subscriber_count(self, topic: str = None) -> int:
+        """Number of subscribers on a topic, or across all topics"""
+        if topic is not None:
+            return len(self._topics.get(topic, ()))
+        return sum(len(subscribers) for subscribers in self._topics.values())
+
+    def publish(self, topic: str, event: str, data: dict) -> int:
+        """Publish an event to a topic in every worker; returns how many subscribers in this one got it"""
+        if self.relay is not None:
+            self.relay(topic, event, data)
+        return self.deliver(topic, event, data)
+
+    def deliver(self, topic: str, event: str, data: dict) -> int:
+        """Publish an event to this worker's subscribers of a topic and return how many got it"""
+        subscribers = self._topics.get(topic)
+        if not subscribers:
+            return 0
+
+        # Serialize once, no matter how many subscribers are listening
+        message = f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+        delivered = 0
+        for subscription in list(subscribers):
+            if _on_loop(subscription.loop):
+                delivered += self._offer(subscription, message)
+            else:
+                subscription.loop.call_soon_threadsafe(self._offer, subscription, message)
+                delivered += 1
+        return delivered
+
+    def _offer(self, subscription: Subscription, message: str) -> int:
+        """Queue a message for one subscriber, evicting it if it has fallen behind"""
+        try:
+            subscription.queue.put_nowait(message)
+            return 1
+        except asyncio.QueueFull:
+            self.unsubscribe(subscription)
+            while not subscription.queue.empty():
+                subscription.queue.get_nowait()
+            subscription.queue.put_nowait(None)
+            return 0
+
+    async def stream(self, topic: str):
+        """Yield Server-Sent Event frames for a topic until the client goes away"""
+        subscription = self.subscribe(topic)
+        try:
+            # Tell EventSource to wait a few seconds before reconnecting
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    message = await asyncio.wait_for(subscription.queue.get(), KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if message is None:
+                    # Evicted as a slow consumer
+                    yield "event: evicted\ndata: {}\n\n"
+                    return
+                yield message
+        finally:
+            self.unsubscribe(subscription)
+
+
+class WebSocketHub:
+    """Per-channel WebSocket connections fed by a single broadcast loop.
+
+    ``broadcast`` only serializes the message and drops it on an outbox
+    queue. One background task drains the outbox and writes each message to
+    every connection on its channel concurrently, so publishers never wait on
+    slow sockets and a stuck client is disconnected after a send timeout.
+    """
+
+    def __init__(self, send_timeout: float = WEBSOCKET_SEND_TIMEOUT):
+        self.send_timeout = send_timeout
+        self._channels: dict[str, set[WebSocket]] = {}
+        self._outbox: asyncio.Queue = None
+        self._loop: asyncio.AbstractEventLoop = None
+        self._task: asyncio.Task = None
+        # Called with every broadcast event to hand it to the other workers
+        self.relay = None
+
+    async def connect(self, channel: str, websocket: WebSocket):
+        """Accept a WebSocket and add it to a channel"""
+        await websocket.accept()
+        self._ensure_loop()
+        self._channels.setdefault(channel, set()).add(websocket)
+
+    def disconnect(self, channel: str, websocket: WebSocket):
+        """Remove a WebSocket from a channel"""
+        sockets = self._channels.get(channel)
+        if sockets is None:
+            return
+        sockets.discard(websocket)
+        if not sockets:
+            del self._channels[channel]
+
+    def connection_count(self, channel: str = None) -> int:
+        """Number of open connections on a channel, or across all channels"""
+        if channel is not None:
+            return len(self._channels.get(channel, ()))
+        return sum(len(sockets) for sockets in self._channels.values())
+
+    def broadcast(self, channel: str, event: str, data: dict):
+        """Queue an event for every connection on a channel, in every worker"""
+        if self.relay is not None:
+            self.relay(channel, event, data)
+        self.deliver(channel, event, data)
+
+    def deliver(self, channel: str, event: str, data: dict):
+        """Queue an event for every connection on a channel in this worker"""
+        if channel not in self._channels or self._outbox is None:
+            return
+
+        message = json.dumps({"event": event, "data": data})
+        if _on_loop(self._loop):
+            self._outbox.put_nowait((channel, message))
+        else:
+            self._loop.call_soon_threadsafe(self._outbox.put_nowait, (channel, message))
+
+    def _ensure_loop(self):
+        """Start the broadcast task on the running event loop if needed"""
+        if self._task is not None and not self._task.done():
+            return
+        self._loop = asyncio.get_running_loop()
+        self._outbox = asyncio.Queue()
+        self._task = self._loop.create_task(self._broadcast_loop())
+
+    async def _broadcast_loop(self):
+        """Deliver queued messages to every connection on their channel"""
+        while True:
+            channel, message = await self._outbox.get()
+            sockets = list(self._channels.get(channel, ()))
+            if not sockets:
+                continue
+
+            results = await asyncio.gather(
+                *(self._send(websocket, message) for websocket in sockets)
+            )
+            for websocket, delivered in zip(sockets, results):
+                if not delivered:
+                    self.disconnect(channel, websocket)
+
+    async def _send(self, websocket: WebSocket, message: str) -> bool:
+        """Send one message, reporting failure instead of raising"""
+        try:
+            await asyncio.wait_for(websocket.send_text(message), self.send_timeout)
+            return True
+        except Exception:
+            return False
+
+
+def _on_loop(loop: asyncio.AbstractEventLoop) -> bool:
+    """Whether we are currently running inside the given event loop"""
+    try:
+        return asyncio.get_running_loop() is loop
+    except RuntimeError:
+        return False
+
+
+def discussion_topic(discussion_id: int) -> str:
+    return f"discussion:{discussion_id}"
+
+
+def reviews_topic(book_id: int) -> str:
+    return f"reviews:{book_id}"
+
+
+def club_channel(club_id: int) -> str:
+    return f"club:{club_id}"
+
+
+# Shared broker and WebSocket hub for the whole process
+broker = EventBroker()
+hub = WebSocketHub()
+
+
+class Relay:
+    """Sends events to the other workers from a thread, so publishing never waits on the bus"""
+
+    def __init__(self, bus):
+        self.bus = bus
+        self._pending = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def __call__(self, target: str, name: str, event: str, data: dict):
+        if worker_count.value <= 1:
+            return
+        self._ensure_started().put([target, name, event, data])
+
+    def _ensure_started(self) -> queue.SimpleQueue:
+        # Threads do not survive fork, so each worker starts its own
+        if self._pid == os.getpid():
+            return self._pending
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pending = queue.SimpleQueue()
+                threading.Thread(target=self._run, args=(self._pending,), name="event-relay", daemon=True).start()
+                self._pid = os.getpid()
+        return self._pending
+
+    def _run(self, pending: queue.SimpleQueue):
+        while True:
+            batch = [pending.get()]
+            # Whatever was published meanwhile goes in the same message
+            while len(batch) < RELAY_BATCH:
+                try:
+                    batch.append(pending.get_nowait())
+                except queue.Empty:
+                    break
+            self.bus.send(RELAY_KIND, batch)
+
+
+def relay_through(bus):
+    """Hand every event published here to the other workers over the bus, and deliver theirs here"""
+    targets = {"sse": broker, "ws": hub}
+
+    def receive(batch):
+        for target, name, event, data in batch:
+            targets[target].deliver(name, event, data)
+
+    bus.listen(RELAY_KIND, receive)
+    relay = Relay(bus)
+    for target, fanout in targets.items():
+        fanout.relay = partial(relay, target)
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",  # Disable proxy buffering (nginx)
+}
@@ -0,0 +1,240 @@
+"""Streaming export of everything in one club.
+
+``export_jsonl`` yields one JSON object per line: a header, then every row
+of every table that belongs to the club as ``{"table": ..., "row": {...}}``,
+parents before children and each table in id order (so comment trees come
+parent first). ``export_zip`` writes the same rows as one ``<table>.jsonl``
+file per table plus an ``export.json`` manifest with the row counts.
+
+Rows are read with ``yield_per`` (a server-side cursor on PostgreSQL) and
+sent as they are read, so memory stays flat however big the club is. The
+whole export reads one snapshot: a single read transaction, which on SQLite
+(in WAL mode) and PostgreSQL does not hold up writers.
+
+Member secrets (``session_id``, ``token_epoch``) and email addresses are not
+exported. Threads of archived books are exported as their ``book_archives``
+rows, with the compressed snapshots decoded to JSON.
+
+    python -m app.export CLUBCODE > club.jsonl
+    python -m app.export CLUBCODE --format zip --output club.zip
+"""
+import argparse
+import json
+import sys
+import zipfile
+import zlib
+from datetime import date, datetime
+
+from sqlalchemy import select
+
+from .database import SessionLocal
+from .models import (
+    Book, BookArchive, BookReader, BookTag, BookVote, Club, Discussion, DiscussionComment, DiscussionCommentLike,
+    DiscussionPost, DiscussionPostLike, Meeting, MeetingRSVP, MeetingSchedule, Member, MemberTagAffinity, Poll,
+    PollBallot, PollOption, Rating, ReadingProgress, ReadingProgressDaily, ReviewComment, ReviewCommentLike,
+    ReviewLike, Tag, Vote
+)
+from .version import __version__
+
+FORMAT_VERSION = 2
+
+# Rows fetched from the database at a time
+EXPORT_BATCH = 1000
+
+# A slow download keeps the snapshot open; PostgreSQL ends transactions idle longer than this
+EXPORT_IDLE_TIMEOUT_MS = 600000
+
+PRIVATE_COLUMNS = {"members": {"session_id", "token_epoch", "email"}}
+
+# Columns stored as zlib-compressed JSON, exported decoded
+COMPRESSED_COLUMNS = {"book_archives": {"discussions", "reviews"}}
+
+# Tags are shared by every club; each club exports the ones its books use, once
+CLUB_TAGS = select(BookTag.tag_id, BookTag.club_id).distinct().subquery()
+
+# (table, model, joins leading to the club, the column that names the club)
+TABLES = [
+    ("clubs", Club, [], Club.id),
+    ("members", Member, [], Member.club_id),
+    ("books", Book, [], Book.club_id),
+    ("book_readers", BookReader, [(Book, BookReader.book_id == Book.id)], Book.club_id),
+    ("reading_progress", ReadingProgress, [(Book, ReadingProgress.book_id == Book.id)], Book.club_id),
+    ("reading_progress_daily", ReadingProgressDaily, [(Book, ReadingProgressDaily.book_id == Book.id)], Book.club_id),
+    ("book_votes", BookVote, [(Book, BookVote.book_id == Book.id)], Book.club_id),
+    ("tags", Tag, [(CLUB_TAGS, CLUB_TAGS.c.tag_id == Tag.id)], CLUB_TAGS.c.club_id),
+    ("book_tags", BookTag, [], BookTag.club_id),
+    ("member_tag_affinity", MemberTagAffinity, [(Member, MemberTagAffinity.member_id == Member.id)], Member.club_id),
+    ("votes", Vote, [(Book, Vote.book_id == Book.id)], Book.club_id),
+    ("discussions", Discussion, [(Book, Discussion.book_id == Book.id)], Book.club_id),
+    ("discussion_posts", DiscussionPost, [
+        (Discussion, DiscussionPost.discussion_id == Discussion.id), (Book, Discussion.book_id == Book.id)
+    ], Book.club_id),
+    ("discussion_post_likes", DiscussionPostLike, [
+        (DiscussionPost, DiscussionPostLike.post_id == DiscussionPost.id),
+        (Discussion, DiscussionPost.discussion_id == Discussion.id), (Book, Discussion.book_id == Book.id)
+    ], Book.club_id),
+    ("discussion_comments", DiscussionComment, [
+        (DiscussionPost, DiscussionComment.post_id == DiscussionPost.id),
+        (Discussion, DiscussionPost.discussion_id == Discussion.id), (Book, Discussion.book_id == Book.id)
+    ], Book.club_id),
+    ("discussion_comment_likes", DiscussionCommentLike, [
+        (DiscussionComment, DiscussionCommentLike.comment_id == DiscussionComment.id),
+        (DiscussionPost, DiscussionComment.post_id == DiscussionPost.id),
+        (Discussion, DiscussionPost.discussion_id == Discussion.id), (Book, Discussion.book_id == Book.id)
+    ], Book.club_id),
+    ("ratings", Rating, [(Book, Rating.book_id == Book.id)], Book.club_id),
+    ("review_likes", ReviewLike, [
+        (Rating, ReviewLike.rating_id == Rating.id), (Book, Rating.book_id == Book.id)
+    ], Book.club_id),
+    ("review_comments", ReviewComment, [
+        (Rating, ReviewComment.rating_id == Rating.id), (Book, Rating.book_id == Book.id)
+    ], Book.club_id),
+    ("review_comment_likes", ReviewCommentLike, [
+        (ReviewComment, ReviewCommentLike.comment_id == ReviewComment.id),
+        (Rating, ReviewComment.rating_id == Rating.id), (Book, Rating.book_id == Book.id)
+    ], Book.club_id),
+    ("book_archives", BookArchive, [(Book, BookArchive.book_id == Book.id)], Book.club_id),
+    ("meeting_schedules", MeetingSchedule, [], MeetingSchedule.club_id),
+    ("meetings", Meeting, [], Meeting.club_id),
+    ("meeting_rsvps", MeetingRSVP, [(Meeting, MeetingRSVP.meeting_id == Meeting.id)], Meeting.club_id),
+    ("polls", Poll, [], Poll.club_id),
+    ("poll_options", PollOption, [(Poll, PollOption.poll_id == Poll.id)], Poll.club_id),
+    ("poll_ballots", PollBallot, [(Poll, PollBallot.poll_id == Poll.id)], Poll.club_id),
+]
+
+
+def json_value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, (bytes, memoryview)):
+        # Poll ballots: the chosen option positions
+        return list(bytes(value))
+    raise TypeError(f"Cannot export {type(value).__name__}")
+
+
+encoder = json.JSONEncoder(default=json_value, ensure_ascii=False)
+
+
+def dump(record: dict) -> bytes:
+    return encoder.encode(record).encode() + b"\n"
+
+
+def begin_snapshot(db):
+    """Start the read transaction the whole export sees"""
+    if db.bind.dialect.name == "postgresql":
+        connection = db.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+        connection.exec_driver_sql("SET TRANSACTION READ ONLY")
+        connection.exec_driver_sql(f"SET LOCAL idle_in_transaction_session_timeout = {EXPORT_IDLE_TIMEOUT_MS}")
+    elif db.bind.dialect.name == "sqlite":
+        # pysqlite only begins transactions before writes; without this each table would see its own state
+        db.connection().exec_driver_sql("BEGIN")
+
+
+def table_rows(db, club_id: int, name: str, model, joins: list, club_column):
+    """Row dicts of one table that belong to the club, read in batches"""
+    private = PRIVATE_COLUMNS.get(name, set())
+    columns = [column for column in model.__table__.columns if column.name not in private]
+    query = select(*columns)
+    for target, condition in joins:
+        query = query.join(target, condition)
+    query = query.where(club_column == club_id).order_by(model.id).execution_options(yield_per=EXPORT_BATCH)
+    keys = [column.name for column in columns]
+    compressed = COMPRESSED_COLUMNS.get(name, set())
+    for row in db.execute(query):
+        record = dict(zip(keys, row))
+        for key in compressed:
+            record[key] = json.loads(zlib.decompress(record[key]))
+        yield record
+
+
+def header(club_code: str) -> dict:
+    return {
+        "format": FORMAT_VERSION,
+        "club": club_code,
+        "exported_at": datetime.utcnow(),
+        "version": __version__,
+        "tables": [name for name, _, _, _ in TABLES],
+    }
+
+
+def export_jsonl(club_id: int, club_code: str, session_factory=SessionLocal):
+    """The club as JSON lines, yielded a batch of rows at a time"""
+    with session_factory() as db:
+        begin_snapshot(db)
+        yield dump({"table": "export", "row": header(club_code)})
+        chunk = []
+        for table in TABLES:
+            for row in table_rows(db, club_id, *table):
+                chunk.append(dump({"table": table[0], "row": row}))
+                if len(chunk) >= EXPORT_BATCH:
+                    yield b"".join(chunk)
+                    chunk = []
+        yield b"".join(chunk)
+
+
+class ChunkWriter:
+    """Write-only file for zipfile; take() returns what was written since the last call"""
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data) -> int:
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+def export_zip(club_id: int, club_code: str, session_factory=SessionLocal):
+    """The club as a zip of one JSON lines file per table, yielded as it is compressed"""
+    output = ChunkWriter()
+    counts = {name: 0 for name, _, _, _ in TABLES}
+    with session_factory() as db, zipfile.ZipFile(output, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        begin_snapshot(db)
+        manifest = header(club_code)
+        for table in TABLES:
+            name = table[0]
+            # The output cannot seek, so each entry is streamed with a data descriptor
+            with archive.open(f"{name}.jsonl", "w", force_zip64=True) as entry:
+                for row in table_rows(db, club_id, *table):
+                    entry.write(dump(row))
+                    counts[name] += 1
+                    if counts[name] % EXPORT_BATCH == 0:
+                        yield output.take()
+        manifest["counts"] = counts
+        archive.writestr("export.json", json.dumps(manifest, default=json_value, indent=2))
+    yield output.take()
+
+
+EXPORTERS = {
+    "jsonl": (export_jsonl, "application/x-ndjson"),
+    "zip": (export_zip, "application/zip"),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("club_code")
+    parser.add_argument("--format", choices=sorted(EXPORTERS), default="jsonl")
+    parser.add_argument("--output", help="file to write instead of standard output")
+    args = parser.parse_args()
+
+    with SessionLocal() as db:
+        club_id = db.scalar(select(Club.id).where(Club.code == args.club_code.upper()))
+    if club_id is None:
+        sys.exit(f"No club with code {args.club_code}")
+
+    exporter, _ = EXPORTERS[args.format]
+    with (open(args.output, "wb") if args.output else sys.stdout.buffer) as handle:
+        for chunk in exporter(club_id, args.club_code.upper()):
+            handle.write(chunk)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+"""Genre tags on books, per-club facet counts and members' genre affinity.
+
+Tags are shared by every club and named in lower case with single spaces
+(``science fiction``). ``book_tags`` links them to books and carries each
+book's club, so a club's tags are one range of the (club_id, tag_id, book_id)
+index: filtering its suggestions or reading history by a tag, and counting
+its books per tag in one grouped query, never read other clubs' rows.
+
+A member's genre affinity is a sparse vector stored in
+``member_tag_affinity``, one row per tag: each book whose readers they
+joined adds 1 to every tag of the book, and their rating of it adds
+(stars - 3) / 2. Rating a book, joining or leaving its readers and retagging
+a book queue a ``genres.affinity`` job (de-duplicated per member or club,
+after ``GENRE_AFFINITY_DELAY`` seconds so bursts are recomputed once) that
+rebuilds the vectors with one grouped INSERT ... SELECT. Pages only read
+the stored rows.
+
+    python -m app.genres               # rebuild every member's vector now
+"""
+import argparse
+import os
+import re
+import time
+from datetime import datetime
+
+from sqlalchemy import case, delete, func, literal, select, true, union_all
+
+from .database import SessionLocal, insert_on_conflict
+from .jobs import enqueue, job
+from .models import Book, BookReader, BookTag, Member, MemberTagAffinity, Rating, Tag
+
+GENRE_AFFINITY_DELAY = float(os.getenv("GENRE_AFFINITY_DELAY", "30"))
+
+MAX_TAGS = 8
+MAX_TAG_LENGTH = 40
+
+
+def normalize(text: str) -> list:
+    """Tag names from comma-separated text, lower case and de-duplicated; ValueError if there are too many"""
+    names = []
+    for part in text.split(","):
+        name = re.sub(r"\s+", " ", part).strip().lower()[:MAX_TAG_LENGTH].strip()
+        if name and name not in names:
+            names.append(name)
+    if len(names) > MAX_TAGS:
+        raise ValueError(f"A book can have at most {MAX_TAGS} tags")
+    return names
+
+
+def tag_ids(db, names: list) -> dict:
+    """{name: id} for the names, creating tags that do not exist yet"""
+    if not names:
+        return {}
+    now = datetime.utcnow()
+    db.execute(
+        insert_on_conflict(Tag)
+        .values([{"name": name, "created_at": now} for name in names])
+        .on_conflict_do_nothing(index_elements=["name"])
+    )
+    return dict(db.execute(select(Tag.name, Tag.id).where(Tag.name.in_(names))).all())
+
+
+def queue_refresh(db, member_id: int = None, club_id: int = None):
+    """Queue a rebuild of one member's affinity vector, or every member's in a club, in db's transaction"""
+    key = f"member:{member_id}" if member_id else f"club:{club_id}"
+    enqueue(db, "genres.affinity", {"member_id": member_id, "club_id": club_id},
+            delay=GENRE_AFFINITY_DELAY, dedup_key=f"genres.affinity:{key}")
+
+
+def set_tags(db, book_id: int, club_id: int, names: list):
+    """Replace the book's tags with these names"""
+    add_tags(db, book_id, club_id, names, replace=True)
+
+
+def add_tags(db, book_id: int, club_id: int, names: list, replace: bool = False):
+    """Tag the book with these names, keeping its other tags unless replace"""
+    ids = list(tag_ids(db, names).values())
+    if replace:
+        db.execute(delete(BookTag).where(BookTag.book_id == book_id, BookTag.tag_id.not_in(ids)))
+    elif not ids:
+        return
+    if ids:
+        db.execute(
+            insert_on_conflict(BookTag)
+            .values([{"book_id": book_id, "tag_id": tag_id, "club_id": club_id} for tag_id in ids])
+            .on_conflict_do_nothing(index_elements=["book_id", "tag_id"])
+        )
+    # Readers of the book weigh its genres differently now
+    queue_refresh(db, club_id=club_id)
+
+
+def facets(db, club_id: int) -> list:
+    """(tag, open suggestions, books read) for the club's tags, most used first, from one grouped query"""
+    suggested = func.sum(case(((Book.status == "suggested") & (Book.vetoed == False), 1), else_=0))
+    completed = func.sum(case((Book.status == "completed", 1), else_=0))
+    return [tuple(row) for row in db.execute(
+        select(Tag.name, suggested, completed)
+        .select_from(BookTag)
+        .join(Tag, Tag.id == BookTag.tag_id)
+        .join(Book, Book.id == BookTag.book_id)
+        .where(BookTag.club_id == club_id)
+        .group_by(Tag.id, Tag.name)
+        .having(suggested + completed > 0)
+        .order_by((suggested + completed).desc(), Tag.name)
+    )]
+
+
+def tagged(db, club_id: int, name: str) -> set:
+    """Ids of the club's books with the tag"""
+    return set(db.scalars(
+        select(BookTag.book_id)
+        .join(Tag, Tag.id == BookTag.tag_id)
+        .where(BookTag.club_id == club_id, Tag.name == name)
+    ))
+
+
+def tags_by_book(db, club_id: int) -> dict:
+    """{book id: [tag names]} for every tagged book in the club"""
+    tags = {}
+    for book_id, name in db.execute(
+        select(BookTag.book_id, Tag.name)
+        .join(Tag, Tag.id == BookTag.tag_id)
+        .where(BookTag.club_id == club_id)
+        .order_by(Tag.name)
+    ):
+        tags.setdefault(book_id, []).append(name)
+    return tags
+
+
+def favorites(db, member_id: int, limit: int = 5) -> list:
+    """The member's strongest genres as (tag, score)"""
+    return [tuple(row) for row in db.execute(
+        select(Tag.name, MemberTagAffinity.score)
+        .join(Tag, Tag.id == MemberTagAffinity.tag_id)
+        .where(MemberTagAffinity.member_id == member_id, MemberTagAffinity.score > 0)
+        .order_by(MemberTagAffinity.score.desc(), Tag.name)
+        .limit(limit)
+    )]
+
+
+def fit(db, member_id: int, club_id: int) -> dict:
+    """{book id: how well its tags match the member's affinity} for the club's tagged books"""
+    return dict(db.execute(
+        select(BookTag.book_id, func.sum(MemberTagAffinity.score))
+        .join(MemberTagAffinity, MemberTagAffinity.tag_id == BookTag.tag_id)
+        .where(BookTag.club_id == club_id, MemberTagAffinity.member_id == member_id)
+        .group_by(BookTag.book_id)
+    ).all())
+
+
+def refresh(db, member_ids: list = None, club_id: int = None, now: datetime = None) -> int:
+    """Rebuild the affinity vectors of these members (or the club's, or everyone's); returns rows written"""
+    now = now or datetime.utcnow()
+    if member_ids is not None:
+        members = member_ids
+    elif club_id is not None:
+        members = select(Member.id).where(Member.club_id == club_id)
+    else:
+        members = None
+
+    def whose(column):
+        return column.in_(members) if members is not None else true()
+
+    # One weight per (member, book tag): 1 for reading the book, (stars - 3) / 2 for rating it
+    weights = union_all(
+        select(BookReader.member_id, BookTag.tag_id, literal(1.0).label("weight"))
+        .join(BookTag, BookTag.book_id == BookReader.book_id)
+        .where(whose(BookReader.member_id)),
+        select(Rating.member_id, BookTag.tag_id, ((Rating.rating - 3) * 0.5).label("weight"))
+        .join(BookTag, BookTag.book_id == Rating.book_id)
+        .where(whose(Rating.member_id)),
+    ).subquery()
+    score = func.sum(weights.c.weight)
+    vectors = (
+        select(weights.c.member_id, weights.c.tag_id, score, literal(now))
+        .group_by(weights.c.member_id, weights.c.tag_id)
+        .having(score != 0)
+    )
+
+    db.execute(delete(MemberTagAffinity).where(whose(MemberTagAffinity.member_id)))
+    statement = insert_on_conflict(MemberTagAffinity).from_select(
+        ["member_id", "tag_id", "score", "updated_at"], vectors
+    )
+    # A rebuild of the same member running at once may have written the row first
+    statement = statement.on_conflict_do_update(
+        index_elements=["member_id", "tag_id"],
+        set_={"score": statement.excluded.score, "updated_at": statement.excluded.updated_at},
+    )
+    return db.execute(statement).rowcount
+
+
+@job("genres.affinity", max_attempts=3, concurrency=1)
+def refresh_affinity(member_id: int = None, club_id: int = None):
+    """Rebuild a member's or a club's genre affinity vectors"""
+    with SessionLocal() as db:
+        refresh(db, member_ids=[member_id] if member_id else None, club_id=club_id)
+        db.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--club", type=int, help="only the members of this club id")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    with SessionLocal() as db:
+        rows = refresh(db, club_id=args.club)
+        db.commit()
+    print(f"Wrote {rows} genre affinity rows in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+"""Cross-worker cache invalidation.
+
+Each worker keeps its own in-process caches. When a write makes a cached
+entity stale, the code that committed it calls ``bus.publish(kind,
+entity_id)``: the local caches subscribed to that kind drop the entry at
+once, and every other worker drops it when the message reaches it.
+
+Backends (``CACHE_BUS``):
+
+- ``sqlite`` (default): messages are rows in a small SQLite file shared by
+  the workers on one host (``CACHE_BUS_URL``, by default next to a SQLite
+  database or ``./data/cache_bus.db``), polled every ``CACHE_BUS_INTERVAL``
+  seconds. No extra dependency.
+- ``redis``: Redis pub/sub on ``CACHE_BUS_URL`` (``redis://...``); needs the
+  optional ``redis`` package. Any client with the redis-py pub/sub API can be
+  passed to ``RedisBackend`` instead, e.g. a local stand-in.
+- ``local``: no other workers; only local subscribers are told.
+
+A worker that has not heard from the bus for ``STALE_AFTER`` seconds (poller
+failing, Redis unreachable) reports ``bus.fresh`` as false; caches read
+through to the database until it recovers, and everything is dropped when
+it does, so a cached entry is never more than that much out of date.
+
+Live page updates (``app/events.py``) travel over the same bus to reach
+subscribers connected to other workers; they are not replayed after an
+outage.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from .metrics import registry
+
+logger = logging.getLogger("bookclub.invalidation")
+
+
+def _default_bus_url() -> str:
+    database_url = os.getenv("DATABASE_URL", "sqlite:///./data/bookclub.db")
+    if database_url.startswith("sqlite:///"):
+        return os.path.splitext(database_url[len("sqlite:///"):])[0] + ".bus.db"
+    return "./data/cache_bus.db"
+
+
+CACHE_BUS = os.getenv("CACHE_BUS", "sqlite").lower()
+CACHE_BUS_URL = os.getenv("CACHE_BUS_URL") or _default_bus_url()
+CACHE_BUS_INTERVAL = float(os.getenv("CACHE_BUS_INTERVAL", "0.5"))
+
+# Longest a worker trusts its caches without hearing from the bus
+STALE_AFTER = max(2.0, CACHE_BUS_INTERVAL * 4)
+
+# SQLite messages older than this are pruned; a worker that fell further behind drops everything
+RETENTION_SECONDS = 300
+
+invalidations = registry.counter(
+    "bookclub_cache_invalidations_total", "Cache invalidations applied, by entity kind and origin",
+    ("kind", "origin")
+)
+bus_errors = registry.counter(
+    "bookclub_cache_bus_errors_total", "Failed publishes or polls on the cache invalidation bus"
+)
+
+
+class LocalBackend:
+    """Single process: nothing to send or receive"""
+    remote = False
+
+    def publish(self, origin: str, kind: str, entity_id):
+        pass
+
+    def poll(self, timeout: float) -> list:
+        time.sleep(timeout)
+        return []
+
+
+class SQLiteBackend:
+    """Messages appended to a shared SQLite table and read by sequence number"""
+    remote = True
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._writer = self._connect()
+        self._writer.execute(
+            "CREATE TABLE IF NOT EXISTS invalidations ("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT, origin TEXT NOT NULL, kind TEXT NOT NULL, "
+            "entity_id TEXT, created REAL NOT NULL)"
+        )
+        self._reader = self._connect()
+        self._last_seq = self._reader.execute("SELECT COALESCE(MAX(seq), 0) FROM invalidations").fetchone()[0]
+        self._last_prune = 0.0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def publish(self, origin: str, kind: str, entity_id):
+        with self._lock:
+            self._writer.execute(
+                "INSERT INTO invalidations (origin, kind, entity_id, created) VALUES (?, ?, ?, ?)",
+                (origin, kind, json.dumps(entity_id), time.time())
+            )
+
+    def poll(self, timeout: float) -> list:
+        time.sleep(timeout)
+        rows = self._reader.execute(
+            "SELECT seq, origin, kind, entity_id FROM invalidations WHERE seq > ? ORDER BY seq",
+            (self._last_seq,)
+        ).fetchall()
+        if rows:
+            self._last_seq = rows[-1][0]
+
+        now = time.time()
+        if now - self._last_prune > RETENTION_SECONDS / 10:
+            self._last_prune = now
+            with self._lock:
+                self._writer.execute("DELETE FROM invalidations WHERE created < ?", (now - RETENTION_SECONDS,))
+        return [(origin, kind, json.loads(entity_id)) for _, origin, kind, entity_id in rows]
+
+
+class RedisBackend:
+    """Redis pub/sub; pass ``client`` to use an existing connection or a stand-in"""
+    remote = True
+
+    def __init__(self, url: str = None, client=None, channel: str = "bookclub:invalidations"):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.channel = channel
+        self._pubsub = None
+
+    def publish(self, origin: str, kind: str, entity_id):
+        self.client.publish(self.channel, json.dumps([origin, kind, entity_id]))
+
+    def poll(self, timeout: float) -> list:
+        if self._pubsub is None:
+            self._pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+            self._pubsub.subscribe(self.channel)
+        messages = []
+        message = self._pubsub.get_message(timeout=timeout)
+        while message is not None:
+            if message.get("type") == "message":
+                messages.append(tuple(json.loads(message["data"])))
+            message = self._pubsub.get_message(timeout=0)
+        return messages
+
+    def reset(self):
+        """Resubscribe on the next poll; messages sent in between are lost"""
+        if self._pubsub is not None:
+            try:
+                self._pubsub.close()
+            except Exception:
+                pass
+        self._pubsub = None
+
+
+def create_backend(kind: str = CACHE_BUS, url: str = CACHE_BUS_URL):
+    if kind == "local":
+        return LocalBackend()
+    if kind == "redis":
+        return RedisBackend(url)
+    if kind == "sqlite":
+        return SQLiteBackend(url)
+    raise ValueError(f"Unknown CACHE_BUS backend: {kind}")
+
+
+class InvalidationBus:
+    """Tells subscribed caches in every worker which entities changed"""
+
+    def __init__(self, backend_factory=create_backend, interval: float = CACHE_BUS_INTERVAL):
+        self.backend_factory = backend_factory
+        self.interval = interval
+        self._subscribers: dict[str, list] = {}
+        self._listeners: dict[str, list] = {}
+        self._resets: list = []
+        self._lock = threading.Lock()
+        self._pid = None
+        self._backend = None
+        self._origin = None
+        self._last_sync = 0.0
+        self._healthy = True
+
+    def subscribe(self, kind: str, forget, clear):
+        """Call forget(entity_id) when an entity of this kind changes, and clear() when messages may have been missed"""
+        self._subscribers.setdefault(kind, []).append(forget)
+        self._resets.append(clear)
+
+    def start(self):
+        """Start listening in this worker now instead of on first use, so its listeners hear from the others"""
+        self._ensure_started()
+
+    def listen(self, kind: str, receive):
+        """Call receive(message) with every message of this kind sent by another worker; not an invalidation"""
+        self._listeners.setdefault(kind, []).append(receive)
+
+    def publish(self, kind: str, entity_id):
+        """Invalidate an entity here and in every other worker; call after committing the change"""
+        self._apply(kind, entity_id, "local")
+        self.send(kind, entity_id)
+
+    def send(self, kind: str, message):
+        """Hand a JSON-serializable message to the subscribers or listeners of this kind in every other worker"""
+        backend = self._ensure_started()
+        try:
+            backend.publish(self._origin, kind, message)
+        except Exception as exc:
+            bus_errors.inc()
+            logger.warning("Cache invalidation publish failed: %s", exc)
+
+    @property
+    def fresh(self) -> bool:
+        """Whether this worker has heard from the bus recently enough to trust its caches"""
+        backend = self._ensure_started()
+        if not backend.remote:
+            return True
+        return self._healthy and time.monotonic() - self._last_sync < STALE_AFTER
+
+    def _apply(self, kind: str, entity_id, origin: str):
+        invalidations.inc(kind, origin)
+        for forget in self._subscribers.get(kind, ()):
+            forget(entity_id)
+
+    def _reset(self):
+        for clear in self._resets:
+            clear()
+
+    def _ensure_started(self):
+        # Threads and connections do not survive fork, so each worker starts its own
+        if self._pid == os.getpid():
+            return self._backend
+        with self._lock:
+            if self._pid != os.getpid():
+                self._origin = uuid.uuid4().hex
+                self._backend = self.backend_factory()
+                self._last_sync = time.monotonic()
+                self._healthy = True
+                self._pid = os.getpid()
+                if self._backend.remote:
+                    threading.Thread(target=self._run, name="cache-invalidation", daemon=True).start()
+        return self._backend
+
+    def _run(self):
+        backend, pid = self._backend, self._pid
+        delay = self.interval
+        while self._pid == pid:
+            try:
+                messages = backend.poll(self.interval)
+            except Exception as exc:
+                bus_errors.inc()
+                if self._healthy:
+                    logger.warning("Cache invalidation bus unavailable, reading through: %s", exc)
+                self._healthy = False
+                if hasattr(backend, "reset"):
+                    backend.reset()
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+                continue
+
+            gap = time.monotonic() - self._last_sync
+            for origin, kind, entity_id in messages:
+                if origin == self._origin:
+                    continue
+                if kind in self._listeners:
+                    # Not an invalidation, so not counted as one
+                    for receive in self._listeners[kind]:
+                        receive(entity_id)
+                else:
+                    self._apply(kind, entity_id, "remote")
+            if not self._healthy or gap > RETENTION_SECONDS:
+                # Whatever was missed while out of touch can no longer be replayed
+                self._reset()
+                logger.info("Cache invalidation bus recovered; local caches cleared")
+            self._healthy = True
+            self._last_sync = time.monotonic()
+            delay = self.interval
+
+
+bus = InvalidationBus()
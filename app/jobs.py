@@ -0,0 +1,346 @@
+"""Durable background jobs, stored in the ``jobs`` table of the app's database.
+
+Register a handler with ``@job(name)`` and queue work for it from any
+request with ``enqueue(db, name, {...})``. The job row is written in the
+caller's transaction, so it exists exactly when the change that asked for
+it was committed. Handlers take the payload as keyword arguments and open
+their own sessions; plain functions run in a thread, coroutines on the event
+loop.
+
+Every web worker runs a ``JobRunner`` alongside the app (unless
+``JOBS_ENABLED=off``). A runner claims due jobs
+(``FOR UPDATE SKIP LOCKED`` on PostgreSQL, one ``UPDATE ... RETURNING``
+under SQLite's write lock), so however many processes poll, each job runs
+once at a time. At most ``JOB_CONCURRENCY`` run per process, fewer for a
+handler registered with ``concurrency``.
+
+- A job runs no earlier than ``run_at`` (``enqueue(..., delay=60)``).
+- A failed job is retried with exponential backoff until ``max_attempts``.
+- A job still running past its lease (the process died) is run again.
+- ``dedup_key``: while a job with the key is queued, enqueueing another is a
+  no-op. A job that has started does not count, so changes made while it
+  runs still get their own run.
+- ``@job(name, every=seconds)`` also runs the job periodically.
+
+Finished jobs are deleted after ``JOB_RETENTION_DAYS``.
+"""
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from datetime import datetime, timedelta
+
+from anyio import CapacityLimiter, to_thread
+from sqlalchemy import and_, func, insert, or_, select, update
+from sqlalchemy.orm import aliased
+
+from .database import SessionLocal, insert_on_conflict
+from .metrics import registry
+from .models import Job, QUEUED_JOB
+
+logger = logging.getLogger("bookclub.jobs")
+
+JOBS_ENABLED = os.getenv("JOBS_ENABLED", "on").lower() in ("1", "on", "true", "yes")
+JOB_CONCURRENCY = int(os.getenv("JOB_CONCURRENCY", "4"))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1"))
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "300"))
+JOB_RETENTION_DAYS = int(os.getenv("JOB_RETENTION_DAYS", "7"))
+
+# Queue depth is counted at most this often
+DEPTH_INTERVAL = 5.0
+
+JOB_LATENCY_BUCKETS = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+
+jobs_total = registry.counter(
+    "bookclub_jobs_total", "Background job runs by outcome (succeeded, retried, failed)",
+    ("kind", "outcome")
+)
+job_latency = registry.histogram(
+    "bookclub_job_latency_seconds", "Time from a job becoming due to it starting",
+    ("kind",), buckets=JOB_LATENCY_BUCKETS
+)
+job_duration = registry.histogram(
+    "bookclub_job_duration_seconds", "Time a background job ran for",
+    ("kind",), buckets=JOB_LATENCY_BUCKETS
+)
+queue_depth = registry.gauge(
+    "bookclub_jobs_queued", "Queued background jobs, including ones scheduled for later",
+    ("kind",)
+)
+
+
+class JobType:
+    """A registered handler and how to run it"""
+
+    def __init__(self, name: str, fn, max_attempts: int, concurrency: int, backoff: float, every: float):
+        self.name = name
+        self.fn = fn
+        self.max_attempts = max_attempts
+        self.concurrency = concurrency
+        self.backoff = backoff
+        self.every = every
+        self.is_async = asyncio.iscoroutinefunction(fn)
+
+    def retry_delay(self, attempts: int) -> float:
+        """Seconds before the next attempt: doubling from ``backoff``, capped at an hour, with jitter"""
+        return min(3600.0, self.backoff * 2 ** (attempts - 1)) * random.uniform(0.5, 1.0)
+
+
+job_types: dict[str, JobType] = {}
+
+
+def job(name: str, max_attempts: int = 5, concurrency: int = None, backoff: float = 10.0, every: float = None):
+    """Register the decorated function as the handler for jobs called name
+
+    With ``every``, the job also runs on its own (without a payload) that many
+    seconds after its previous run ended.
+    """
+    def register(fn):
+        job_types[name] = JobType(name, fn, max_attempts, concurrency, backoff, every)
+        return fn
+    return register
+
+
+def enqueue(db, name: str, payload: dict = None, run_at: datetime = None, delay: float = 0,
+            dedup_key: str = None) -> bool:
+    """Queue a job in db's transaction; False if a queued job already holds dedup_key"""
+    if name not in job_types:
+        raise ValueError(f"No handler registered for job {name!r}")
+    now = datetime.utcnow()
+    values = dict(
+        kind=name,
+        payload=json.dumps(payload or {}),
+        dedup_key=dedup_key,
+        status="queued",
+        attempts=0,
+        max_attempts=job_types[name].max_attempts,
+        run_at=run_at or now + timedelta(seconds=delay),
+        created_at=now
+    )
+    if dedup_key is None:
+        db.execute(insert(Job).values(**values))
+        return True
+    inserted = db.execute(
+        insert_on_conflict(Job)
+        .values(**values)
+        .on_conflict_do_nothing(index_elements=["dedup_key"], index_where=QUEUED_JOB)
+        .returning(Job.id)
+    ).first()
+    return inserted is not None
+
+
+def claim(db, limit: int, kinds: list) -> list:
+    """Mark up to limit due jobs of these kinds as running by this process and return them"""
+    now = datetime.utcnow()
+    ready = and_(
+        Job.kind.in_(kinds),
+        or_(
+            and_(Job.status == "queued", Job.run_at <= now),
+            # Lease expired: whoever ran it is gone
+            and_(Job.status == "running", Job.locked_until < now, Job.attempts < Job.max_attempts)
+        )
+    )
+    # An idle poll only reads, so it never takes SQLite's write lock
+    if db.execute(select(Job.id).where(ready).limit(1)).first() is None:
+        db.commit()
+        return []
+    due = select(Job.id).where(ready).order_by(Job.run_at).limit(limit).with_for_update(skip_locked=True)
+    claimed = db.execute(
+        update(Job)
+        .where(Job.id.in_(due))
+        .values(
+            status="running",
+            attempts=Job.attempts + 1,
+            started_at=now,
+            locked_until=now + timedelta(seconds=JOB_LEASE_SECONDS)
+        )
+        .returning(Job.id, Job.kind, Job.payload, Job.attempts, Job.max_attempts, Job.run_at, Job.dedup_key)
+        .execution_options(synchronize_session=False)
+    ).all()
+    db.commit()
+    return claimed
+
+
+def finish(db, claimed, error: Exception = None) -> str:
+    """Record how a claimed job ended: "succeeded", "retried" or "failed" """
+    now = datetime.utcnow()
+    # Unless the lease ran out and another runner has taken the job since
+    ours = update(Job).where(Job.id == claimed.id, Job.status == "running", Job.attempts == claimed.attempts)
+    ours = ours.execution_options(synchronize_session=False)
+
+    if error is None:
+        outcome = "succeeded"
+        db.execute(ours.values(status="done", finished_at=now, locked_until=None, last_error=None))
+    elif claimed.attempts < claimed.max_attempts:
+        outcome = "retried"
+        kind = job_types.get(claimed.kind)
+        delay = kind.retry_delay(claimed.attempts) if kind else JOB_POLL_INTERVAL
+        retry = ours
+        if claimed.dedup_key is not None:
+            # A newer queued job with the same key does the same work
+            other = aliased(Job)
+            retry = retry.where(~select(other.id).where(
+                other.dedup_key == claimed.dedup_key, other.status == "queued"
+            ).exists())
+        retried = db.execute(retry.values(
+            status="queued", run_at=now + timedelta(seconds=delay), locked_until=None, last_error=repr(error)
+        ))
+        if retried.rowcount == 0:
+            db.execute(ours.values(status="done", finished_at=now, locked_until=None, last_error=repr(error)))
+    else:
+        outcome = "failed"
+        db.execute(ours.values(status="failed", finished_at=now, locked_until=None, last_error=repr(error)))
+    db.commit()
+    return outcome
+
+
+def count_queued(db) -> dict:
+    """{kind: queued jobs}"""
+    rows = db.execute(select(Job.kind, func.count(Job.id)).where(Job.status == "queued").group_by(Job.kind))
+    return dict(rows.all())
+
+
+class JobRunner:
+    """Claims due jobs and runs them on the current event loop and a small thread pool"""
+
+    def __init__(self, concurrency: int = JOB_CONCURRENCY, poll_interval: float = JOB_POLL_INTERVAL,
+                 session_factory=SessionLocal):
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.session_factory = session_factory
+        self._running: dict[str, int] = {}
+        self._tasks: set = set()
+        self._task = None
+        self._wake = None
+        self._limiter = None
+        self._last_depth = 0.0
+
+    def start(self):
+        """Start polling on the running event loop"""
+        self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self, timeout: float = 10.0):
+        """Stop claiming and give running jobs up to timeout seconds; unfinished ones run again after their lease"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._tasks:
+            await asyncio.wait(self._tasks, timeout=timeout)
+
+    async def run(self):
+        self._wake = asyncio.Event()
+        # Job threads do not take capacity from request handlers
+        self._limiter = CapacityLimiter(self.concurrency)
+        await to_thread.run_sync(self._schedule_periodic)
+        delay = self.poll_interval
+        while True:
+            self._wake.clear()
+            try:
+                claimed = await to_thread.run_sync(self._claim)
+                delay = self.poll_interval
+            except Exception as exc:
+                logger.warning("Claiming jobs failed: %s", exc)
+                claimed = []
+                delay = min(delay * 2, 60)
+            for row in claimed:
+                self._running[row.kind] = self._running.get(row.kind, 0) + 1
+                task = asyncio.get_running_loop().create_task(self._execute(row))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+            if claimed and len(self._tasks) < self.concurrency:
+                continue
+            # Sleep until the next poll, or until a finished job frees a slot
+            try:
+                await asyncio.wait_for(self._wake.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _claim(self) -> list:
+        free = self.concurrency - len(self._tasks)
+        # Handlers without their own limit share one claim; each limited one is claimed up to its limit
+        groups = [([name for name, kind in job_types.items() if not kind.concurrency], free)]
+        for name, kind in job_types.items():
+            if kind.concurrency:
+                groups.append(([name], kind.concurrency - self._running.get(name, 0)))
+
+        claimed = []
+        with self.session_factory() as db:
+            if time.monotonic() - self._last_depth > DEPTH_INTERVAL:
+                self._last_depth = time.monotonic()
+                depth = count_queued(db)
+                db.commit()
+                for name in set(job_types) | set(depth):
+                    queue_depth.set(depth.get(name, 0), name)
+            for kinds, limit in groups:
+                limit = min(limit, free - len(claimed))
+                if kinds and limit > 0:
+                    claimed.extend(claim(db, limit, kinds))
+        return claimed
+
+    async def _execute(self, row):
+        kind = job_types[row.kind]
+        job_latency.observe(max(0.0, (datetime.utcnow() - row.run_at).total_seconds()), row.kind)
+        started = time.perf_counter()
+        error = None
+        try:
+            payload = json.loads(row.payload or "{}")
+            if kind.is_async:
+                await kind.fn(**payload)
+            else:
+                await to_thread.run_sync(lambda: kind.fn(**payload), limiter=self._limiter)
+        except Exception as exc:
+            error = exc
+            logger.exception("Job %s (%s) failed on attempt %s", row.id, row.kind, row.attempts)
+        job_duration.observe(time.perf_counter() - started, row.kind)
+
+        try:
+            outcome = await to_thread.run_sync(self._finish, row, error)
+            jobs_total.inc(row.kind, outcome)
+        except Exception as exc:
+            # The lease runs out and the job is tried again
+            logger.warning("Recording the end of job %s failed: %s", row.id, exc)
+        finally:
+            self._running[row.kind] -= 1
+            self._wake.set()
+
+    def _finish(self, row, error) -> str:
+        with self.session_factory() as db:
+            outcome = finish(db, row, error)
+            every = job_types[row.kind].every
+            if every and outcome != "retried" and row.dedup_key == row.kind:
+                enqueue(db, row.kind, delay=every, dedup_key=row.kind)
+                db.commit()
+            return outcome
+
+    def _schedule_periodic(self):
+        # The first run of each periodic job; the dedup key keeps workers from queueing it twice
+        with self.session_factory() as db:
+            for name, kind in job_types.items():
+                if kind.every:
+                    enqueue(db, name, dedup_key=name)
+            db.commit()
+
+
+@job("jobs.prune", max_attempts=3, every=3600)
+def prune_jobs():
+    """Fail jobs lost on their last attempt and delete finished jobs past their retention"""
+    now = datetime.utcnow()
+    cutoff = now - timedelta(days=JOB_RETENTION_DAYS)
+    with SessionLocal() as db:
+        db.query(Job).filter(
+            Job.status == "running", Job.locked_until < now, Job.attempts >= Job.max_attempts
+        ).update(
+            {"status": "failed", "finished_at": now, "last_error": "Lease expired on the last attempt"},
+            synchronize_session=False
+        )
+        db.query(Job).filter(Job.status.in_(("done", "failed")), Job.finished_at < cutoff).delete(
+            synchronize_session=False
+        )
+        db.commit()
+
+
+runner = JobRunner()
+
@@ -0,0 +1,54 @@
+"""Development guard that turns lazy relationship loads into errors.
+
+Equivalent to declaring every relationship with ``lazy="raise_on_sql"``:
+loads answered from the identity map still work, anything that would emit
+SQL raises. The error names the template line (or, outside a template, the
+app source line) that touched the relationship, which is where an N+1
+usually hides.
+"""
+import os
+import sys
+
+from sqlalchemy import event
+from sqlalchemy.exc import InvalidRequestError
+
+RAISE_ON_LAZY_LOAD = os.getenv("SQL_RAISE_ON_LAZY_LOAD", "false").lower() == "true"
+
+_APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class LazyLoadError(InvalidRequestError):
+    """A relationship was lazy loaded while the guard was active"""
+
+
+def trigger_location() -> str:
+    """The template line, or failing that the app source line, that caused the load"""
+    fallback = None
+    frame = sys._getframe(1)
+    while frame is not None:
+        template = frame.f_globals.get("__jinja_template__")
+        if template is not None:
+            return f"{template.name}:{template.get_corresponding_lineno(frame.f_lineno)}"
+        filename = frame.f_code.co_filename
+        if fallback is None and filename.startswith(_APP_DIR) and filename != __file__:
+            fallback = f"{os.path.relpath(filename, os.path.dirname(_APP_DIR))}:{frame.f_lineno}"
+        frame = frame.f_back
+    return fallback or "unknown location"
+
+
+def install(session_factory):
+    """Raise LazyLoadError for every lazy load that would emit SQL"""
+
+    @event.listens_for(session_factory, "do_orm_execute")
+    def do_orm_execute(execute_state):
+        state = execute_state.lazy_loaded_from
+        if state is None:
+            return
+        # The relationship being loaded is the one whose loader issued this statement
+        path = execute_state.loader_strategy_path
+        relationship = path[-1] if path is not None and len(path) else None
+        name = f"{state.class_.__name__}.{relationship.key}" if relationship is not None else state.class_.__name__
+        raise LazyLoadError(
+            f"Lazy load of {name} at {trigger_location()}; "
+            f"load it up front with selectinload()/joinedload() or query it explicitly"
+        )
@@ -1,33 +1,87 @@
+import asyncio
+
 from fastapi import FastAPI, Request, Depends
-from fastapi.staticfiles import StaticFiles
-from fastapi.templating import Jinja2Templates
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, PlainTextResponse
+from sqlalchemy import func, select
 from sqlalchemy.orm import Session
 from starlette.middleware.sessions import SessionMiddleware
-import os
+from contextlib import asynccontextmanager
+from datetime import datetime
 
-from .database import engine, get_db, Base
-from .routers import clubs, books, discussions, meetings, ratings
+from .assets import PrecompressedStaticFiles
+from .database import engine, get_db, Base, SessionLocal, add_autoincrement, add_missing_columns, create_indexes
+from .metrics import (
+    METRICS_DIR, MetricsMiddleware, instrument_engine, registry, share_metrics, share_periodically, shared_snapshots
+)
+from .templating import templates
+from . import tracing
+from .routers import clubs, books, discussions, meetings, ratings, polls, admin
+from . import archive, auth, events, jobs, lazyload, progress, reminders, slowlog
+from .invalidation import bus
 from .version import __version__
 
+# Log lines carry the request ID
+tracing.configure_logging()
+
 # Create database tables
 Base.metadata.create_all(bind=engine)
+add_missing_columns()
+add_autoincrement()
+create_indexes()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    """Run background jobs in every worker process while it serves requests, and share its metrics and slow queries"""
+    if jobs.JOBS_ENABLED:
+        jobs.runner.start()
+    # Live events from other workers arrive through the bus's poller
+    bus.start()
+    sharing = []
+    if METRICS_DIR:
+        sharing = [asyncio.create_task(share_periodically()), asyncio.create_task(slowlog.share_periodically())]
+    yield
+    await jobs.runner.stop()
+    if sharing:
+        # Leave the final counts for the workers still running to report
+        for task in sharing:
+            task.cancel()
+        share_metrics()
+        slowlog.share()
+
 
 # Initialize FastAPI app
 app = FastAPI(
     title="BookClub",
     description="Self-hosted book club management application",
-    version=__version__
+    version=__version__,
+    lifespan=lifespan
 )
 
 # Add session middleware for flash messages
-app.add_middleware(SessionMiddleware, secret_key=os.getenv("SECRET_KEY", "change-this-secret-key"))
+app.add_middleware(SessionMiddleware, secret_key=auth.SECRET_KEY)
 
-# Mount static files
-app.mount("/static", StaticFiles(directory="app/static"), name="static")
+# Re-sign member tokens whose claims were refreshed during the request
+app.add_middleware(auth.TokenRefreshMiddleware)
+
+# Request IDs and sampled trace spans (TRACE_SAMPLE_RATE)
+app.add_middleware(tracing.TracingMiddleware)
+tracing.instrument_engine(engine, SessionLocal)
+
+# Request and SQL instrumentation for /metrics (outermost, so it times everything)
+app.add_middleware(MetricsMiddleware)
+instrument_engine(engine)
+slowlog.install(engine)
 
-# Setup templates
-templates = Jinja2Templates(directory="app/templates")
+# Live updates published in one worker reach subscribers connected to the others
+events.relay_through(bus)
+
+# Development only: make unplanned lazy loads fail loudly
+if lazyload.RAISE_ON_LAZY_LOAD:
+    lazyload.install(SessionLocal)
+
+# Mount static files
+app.mount("/static", PrecompressedStaticFiles(directory="app/static"), name="static")
 
 # Include routers
 app.include_router(clubs.router, prefix="/clubs", tags=["clubs"])
@@ -35,6 +89,61 @@ app.include_router(books.router, prefix="/books", tags=["books"])
 app.include_router(discussions.router, prefix="/discussions", tags=["discussions"])
 app.include_router(meetings.router, prefix="/meetings", tags=["meetings"])
 app.include_router(ratings.router, prefix="/ratings", tags=["ratings"])
+app.include_router(polls.router, prefix="/polls", tags=["polls"])
+app.include_router(admin.router, prefix="/admin", tags=["admin"])
+
+
+def member_clubs(db: Session, member_ids: list):
+    """One row per club of the given memberships, with the figures the home page shows"""
+    from .models import Book, Club, Meeting, Member
+
+    member_count = (
+        select(func.count(Member.id))
+        .where(Member.club_id == Club.id)
+        .correlate(Club)
+        .scalar_subquery()
+    )
+    book_count = (
+        select(func.count(Book.id))
+        .where(Book.club_id == Club.id)
+        .correlate(Club)
+        .scalar_subquery()
+    )
+    current_book = (
+        select(Book.title)
+        .where(Book.club_id == Club.id, Book.status == "reading")
+        .order_by(Book.selected_at.desc())
+        .limit(1)
+        .correlate(Club)
+        .scalar_subquery()
+    )
+    next_meeting = (
+        select(func.min(Meeting.meeting_datetime))
+        .where(
+            Meeting.club_id == Club.id,
+            Meeting.status == "scheduled",
+            Meeting.meeting_datetime >= datetime.utcnow()
+        )
+        .correlate(Club)
+        .scalar_subquery()
+    )
+
+    query = (
+        select(
+            Club.id,
+            Club.name,
+            Club.code,
+            Club.description,
+            member_count.label("member_count"),
+            book_count.label("book_count"),
+            current_book.label("current_book"),
+            next_meeting.label("next_meeting")
+        )
+        .join(Member, Member.club_id == Club.id)
+        .where(Member.id.in_(member_ids))
+        .order_by(Club.name)
+    )
+    return db.execute(query).all()
 
 
 @app.get("/", response_class=HTMLResponse)
@@ -42,13 +151,12 @@ async def home(request: Request, db: Session = Depends(get_db)):
     """Home page"""
     # Get user's clubs if they have a session
     user_clubs = []
-    session_id = request.cookies.get("session_id")
+    member_ids = auth.member_ids(request, db)
     
-    if session_id:
-        from .models import Member
-        # Find all clubs this user is a member of
-        members = db.query(Member).filter(Member.session_id == session_id).all()
-        user_clubs = [member.club for member in members]
+    if member_ids:
+        # Clubs with their counts, current book and next meeting in one query
+        with tracing.span("member_clubs"):
+            user_clubs = member_clubs(db, member_ids)
     
     return templates.TemplateResponse(
         "index.html",
@@ -66,6 +174,16 @@ async def health_check():
     return {"status": "healthy", "version": __version__}
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Prometheus metrics endpoint; every worker's under app.server"""
+    snapshots = shared_snapshots() if METRICS_DIR else None
+    return PlainTextResponse(
+        registry.render(snapshots),
+        media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
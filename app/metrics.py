@@ -0,0 +1,483 @@
+"""Prometheus metrics collected in-process and rendered in the text exposition format.
+
+Under ``app.server`` each worker also leaves its metrics in ``METRICS_DIR``
+every ``METRICS_SHARE_SECONDS``, and a scrape, whichever worker serves it,
+reports every worker: counters and histograms summed (those of exited
+workers included, so they never go backwards) and gauges labelled with
+each live worker's pid.
+"""
+import asyncio
+import fcntl
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from anyio import to_thread
+from sqlalchemy import event
+
+from .context import begin_request, end_request, current_request
+from .events import broker, hub
+
+# Default latency buckets (seconds), same as the Prometheus client libraries
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# Where workers share their metrics (set by app.server), and how often each writes them
+METRICS_DIR = os.getenv("METRICS_DIR")
+METRICS_SHARE_SECONDS = float(os.getenv("METRICS_SHARE_SECONDS", "5"))
+
+
+def _format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter:
+    """Monotonically increasing value per label set"""
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def get(self, *label_values) -> float:
+        return self._values.get(label_values, 0)
+
+    def collect(self) -> dict:
+        with self._lock:
+            return dict(self._values)
+
+    def samples(self, values: dict = None, labels: tuple = None):
+        labels = self.labels if labels is None else labels
+        for label_values, value in (self.collect() if values is None else values).items():
+            yield self.name, _format_labels(labels, label_values), value
+
+
+class Gauge:
+    """Point-in-time value, either set directly or read from a callback at scrape time"""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), callback=None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.callback = callback
+        self._values: dict[tuple, float] = {}
+
+    def set(self, value: float, *label_values):
+        self._values[label_values] = value
+
+    def inc(self, *label_values, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def dec(self, *label_values, amount: float = 1):
+        self.inc(*label_values, amount=-amount)
+
+    def collect(self) -> dict:
+        if self.callback is not None:
+            values = self.callback()
+            return values if isinstance(values, dict) else {(): values}
+        return dict(self._values)
+
+    def samples(self, values: dict = None, labels: tuple = None):
+        labels = self.labels if labels is None else labels
+        for label_values, value in (self.collect() if values is None else values).items():
+            yield self.name, _format_labels(labels, label_values), value
+
+
+class Histogram:
+    """Bucketed observations with a running sum and count per label set"""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self._series: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                # [per-bucket counts..., sum, count]
+                series = self._series[label_values] = [0] * len(self.buckets) + [0.0, 0]
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def collect(self) -> dict:
+        with self._lock:
+            return {label_values: list(series) for label_values, series in self._series.items()}
+
+    def samples(self, values: dict = None, labels: tuple = None):
+        labels = self.labels if labels is None else labels
+        bucket_labels = labels + ("le",)
+        for label_values, series in (self.collect() if values is None else values).items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                yield self.name + "_bucket", _format_labels(bucket_labels, label_values + (_format_value(bound),)), \
+                    cumulative
+            yield self.name + "_sum", _format_labels(labels, label_values), series[-2]
+            yield self.name + "_count", _format_labels(labels, label_values), series[-1]
+
+
+class Registry:
+    """Collection of metrics rendered together for a scrape"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs) -> Counter:
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs) -> Gauge:
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs) -> Histogram:
+        return self.register(Histogram(*args, **kwargs))
+
+    def snapshot(self) -> dict:
+        """Every metric's values as JSON, for the other workers to report"""
+        return {
+            metric.name: [[list(label_values), value] for label_values, value in metric.collect().items()]
+            for metric in self._metrics
+        }
+
+    def combine(self, snapshots: dict) -> dict:
+        """Workers' snapshots by worker as {metric name: {label values: value}}
+
+        Counters and histograms are summed; gauges get the worker as a last label value.
+        """
+        kinds = {metric.name: metric.kind for metric in self._metrics}
+        combined = {name: {} for name in kinds}
+        for worker, snapshot in snapshots.items():
+            for name, series in snapshot.items():
+                # Metrics the code that wrote the snapshot had and this code does not
+                if name not in kinds:
+                    continue
+                values = combined[name]
+                for label_values, value in series:
+                    label_values = tuple(str(label) for label in label_values)
+                    if kinds[name] == "gauge":
+                        values[label_values + (worker,)] = value
+                    elif kinds[name] == "histogram":
+                        known = values.get(label_values)
+                        values[label_values] = value if known is None else [a + b for a, b in zip(known, value)]
+                    else:
+                        values[label_values] = values.get(label_values, 0) + value
+        return combined
+
+    def render(self, snapshots: dict = None) -> str:
+        """This worker's metrics, or those of every worker in snapshots combined"""
+        combined = self.combine(snapshots) if snapshots is not None else {}
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            if snapshots is None:
+                samples = metric.samples()
+            else:
+                labels = metric.labels + ("worker",) if metric.kind == "gauge" else metric.labels
+                samples = metric.samples(combined[metric.name], labels)
+            for name, labels, value in samples:
+                lines.append(f"{name}{labels} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def _read_snapshot(path: str):
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_snapshot(path: str, snapshot: dict):
+    partial = f"{path}.{os.getpid()}.tmp"
+    with open(partial, "w") as file:
+        json.dump(snapshot, file)
+    os.replace(partial, path)
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _retire(directory: str, paths: list):
+    """Fold exited workers' counters and histograms into exited.json and drop their files; hold the lock"""
+    exited_path = os.path.join(directory, "exited.json")
+    snapshots = {"exited": _read_snapshot(exited_path) or {}}
+    for path in paths:
+        snapshots[path] = _read_snapshot(path) or {}
+    gauges = {metric.name for metric in registry._metrics if metric.kind == "gauge"}
+    _write_snapshot(exited_path, {
+        name: [[list(label_values), value] for label_values, value in values.items()]
+        for name, values in registry.combine(snapshots).items() if name not in gauges
+    })
+    for path in paths:
+        os.remove(path)
+
+
+_shared_pid = None
+
+
+def share_metrics(directory: str = METRICS_DIR):
+    """Leave this worker's metrics in the shared directory"""
+    global _shared_pid
+    path = os.path.join(directory, f"{os.getpid()}.json")
+    if _shared_pid != os.getpid():
+        # A worker that had this pid before us left its metrics behind
+        with open(os.path.join(directory, ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.exists(path):
+                _retire(directory, [path])
+        _shared_pid = os.getpid()
+    _write_snapshot(path, registry.snapshot())
+
+
+def shared_snapshots(directory: str = METRICS_DIR) -> dict:
+    """Every worker's last metrics by pid, this worker's current ones and the exited workers' as "exited" """
+    snapshots = {}
+    with open(os.path.join(directory, ".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        exited = []
+        for entry in os.listdir(directory):
+            worker, extension = os.path.splitext(entry)
+            if extension != ".json" or not worker.isdigit() or int(worker) == os.getpid():
+                continue
+            path = os.path.join(directory, entry)
+            if not _alive(int(worker)):
+                exited.append(path)
+                continue
+            snapshot = _read_snapshot(path)
+            if snapshot is not None:
+                snapshots[worker] = snapshot
+        if exited:
+            _retire(directory, exited)
+        snapshots["exited"] = _read_snapshot(os.path.join(directory, "exited.json")) or {}
+    snapshots[str(os.getpid())] = registry.snapshot()
+    return snapshots
+
+
+async def share_periodically(directory: str = METRICS_DIR, interval: float = METRICS_SHARE_SECONDS):
+    """Share this worker's metrics every interval seconds"""
+    while True:
+        share_metrics(directory)
+        await asyncio.sleep(interval)
+
+# HTTP
+http_requests = registry.counter(
+    "bookclub_http_requests_total", "HTTP requests by route and status",
+    ("method", "route", "status")
+)
+http_latency = registry.histogram(
+    "bookclub_http_request_duration_seconds", "HTTP request latency by route",
+    ("method", "route")
+)
+http_in_flight = registry.gauge(
+    "bookclub_http_requests_in_flight", "HTTP requests currently being served"
+)
+
+# Database
+db_queries = registry.counter(
+    "bookclub_db_queries_total", "SQL statements executed, by originating route",
+    ("route",)
+)
+db_query_seconds = registry.counter(
+    "bookclub_db_query_seconds_total", "Time spent executing SQL statements, by originating route",
+    ("route",)
+)
+db_queries_per_request = registry.histogram(
+    "bookclub_http_request_db_queries", "SQL statements executed per request",
+    ("route",), buckets=QUERY_COUNT_BUCKETS
+)
+db_seconds_per_request = registry.histogram(
+    "bookclub_http_request_db_seconds", "Time spent in SQL per request",
+    ("route",)
+)
+db_pool_checkout_wait = registry.histogram(
+    "bookclub_db_pool_checkout_wait_seconds", "Time a session waited to obtain a pooled connection"
+)
+
+# Caches
+cache_requests = registry.counter(
+    "bookclub_cache_requests_total", "In-process cache lookups by result",
+    ("cache", "result")
+)
+
+
+def _cache_hit_ratios() -> dict:
+    ratios = {}
+    names = {label_values[0] for label_values, _ in cache_requests._values.items()}
+    for name in names:
+        hits = cache_requests.get(name, "hit")
+        total = hits + cache_requests.get(name, "miss")
+        ratios[(name,)] = hits / total if total else 0
+    return ratios
+
+
+registry.gauge(
+    "bookclub_cache_hit_ratio", "Share of in-process cache lookups that were hits",
+    ("cache",), callback=_cache_hit_ratios
+)
+
+
+def record_cache(cache: str, hit: bool):
+    """Count a lookup against a named in-process cache"""
+    cache_requests.inc(cache, "hit" if hit else "miss")
+
+
+# Worker threadpool (sync dependencies and endpoints run here)
+def _threadpool_stat(attribute: str):
+    def read():
+        try:
+            return getattr(to_thread.current_default_thread_limiter(), attribute)
+        except RuntimeError:
+            # Not inside an event loop
+            return 0
+    return read
+
+
+registry.gauge(
+    "bookclub_threadpool_threads_busy", "Worker threads currently borrowed",
+    callback=_threadpool_stat("borrowed_tokens")
+)
+registry.gauge(
+    "bookclub_threadpool_threads_total", "Worker thread capacity",
+    callback=_threadpool_stat("total_tokens")
+)
+
+# Live updates
+registry.gauge(
+    "bookclub_sse_subscribers", "Open Server-Sent Event streams",
+    callback=lambda: broker.subscriber_count()
+)
+registry.gauge(
+    "bookclub_websocket_connections", "Open club WebSocket connections",
+    callback=lambda: hub.connection_count()
+)
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording per-route request counts, latency and SQL usage"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        token = begin_request(scope)
+        context = current_request()
+        status = 500
+        started = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        http_in_flight.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            http_in_flight.dec()
+            route = context.route
+            http_requests.inc(context.method, route, status)
+            http_latency.observe(elapsed, context.method, route)
+            db_queries_per_request.observe(context.queries, route)
+            db_seconds_per_request.observe(context.db_seconds, route)
+            end_request(token)
+
+
+def instrument_engine(engine):
+    """Hook SQL execution and pool checkout timing into the metrics"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info["metrics_query_start"] = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info.pop("metrics_query_start")
+        request = current_request()
+        route = request.route if request else "background"
+        if request:
+            request.queries += 1
+            request.db_seconds += elapsed
+        db_queries.inc(route)
+        db_query_seconds.inc(route, amount=elapsed)
+
+    # The checkout wait is the pool's connect() itself: waiting for a
+    # connection to come back, or opening one, and pinging it. dispose()
+    # replaces the pool (workers do after fork), so time the new one too.
+    def time_checkouts(pool):
+        connect = pool.connect
+
+        def timed_connect():
+            started = time.perf_counter()
+            try:
+                return connect()
+            finally:
+                db_pool_checkout_wait.observe(time.perf_counter() - started)
+
+        pool.connect = timed_connect
+
+    time_checkouts(engine.pool)
+
+    @event.listens_for(engine, "engine_disposed")
+    def engine_disposed(engine):
+        time_checkouts(engine.pool)
+
+    if hasattr(engine.pool, "checkedout"):
+        registry.gauge(
+            "bookclub_db_pool_checked_out", "Connections currently checked out of the pool",
+            callback=lambda: engine.pool.checkedout()
+        )
+        registry.gauge(
+            "bookclub_db_pool_size", "Configured connection pool size",
+            callback=lambda: engine.pool.size()
+        )
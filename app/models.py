@@ -1,4 +1,6 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Boolean, Float
+from sqlalchemy import (
+    Column, Integer, SmallInteger, String, Text, Date, DateTime, ForeignKey, Boolean, Float, Index, LargeBinary, text
+)
 from sqlalchemy.orm import relationship
 from datetime import datetime
 import secrets
@@ -36,11 +38,13 @@ class Member(Base):
     __tablename__ = "members"
     
     id = Column(Integer, primary_key=True, index=True)
-    club_id = Column(Integer, ForeignKey("clubs.id"), nullable=False)
+    club_id = Column(Integer, ForeignKey("clubs.id"), nullable=False, index=True)
     display_name = Column(String(100), nullable=False)
+    email = Column(String(254))  # Optional; where meeting reminders are sent
     session_id = Column(String(64), unique=True, nullable=False, index=True)
     joined_at = Column(DateTime, default=datetime.utcnow)
     is_admin = Column(Boolean, default=False)  # Club admin status
+    token_epoch = Column(Integer, default=0, nullable=False, server_default="0")  # Bumped to revoke issued tokens
     
     # Relationships
     club = relationship("Club", back_populates="members")
@@ -53,7 +57,7 @@ class Book(Base):
     __tablename__ = "books"
     
     id = Column(Integer, primary_key=True, index=True)
-    club_id = Column(Integer, ForeignKey("clubs.id"), nullable=False)
+    club_id = Column(Integer, ForeignKey("clubs.id"), nullable=False, index=True)
     title = Column(String(300), nullable=False)
     author = Column(String(200), nullable=False)
     description = Column(Text)
@@ -68,11 +72,15 @@ class Book(Base):
     status = Column(String(20), default="suggested")  # suggested, selected, reading, completed
     selected_at = Column(DateTime)
     completed_at = Column(DateTime)
+    archived_at = Column(DateTime)  # Set while the book's threads live in book_archives
     
     # Weighting for random selection
     weight = Column(Float, default=1.0)
     vetoed = Column(Boolean, default=False)
     
+    # Upvotes in the current voting round, kept with the book_votes rows they count
+    upvotes = Column(Integer, default=0, nullable=False, server_default="0")
+    
     # Relationships
     club = relationship("Club", back_populates="books")
     suggested_by_member = relationship("Member", back_populates="book_suggestions")
@@ -80,13 +88,14 @@ class Book(Base):
     ratings = relationship("Rating", back_populates="book", cascade="all, delete-orphan")
     votes = relationship("BookVote", back_populates="book", cascade="all, delete-orphan")
     readers = relationship("BookReader", back_populates="book", cascade="all, delete-orphan")
+    tags = relationship("BookTag", back_populates="book", cascade="all, delete-orphan")
 
 
 class Discussion(Base):
     __tablename__ = "discussions"
     
     id = Column(Integer, primary_key=True, index=True)
-    book_id = Column(Integer, ForeignKey("books.id"), nullable=False)
+    book_id = Column(Integer, ForeignKey("books.id"), nullable=False, index=True)
     title = Column(String(200), nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
     
@@ -97,9 +106,11 @@ class Discussion(Base):
 
 class DiscussionPost(Base):
     __tablename__ = "discussion_posts"
+    # Archived rows come back with their ids, so SQLite must never hand a deleted id out again
+    __table_args__ = {"sqlite_autoincrement": True}
     
     id = Column(Integer, primary_key=True, index=True)
-    discussion_id = Column(Integer, ForeignKey("discussions.id"), nullable=False)
+    discussion_id = Column(Integer, ForeignKey("discussions.id"), nullable=False, index=True)
     author_id = Column(Integer, ForeignKey("members.id"), nullable=False)
     content = Column(Text, nullable=False)
     is_spoiler = Column(Boolean, default=False)
@@ -114,9 +125,11 @@ class DiscussionPost(Base):
 
 class DiscussionComment(Base):
     __tablename__ = "discussion_comments"
+    # Archived rows come back with their ids, so SQLite must never hand a deleted id out again
+    __table_args__ = {"sqlite_autoincrement": True}
     
     id = Column(Integer, primary_key=True, index=True)
-    post_id = Column(Integer, ForeignKey("discussion_posts.id"), nullable=False)
+    post_id = Column(Integer, ForeignKey("discussion_posts.id"), nullable=False, index=True)
     parent_comment_id = Column(Integer, ForeignKey("discussion_comments.id"), nullable=True)  # Self-referencing for infinite nesting
     author_id = Column(Integer, ForeignKey("members.id"), nullable=False)
     content = Column(Text, nullable=False)
@@ -133,6 +146,12 @@ class DiscussionComment(Base):
 
 class DiscussionCommentLike(Base):
     __tablename__ = "discussion_comment_likes"
+    __table_args__ = (
+        # One like per member, so liking can be a single INSERT ... ON CONFLICT
+        Index("uq_discussion_comment_likes_comment_member", "comment_id", "member_id", unique=True),
+        # Archived rows come back with their ids, so SQLite must never hand a deleted id out again
+        {"sqlite_autoincrement": True},
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     comment_id = Column(Integer, ForeignKey("discussion_comments.id"), nullable=False)
@@ -146,6 +165,10 @@ class DiscussionCommentLike(Base):
 
 class Rating(Base):
     __tablename__ = "ratings"
+    __table_args__ = (
+        # One rating per member and book, updated in place
+        Index("uq_ratings_book_member", "book_id", "member_id", unique=True),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     book_id = Column(Integer, ForeignKey("books.id"), nullable=False)
@@ -164,6 +187,12 @@ class Rating(Base):
 
 class ReviewLike(Base):
     __tablename__ = "review_likes"
+    __table_args__ = (
+        # One like per member, so liking can be a single INSERT ... ON CONFLICT
+        Index("uq_review_likes_rating_member", "rating_id", "member_id", unique=True),
+        # Archived rows come back with their ids, so SQLite must never hand a deleted id out again
+        {"sqlite_autoincrement": True},
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     rating_id = Column(Integer, ForeignKey("ratings.id"), nullable=False)
@@ -177,9 +206,11 @@ class ReviewLike(Base):
 
 class ReviewComment(Base):
     __tablename__ = "review_comments"
+    # Archived rows come back with their ids, so SQLite must never hand a deleted id out again
+    __table_args__ = {"sqlite_autoincrement": True}
     
     id = Column(Integer, primary_key=True, index=True)
-    rating_id = Column(Integer, ForeignKey("ratings.id"), nullable=False)
+    rating_id = Column(Integer, ForeignKey("ratings.id"), nullable=False, index=True)
     parent_comment_id = Column(Integer, ForeignKey("review_comments.id"), nullable=True)  # Self-referencing for infinite nesting
     member_id = Column(Integer, ForeignKey("members.id"), nullable=False)
     content = Column(Text, nullable=False)
@@ -230,9 +261,13 @@ class MeetingSchedule(Base):
 
 class Meeting(Base):
     __tablename__ = "meetings"
+    __table_args__ = (
+        # The reminder scheduler looks for scheduled meetings coming up across every club
+        Index("ix_meetings_status_datetime", "status", "meeting_datetime"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
-    club_id = Column(Integer, ForeignKey("clubs.id"), nullable=False)
+    club_id = Column(Integer, ForeignKey("clubs.id"), nullable=False, index=True)
     book_id = Column(Integer, ForeignKey("books.id"), nullable=True)
     host_id = Column(Integer, ForeignKey("members.id"), nullable=False)
     
@@ -256,6 +291,10 @@ class Meeting(Base):
 
 class MeetingRSVP(Base):
     __tablename__ = "meeting_rsvps"
+    __table_args__ = (
+        # One RSVP per member, updated in place by INSERT ... ON CONFLICT
+        Index("uq_meeting_rsvps_meeting_member", "meeting_id", "member_id", unique=True),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     meeting_id = Column(Integer, ForeignKey("meetings.id"), nullable=False)
@@ -273,8 +312,26 @@ class MeetingRSVP(Base):
     member = relationship("Member")
 
 
+class MeetingReminder(Base):
+    __tablename__ = "meeting_reminders"
+    __table_args__ = (
+        # Claimed before sending, so a reminder goes out once however often the scheduler runs
+        Index("uq_meeting_reminders_meeting_member_hours", "meeting_id", "member_id", "hours_before", unique=True),
+    )
+    
+    id = Column(Integer, primary_key=True, index=True)
+    meeting_id = Column(Integer, ForeignKey("meetings.id", ondelete="CASCADE"), nullable=False)
+    member_id = Column(Integer, ForeignKey("members.id", ondelete="CASCADE"), nullable=False)
+    hours_before = Column(Integer, nullable=False)  # Which reminder window this was sent for
+    sent_at = Column(DateTime, default=datetime.utcnow)
+
+
 class BookVote(Base):
     __tablename__ = "book_votes"
+    __table_args__ = (
+        # A member vetoes (or upvotes) a book at most once
+        Index("uq_book_votes_book_member_type", "book_id", "member_id", "vote_type", unique=True),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     book_id = Column(Integer, ForeignKey("books.id"), nullable=False)
@@ -289,6 +346,12 @@ class BookVote(Base):
 
 class ReviewCommentLike(Base):
     __tablename__ = "review_comment_likes"
+    __table_args__ = (
+        # One like per member, so liking can be a single INSERT ... ON CONFLICT
+        Index("uq_review_comment_likes_comment_member", "comment_id", "member_id", unique=True),
+        # Archived rows come back with their ids, so SQLite must never hand a deleted id out again
+        {"sqlite_autoincrement": True},
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     comment_id = Column(Integer, ForeignKey("review_comments.id"), nullable=False)
@@ -302,6 +365,12 @@ class ReviewCommentLike(Base):
 
 class DiscussionPostLike(Base):
     __tablename__ = "discussion_post_likes"
+    __table_args__ = (
+        # One like per member, so liking can be a single INSERT ... ON CONFLICT
+        Index("uq_discussion_post_likes_post_member", "post_id", "member_id", unique=True),
+        # Archived rows come back with their ids, so SQLite must never hand a deleted id out again
+        {"sqlite_autoincrement": True},
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     post_id = Column(Integer, ForeignKey("discussion_posts.id"), nullable=False)
@@ -315,12 +384,196 @@ class DiscussionPostLike(Base):
 
 class BookReader(Base):
     __tablename__ = "book_readers"
+    __table_args__ = (
+        # A member joins a book's readers at most once
+        Index("uq_book_readers_book_member", "book_id", "member_id", unique=True),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     book_id = Column(Integer, ForeignKey("books.id"), nullable=False)
     member_id = Column(Integer, ForeignKey("members.id"), nullable=False)
     joined_at = Column(DateTime, default=datetime.utcnow)
     
+    # Latest reported position; the history is in reading_progress
+    page = Column(Integer)
+    pages = Column(Integer)  # Pages in the reader's edition
+    permille = Column(SmallInteger)  # page / pages in thousandths
+    progress_at = Column(DateTime)
+    
     # Relationships
     book = relationship("Book", back_populates="readers")
-    member = relationship("Member")
\ No newline at end of file
+    member = relationship("Member")
+
+
+# One reported position; append-only, rolled up into reading_progress_daily after PROGRESS_KEEP_DAYS
+class ReadingProgress(Base):
+    __tablename__ = "reading_progress"
+    __table_args__ = (
+        # A reader's history, and the rollup's scan of old events
+        Index("ix_reading_progress_book_member_created", "book_id", "member_id", "created_at"),
+        Index("ix_reading_progress_created_at", "created_at"),
+    )
+    
+    id = Column(Integer, primary_key=True, index=True)
+    book_id = Column(Integer, ForeignKey("books.id"), nullable=False)
+    member_id = Column(Integer, ForeignKey("members.id"), nullable=False)
+    page = Column(Integer, nullable=False)
+    pages = Column(Integer, nullable=False)
+    permille = Column(SmallInteger, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+
+# A reader's last position on each day, and how many times they reported it that day
+class ReadingProgressDaily(Base):
+    __tablename__ = "reading_progress_daily"
+    __table_args__ = (
+        Index("uq_reading_progress_daily_book_member_day", "book_id", "member_id", "day", unique=True),
+    )
+    
+    id = Column(Integer, primary_key=True, index=True)
+    book_id = Column(Integer, ForeignKey("books.id"), nullable=False)
+    member_id = Column(Integer, ForeignKey("members.id"), nullable=False)
+    day = Column(Date, nullable=False)
+    page = Column(Integer, nullable=False)
+    pages = Column(Integer, nullable=False)
+    permille = Column(SmallInteger, nullable=False)
+    events = Column(Integer, nullable=False)
+
+
+class Poll(Base):
+    __tablename__ = "polls"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    club_id = Column(Integer, ForeignKey("clubs.id"), nullable=False, index=True)
+    meeting_id = Column(Integer, ForeignKey("meetings.id"), index=True)  # Set for a poll about one meeting
+    created_by = Column(Integer, ForeignKey("members.id"), nullable=False)
+    question = Column(String(300), nullable=False)
+    kind = Column(String(20), nullable=False, default="single")  # single, approval, ranked
+    closed = Column(Boolean, nullable=False, default=False)
+    ballots = Column(Integer, nullable=False, default=0)  # Running count of ballots cast
+    version = Column(Integer, nullable=False, default=0)  # Bumped by every ballot; keys cached results
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    # Relationships
+    club = relationship("Club")
+    meeting = relationship("Meeting")
+    creator = relationship("Member")
+    options = relationship("PollOption", back_populates="poll", order_by="PollOption.position",
+                           cascade="all, delete-orphan")
+
+
+class PollOption(Base):
+    __tablename__ = "poll_options"
+    __table_args__ = (
+        Index("uq_poll_options_poll_position", "poll_id", "position", unique=True),
+    )
+    
+    id = Column(Integer, primary_key=True, index=True)
+    poll_id = Column(Integer, ForeignKey("polls.id"), nullable=False)
+    position = Column(Integer, nullable=False)  # 0, 1, ...; what ballots store
+    label = Column(String(200), nullable=False)
+    # Running tally: ballots choosing it (single), approving it (approval) or ranking it first (ranked)
+    votes = Column(Integer, nullable=False, default=0)
+    
+    # Relationships
+    poll = relationship("Poll", back_populates="options")
+
+
+class PollBallot(Base):
+    __tablename__ = "poll_ballots"
+    __table_args__ = (
+        # One ballot per member, replaced in place when they vote again
+        Index("uq_poll_ballots_poll_member", "poll_id", "member_id", unique=True),
+    )
+    
+    id = Column(Integer, primary_key=True, index=True)
+    poll_id = Column(Integer, ForeignKey("polls.id"), nullable=False)
+    member_id = Column(Integer, ForeignKey("members.id"), nullable=False)
+    # Option positions, one byte each, in order of preference for ranked polls
+    choices = Column(LargeBinary, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+# Genre tags, shared by every club
+class Tag(Base):
+    __tablename__ = "tags"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String(40), unique=True, nullable=False)  # Lower case, single spaces
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class BookTag(Base):
+    __tablename__ = "book_tags"
+    __table_args__ = (
+        Index("uq_book_tags_book_tag", "book_id", "tag_id", unique=True),
+        # A club's books with a tag, and the club's facet counts, without other clubs' rows
+        Index("ix_book_tags_club_tag_book", "club_id", "tag_id", "book_id"),
+    )
+    
+    id = Column(Integer, primary_key=True, index=True)
+    book_id = Column(Integer, ForeignKey("books.id"), nullable=False)
+    tag_id = Column(Integer, ForeignKey("tags.id"), nullable=False)
+    club_id = Column(Integer, ForeignKey("clubs.id"), nullable=False)  # The book's club
+    
+    # Relationships
+    book = relationship("Book", back_populates="tags")
+    tag = relationship("Tag")
+
+
+# A member's genre affinity: one row per tag of their sparse vector, recomputed from ratings and readers
+class MemberTagAffinity(Base):
+    __tablename__ = "member_tag_affinity"
+    __table_args__ = (
+        Index("uq_member_tag_affinity_member_tag", "member_id", "tag_id", unique=True),
+    )
+    
+    id = Column(Integer, primary_key=True, index=True)
+    member_id = Column(Integer, ForeignKey("members.id", ondelete="CASCADE"), nullable=False)
+    tag_id = Column(Integer, ForeignKey("tags.id"), nullable=False)
+    score = Column(Float, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+
+class BookArchive(Base):
+    __tablename__ = "book_archives"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    book_id = Column(Integer, ForeignKey("books.id", ondelete="CASCADE"), nullable=False, unique=True)
+    format = Column(Integer, nullable=False)
+    # zlib-compressed JSON: each discussion's posts with their comments and likes
+    discussions = Column(LargeBinary, nullable=False)
+    # zlib-compressed JSON: each rating's likes and comments
+    reviews = Column(LargeBinary, nullable=False)
+    counts = Column(Text, nullable=False)  # JSON: posts per discussion and rows archived per table
+    size = Column(Integer, nullable=False)  # Bytes before compression
+    archived_at = Column(DateTime, default=datetime.utcnow)
+
+
+# Jobs a de-duplication key is unique among: a job that already started may be queued again
+QUEUED_JOB = text("status = 'queued'")
+
+
+class Job(Base):
+    __tablename__ = "jobs"
+    __table_args__ = (
+        # Workers look for the next due job
+        Index("ix_jobs_status_run_at", "status", "run_at"),
+        Index("uq_jobs_dedup_key_queued", "dedup_key", unique=True,
+              sqlite_where=QUEUED_JOB, postgresql_where=QUEUED_JOB),
+    )
+    
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String(100), nullable=False)
+    payload = Column(Text, nullable=False, default="{}")  # JSON keyword arguments for the handler
+    dedup_key = Column(String(200))
+    status = Column(String(20), nullable=False, default="queued")  # queued, running, done or failed
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=5)
+    run_at = Column(DateTime, nullable=False, default=datetime.utcnow)  # Not run before this
+    locked_until = Column(DateTime)  # A running job past this is presumed lost and run again
+    last_error = Column(Text)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
@@ -0,0 +1,224 @@
+"""Club polls: single choice, approval and ranked choice.
+
+A ballot is stored as the positions of the options it picks, one byte each
+(in order of preference for ranked polls), one ballot per member.
+
+Single-choice and approval results are running tallies: each option's
+``votes`` and the poll's ``ballots`` are moved by the difference between a
+member's old and new ballot, in the same transaction as the ballot, so
+showing them reads one row per option. Ranked polls keep first preferences
+the same way.
+
+Ranked results are an instant runoff over every ballot. Identical ballots
+are counted once with a weight, and each round walks every distinct ballot
+once, advancing it past eliminated options; the result is cached in the
+worker under the poll's ``version``, which every ballot bumps, so it is
+worked out again only after a ballot changed.
+
+Every change to a poll's ballots starts by updating the poll's row, which
+holds its lock (SQLite's write lock) until the commit, so a member voting
+twice at once cannot count twice.
+"""
+import threading
+from collections import Counter, OrderedDict
+from datetime import datetime
+
+from sqlalchemy import bindparam, delete, select, update
+
+from .database import insert_on_conflict
+from .metrics import record_cache
+from .models import Poll, PollBallot, PollOption
+
+KINDS = {"single": "Single choice", "approval": "Approval", "ranked": "Ranked choice"}
+
+# Options a poll may have; a position must fit in a ballot's byte
+MAX_OPTIONS = 20
+
+# Ranked results kept per worker
+RESULTS_CACHE_SIZE = 1000
+
+
+def ballot(kind: str, choices: list, options: int) -> bytes:
+    """The encoded ballot for the chosen option positions; ValueError if the poll cannot take it"""
+    if not choices:
+        raise ValueError("Choose at least one option")
+    if len(set(choices)) != len(choices):
+        raise ValueError("Each option can be chosen once")
+    if any(not 0 <= position < options for position in choices):
+        raise ValueError("No such option")
+    if kind == "single" and len(choices) != 1:
+        raise ValueError("Choose one option")
+    return bytes(choices)
+
+
+def counted(kind: str, choices) -> bytes:
+    """The positions a ballot adds to the running tally"""
+    if not choices:
+        return b""
+    return bytes(choices) if kind == "approval" else bytes(choices[:1])
+
+
+def lock(db, poll_id: int):
+    """Bump the poll's version, locking its row until the commit; its kind, or None if closed"""
+    return db.execute(
+        update(Poll)
+        .where(Poll.id == poll_id, Poll.closed == False)
+        .values(version=Poll.version + 1)
+        .returning(Poll.kind)
+    ).scalar()
+
+
+def adjust(db, poll_id: int, kind: str, old, new, ballots: int):
+    """Move the running tallies from the old ballot to the new one"""
+    delta = Counter(counted(kind, new))
+    delta.subtract(counted(kind, old))
+    changes = [{"pos": position, "delta": change} for position, change in delta.items() if change]
+    if changes:
+        # One statement run for each changed option (the table, as the ORM only bulk-updates by primary key)
+        options = PollOption.__table__
+        db.execute(
+            update(options)
+            .where(options.c.poll_id == poll_id, options.c.position == bindparam("pos"))
+            .values(votes=options.c.votes + bindparam("delta")),
+            changes
+        )
+    if ballots:
+        db.execute(update(Poll).where(Poll.id == poll_id).values(ballots=Poll.ballots + ballots))
+
+
+def cast(db, poll_id: int, member_id: int, choices: bytes) -> bool:
+    """Record or replace the member's ballot; False if the poll is closed"""
+    kind = lock(db, poll_id)
+    if kind is None:
+        return False
+    old = db.scalar(select(PollBallot.choices).where(PollBallot.poll_id == poll_id, PollBallot.member_id == member_id))
+    now = datetime.utcnow()
+    statement = insert_on_conflict(PollBallot).values(
+        poll_id=poll_id, member_id=member_id, choices=choices, created_at=now, updated_at=now
+    )
+    db.execute(statement.on_conflict_do_update(
+        index_elements=["poll_id", "member_id"],
+        set_={"choices": statement.excluded.choices, "updated_at": statement.excluded.updated_at}
+    ))
+    adjust(db, poll_id, kind, old, choices, 0 if old is not None else 1)
+    return True
+
+
+def retract(db, poll_id: int, member_id: int) -> bool:
+    """Remove the member's ballot; False if the poll is closed"""
+    kind = lock(db, poll_id)
+    if kind is None:
+        return False
+    old = db.scalar(
+        delete(PollBallot)
+        .where(PollBallot.poll_id == poll_id, PollBallot.member_id == member_id)
+        .returning(PollBallot.choices)
+    )
+    if old is not None:
+        adjust(db, poll_id, kind, old, None, -1)
+    return True
+
+
+def close(db, poll_id: int):
+    db.execute(update(Poll).where(Poll.id == poll_id).values(closed=True, version=Poll.version + 1))
+
+
+def instant_runoff(ballots: list, options: int) -> dict:
+    """Rounds of an instant runoff, eliminating the last option each round until one has a majority
+
+    Returns {"rounds": [[votes per option, None once eliminated]], "exhausted":
+    [ballots with no option left, per round], "winner": position or None,
+    "tied": positions still level when no winner can be told apart}.
+    """
+    weights = Counter(ballots)
+    distinct = list(weights)
+    counts_of = [weights[choices] for choices in distinct]
+    # Where each distinct ballot's first option still in the running is
+    pointers = [0] * len(distinct)
+    eliminated = [False] * options
+    rounds, exhausted_per_round, history = [], [], []
+
+    while True:
+        counts = [0] * options
+        exhausted = 0
+        for index, choices in enumerate(distinct):
+            pointer = pointers[index]
+            while pointer < len(choices) and eliminated[choices[pointer]]:
+                pointer += 1
+            pointers[index] = pointer
+            if pointer < len(choices):
+                counts[choices[pointer]] += counts_of[index]
+            else:
+                exhausted += counts_of[index]
+        running = [position for position in range(options) if not eliminated[position]]
+        rounds.append([None if eliminated[position] else counts[position] for position in range(options)])
+        exhausted_per_round.append(exhausted)
+        history.append(counts)
+
+        active = sum(counts)
+        leader = max(running, key=lambda position: counts[position])
+        if active and counts[leader] * 2 > active or len(running) == 1:
+            return {"rounds": rounds, "exhausted": exhausted_per_round, "winner": leader if active else None,
+                    "tied": []}
+        fewest = min(counts[position] for position in running)
+        if all(counts[position] == fewest for position in running):
+            return {"rounds": rounds, "exhausted": exhausted_per_round, "winner": None, "tied": running}
+
+        # Eliminate the option with fewest votes; a tie goes against the one that did worst in earlier rounds
+        last = min(
+            (position for position in running if counts[position] == fewest),
+            key=lambda position: ([earlier[position] for earlier in reversed(history)], -position)
+        )
+        eliminated[last] = True
+
+
+def plurality(votes: list) -> dict:
+    """The winner of a running tally, or the options tied for most votes"""
+    most = max(votes, default=0)
+    leaders = [position for position, count in enumerate(votes) if count == most] if most else []
+    if len(leaders) == 1:
+        return {"winner": leaders[0], "tied": []}
+    return {"winner": None, "tied": leaders}
+
+
+class ResultsCache:
+    """Ranked results per poll id as of a poll version"""
+
+    def __init__(self, size: int = RESULTS_CACHE_SIZE):
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+        self.size = size
+
+    def get(self, poll_id: int, version: int):
+        with self._lock:
+            cached = self._results.get(poll_id)
+            if cached is None or cached[0] != version:
+                return None
+            self._results.move_to_end(poll_id)
+            return cached[1]
+
+    def put(self, poll_id: int, version: int, result: dict):
+        with self._lock:
+            self._results[poll_id] = (version, result)
+            self._results.move_to_end(poll_id)
+            while len(self._results) > self.size:
+                self._results.popitem(last=False)
+
+
+results_cache = ResultsCache()
+
+
+def results(db, poll: Poll) -> dict:
+    """Running tally per option, the winner or the tied options, and a ranked poll's runoff rounds"""
+    votes = [option.votes for option in poll.options]
+    if poll.kind != "ranked":
+        return {"votes": votes, **plurality(votes)}
+
+    cached = results_cache.get(poll.id, poll.version)
+    record_cache("poll_results", cached is not None)
+    if cached is None:
+        # Read at least as new as the version it is filed under, so a stale result is never served for it
+        ballots = db.scalars(select(PollBallot.choices).where(PollBallot.poll_id == poll.id))
+        cached = instant_runoff([bytes(choices) for choices in ballots], len(votes))
+        results_cache.put(poll.id, poll.version, cached)
+    return {"votes": votes, **cached}
@@ -0,0 +1,161 @@
+"""Reading pace: where each reader is in the club's current book.
+
+Readers report the page they are on and how many pages their edition has.
+Each report is appended to ``reading_progress`` (a narrow, insert-only row)
+and copied onto the reader's ``book_readers`` row, which always holds their
+latest position. Pages that show where everyone is read only
+``book_readers``: the club histogram is one aggregate query over at most
+one row per member, however long the history grows.
+
+Every ``PROGRESS_ROLLUP_INTERVAL`` seconds the ``reading.rollup`` job
+downsamples reports older than ``PROGRESS_KEEP_DAYS`` (whole UTC days) into
+``reading_progress_daily``, one row per reader and day with the day's last
+position and the number of reports, and deletes them from
+``reading_progress``.
+
+    python -m app.progress             # roll up old reports now
+"""
+import argparse
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import case, delete, func, insert, select, update
+
+from . import genres
+from .database import SessionLocal, insert_on_conflict, insert_once
+from .jobs import job
+from .metrics import registry
+from .models import BookReader, ReadingProgress, ReadingProgressDaily
+
+logger = logging.getLogger("bookclub.progress")
+
+PROGRESS_KEEP_DAYS = int(os.getenv("PROGRESS_KEEP_DAYS", "7"))
+PROGRESS_ROLLUP_INTERVAL = float(os.getenv("PROGRESS_ROLLUP_INTERVAL", "3600"))
+
+# Longest edition accepted, to keep typos out of the histogram
+MAX_PAGES = 100000
+
+# Histogram buckets: not started, 0-9% ... 90-99%, finished
+NOT_STARTED = -1
+FINISHED = 10
+BUCKET_LABELS = {NOT_STARTED: "Not started", FINISHED: "Finished"}
+BUCKET_LABELS.update({bucket: f"{bucket * 10}–{bucket * 10 + 9}%" for bucket in range(10)})
+
+progress_rollup_total = registry.counter(
+    "bookclub_reading_progress_rollup_total", "Reading progress reports rolled up into daily rows"
+)
+
+
+def permille(page: int, pages: int) -> int:
+    return min(1000, page * 1000 // pages)
+
+
+def record(db, book_id: int, member_id: int, page: int, pages: int, now: datetime = None):
+    """Append a report and move the reader's latest position; joins the readers if needed"""
+    now = now or datetime.utcnow()
+    position = {"page": page, "pages": pages, "permille": permille(page, pages)}
+    if insert_once(db, BookReader, book_id=book_id, member_id=member_id):
+        genres.queue_refresh(db, member_id=member_id)
+    db.execute(
+        update(BookReader)
+        .where(BookReader.book_id == book_id, BookReader.member_id == member_id)
+        .values(progress_at=now, **position)
+    )
+    db.execute(insert(ReadingProgress).values(book_id=book_id, member_id=member_id, created_at=now, **position))
+
+
+def histogram(db, book_id: int) -> list:
+    """(label, readers) for every bucket, from the readers' latest positions in one query"""
+    bucket = case((BookReader.permille.is_(None), NOT_STARTED), else_=BookReader.permille // 100)
+    counts = dict(db.execute(
+        select(bucket, func.count(BookReader.id)).where(BookReader.book_id == book_id).group_by(bucket)
+    ).all())
+    return [(BUCKET_LABELS[key], counts.get(key, 0)) for key in sorted(BUCKET_LABELS)]
+
+
+def pace(reader: BookReader):
+    """Pages a day from joining to the latest report, or None before the first report"""
+    if reader.page is None or reader.joined_at is None:
+        return None
+    days = max(1.0, (reader.progress_at - reader.joined_at).total_seconds() / 86400)
+    return reader.page / days
+
+
+def days_left(reader: BookReader):
+    """Days to the end of the book at the reader's pace so far, or None"""
+    speed = pace(reader)
+    if not speed:
+        return None
+    return max(0, reader.pages - reader.page) / speed
+
+
+def rollup(db, now: datetime = None, keep_days: int = PROGRESS_KEEP_DAYS) -> dict:
+    """Fold reports from before the last keep_days whole days into daily rows; returns {"events", "days"}"""
+    now = now or datetime.utcnow()
+    first_kept = (now - timedelta(days=keep_days)).date()
+    cutoff = datetime(first_kept.year, first_kept.month, first_kept.day)
+    old = ReadingProgress.created_at < cutoff
+    day = func.date(ReadingProgress.created_at)
+
+    # The last report of each reader's day, and how many there were
+    last = (
+        select(func.max(ReadingProgress.id).label("id"), func.count(ReadingProgress.id).label("events"))
+        .where(old)
+        .group_by(ReadingProgress.book_id, ReadingProgress.member_id, day)
+        .subquery()
+    )
+    days = (
+        select(
+            ReadingProgress.book_id, ReadingProgress.member_id, day, ReadingProgress.page,
+            ReadingProgress.pages, ReadingProgress.permille, last.c.events
+        )
+        .join(last, ReadingProgress.id == last.c.id)
+        # Also keeps SQLite from reading ON CONFLICT as part of the join
+        .where(old)
+    )
+    statement = insert_on_conflict(ReadingProgressDaily).from_select(
+        ["book_id", "member_id", "day", "page", "pages", "permille", "events"], days
+    )
+    # A day rolled up before gains any reports that arrived for it since
+    statement = statement.on_conflict_do_update(
+        index_elements=["book_id", "member_id", "day"],
+        set_={
+            "page": statement.excluded.page,
+            "pages": statement.excluded.pages,
+            "permille": statement.excluded.permille,
+            "events": ReadingProgressDaily.events + statement.excluded.events,
+        },
+    )
+    rolled = db.execute(statement).rowcount
+    events = db.execute(delete(ReadingProgress).where(old)).rowcount
+    db.commit()
+    progress_rollup_total.inc(amount=events)
+    return {"events": events, "days": rolled}
+
+
+@job("reading.rollup", max_attempts=3, concurrency=1, every=PROGRESS_ROLLUP_INTERVAL)
+def rollup_progress():
+    """Downsample old reading progress reports into daily rows"""
+    with SessionLocal() as db:
+        stats = rollup(db)
+    if stats["events"]:
+        logger.info("Rolled up %d reading progress reports into %d daily rows", stats["events"], stats["days"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--keep-days", type=int, default=PROGRESS_KEEP_DAYS,
+                        help=f"keep this many whole days of reports (default: {PROGRESS_KEEP_DAYS})")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    with SessionLocal() as db:
+        stats = rollup(db, keep_days=args.keep_days)
+    print(f"Rolled up {stats['events']} reports into {stats['days']} daily rows "
+          f"in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,367 @@
+"""Meeting reminders, sent in batches by a periodic background job.
+
+Every ``REMINDER_INTERVAL`` seconds the ``meetings.remind`` job finds, in
+one query across every club, each (meeting, member) pair whose meeting
+starts within one of the ``REMINDER_HOURS_BEFORE`` windows and has not been
+reminded for that window. Members who RSVPed "no" are skipped. The pairs are
+grouped into one digest per recipient (a member in several clubs gets one
+email listing all their meetings) and handed to the transport
+(``REMINDER_TRANSPORT``):
+
+- ``smtp``: one email per digest over a single SMTP connection per batch
+  (``SMTP_HOST``, ``SMTP_PORT``, ...); members without an email are skipped.
+- ``webhook``: one JSON POST per batch of digests to ``REMINDER_WEBHOOK_URL``.
+- ``log``: digests are only logged.
+
+Unset, no reminders are sent. Before a batch is sent its reminders are
+claimed as rows of ``meeting_reminders`` (unique per meeting, member and
+window) and committed, so restarts, overlapping runs and several workers
+never send one twice. Reminders a transport fails to deliver are released
+and retried on the next run; a worker that dies mid-send loses its batch
+rather than sending it again.
+"""
+import json
+import logging
+import os
+import smtplib
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from email.header import Header
+from email.utils import formatdate, make_msgid
+
+from sqlalchemy import and_, case, delete, or_, select, tuple_
+
+from .database import SessionLocal, insert_on_conflict
+from .jobs import job
+from .metrics import registry
+from .models import Book, Club, Meeting, MeetingReminder, MeetingRSVP, Member
+
+logger = logging.getLogger("bookclub.reminders")
+
+REMINDER_TRANSPORT = os.getenv("REMINDER_TRANSPORT", "").lower()
+REMINDER_HOURS_BEFORE = sorted({int(hours) for hours in os.getenv("REMINDER_HOURS_BEFORE", "24").split(",") if hours.strip()})
+REMINDER_INTERVAL = float(os.getenv("REMINDER_INTERVAL", "300"))
+# Digests claimed, then sent, together
+REMINDER_BATCH = int(os.getenv("REMINDER_BATCH", "500"))
+REMINDER_FROM = os.getenv("REMINDER_FROM", "bookclub@localhost")
+REMINDER_WEBHOOK_URL = os.getenv("REMINDER_WEBHOOK_URL", "")
+# Used to link to meetings from reminders, e.g. https://bookclub.example.com
+BASE_URL = os.getenv("BASE_URL", "").rstrip("/")
+
+SMTP_HOST = os.getenv("SMTP_HOST", "localhost")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "25"))
+SMTP_USERNAME = os.getenv("SMTP_USERNAME", "")
+SMTP_PASSWORD = os.getenv("SMTP_PASSWORD", "")
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "off").lower() in ("1", "on", "true", "yes")
+SMTP_CONNECTIONS = int(os.getenv("SMTP_CONNECTIONS", "4"))
+
+reminders_total = registry.counter(
+    "bookclub_reminders_total", "Meeting reminders by outcome (sent, failed)", ("outcome",)
+)
+reminder_run_seconds = registry.histogram(
+    "bookclub_reminder_run_seconds", "Time to find, claim and send every due meeting reminder"
+)
+
+
+class Digest:
+    """Everything due for one recipient: the reminders and the members they are for"""
+
+    def __init__(self, email: str = None):
+        self.email = email
+        self.rows = []
+
+    @property
+    def name(self) -> str:
+        return self.rows[0].display_name
+
+    def claims(self) -> list:
+        return [(row.meeting_id, row.member_id, row.hours_before) for row in self.rows]
+
+    def as_dict(self) -> dict:
+        return {
+            "email": self.email,
+            "name": self.name,
+            "meetings": [
+                {
+                    "meeting_id": row.meeting_id,
+                    "member_id": row.member_id,
+                    "title": row.title,
+                    "club": row.club_name,
+                    "club_code": row.club_code,
+                    "starts_at": row.meeting_datetime.isoformat(),
+                    "duration_minutes": row.duration_minutes,
+                    "location": row.location,
+                    "book": row.book_title,
+                    "rsvp": row.rsvp,
+                    "hours_before": row.hours_before,
+                    "url": meeting_url(row.meeting_id),
+                }
+                for row in self.rows
+            ],
+        }
+
+
+def meeting_url(meeting_id: int) -> str:
+    return f"{BASE_URL}/meetings/{meeting_id}/rsvp"
+
+
+def header(value: str) -> str:
+    """A header value that cannot start another header; RFC 2047 encoded unless it is ASCII"""
+    value = " ".join(value.split())
+    return value if value.isascii() else Header(value, "utf-8").encode()
+
+
+def render_email(digest: Digest, sender: str) -> bytes:
+    """The reminder email for a digest, ready for SMTP"""
+    if len(digest.rows) == 1:
+        row = digest.rows[0]
+        subject = f"Reminder: {row.title} on {row.meeting_datetime:%a %b %d at %I:%M %p}"
+    else:
+        subject = f"Reminder: {len(digest.rows)} upcoming book club meetings"
+
+    lines = [f"Hi {digest.name},", "", "Coming up soon:", ""]
+    for row in digest.rows:
+        lines.append(f"- {row.title} ({row.club_name})")
+        lines.append(f"  When: {row.meeting_datetime:%A, %B %d at %I:%M %p}")
+        if row.location:
+            lines.append(f"  Where: {row.location}")
+        if row.book_title:
+            lines.append(f"  Reading: {row.book_title} by {row.book_author}")
+        lines.append(f"  Your RSVP: {row.rsvp or 'not yet'} - {meeting_url(row.meeting_id)}")
+        lines.append("")
+    # Written out directly: the email package's header folding costs more than sending the message
+    headers = [
+        f"From: {header(sender)}",
+        f"To: {header(digest.email)}",
+        f"Subject: {header(subject)}",
+        f"Date: {formatdate()}",
+        f"Message-ID: {make_msgid('reminder', domain=sender.rpartition('@')[2] or 'localhost')}",
+        "MIME-Version: 1.0",
+        'Content-Type: text/plain; charset="utf-8"',
+        "Content-Transfer-Encoding: 8bit",
+    ]
+    body = "\r\n".join("\n".join(lines).splitlines())
+    return ("\r\n".join(headers) + "\r\n\r\n" + body + "\r\n").encode()
+
+
+class LogTransport:
+    """Logs each digest instead of delivering it"""
+    needs_email = False
+
+    def send(self, digests: list) -> list:
+        for digest in digests:
+            logger.info("Reminder for %s: %s", digest.email or digest.name,
+                        ", ".join(f"{row.title} ({row.club_name})" for row in digest.rows))
+        return []
+
+
+class SMTPTransport:
+    """One email per digest, sent over a few connections at once"""
+    needs_email = True
+
+    def __init__(self, host: str = SMTP_HOST, port: int = SMTP_PORT, username: str = SMTP_USERNAME,
+                 password: str = SMTP_PASSWORD, starttls: bool = SMTP_STARTTLS, sender: str = REMINDER_FROM,
+                 connections: int = SMTP_CONNECTIONS):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.sender = sender
+        self.connections = max(1, connections)
+
+    def send(self, digests: list) -> list:
+        """Send every digest; returns those that were not delivered"""
+        # Each message costs several round trips, so keep more than one in flight
+        shares = [digests[index::self.connections] for index in range(self.connections)]
+        with ThreadPoolExecutor(self.connections, thread_name_prefix="smtp") as pool:
+            results = list(pool.map(self._send_over_one_connection, [share for share in shares if share]))
+        return [digest for failed in results for digest in failed]
+
+    def _send_over_one_connection(self, digests: list) -> list:
+        failed = []
+        with smtplib.SMTP(self.host, self.port, timeout=30) as smtp:
+            if self.starttls:
+                smtp.starttls()
+            if self.username:
+                smtp.login(self.username, self.password)
+            for index, digest in enumerate(digests):
+                try:
+                    smtp.sendmail(self.sender, [digest.email], render_email(digest, self.sender))
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError, smtplib.SMTPSenderRefused) as exc:
+                    logger.warning("Reminder to %s refused: %s", digest.email, exc)
+                    failed.append(digest)
+                except (smtplib.SMTPException, OSError):
+                    # The connection is gone; the rest go out on the next run
+                    logger.exception("SMTP connection lost while sending reminders")
+                    failed.extend(digests[index:])
+                    break
+        return failed
+
+
+class WebhookTransport:
+    """Each batch of digests POSTed as one JSON document: {"reminders": [...]}"""
+    needs_email = False
+
+    def __init__(self, url: str = REMINDER_WEBHOOK_URL, timeout: float = 30):
+        if not url:
+            raise ValueError("REMINDER_WEBHOOK_URL is required for the webhook transport")
+        self.url = url
+        self.timeout = timeout
+
+    def send(self, digests: list) -> list:
+        body = json.dumps({"reminders": [digest.as_dict() for digest in digests]}).encode()
+        request = urllib.request.Request(
+            self.url, data=body, method="POST", headers={"Content-Type": "application/json"}
+        )
+        # Anything but a 2xx raises, and the whole batch is released
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+        return []
+
+
+def create_transport(kind: str = REMINDER_TRANSPORT):
+    if kind == "smtp":
+        return SMTPTransport()
+    if kind == "webhook":
+        return WebhookTransport()
+    if kind == "log":
+        return LogTransport()
+    raise ValueError(f"Unknown REMINDER_TRANSPORT: {kind}")
+
+
+def due_reminders(db, now: datetime, hours_before: list = REMINDER_HOURS_BEFORE, with_email: bool = False) -> list:
+    """Every reminder due now and not yet claimed, across all clubs, in one query
+
+    A meeting is reminded for the smallest window it falls in, so one created
+    an hour before it starts skips its day-before reminder.
+    """
+    window = case(
+        *[(Meeting.meeting_datetime <= now + timedelta(hours=hours), hours) for hours in hours_before]
+    )
+    claimed = select(MeetingReminder.id).where(
+        MeetingReminder.meeting_id == Meeting.id,
+        MeetingReminder.member_id == Member.id,
+        MeetingReminder.hours_before == window,
+    ).exists()
+    query = (
+        select(
+            Meeting.id.label("meeting_id"), Meeting.title, Meeting.meeting_datetime, Meeting.duration_minutes,
+            Meeting.location, Club.name.label("club_name"), Club.code.label("club_code"),
+            Book.title.label("book_title"), Book.author.label("book_author"),
+            Member.id.label("member_id"), Member.display_name, Member.email,
+            MeetingRSVP.status.label("rsvp"), window.label("hours_before"),
+        )
+        .select_from(Meeting)
+        .join(Club, Club.id == Meeting.club_id)
+        .join(Member, Member.club_id == Meeting.club_id)
+        .outerjoin(Book, Book.id == Meeting.book_id)
+        .outerjoin(MeetingRSVP, and_(MeetingRSVP.meeting_id == Meeting.id, MeetingRSVP.member_id == Member.id))
+        .where(
+            Meeting.status == "scheduled",
+            Meeting.meeting_datetime > now,
+            Meeting.meeting_datetime <= now + timedelta(hours=max(hours_before)),
+            or_(MeetingRSVP.status.is_(None), MeetingRSVP.status != "no"),
+            ~claimed,
+        )
+        .order_by(Meeting.meeting_datetime, Meeting.id, Member.id)
+    )
+    if with_email:
+        query = query.where(Member.email.is_not(None), Member.email != "")
+    return db.execute(query).all()
+
+
+def group_digests(rows: list, by_email: bool) -> list:
+    """One digest per email address (or per member when the transport does not use email)"""
+    digests = {}
+    for row in rows:
+        key = row.email.strip().lower() if by_email else row.member_id
+        if key not in digests:
+            digests[key] = Digest(row.email.strip() if by_email else row.email)
+        digests[key].rows.append(row)
+    return list(digests.values())
+
+
+def claim(db, digests: list, now: datetime) -> list:
+    """Record the digests' reminders as sent; returns the digests holding only the reminders this call claimed"""
+    claims = [claim for digest in digests for claim in digest.claims()]
+    table = MeetingReminder.__table__
+    # Compiled once and sent as multi-row INSERTs ("insertmanyvalues"); conflicting rows return nothing
+    won = set(db.execute(
+        insert_on_conflict(table)
+        .on_conflict_do_nothing(index_elements=["meeting_id", "member_id", "hours_before"])
+        .returning(table.c.meeting_id, table.c.member_id, table.c.hours_before),
+        [
+            {"meeting_id": meeting_id, "member_id": member_id, "hours_before": hours, "sent_at": now}
+            for meeting_id, member_id, hours in claims
+        ]
+    ).all())
+    db.commit()
+
+    claimed = []
+    for digest in digests:
+        # Another runner may have sent some of these since they were read
+        digest.rows = [row for row in digest.rows if (row.meeting_id, row.member_id, row.hours_before) in won]
+        if digest.rows:
+            claimed.append(digest)
+    return claimed
+
+
+def release(db, digests: list):
+    """Forget the reminders in digests that were not delivered, so the next run sends them"""
+    claims = [claim for digest in digests for claim in digest.claims()]
+    for start in range(0, len(claims), REMINDER_BATCH):
+        db.execute(delete(MeetingReminder).where(
+            tuple_(MeetingReminder.meeting_id, MeetingReminder.member_id, MeetingReminder.hours_before)
+            .in_(claims[start:start + REMINDER_BATCH])
+        ))
+    db.commit()
+
+
+def send_due_reminders(db, transport, now: datetime = None, hours_before: list = REMINDER_HOURS_BEFORE,
+                       batch: int = REMINDER_BATCH) -> dict:
+    """Find, claim and send every due reminder; returns {"sent": reminders, "failed": reminders, "digests": sent}"""
+    started = time.perf_counter()
+    now = now or datetime.utcnow()
+    rows = due_reminders(db, now, hours_before, transport.needs_email)
+    # Release the read transaction (and SQLite's snapshot) before claiming
+    db.commit()
+    digests = group_digests(rows, transport.needs_email)
+
+    stats = {"sent": 0, "failed": 0, "digests": 0}
+    for start in range(0, len(digests), batch):
+        chunk = claim(db, digests[start:start + batch], now)
+        if not chunk:
+            continue
+        try:
+            failed = transport.send(chunk)
+        except Exception:
+            release(db, chunk)
+            raise
+        if failed:
+            release(db, failed)
+        failed_count = sum(len(digest.rows) for digest in failed)
+        sent_count = sum(len(digest.rows) for digest in chunk) - failed_count
+        reminders_total.inc("sent", amount=sent_count)
+        reminders_total.inc("failed", amount=failed_count)
+        stats["sent"] += sent_count
+        stats["failed"] += failed_count
+        stats["digests"] += len(chunk) - len(failed)
+
+    reminder_run_seconds.observe(time.perf_counter() - started)
+    return stats
+
+
+@job("meetings.remind", max_attempts=3, concurrency=1, every=REMINDER_INTERVAL if REMINDER_TRANSPORT else None)
+def remind_meetings():
+    """Send every meeting reminder that is due"""
+    if not REMINDER_TRANSPORT:
+        return
+    transport = create_transport()
+    with SessionLocal() as db:
+        stats = send_due_reminders(db, transport)
+    if stats["sent"] or stats["failed"]:
+        logger.info("Sent %d meeting reminders in %d messages (%d failed)",
+                    stats["sent"], stats["digests"], stats["failed"])
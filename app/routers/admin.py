@@ -0,0 +1,44 @@
+from fastapi import APIRouter, HTTPException, Request
+import os
+import secrets
+
+from .. import slowlog
+
+router = APIRouter()
+
+
+def require_admin_token(request: Request):
+    """Verify the instance operator token for site-wide admin endpoints"""
+    admin_token = os.getenv("ADMIN_TOKEN")
+    if not admin_token:
+        raise HTTPException(status_code=404, detail="Not found")
+
+    # Header only: a token in the URL would end up in access logs and browser history
+    supplied = request.headers.get("X-Admin-Token") or ""
+    if not secrets.compare_digest(supplied, admin_token):
+        raise HTTPException(status_code=403, detail="Admin access required")
+
+
+@router.get("/slow-queries")
+async def slow_queries(request: Request, limit: int = 20):
+    """List the slowest statements by total time"""
+    require_admin_token(request)
+
+    # Every worker's under app.server
+    limit = max(1, min(limit, 200))
+    return {
+        "threshold_ms": slowlog.SLOW_QUERY_MS,
+        "statements": slowlog.shared_top(limit) if slowlog.SHARED_DIR else slowlog.stats.top(limit)
+    }
+
+
+@router.post("/slow-queries/reset")
+async def reset_slow_queries(request: Request):
+    """Clear the slow-query report, in every worker under app.server"""
+    require_admin_token(request)
+
+    if slowlog.SHARED_DIR:
+        slowlog.reset_shared()
+    else:
+        slowlog.stats.clear()
+    return {"status": "cleared"}
@@ -4,25 +4,16 @@ from sqlalchemy.orm import Session
 from datetime import datetime
 import random
 
-from ..database import get_db
+from ..database import get_db, insert_once, delete_once
+from ..writes import add, write
+from ..events import hub, club_channel
+from .. import duplicates, genres, progress, selection
+from ..auth import get_current_member
 from ..models import Book, Club, Member, BookVote, BookReader
 
 router = APIRouter()
 
 
-def get_current_member(request: Request, db: Session) -> Member:
-    """Get current authenticated member"""
-    session_id = request.cookies.get("session_id")
-    if not session_id:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    member = db.query(Member).filter(Member.session_id == session_id).first()
-    if not member:
-        raise HTTPException(status_code=401, detail="Invalid session")
-    
-    return member
-
-
 @router.post("/suggest")
 async def suggest_book(
     request: Request,
@@ -31,6 +22,7 @@ async def suggest_book(
     author: str = Form(...),
     description: str = Form(""),
     isbn: str = Form(""),
+    tags: str = Form(""),
     db: Session = Depends(get_db)
 ):
     """Add a book suggestion to the club"""
@@ -40,9 +32,22 @@ async def suggest_book(
         raise HTTPException(status_code=404, detail="Club not found")
     
     # Get current member
-    member = get_current_member(request, db)
-    if member.club_id != club.id:
-        raise HTTPException(status_code=403, detail="Not a member of this club")
+    member = get_current_member(request, db, club.id)
+    
+    # Comma-separated genre tags
+    try:
+        names = genres.normalize(tags)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    
+    # ISBN-10 or ISBN-13, stored as ISBN-13
+    try:
+        isbn = duplicates.canonical_isbn(isbn)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    
+    # Open suggestions that are the same book
+    matches = duplicates.matches(db, club.id, title, author, isbn)
     
     # Create book suggestion
     book = Book(
@@ -54,11 +59,23 @@ async def suggest_book(
         suggested_by=member.id,
         status="suggested"
     )
-    db.add(book)
-    db.commit()
+    club_id, club_code = club.id, club.code
+    
+    def suggest(session):
+        # A duplicate adds its weight to the open suggestion instead
+        book_id = duplicates.merge(session, club_id, matches, isbn)
+        if book_id is not None:
+            genres.add_tags(session, book_id, club_id, names)
+            return book_id
+        book_id = add(book)(session)
+        if names:
+            genres.set_tags(session, book_id, club_id, names)
+        return book_id
+    
+    book_id = await write(db, suggest)
     
     return RedirectResponse(
-        url=f"/clubs/{club.code}",
+        url=f"/clubs/{club_code}#suggestion-{book_id}",
         status_code=303
     )
 
@@ -76,9 +93,7 @@ async def select_random_book(
         raise HTTPException(status_code=404, detail="Club not found")
     
     # Verify member
-    member = get_current_member(request, db)
-    if member.club_id != club.id:
-        raise HTTPException(status_code=403, detail="Not a member of this club")
+    member = get_current_member(request, db, club.id)
     
     # Get suggested books that aren't vetoed
     suggested_books = db.query(Book).filter(
@@ -94,23 +109,21 @@ async def select_random_book(
     weights = [book.weight for book in suggested_books]
     selected_book = random.choices(suggested_books, weights=weights, k=1)[0]
     
-    # Mark current reading book as completed if exists
-    current_book = db.query(Book).filter(
-        Book.club_id == club.id,
-        Book.status == "reading"
-    ).first()
-    if current_book:
-        current_book.status = "completed"
-        current_book.completed_at = datetime.utcnow()
+    club_id, club_code = club.id, club.code
+    book_id, title, author = selected_book.id, selected_book.title, selected_book.author
     
-    # Update selected book
-    selected_book.status = "reading"
-    selected_book.selected_at = datetime.utcnow()
+    # Complete the current book and start the selected one
+    completed_book_id = await write(db, lambda session: selection.start(session, club_id, book_id))
     
-    db.commit()
+    hub.broadcast(club_channel(club_id), "selected", {
+        "book_id": book_id,
+        "title": title,
+        "author": author,
+        "completed_book_id": completed_book_id
+    })
     
     return RedirectResponse(
-        url=f"/clubs/{club.code}",
+        url=f"/clubs/{club_code}",
         status_code=303
     )
 
@@ -127,9 +140,7 @@ async def complete_book(
         raise HTTPException(status_code=404, detail="Book not found")
     
     # Verify member
-    member = get_current_member(request, db)
-    if member.club_id != book.club_id:
-        raise HTTPException(status_code=403, detail="Not a member of this club")
+    member = get_current_member(request, db, book.club_id)
     
     book.status = "completed"
     book.completed_at = datetime.utcnow()
@@ -159,43 +170,126 @@ async def veto_book(
         raise HTTPException(status_code=403, detail="Veto system is disabled for this club")
     
     # Verify member
-    member = get_current_member(request, db)
-    if member.club_id != book.club_id:
-        raise HTTPException(status_code=403, detail="Not a member of this club")
-    
-    # Check if member already vetoed
-    existing_veto = db.query(BookVote).filter(
-        BookVote.book_id == book_id,
-        BookVote.member_id == member.id,
-        BookVote.vote_type == "veto"
-    ).first()
-    
-    if not existing_veto:
-        # Add veto vote
-        veto = BookVote(
-            book_id=book_id,
-            member_id=member.id,
-            vote_type="veto"
-        )
-        db.add(veto)
-        db.commit()
-    
-    # Calculate veto percentage
-    total_members = db.query(Member).filter(Member.club_id == club.id).count()
-    veto_count = db.query(BookVote).filter(
-        BookVote.book_id == book_id,
-        BookVote.vote_type == "veto"
-    ).count()
-    
-    veto_percentage = (veto_count / total_members * 100) if total_members > 0 else 0
-    
-    # Check if veto threshold is met
-    if veto_percentage >= club.veto_percentage:
-        book.vetoed = True
-        db.commit()
+    member = get_current_member(request, db, book.club_id)
+    
+    club_id, club_code, threshold, title = club.id, club.code, club.veto_percentage, book.title
+    
+    def cast_veto(session):
+        # Add the veto unless the member already vetoed; the counts run in the same transaction
+        insert_once(session, BookVote, book_id=book_id, member_id=member.id, vote_type="veto")
+        
+        # Calculate veto percentage
+        total_members = session.query(Member).filter(Member.club_id == club_id).count()
+        veto_count = session.query(BookVote).filter(
+            BookVote.book_id == book_id,
+            BookVote.vote_type == "veto"
+        ).count()
+        
+        veto_percentage = (veto_count / total_members * 100) if total_members > 0 else 0
+        
+        # Check if veto threshold is met
+        vetoed = session.get(Book, book_id)
+        crossed = veto_percentage >= threshold and not vetoed.vetoed
+        if crossed:
+            vetoed.vetoed = True
+        return total_members, veto_count, veto_percentage, crossed
+    
+    total_members, veto_count, veto_percentage, crossed = await write(db, cast_veto)
+    
+    channel = club_channel(club_id)
+    hub.broadcast(channel, "veto", {
+        "book_id": book_id,
+        "veto_count": veto_count,
+        "member_count": total_members,
+        "veto_percentage": round(veto_percentage, 1),
+        "threshold": threshold
+    })
+    if crossed:
+        hub.broadcast(channel, "vetoed", {
+            "book_id": book_id,
+            "title": title
+        })
     
     return RedirectResponse(
-        url=f"/clubs/{book.club.code}",
+        url=f"/clubs/{club_code}",
+        status_code=303
+    )
+
+
+@router.post("/{book_id}/upvote")
+async def upvote_book(
+    request: Request,
+    book_id: int,
+    db: Session = Depends(get_db)
+):
+    """Upvote a book suggestion, or take the upvote back"""
+    book = db.query(Book).filter(Book.id == book_id).first()
+    if not book:
+        raise HTTPException(status_code=404, detail="Book not found")
+    
+    club = book.club
+    
+    # Check the club selects books by voting
+    if club.book_selection_method != "voting":
+        raise HTTPException(status_code=403, detail="This club does not vote on books")
+    
+    # Verify member
+    member = get_current_member(request, db, book.club_id)
+    
+    club_id, club_code, title, author, member_id = club.id, club.code, book.title, book.author, member.id
+    
+    # Count the upvote; reaching the threshold starts the book in the same transaction
+    try:
+        result = await write(db, lambda session: selection.upvote(session, book_id, member_id))
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    
+    channel = club_channel(club_id)
+    hub.broadcast(channel, "upvote", {
+        "book_id": book_id,
+        "upvotes": result["upvotes"],
+        "needed": result["needed"]
+    })
+    if result["selected"]:
+        hub.broadcast(channel, "selected", {
+            "book_id": book_id,
+            "title": title,
+            "author": author,
+            "completed_book_id": result["completed_book_id"]
+        })
+    
+    return RedirectResponse(
+        url=f"/clubs/{club_code}",
+        status_code=303
+    )
+
+
+@router.post("/{book_id}/tags")
+async def tag_book(
+    request: Request,
+    book_id: int,
+    tags: str = Form(""),
+    db: Session = Depends(get_db)
+):
+    """Replace a book's genre tags"""
+    book = db.query(Book).filter(Book.id == book_id).first()
+    if not book:
+        raise HTTPException(status_code=404, detail="Book not found")
+    
+    # Verify member
+    member = get_current_member(request, db, book.club_id)
+    
+    try:
+        names = genres.normalize(tags)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    
+    club_id, club_code = book.club_id, book.club.code
+    
+    await write(db, lambda session: genres.set_tags(session, book_id, club_id, names))
+    
+    return RedirectResponse(
+        url=f"/clubs/{club_code}",
         status_code=303
     )
 
@@ -215,26 +309,21 @@ async def join_reading(
     if book.status != "reading":
         raise HTTPException(status_code=400, detail="This book is not currently being read")
     
-    member = get_current_member(request, db)
-    if member.club_id != book.club_id:
-        raise HTTPException(status_code=403, detail="Not a member of this club")
+    member = get_current_member(request, db, book.club_id)
+    
+    club_code = book.club.code
+    
+    member_id = member.id
     
-    # Check if already joined
-    existing = db.query(BookReader).filter(
-        BookReader.book_id == book_id,
-        BookReader.member_id == member.id
-    ).first()
+    def join(session):
+        # Join unless already a reader; the member's genres now include the book's
+        if insert_once(session, BookReader, book_id=book_id, member_id=member_id):
+            genres.queue_refresh(session, member_id=member_id)
     
-    if not existing:
-        reader = BookReader(
-            book_id=book_id,
-            member_id=member.id
-        )
-        db.add(reader)
-        db.commit()
+    await write(db, join)
     
     return RedirectResponse(
-        url=f"/clubs/{book.club.code}",
+        url=f"/clubs/{club_code}",
         status_code=303
     )
 
@@ -250,21 +339,53 @@ async def leave_reading(
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
     
-    member = get_current_member(request, db)
-    if member.club_id != book.club_id:
-        raise HTTPException(status_code=403, detail="Not a member of this club")
+    member = get_current_member(request, db, book.club_id)
+    
+    club_code = book.club.code
     
-    # Find and delete reader record
-    reader = db.query(BookReader).filter(
-        BookReader.book_id == book_id,
-        BookReader.member_id == member.id
-    ).first()
+    member_id = member.id
     
-    if reader:
-        db.delete(reader)
-        db.commit()
+    def leave(session):
+        # Delete reader record
+        if delete_once(session, BookReader, book_id=book_id, member_id=member_id):
+            genres.queue_refresh(session, member_id=member_id)
+    
+    await write(db, leave)
     
     return RedirectResponse(
-        url=f"/clubs/{book.club.code}",
+        url=f"/clubs/{club_code}",
+        status_code=303
+    )
+
+
+@router.post("/{book_id}/progress")
+async def report_progress(
+    request: Request,
+    book_id: int,
+    page: int = Form(...),
+    pages: int = Form(...),
+    db: Session = Depends(get_db)
+):
+    """Record the page a member has reached in the current book"""
+    book = db.query(Book).filter(Book.id == book_id).first()
+    if not book:
+        raise HTTPException(status_code=404, detail="Book not found")
+    
+    if book.status != "reading":
+        raise HTTPException(status_code=400, detail="This book is not currently being read")
+    
+    if not 1 <= pages <= progress.MAX_PAGES or not 0 <= page <= pages:
+        raise HTTPException(status_code=400, detail="Page must be between 0 and the number of pages")
+    
+    member = get_current_member(request, db, book.club_id)
+    
+    club_code = book.club.code
+    member_id = member.id
+    
+    # Joins the readers on the first report
+    await write(db, lambda session: progress.record(session, book_id, member_id, page, pages))
+    
+    return RedirectResponse(
+        url=f"/clubs/{club_code}",
         status_code=303
-    )
\ No newline at end of file
+    )
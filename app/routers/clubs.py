@@ -1,15 +1,30 @@
-from fastapi import APIRouter, Depends, HTTPException, Request, Form
-from fastapi.responses import HTMLResponse, RedirectResponse
-from fastapi.templating import Jinja2Templates
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Request, Form, WebSocket, WebSocketDisconnect
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
+from sqlalchemy.orm import Session, selectinload
+from sqlalchemy import func
 from datetime import datetime
 import secrets
 
-from ..database import get_db
-from ..models import Club, Member, Meeting, MeetingSchedule
+from ..database import get_db, SessionLocal
+from ..templating import templates
+from .. import auth, genres, progress, selection
+from ..auth import find_member, get_current_member
+from ..events import hub, club_channel
+from ..export import EXPORTERS
+from ..models import Club, Member, Meeting, MeetingSchedule, Book, BookVote
 
 router = APIRouter()
-templates = Jinja2Templates(directory="app/templates")
+
+
+def clean_email(email: str):
+    """The submitted email address, or None when left blank"""
+    email = email.strip()
+    if not email:
+        return None
+    local, _, domain = email.rpartition("@")
+    if not local or "." not in domain or len(email) > 254 or any(char.isspace() for char in email):
+        raise HTTPException(status_code=400, detail="Invalid email address")
+    return email
 
 
 @router.get("/create", response_class=HTMLResponse)
@@ -27,9 +42,12 @@ async def create_club(
     name: str = Form(...),
     display_name: str = Form(...),
     description: str = Form(""),
+    email: str = Form(""),
     db: Session = Depends(get_db)
 ):
     """Create a new book club"""
+    email = clean_email(email)
+    
     # Generate unique club code
     code = Club.generate_code()
     while db.query(Club).filter(Club.code == code).first():
@@ -42,16 +60,17 @@ async def create_club(
         description=description
     )
     db.add(club)
-    db.commit()
-    db.refresh(club)
+    # Assigns club.id; the club and its first member are committed together
+    db.flush()
     
-    # Generate new session ID for this club membership
+    # Per-membership secret; its digest ties issued tokens to this member row
     session_id = secrets.token_urlsafe(32)
     
     # Auto-join the creator as a member with their chosen display name
     member = Member(
         club_id=club.id,
         display_name=display_name,
+        email=email,
         session_id=session_id,
         is_admin=True  # Creator is automatically admin
     )
@@ -59,17 +78,12 @@ async def create_club(
     db.commit()
     db.refresh(member)
     
-    # Set cookie and redirect
+    # Add the membership to the signed token and redirect
     response = RedirectResponse(
         url=f"/clubs/{club.code}",
         status_code=303
     )
-    response.set_cookie(
-        key="session_id",
-        value=session_id,
-        httponly=True,
-        max_age=30*24*60*60  # 30 days
-    )
+    auth.grant(request, response, member)
     return response
 
 
@@ -87,37 +101,37 @@ async def join_club(
     request: Request,
     code: str = Form(...),
     display_name: str = Form(...),
+    email: str = Form(""),
     db: Session = Depends(get_db)
 ):
     """Join a club with a code"""
+    email = clean_email(email)
+    
     # Find club
     club = db.query(Club).filter(Club.code == code.upper()).first()
     if not club:
         raise HTTPException(status_code=404, detail="Club not found")
     
-    # Generate session ID
+    # Per-membership secret; its digest ties issued tokens to this member row
     session_id = secrets.token_urlsafe(32)
     
     # Create member
     member = Member(
         club_id=club.id,
         display_name=display_name,
+        email=email,
         session_id=session_id
     )
     db.add(member)
     db.commit()
+    db.refresh(member)
     
-    # Set session cookie and redirect
+    # Add the membership to the signed token and redirect
     response = RedirectResponse(
         url=f"/clubs/{club.code}",
         status_code=303
     )
-    response.set_cookie(
-        key="session_id",
-        value=session_id,
-        httponly=True,
-        max_age=30*24*60*60  # 30 days
-    )
+    auth.grant(request, response, member)
     return response
 
 
@@ -125,29 +139,53 @@ async def join_club(
 async def view_club(
     request: Request,
     code: str,
+    tag: str = None,
+    sort: str = None,
     db: Session = Depends(get_db)
 ):
     """View club details"""
-    club = db.query(Club).filter(Club.code == code.upper()).first()
+    # Members and books with everything the page shows about each, a query per relationship
+    club = db.query(Club).options(
+        selectinload(Club.members),
+        selectinload(Club.books).selectinload(Book.ratings),
+        selectinload(Club.books).selectinload(Book.votes),
+        selectinload(Club.books).selectinload(Book.readers),
+    ).filter(Club.code == code.upper()).first()
     if not club:
         raise HTTPException(status_code=404, detail="Club not found")
     
     # Get current member if authenticated
-    session_id = request.cookies.get("session_id")
-    current_member = None
-    if session_id:
-        current_member = db.query(Member).filter(
-            Member.session_id == session_id,
-            Member.club_id == club.id
-        ).first()
+    current_member = find_member(request, db, club.id)
     
     # Get books in different states
     suggested_books = [b for b in club.books if b.status == "suggested" and not b.vetoed]
     current_book = next((b for b in club.books if b.status == "reading"), None)
     completed_books = [b for b in club.books if b.status == "completed"]
     
+    # Books per genre tag, and the tags of each book
+    tag_facets = genres.facets(db, club.id)
+    book_tags = genres.tags_by_book(db, club.id)
+    
+    # Only suggestions and past books with the chosen tag
+    if tag:
+        tagged = genres.tagged(db, club.id, tag)
+        suggested_books = [b for b in suggested_books if b.id in tagged]
+        completed_books = [b for b in completed_books if b.id in tagged]
+    
+    # The member's favorite genres, and suggestions ordered by how well they match them
+    favorite_genres = genres.favorites(db, current_member.id) if current_member else []
+    if sort == "fit" and current_member:
+        fit = genres.fit(db, current_member.id, club.id)
+        suggested_books.sort(key=lambda b: fit.get(b.id, 0), reverse=True)
+    
+    # Where everyone is in the current book, from each reader's latest position
+    reading_progress = progress.histogram(db, current_book.id) if current_book else []
+    
+    # Upvotes a suggestion needs to be selected, in clubs that vote
+    votes_needed = selection.votes_needed(len(club.members), club.voting_percentage)
+    
     # Get next upcoming meeting
-    next_meeting = db.query(Meeting).filter(
+    next_meeting = db.query(Meeting).options(selectinload(Meeting.rsvps)).filter(
         Meeting.club_id == club.id,
         Meeting.status == "scheduled",
         Meeting.meeting_datetime >= datetime.utcnow()
@@ -164,11 +202,92 @@ async def view_club(
             "current_book": current_book,
             "completed_books": completed_books,
             "next_meeting": next_meeting,
+            "reading_progress": reading_progress,
+            "votes_needed": votes_needed,
+            "tag_facets": tag_facets,
+            "book_tags": book_tags,
+            "tag": tag,
+            "sort": sort,
+            "favorite_genres": favorite_genres,
+            "pace": progress.pace,
+            "days_left": progress.days_left,
             "datetime": datetime
         }
     )
 
 
+def tally_snapshot(db: Session, club: Club) -> dict:
+    """Current veto and upvote counts and reading book for a club's live channel"""
+    member_count = db.query(func.count(Member.id)).filter(Member.club_id == club.id).scalar()
+    
+    veto_counts = dict(
+        db.query(BookVote.book_id, func.count(BookVote.id))
+        .join(Book, Book.id == BookVote.book_id)
+        .filter(
+            Book.club_id == club.id,
+            Book.status == "suggested",
+            BookVote.vote_type == "veto"
+        )
+        .group_by(BookVote.book_id)
+        .all()
+    )
+    
+    # Running upvote counts, kept on each book
+    upvote_counts = dict(
+        db.query(Book.id, Book.upvotes)
+        .filter(
+            Book.club_id == club.id,
+            Book.status == "suggested",
+            Book.upvotes > 0
+        )
+        .all()
+    )
+    
+    current_book = db.query(Book.id, Book.title, Book.author).filter(
+        Book.club_id == club.id,
+        Book.status == "reading"
+    ).first()
+    
+    return {
+        "member_count": member_count,
+        "veto_enabled": club.veto_enabled,
+        "veto_percentage": club.veto_percentage,
+        "veto_counts": {str(book_id): count for book_id, count in veto_counts.items()},
+        "book_selection_method": club.book_selection_method,
+        "upvotes_needed": selection.votes_needed(member_count, club.voting_percentage),
+        "upvote_counts": {str(book_id): count for book_id, count in upvote_counts.items()},
+        "current_book": dict(current_book._mapping) if current_book else None
+    }
+
+
+@router.websocket("/{code}/ws")
+async def club_live(websocket: WebSocket, code: str):
+    """Push live veto tallies and book selections for a club"""
+    # Use a short-lived session so idle sockets don't hold pooled connections
+    db = SessionLocal()
+    try:
+        club = db.query(Club).filter(Club.code == code.upper()).first()
+        snapshot = tally_snapshot(db, club) if club else None
+    finally:
+        db.close()
+    
+    if not club:
+        await websocket.close(code=4404)
+        return
+    
+    channel = club_channel(club.id)
+    await hub.connect(channel, websocket)
+    try:
+        await websocket.send_json({"event": "snapshot", "data": snapshot})
+        # Nothing is expected from the client; wait until it goes away
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        hub.disconnect(channel, websocket)
+
+
 @router.post("/{code}/leave")
 async def leave_club(
     request: Request,
@@ -181,21 +300,56 @@ async def leave_club(
         raise HTTPException(status_code=404, detail="Club not found")
     
     # Get current member
-    session_id = request.cookies.get("session_id")
-    if not session_id:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    member = db.query(Member).filter(
-        Member.session_id == session_id,
-        Member.club_id == club.id
-    ).first()
+    current_member = get_current_member(request, db, club.id)
+    member = db.query(Member).filter(Member.id == current_member.id).first()
     
+    selected = None
     if member:
-        # Delete the member
+        # Their upvotes leave with them
+        selection.withdraw(db, club.id, member.id)
+        # Delete the member; tokens naming them stop working on every request
         db.delete(member)
+        db.flush()
+        # One member fewer can bring a suggestion to the threshold
+        selected = selection.check_threshold(db, club.id)
         db.commit()
+        auth.forget(member.id)
+    
+    if selected:
+        hub.broadcast(club_channel(club.id), "selected", selected)
     
-    return RedirectResponse(url="/", status_code=303)
+    response = RedirectResponse(url="/", status_code=303)
+    auth.drop(request, response, club.id)
+    return response
+
+
+@router.get("/{code}/export")
+async def export_club(
+    request: Request,
+    code: str,
+    format: str = "zip",
+    db: Session = Depends(get_db)
+):
+    """Download everything in the club as a zip or JSON lines (admins only)"""
+    if format not in EXPORTERS:
+        raise HTTPException(status_code=400, detail="Unknown export format")
+    club = db.query(Club).filter(Club.code == code.upper()).first()
+    if not club:
+        raise HTTPException(status_code=404, detail="Club not found")
+    
+    # Get current member
+    current_member = get_current_member(request, db, club.id)
+    if not current_member.is_admin:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    # Streamed from its own session and snapshot after this returns
+    exporter, media_type = EXPORTERS[format]
+    filename = f"bookclub-{club.code}-{datetime.utcnow():%Y%m%d}.{format}"
+    return StreamingResponse(
+        exporter(club.id, club.code),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
 
 
 @router.get("/{code}/admin", response_class=HTMLResponse)
@@ -210,16 +364,8 @@ async def admin_settings(
         raise HTTPException(status_code=404, detail="Club not found")
     
     # Get current member
-    session_id = request.cookies.get("session_id")
-    if not session_id:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    current_member = db.query(Member).filter(
-        Member.session_id == session_id,
-        Member.club_id == club.id
-    ).first()
-    
-    if not current_member or not current_member.is_admin:
+    current_member = get_current_member(request, db, club.id)
+    if not current_member.is_admin:
         raise HTTPException(status_code=403, detail="Admin access required")
     
     # Get flash message if exists
@@ -255,16 +401,8 @@ async def update_settings(
         raise HTTPException(status_code=404, detail="Club not found")
     
     # Verify admin
-    session_id = request.cookies.get("session_id")
-    if not session_id:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    current_member = db.query(Member).filter(
-        Member.session_id == session_id,
-        Member.club_id == club.id
-    ).first()
-    
-    if not current_member or not current_member.is_admin:
+    current_member = get_current_member(request, db, club.id)
+    if not current_member.is_admin:
         raise HTTPException(status_code=403, detail="Admin access required")
     
     # Update settings
@@ -272,9 +410,15 @@ async def update_settings(
     club.veto_percentage = max(1, min(100, veto_percentage))
     club.book_selection_method = book_selection_method
     club.voting_percentage = max(1, min(100, voting_percentage))
+    db.flush()
     
+    # A lower threshold, or switching to voting, can start a suggestion at once
+    selected = selection.check_threshold(db, club.id)
     db.commit()
     
+    if selected:
+        hub.broadcast(club_channel(club.id), "selected", selected)
+    
     # Set flash message
     request.session['flash_message'] = "Settings updated successfully!"
     request.session['flash_type'] = "success"
@@ -295,16 +439,8 @@ async def promote_member(
         raise HTTPException(status_code=404, detail="Club not found")
     
     # Verify current user is admin
-    session_id = request.cookies.get("session_id")
-    if not session_id:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    current_member = db.query(Member).filter(
-        Member.session_id == session_id,
-        Member.club_id == club.id
-    ).first()
-    
-    if not current_member or not current_member.is_admin:
+    current_member = get_current_member(request, db, club.id)
+    if not current_member.is_admin:
         raise HTTPException(status_code=403, detail="Admin access required")
     
     # Promote member
@@ -317,7 +453,7 @@ async def promote_member(
         raise HTTPException(status_code=404, detail="Member not found")
     
     member.is_admin = True
-    db.commit()
+    auth.revoke(db, member)
     
     # Set flash message
     request.session['flash_message'] = f"{member.display_name} promoted to admin!"
@@ -339,16 +475,8 @@ async def demote_member(
         raise HTTPException(status_code=404, detail="Club not found")
     
     # Verify current user is admin
-    session_id = request.cookies.get("session_id")
-    if not session_id:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    current_member = db.query(Member).filter(
-        Member.session_id == session_id,
-        Member.club_id == club.id
-    ).first()
-    
-    if not current_member or not current_member.is_admin:
+    current_member = get_current_member(request, db, club.id)
+    if not current_member.is_admin:
         raise HTTPException(status_code=403, detail="Admin access required")
     
     # Demote member
@@ -371,7 +499,7 @@ async def demote_member(
         raise HTTPException(status_code=400, detail="Cannot demote the last admin")
     
     member.is_admin = False
-    db.commit()
+    auth.revoke(db, member)
     
     # Set flash message
     request.session['flash_message'] = f"{member.display_name} removed as admin"
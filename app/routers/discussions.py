@@ -1,26 +1,22 @@
 from fastapi import APIRouter, Depends, HTTPException, Request, Form
-from fastapi.responses import HTMLResponse, RedirectResponse
-from fastapi.templating import Jinja2Templates
-from sqlalchemy.orm import Session
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
+from sqlalchemy import func
+from sqlalchemy.orm import Session, joinedload
+from sqlalchemy.orm.attributes import set_committed_value
+from starlette.background import BackgroundTask
 
-from ..database import get_db
-from ..models import Discussion, DiscussionPost, DiscussionPostLike, DiscussionComment, DiscussionCommentLike, Book, Member
+from .. import archive
+from ..database import get_db, SessionLocal, toggle
+from ..writes import add, write
+from ..templating import templates
+from ..auth import find_member, get_current_member
+from ..events import broker, discussion_topic, SSE_HEADERS
+from ..models import Discussion, DiscussionPost, DiscussionPostLike, DiscussionComment, DiscussionCommentLike, Book
 
 router = APIRouter()
-templates = Jinja2Templates(directory="app/templates")
 
-
-def get_current_member(request: Request, db: Session) -> Member:
-    """Get current authenticated member"""
-    session_id = request.cookies.get("session_id")
-    if not session_id:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    member = db.query(Member).filter(Member.session_id == session_id).first()
-    if not member:
-        raise HTTPException(status_code=401, detail="Invalid session")
-    
-    return member
+# Posts loaded and rendered per step when streaming a thread
+POSTS_PER_BATCH = 20
 
 
 @router.get("/book/{book_id}", response_class=HTMLResponse)
@@ -35,13 +31,18 @@ async def view_discussions(
         raise HTTPException(status_code=404, detail="Book not found")
     
     # Get current member
-    session_id = request.cookies.get("session_id")
-    current_member = None
-    if session_id:
-        current_member = db.query(Member).filter(
-            Member.session_id == session_id,
-            Member.club_id == book.club_id
-        ).first()
+    current_member = find_member(request, db, book.club_id)
+    
+    # Posts per thread, from the archive once the book's threads are in it
+    post_counts = archive.post_counts(db, book.id) if book.archived_at else None
+    if post_counts is None:
+        post_counts = dict(
+            db.query(DiscussionPost.discussion_id, func.count(DiscussionPost.id))
+            .join(Discussion, DiscussionPost.discussion_id == Discussion.id)
+            .filter(Discussion.book_id == book.id)
+            .group_by(DiscussionPost.discussion_id)
+            .all()
+        )
     
     return templates.TemplateResponse(
         "discussions/list.html",
@@ -51,7 +52,8 @@ async def view_discussions(
             "book": book,
             "club": book.club,
             "current_member": current_member,
-            "discussions": book.discussions
+            "discussions": book.discussions,
+            "post_counts": post_counts
         }
     )
 
@@ -69,53 +71,144 @@ async def create_discussion(
         raise HTTPException(status_code=404, detail="Book not found")
     
     # Verify member
-    member = get_current_member(request, db)
-    if member.club_id != book.club_id:
-        raise HTTPException(status_code=403, detail="Not a member of this club")
+    member = get_current_member(request, db, book.club_id)
     
     discussion = Discussion(
         book_id=book_id,
         title=title
     )
-    db.add(discussion)
-    db.commit()
+    discussion_id = await write(db, add(discussion))
     
     return RedirectResponse(
-        url=f"/discussions/{discussion.id}",
+        url=f"/discussions/{discussion_id}",
         status_code=303
     )
 
 
+def iter_posts(db: Session, discussion_id: int, batch_size: int = POSTS_PER_BATCH):
+    """Yield a discussion's posts a batch at a time, with comments, replies and likes attached
+
+    Each batch costs four queries however deep its comment trees are, only
+    the batch being rendered is held in memory, and the session commits
+    before each batch is yielded so no pooled connection is held while it is
+    sent. Use a session with ``expire_on_commit=False``.
+    """
+    last_id = 0
+    while True:
+        posts = (
+            db.query(DiscussionPost)
+            .options(joinedload(DiscussionPost.author))
+            .filter(DiscussionPost.discussion_id == discussion_id, DiscussionPost.id > last_id)
+            .order_by(DiscussionPost.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not posts:
+            return
+        post_ids = [post.id for post in posts]
+
+        post_likes = {post_id: [] for post_id in post_ids}
+        for like in db.query(DiscussionPostLike).filter(DiscussionPostLike.post_id.in_(post_ids)):
+            post_likes[like.post_id].append(like)
+
+        comments = (
+            db.query(DiscussionComment)
+            .options(joinedload(DiscussionComment.author))
+            .filter(DiscussionComment.post_id.in_(post_ids))
+            .order_by(DiscussionComment.id)
+            .all()
+        )
+        comment_likes = {comment.id: [] for comment in comments}
+        post_comments = {post_id: [] for post_id in post_ids}
+        for comment in comments:
+            post_comments[comment.post_id].append(comment)
+        if comments:
+            for like in db.query(DiscussionCommentLike).filter(
+                DiscussionCommentLike.comment_id.in_(list(comment_likes))
+            ):
+                comment_likes[like.comment_id].append(like)
+
+        # Fill the relationships the template walks so none of them lazy load
+        children = {comment.id: [] for comment in comments}
+        for comment in comments:
+            if comment.parent_comment_id in children:
+                children[comment.parent_comment_id].append(comment)
+        for comment in comments:
+            set_committed_value(comment, "child_comments", children[comment.id])
+            set_committed_value(comment, "likes", comment_likes[comment.id])
+        for post in posts:
+            set_committed_value(post, "likes", post_likes[post.id])
+            set_committed_value(post, "comments", post_comments[post.id])
+        # Return the connection to the pool while this batch is rendered and sent
+        db.commit()
+
+        yield from posts
+        last_id = post_ids[-1]
+        if len(posts) < batch_size:
+            return
+
+
 @router.get("/{discussion_id}", response_class=HTMLResponse)
 async def view_discussion(
     request: Request,
-    discussion_id: int,
-    db: Session = Depends(get_db)
+    discussion_id: int
 ):
     """View a discussion thread"""
-    discussion = db.query(Discussion).filter(Discussion.id == discussion_id).first()
-    if not discussion:
-        raise HTTPException(status_code=404, detail="Discussion not found")
-    
-    # Get current member
-    session_id = request.cookies.get("session_id")
-    current_member = None
-    if session_id:
-        current_member = db.query(Member).filter(
-            Member.session_id == session_id,
-            Member.club_id == discussion.book.club_id
-        ).first()
+    # The page renders while it streams, so the session has to outlive this function.
+    # Loaded objects stay usable between the per-batch commits that release its connection
+    db = SessionLocal(expire_on_commit=False)
+    try:
+        discussion = db.query(Discussion).filter(Discussion.id == discussion_id).first()
+        if not discussion:
+            raise HTTPException(status_code=404, detail="Discussion not found")
+        
+        # Get current member
+        current_member = find_member(request, db, discussion.book.club_id)
+        
+        # A finished book's threads may be served from its archive
+        posts = archive.thread(db, discussion.book_id, discussion.id) if discussion.book.archived_at else None
+        if posts is not None:
+            has_posts = bool(posts)
+        else:
+            has_posts = db.query(
+                db.query(DiscussionPost.id).filter(DiscussionPost.discussion_id == discussion.id).exists()
+            ).scalar()
+            posts = iter_posts(db, discussion.id)
+        db.commit()
+    except BaseException:
+        db.close()
+        raise
     
-    return templates.TemplateResponse(
+    return templates.TemplateStream(
+        request,
         "discussions/view.html",
         {
-            "request": request,
             "title": discussion.title,
             "discussion": discussion,
             "book": discussion.book,
             "club": discussion.book.club,
-            "current_member": current_member
-        }
+            "current_member": current_member,
+            "has_posts": has_posts,
+            "posts": posts
+        },
+        background=BackgroundTask(db.close)
+    )
+
+
+@router.get("/{discussion_id}/events")
+async def discussion_events(
+    discussion_id: int,
+    db: Session = Depends(get_db)
+):
+    """Stream live updates for a discussion thread (Server-Sent Events)"""
+    exists = db.query(Discussion.id).filter(Discussion.id == discussion_id).first()
+    if not exists:
+        raise HTTPException(status_code=404, detail="Discussion not found")
+    
+    return StreamingResponse(
+        broker.stream(discussion_topic(discussion_id)),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS
     )
 
 
@@ -133,9 +226,7 @@ async def add_post(
         raise HTTPException(status_code=404, detail="Discussion not found")
     
     # Verify member
-    member = get_current_member(request, db)
-    if member.club_id != discussion.book.club_id:
-        raise HTTPException(status_code=403, detail="Not a member of this club")
+    member = get_current_member(request, db, discussion.book.club_id)
     
     post = DiscussionPost(
         discussion_id=discussion_id,
@@ -143,8 +234,12 @@ async def add_post(
         content=content,
         is_spoiler=is_spoiler
     )
-    db.add(post)
-    db.commit()
+    post_id = await write(db, archive.live(discussion.book, add(post)))
+    
+    broker.publish(discussion_topic(discussion_id), "post", {
+        "post_id": post_id,
+        "author": member.display_name
+    })
     
     return RedirectResponse(
         url=f"/discussions/{discussion_id}",
@@ -152,42 +247,56 @@ async def add_post(
     )
 
 
+async def find_archived(request: Request, db: Session, model, row_id: int, discussion_id: int):
+    """Restore the thread's book from its archive, if it is archived, and look the post or comment up again
+
+    Only a member of the book's club can bring it back.
+    """
+    if not discussion_id:
+        return None
+    book = db.query(Book).join(Discussion, Discussion.book_id == Book.id).filter(Discussion.id == discussion_id).first()
+    if not book or not book.archived_at:
+        return None
+    get_current_member(request, db, book.club_id)
+    book_id = book.id
+    await write(db, lambda session: archive.restore(session, book_id))
+    return db.query(model).filter(model.id == row_id).first()
+
+
 @router.post("/post/{post_id}/like")
 async def like_post(
     request: Request,
     post_id: int,
+    discussion_id: int = Form(None),
     db: Session = Depends(get_db)
 ):
     """Like or unlike a discussion post"""
     post = db.query(DiscussionPost).filter(DiscussionPost.id == post_id).first()
+    if not post:
+        # Pages of archived threads name the thread, so the post can be brought back
+        post = await find_archived(request, db, DiscussionPost, post_id, discussion_id)
     if not post:
         raise HTTPException(status_code=404, detail="Post not found")
     
-    member = get_current_member(request, db)
-    if member.club_id != post.discussion.book.club_id:
-        raise HTTPException(status_code=403, detail="Not a member of this club")
+    member = get_current_member(request, db, post.discussion.book.club_id)
     
-    # Check if already liked
-    existing_like = db.query(DiscussionPostLike).filter(
-        DiscussionPostLike.post_id == post_id,
-        DiscussionPostLike.member_id == member.id
-    ).first()
+    # Read before committing: expired attributes would check out a connection
+    # again and hold it until the session closes
+    discussion_id = post.discussion_id
     
-    if existing_like:
-        # Unlike
-        db.delete(existing_like)
-    else:
-        # Like
-        like = DiscussionPostLike(
-            post_id=post_id,
-            member_id=member.id
-        )
-        db.add(like)
+    # Like, or unlike if the like already exists
+    liked = await write(db, archive.live(
+        post.discussion.book,
+        lambda session: toggle(session, DiscussionPostLike, post_id=post_id, member_id=member.id)
+    ))
     
-    db.commit()
+    broker.publish(discussion_topic(discussion_id), "like", {
+        "post_id": post_id,
+        "liked": liked
+    })
     
     return RedirectResponse(
-        url=f"/discussions/{post.discussion_id}",
+        url=f"/discussions/{discussion_id}",
         status_code=303
     )
 
@@ -199,16 +308,17 @@ async def add_comment(
     content: str = Form(...),
     is_spoiler: bool = Form(False),
     parent_comment_id: int = Form(None),
+    discussion_id: int = Form(None),
     db: Session = Depends(get_db)
 ):
     """Add a comment to a discussion post (or reply to another comment)"""
     post = db.query(DiscussionPost).filter(DiscussionPost.id == post_id).first()
+    if not post:
+        post = await find_archived(request, db, DiscussionPost, post_id, discussion_id)
     if not post:
         raise HTTPException(status_code=404, detail="Post not found")
     
-    member = get_current_member(request, db)
-    if member.club_id != post.discussion.book.club_id:
-        raise HTTPException(status_code=403, detail="Not a member of this club")
+    member = get_current_member(request, db, post.discussion.book.club_id)
     
     # Validate content
     if not content or content.strip() == "":
@@ -221,11 +331,18 @@ async def add_comment(
         content=content.strip(),
         is_spoiler=is_spoiler
     )
-    db.add(comment)
-    db.commit()
+    discussion_id = post.discussion_id
+    comment_id = await write(db, archive.live(post.discussion.book, add(comment)))
+    
+    broker.publish(discussion_topic(discussion_id), "comment", {
+        "post_id": post_id,
+        "comment_id": comment_id,
+        "parent_comment_id": parent_comment_id,
+        "author": member.display_name
+    })
     
     return RedirectResponse(
-        url=f"/discussions/{post.discussion_id}",
+        url=f"/discussions/{discussion_id}",
         status_code=303
     )
 
@@ -234,37 +351,32 @@ async def add_comment(
 async def like_comment(
     request: Request,
     comment_id: int,
+    discussion_id: int = Form(None),
     db: Session = Depends(get_db)
 ):
     """Like or unlike a comment"""
     comment = db.query(DiscussionComment).filter(DiscussionComment.id == comment_id).first()
+    if not comment:
+        comment = await find_archived(request, db, DiscussionComment, comment_id, discussion_id)
     if not comment:
         raise HTTPException(status_code=404, detail="Comment not found")
     
-    member = get_current_member(request, db)
-    if member.club_id != comment.post.discussion.book.club_id:
-        raise HTTPException(status_code=403, detail="Not a member of this club")
+    member = get_current_member(request, db, comment.post.discussion.book.club_id)
     
-    # Check if already liked
-    existing_like = db.query(DiscussionCommentLike).filter(
-        DiscussionCommentLike.comment_id == comment_id,
-        DiscussionCommentLike.member_id == member.id
-    ).first()
+    discussion_id = comment.post.discussion_id
     
-    if existing_like:
-        # Unlike
-        db.delete(existing_like)
-    else:
-        # Like
-        like = DiscussionCommentLike(
-            comment_id=comment_id,
-            member_id=member.id
-        )
-        db.add(like)
+    # Like, or unlike if the like already exists
+    liked = await write(db, archive.live(
+        comment.post.discussion.book,
+        lambda session: toggle(session, DiscussionCommentLike, comment_id=comment_id, member_id=member.id)
+    ))
     
-    db.commit()
+    broker.publish(discussion_topic(discussion_id), "like", {
+        "comment_id": comment_id,
+        "liked": liked
+    })
     
     return RedirectResponse(
-        url=f"/discussions/{comment.post.discussion_id}",
+        url=f"/discussions/{discussion_id}",
         status_code=303
     )
\ No newline at end of file
@@ -1,29 +1,17 @@
 from fastapi import APIRouter, Depends, HTTPException, Request, Form
 from fastapi.responses import HTMLResponse, RedirectResponse, Response
-from fastapi.templating import Jinja2Templates
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, joinedload, selectinload
 from datetime import datetime, timedelta
 from icalendar import Calendar, Event
 import pytz
 
-from ..database import get_db
+from ..database import get_db, insert_on_conflict
+from ..writes import write
+from ..templating import templates
+from ..auth import find_member, get_current_member
 from ..models import Meeting, MeetingSchedule, Club, Member, Book, MeetingRSVP, MeetingRSVP
 
 router = APIRouter()
-templates = Jinja2Templates(directory="app/templates")
-
-
-def get_current_member(request: Request, db: Session) -> Member:
-    """Get current authenticated member"""
-    session_id = request.cookies.get("session_id")
-    if not session_id:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    member = db.query(Member).filter(Member.session_id == session_id).first()
-    if not member:
-        raise HTTPException(status_code=401, detail="Invalid session")
-    
-    return member
 
 
 @router.get("/club/{club_code}", response_class=HTMLResponse)
@@ -33,28 +21,23 @@ async def view_meetings(
     db: Session = Depends(get_db)
 ):
     """View all meetings for a club in calendar format"""
-    club = db.query(Club).filter(Club.code == club_code.upper()).first()
+    # Members up front, so hosts and the member lookup come from the identity map
+    club = db.query(Club).options(selectinload(Club.members)).filter(Club.code == club_code.upper()).first()
     if not club:
         raise HTTPException(status_code=404, detail="Club not found")
     
     # Get current member
-    session_id = request.cookies.get("session_id")
-    current_member = None
-    if session_id:
-        current_member = db.query(Member).filter(
-            Member.session_id == session_id,
-            Member.club_id == club.id
-        ).first()
+    current_member = find_member(request, db, club.id)
     
     # Get upcoming meetings
-    upcoming_meetings = db.query(Meeting).filter(
+    upcoming_meetings = db.query(Meeting).options(joinedload(Meeting.book)).filter(
         Meeting.club_id == club.id,
         Meeting.status == "scheduled",
         Meeting.meeting_datetime >= datetime.utcnow()
     ).order_by(Meeting.meeting_datetime).all()
     
     # Get past meetings
-    past_meetings = db.query(Meeting).filter(
+    past_meetings = db.query(Meeting).options(joinedload(Meeting.book)).filter(
         Meeting.club_id == club.id,
         Meeting.status.in_(["completed", "cancelled"]),
     ).order_by(Meeting.meeting_datetime.desc()).limit(10).all()
@@ -85,9 +68,7 @@ async def setup_schedule_form(
         raise HTTPException(status_code=404, detail="Club not found")
     
     # Verify current member is the host (or creator if no schedule exists)
-    member = get_current_member(request, db)
-    if member.club_id != club.id:
-        raise HTTPException(status_code=403, detail="Not a member of this club")
+    member = get_current_member(request, db, club.id)
     
     # If schedule exists, verify this member is the host
     if club.meeting_schedule and club.meeting_schedule.current_host_id != member.id:
@@ -119,9 +100,7 @@ async def setup_schedule(
     if not club:
         raise HTTPException(status_code=404, detail="Club not found")
     
-    member = get_current_member(request, db)
-    if member.club_id != club.id:
-        raise HTTPException(status_code=403, detail="Not a member of this club")
+    member = get_current_member(request, db, club.id)
     
     # Check if schedule exists
     if club.meeting_schedule:
@@ -163,9 +142,7 @@ async def create_meeting_form(
     if not club:
         raise HTTPException(status_code=404, detail="Club not found")
     
-    member = get_current_member(request, db)
-    if member.club_id != club.id:
-        raise HTTPException(status_code=403, detail="Not a member of this club")
+    member = get_current_member(request, db, club.id)
     
     # Verify member is the current host
     if club.meeting_schedule and club.meeting_schedule.current_host_id != member.id:
@@ -208,9 +185,7 @@ async def create_meeting(
     if not club:
         raise HTTPException(status_code=404, detail="Club not found")
     
-    member = get_current_member(request, db)
-    if member.club_id != club.id:
-        raise HTTPException(status_code=403, detail="Not a member of this club")
+    member = get_current_member(request, db, club.id)
     
     # Verify member is the current host
     if club.meeting_schedule and club.meeting_schedule.current_host_id != member.id:
@@ -219,35 +194,38 @@ async def create_meeting(
     # Parse datetime
     meeting_datetime = datetime.strptime(f"{meeting_date} {meeting_time}", "%Y-%m-%d %H:%M")
     
-    # Create meeting
-    meeting = Meeting(
-        club_id=club.id,
-        host_id=member.id,
-        book_id=book_id if book_id else None,
-        title=title,
-        description=description,
-        meeting_datetime=meeting_datetime,
-        duration_minutes=duration_minutes,
-        location=location,
-        status="scheduled"
-    )
-    db.add(meeting)
-    db.commit()
-    db.refresh(meeting)
+    club_id, club_code = club.id, club.code
+    
+    def schedule(session):
+        # Create meeting
+        meeting = Meeting(
+            club_id=club_id,
+            host_id=member.id,
+            book_id=book_id if book_id else None,
+            title=title,
+            description=description,
+            meeting_datetime=meeting_datetime,
+            duration_minutes=duration_minutes,
+            location=location,
+            status="scheduled"
+        )
+        session.add(meeting)
+        session.flush()
+        
+        # Automatically RSVP the host as attending, in the same transaction
+        session.add(MeetingRSVP(
+            meeting_id=meeting.id,
+            member_id=member.id,
+            status="yes",
+            bringing="",  # Host can update this later if they want
+            notes="Host"
+        ))
+        return meeting.id
     
-    # Automatically RSVP the host as attending
-    host_rsvp = MeetingRSVP(
-        meeting_id=meeting.id,
-        member_id=member.id,
-        status="yes",
-        bringing="",  # Host can update this later if they want
-        notes="Host"
-    )
-    db.add(host_rsvp)
-    db.commit()
+    await write(db, schedule)
     
     return RedirectResponse(
-        url=f"/meetings/club/{club.code}",
+        url=f"/meetings/club/{club_code}",
         status_code=303
     )
 
@@ -263,9 +241,7 @@ async def complete_meeting(
     if not meeting:
         raise HTTPException(status_code=404, detail="Meeting not found")
     
-    member = get_current_member(request, db)
-    if member.club_id != meeting.club_id:
-        raise HTTPException(status_code=403, detail="Not a member of this club")
+    member = get_current_member(request, db, meeting.club_id)
     
     meeting.status = "completed"
     meeting.completed_at = datetime.utcnow()
@@ -289,7 +265,7 @@ async def cancel_meeting(
     if not meeting:
         raise HTTPException(status_code=404, detail="Meeting not found")
     
-    member = get_current_member(request, db)
+    member = get_current_member(request, db, meeting.club_id)
     
     # Only host can cancel
     if meeting.host_id != member.id:
@@ -316,9 +292,7 @@ async def transfer_host(
     if not club:
         raise HTTPException(status_code=404, detail="Club not found")
     
-    member = get_current_member(request, db)
-    if member.club_id != club.id:
-        raise HTTPException(status_code=403, detail="Not a member of this club")
+    member = get_current_member(request, db, club.id)
     
     # Verify current member is the host
     if not club.meeting_schedule or club.meeting_schedule.current_host_id != member.id:
@@ -394,9 +368,7 @@ async def rsvp_form(
     if not meeting:
         raise HTTPException(status_code=404, detail="Meeting not found")
     
-    member = get_current_member(request, db)
-    if member.club_id != meeting.club_id:
-        raise HTTPException(status_code=403, detail="Not a member of this club")
+    member = get_current_member(request, db, meeting.club_id)
     
     # Get current user's RSVP if exists
     current_rsvp = db.query(MeetingRSVP).filter(
@@ -405,7 +377,7 @@ async def rsvp_form(
     ).first()
     
     # Get all RSVPs for this meeting
-    all_rsvps = db.query(MeetingRSVP).filter(
+    all_rsvps = db.query(MeetingRSVP).options(joinedload(MeetingRSVP.member)).filter(
         MeetingRSVP.meeting_id == meeting_id,
         MeetingRSVP.status == "yes"
     ).all()
@@ -438,36 +410,33 @@ async def submit_rsvp(
     if not meeting:
         raise HTTPException(status_code=404, detail="Meeting not found")
     
-    member = get_current_member(request, db)
-    if member.club_id != meeting.club_id:
-        raise HTTPException(status_code=403, detail="Not a member of this club")
+    member = get_current_member(request, db, meeting.club_id)
     
-    # Check if RSVP already exists
-    rsvp = db.query(MeetingRSVP).filter(
-        MeetingRSVP.meeting_id == meeting_id,
-        MeetingRSVP.member_id == member.id
-    ).first()
+    club_code = meeting.club.code
     
-    if rsvp:
-        # Update existing RSVP
-        rsvp.status = status
-        rsvp.bringing = bringing
-        rsvp.notes = notes
-        rsvp.updated_at = datetime.utcnow()
-    else:
-        # Create new RSVP
-        rsvp = MeetingRSVP(
-            meeting_id=meeting_id,
-            member_id=member.id,
-            status=status,
-            bringing=bringing,
-            notes=notes
-        )
-        db.add(rsvp)
-    
-    db.commit()
+    # Create the RSVP, or update it in place if the member already answered
+    now = datetime.utcnow()
+    rsvp = insert_on_conflict(MeetingRSVP).values(
+        meeting_id=meeting_id,
+        member_id=member.id,
+        status=status,
+        bringing=bringing,
+        notes=notes,
+        created_at=now,
+        updated_at=now
+    )
+    rsvp = rsvp.on_conflict_do_update(
+        index_elements=["meeting_id", "member_id"],
+        set_={
+            "status": rsvp.excluded.status,
+            "bringing": rsvp.excluded.bringing,
+            "notes": rsvp.excluded.notes,
+            "updated_at": rsvp.excluded.updated_at
+        }
+    )
+    await write(db, lambda session: session.execute(rsvp).rowcount)
     
     return RedirectResponse(
-        url=f"/clubs/{meeting.club.code}",
+        url=f"/clubs/{club_code}",
         status_code=303
     )
\ No newline at end of file
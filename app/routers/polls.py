@@ -0,0 +1,223 @@
+from fastapi import APIRouter, Depends, HTTPException, Request, Form
+from fastapi.responses import HTMLResponse, RedirectResponse
+from sqlalchemy.orm import Session, selectinload
+from datetime import datetime
+from typing import List
+
+from ..database import get_db
+from ..writes import write
+from ..templating import templates
+from ..auth import find_member, get_current_member
+from .. import polls
+from ..models import Club, Meeting, Poll, PollBallot, PollOption
+
+router = APIRouter()
+
+
+def find_poll(db: Session, poll_id: int) -> Poll:
+    poll = db.query(Poll).options(selectinload(Poll.options)).filter(Poll.id == poll_id).first()
+    if not poll:
+        raise HTTPException(status_code=404, detail="Poll not found")
+    return poll
+
+
+@router.get("/club/{club_code}", response_class=HTMLResponse)
+async def view_polls(
+    request: Request,
+    club_code: str,
+    meeting_id: int = None,
+    db: Session = Depends(get_db)
+):
+    """List a club's polls, with a form to start one"""
+    club = db.query(Club).filter(Club.code == club_code.upper()).first()
+    if not club:
+        raise HTTPException(status_code=404, detail="Club not found")
+    
+    current_member = find_member(request, db, club.id)
+    
+    # Open polls first, newest first
+    club_polls = db.query(Poll).options(selectinload(Poll.meeting)).filter(
+        Poll.club_id == club.id
+    ).order_by(Poll.closed, Poll.created_at.desc()).all()
+    
+    # Upcoming meetings a new poll can be about
+    upcoming_meetings = db.query(Meeting).filter(
+        Meeting.club_id == club.id,
+        Meeting.status == "scheduled",
+        Meeting.meeting_datetime >= datetime.utcnow()
+    ).order_by(Meeting.meeting_datetime).all()
+    
+    return templates.TemplateResponse(
+        "polls/list.html",
+        {
+            "request": request,
+            "title": f"Polls - {club.name}",
+            "club": club,
+            "current_member": current_member,
+            "polls": club_polls,
+            "upcoming_meetings": upcoming_meetings,
+            "meeting_id": meeting_id,
+            "kinds": polls.KINDS,
+            "max_options": polls.MAX_OPTIONS
+        }
+    )
+
+
+@router.post("/create/{club_code}")
+async def create_poll(
+    request: Request,
+    club_code: str,
+    question: str = Form(...),
+    kind: str = Form("single"),
+    options: str = Form(...),
+    meeting_id: int = Form(None),
+    db: Session = Depends(get_db)
+):
+    """Start a poll in the club, optionally about one of its meetings"""
+    club = db.query(Club).filter(Club.code == club_code.upper()).first()
+    if not club:
+        raise HTTPException(status_code=404, detail="Club not found")
+    
+    member = get_current_member(request, db, club.id)
+    
+    # One option per line
+    labels = [line.strip() for line in options.splitlines() if line.strip()]
+    if kind not in polls.KINDS:
+        raise HTTPException(status_code=400, detail="Unknown poll type")
+    if not question.strip():
+        raise HTTPException(status_code=400, detail="The poll needs a question")
+    if not 2 <= len(labels) <= polls.MAX_OPTIONS or len(set(labels)) != len(labels):
+        raise HTTPException(status_code=400, detail=f"A poll needs 2 to {polls.MAX_OPTIONS} different options")
+    if meeting_id and not db.query(Meeting.id).filter(Meeting.id == meeting_id, Meeting.club_id == club.id).first():
+        raise HTTPException(status_code=404, detail="Meeting not found")
+    
+    club_id, member_id = club.id, member.id
+    
+    def start(session):
+        poll = Poll(
+            club_id=club_id,
+            meeting_id=meeting_id or None,
+            created_by=member_id,
+            question=question.strip()[:300],
+            kind=kind
+        )
+        poll.options = [PollOption(position=position, label=label[:200]) for position, label in enumerate(labels)]
+        session.add(poll)
+        session.flush()
+        return poll.id
+    
+    poll_id = await write(db, start)
+    
+    return RedirectResponse(
+        url=f"/polls/{poll_id}",
+        status_code=303
+    )
+
+
+@router.get("/{poll_id}", response_class=HTMLResponse)
+async def view_poll(
+    request: Request,
+    poll_id: int,
+    db: Session = Depends(get_db)
+):
+    """Show a poll's ballot form and results"""
+    poll = find_poll(db, poll_id)
+    
+    current_member = find_member(request, db, poll.club_id)
+    
+    # The viewer's ballot, as option positions
+    my_choices = []
+    if current_member:
+        choices = db.query(PollBallot.choices).filter(
+            PollBallot.poll_id == poll.id,
+            PollBallot.member_id == current_member.id
+        ).scalar()
+        my_choices = list(choices or b"")
+    
+    return templates.TemplateResponse(
+        "polls/view.html",
+        {
+            "request": request,
+            "title": poll.question,
+            "club": poll.club,
+            "poll": poll,
+            "current_member": current_member,
+            "my_choices": my_choices,
+            "results": polls.results(db, poll),
+            "kinds": polls.KINDS
+        }
+    )
+
+
+@router.post("/{poll_id}/vote")
+async def vote(
+    request: Request,
+    poll_id: int,
+    choices: List[str] = Form([]),
+    db: Session = Depends(get_db)
+):
+    """Cast or replace the member's ballot"""
+    poll = find_poll(db, poll_id)
+    
+    member = get_current_member(request, db, poll.club_id)
+    
+    # Ranked ballots leave lower preferences blank
+    try:
+        encoded = polls.ballot(poll.kind, [int(choice) for choice in choices if choice != ""], len(poll.options))
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    
+    member_id = member.id
+    
+    if not await write(db, lambda session: polls.cast(session, poll_id, member_id, encoded)):
+        raise HTTPException(status_code=400, detail="This poll is closed")
+    
+    return RedirectResponse(
+        url=f"/polls/{poll_id}",
+        status_code=303
+    )
+
+
+@router.post("/{poll_id}/retract")
+async def retract_vote(
+    request: Request,
+    poll_id: int,
+    db: Session = Depends(get_db)
+):
+    """Withdraw the member's ballot"""
+    poll = find_poll(db, poll_id)
+    
+    member = get_current_member(request, db, poll.club_id)
+    
+    member_id = member.id
+    
+    if not await write(db, lambda session: polls.retract(session, poll_id, member_id)):
+        raise HTTPException(status_code=400, detail="This poll is closed")
+    
+    return RedirectResponse(
+        url=f"/polls/{poll_id}",
+        status_code=303
+    )
+
+
+@router.post("/{poll_id}/close")
+async def close_poll(
+    request: Request,
+    poll_id: int,
+    db: Session = Depends(get_db)
+):
+    """Close a poll to further ballots"""
+    poll = find_poll(db, poll_id)
+    
+    member = get_current_member(request, db, poll.club_id)
+    
+    # Only the member who started it or an admin
+    if poll.created_by != member.id and not member.is_admin:
+        raise HTTPException(status_code=403, detail="Only the poll's creator or an admin can close it")
+    
+    await write(db, lambda session: polls.close(session, poll_id))
+    
+    return RedirectResponse(
+        url=f"/polls/{poll_id}",
+        status_code=303
+    )
@@ -1,27 +1,19 @@
 from fastapi import APIRouter, Depends, HTTPException, Request, Form
-from fastapi.responses import HTMLResponse, RedirectResponse
-from fastapi.templating import Jinja2Templates
-from sqlalchemy.orm import Session
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
+from sqlalchemy.orm import Session, joinedload, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy import func
+from datetime import datetime
 
-from ..database import get_db
-from ..models import Rating, ReviewLike, ReviewComment, ReviewCommentLike, Book, Member
+from .. import archive, genres
+from ..database import get_db, insert_on_conflict, toggle
+from ..writes import add, write
+from ..templating import templates
+from ..auth import find_member, get_current_member
+from ..events import broker, reviews_topic, SSE_HEADERS
+from ..models import Rating, ReviewLike, ReviewComment, ReviewCommentLike, Book
 
 router = APIRouter()
-templates = Jinja2Templates(directory="app/templates")
-
-
-def get_current_member(request: Request, db: Session) -> Member:
-    """Get current authenticated member"""
-    session_id = request.cookies.get("session_id")
-    if not session_id:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    member = db.query(Member).filter(Member.session_id == session_id).first()
-    if not member:
-        raise HTTPException(status_code=401, detail="Invalid session")
-    
-    return member
 
 
 @router.get("/book/{book_id}", response_class=HTMLResponse)
@@ -36,31 +28,40 @@ async def view_ratings(
         raise HTTPException(status_code=404, detail="Book not found")
     
     # Get current member
-    session_id = request.cookies.get("session_id")
-    current_member = None
-    if session_id:
-        current_member = db.query(Member).filter(
-            Member.session_id == session_id,
-            Member.club_id == book.club_id
-        ).first()
-    
-    # Calculate average rating
-    avg_rating = db.query(func.avg(Rating.rating)).filter(
-        Rating.book_id == book_id
-    ).scalar()
-    
-    # Get user's rating if exists
+    current_member = find_member(request, db, book.club_id)
+    
+    # A finished book's likes and comments may be served from its archive
+    archived = archive.reviews(db, book_id) if book.archived_at else None
+    
+    # Get all ratings, newest first, with their reviewers (and the likes and comments still live)
+    query = db.query(Rating).options(joinedload(Rating.member)).filter(Rating.book_id == book_id)
+    if archived is None:
+        query = query.options(
+            selectinload(Rating.likes),
+            selectinload(Rating.comments).options(joinedload(ReviewComment.member), selectinload(ReviewComment.likes)),
+        )
+    ratings = query.order_by(Rating.created_at.desc()).all()
+    
+    if archived is not None:
+        for rating in ratings:
+            likes, comments = archived.get(rating.id, ([], []))
+            set_committed_value(rating, "likes", likes)
+            set_committed_value(rating, "comments", comments)
+    else:
+        # Replies from the review's comments already loaded, instead of a query per comment
+        for rating in ratings:
+            replies = {comment.id: [] for comment in rating.comments}
+            for comment in rating.comments:
+                if comment.parent_comment_id in replies:
+                    replies[comment.parent_comment_id].append(comment)
+            for comment in rating.comments:
+                set_committed_value(comment, "child_comments", replies[comment.id])
+    
+    # Average rating, and the member's own rating if they have one
+    avg_rating = sum(rating.rating for rating in ratings) / len(ratings) if ratings else None
     user_rating = None
     if current_member:
-        user_rating = db.query(Rating).filter(
-            Rating.book_id == book_id,
-            Rating.member_id == current_member.id
-        ).first()
-    
-    # Get all ratings ordered by likes
-    ratings = db.query(Rating).filter(
-        Rating.book_id == book_id
-    ).order_by(Rating.created_at.desc()).all()
+        user_rating = next((rating for rating in ratings if rating.member_id == current_member.id), None)
     
     return templates.TemplateResponse(
         "ratings/list.html",
@@ -78,6 +79,23 @@ async def view_ratings(
     )
 
 
+@router.get("/book/{book_id}/events")
+async def review_events(
+    book_id: int,
+    db: Session = Depends(get_db)
+):
+    """Stream live updates for a book's reviews (Server-Sent Events)"""
+    exists = db.query(Book.id).filter(Book.id == book_id).first()
+    if not exists:
+        raise HTTPException(status_code=404, detail="Book not found")
+    
+    return StreamingResponse(
+        broker.stream(reviews_topic(book_id)),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS
+    )
+
+
 @router.post("/book/{book_id}/submit")
 async def submit_rating(
     request: Request,
@@ -91,35 +109,43 @@ async def submit_rating(
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
     
-    member = get_current_member(request, db)
-    if member.club_id != book.club_id:
-        raise HTTPException(status_code=403, detail="Not a member of this club")
+    member = get_current_member(request, db, book.club_id)
     
     # Validate rating
     if rating < 1 or rating > 5:
         raise HTTPException(status_code=400, detail="Rating must be between 1 and 5")
     
-    # Check if user already rated
-    existing_rating = db.query(Rating).filter(
-        Rating.book_id == book_id,
-        Rating.member_id == member.id
-    ).first()
+    # Create the rating, or update it in place if the member already rated the book
+    now = datetime.utcnow()
+    upsert = insert_on_conflict(Rating).values(
+        book_id=book_id,
+        member_id=member.id,
+        rating=rating,
+        review=review,
+        created_at=now,
+        updated_at=now
+    )
+    upsert = upsert.on_conflict_do_update(
+        index_elements=["book_id", "member_id"],
+        set_={
+            "rating": upsert.excluded.rating,
+            "review": upsert.excluded.review,
+            "updated_at": upsert.excluded.updated_at
+        }
+    )
+    member_id = member.id
     
-    if existing_rating:
-        # Update existing rating
-        existing_rating.rating = rating
-        existing_rating.review = review
-    else:
-        # Create new rating
-        new_rating = Rating(
-            book_id=book_id,
-            member_id=member.id,
-            rating=rating,
-            review=review
-        )
-        db.add(new_rating)
+    def rate(session):
+        session.execute(upsert)
+        # The rating moves the member's genre affinity
+        genres.queue_refresh(session, member_id=member_id)
     
-    db.commit()
+    await write(db, rate)
+    
+    broker.publish(reviews_topic(book_id), "rating", {
+        "member": member.display_name,
+        "rating": rating
+    })
     
     return RedirectResponse(
         url=f"/ratings/book/{book_id}",
@@ -138,31 +164,24 @@ async def like_rating(
     if not rating:
         raise HTTPException(status_code=404, detail="Rating not found")
     
-    member = get_current_member(request, db)
-    if member.club_id != rating.book.club_id:
-        raise HTTPException(status_code=403, detail="Not a member of this club")
+    member = get_current_member(request, db, rating.book.club_id)
     
-    # Check if already liked
-    existing_like = db.query(ReviewLike).filter(
-        ReviewLike.rating_id == rating_id,
-        ReviewLike.member_id == member.id
-    ).first()
+    # Read before committing: expired attributes would check out a connection
+    # again and hold it until the session closes
+    book_id = rating.book_id
     
-    if existing_like:
-        # Unlike
-        db.delete(existing_like)
-    else:
-        # Like
-        like = ReviewLike(
-            rating_id=rating_id,
-            member_id=member.id
-        )
-        db.add(like)
+    # Like, or unlike if the like already exists
+    liked = await write(db, archive.live(
+        rating.book, lambda session: toggle(session, ReviewLike, rating_id=rating_id, member_id=member.id)
+    ))
     
-    db.commit()
+    broker.publish(reviews_topic(book_id), "like", {
+        "rating_id": rating_id,
+        "liked": liked
+    })
     
     return RedirectResponse(
-        url=f"/ratings/book/{rating.book_id}",
+        url=f"/ratings/book/{book_id}",
         status_code=303
     )
 
@@ -180,9 +199,7 @@ async def add_comment(
     if not rating:
         raise HTTPException(status_code=404, detail="Rating not found")
     
-    member = get_current_member(request, db)
-    if member.club_id != rating.book.club_id:
-        raise HTTPException(status_code=403, detail="Not a member of this club")
+    member = get_current_member(request, db, rating.book.club_id)
     
     # Validate content
     if not content or content.strip() == "":
@@ -194,11 +211,18 @@ async def add_comment(
         member_id=member.id,
         content=content.strip()
     )
-    db.add(comment)
-    db.commit()
+    book_id = rating.book_id
+    comment_id = await write(db, archive.live(rating.book, add(comment)))
+    
+    broker.publish(reviews_topic(book_id), "comment", {
+        "rating_id": rating_id,
+        "comment_id": comment_id,
+        "parent_comment_id": parent_comment_id,
+        "author": member.display_name
+    })
     
     return RedirectResponse(
-        url=f"/ratings/book/{rating.book_id}",
+        url=f"/ratings/book/{book_id}",
         status_code=303
     )
 
@@ -214,15 +238,29 @@ async def delete_rating(
     if not rating:
         raise HTTPException(status_code=404, detail="Rating not found")
     
-    member = get_current_member(request, db)
+    member = get_current_member(request, db, rating.book.club_id)
     
     # Only the author can delete their rating
     if rating.member_id != member.id:
         raise HTTPException(status_code=403, detail="You can only delete your own rating")
     
     book_id = rating.book_id
-    db.delete(rating)
-    db.commit()
+    member_id = member.id
+    
+    def unrate(session):
+        # Restored first, so an archived book's likes and comments go with the rating
+        found = session.get(Rating, rating_id)
+        if found is not None:
+            session.delete(found)
+        # Dropping the rating moves the member's genre affinity
+        genres.queue_refresh(session, member_id=member_id)
+    
+    await write(db, archive.live(rating.book, unrate))
+    
+    broker.publish(reviews_topic(book_id), "rating", {
+        "member": member.display_name,
+        "rating": None
+    })
     
     return RedirectResponse(
         url=f"/ratings/book/{book_id}",
@@ -234,37 +272,38 @@ async def delete_rating(
 async def like_comment(
     request: Request,
     comment_id: int,
+    book_id: int = Form(None),
     db: Session = Depends(get_db)
 ):
     """Like or unlike a comment"""
     comment = db.query(ReviewComment).filter(ReviewComment.id == comment_id).first()
+    if not comment and book_id:
+        # Pages of archived reviews name the book, so the comment can be brought back
+        book = db.query(Book).filter(Book.id == book_id).first()
+        if book and book.archived_at:
+            # Only a member of the book's club can bring it back
+            get_current_member(request, db, book.club_id)
+            await write(db, lambda session: archive.restore(session, book_id))
+            comment = db.query(ReviewComment).filter(ReviewComment.id == comment_id).first()
     if not comment:
         raise HTTPException(status_code=404, detail="Comment not found")
     
-    member = get_current_member(request, db)
-    if member.club_id != comment.rating.book.club_id:
-        raise HTTPException(status_code=403, detail="Not a member of this club")
+    member = get_current_member(request, db, comment.rating.book.club_id)
     
-    # Check if already liked
-    existing_like = db.query(ReviewCommentLike).filter(
-        ReviewCommentLike.comment_id == comment_id,
-        ReviewCommentLike.member_id == member.id
-    ).first()
+    book_id = comment.rating.book_id
     
-    if existing_like:
-        # Unlike
-        db.delete(existing_like)
-    else:
-        # Like
-        like = ReviewCommentLike(
-            comment_id=comment_id,
-            member_id=member.id
-        )
-        db.add(like)
+    # Like, or unlike if the like already exists
+    liked = await write(db, archive.live(
+        comment.rating.book,
+        lambda session: toggle(session, ReviewCommentLike, comment_id=comment_id, member_id=member.id)
+    ))
     
-    db.commit()
+    broker.publish(reviews_topic(book_id), "like", {
+        "comment_id": comment_id,
+        "liked": liked
+    })
     
     return RedirectResponse(
-        url=f"/ratings/book/{comment.rating.book_id}",
+        url=f"/ratings/book/{book_id}",
         status_code=303
     )
\ No newline at end of file
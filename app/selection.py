@@ -0,0 +1,147 @@
+"""Choosing the club's next book: at random, or by members' upvotes.
+
+Each book keeps a running count of its upvotes in ``Book.upvotes``, moved
+in the same transaction as the ``book_votes`` row it counts, so showing the
+counts and checking the threshold read one row per book and never count
+votes.
+
+In a club that selects by voting, the upvote that brings a suggestion to
+``voting_percentage`` of the club's members starts it as the book being
+read, in the upvote's own transaction. Upvotes in a club are serialized by
+locking the club's row (on SQLite, by the write lock), so when two
+suggestions reach the threshold at once the first one wins. Starting a book
+opens a new round: upvotes on the remaining suggestions are cleared.
+
+The threshold also moves without an upvote, when an admin changes the
+percentage or a member leaves; ``check_threshold`` then starts the
+suggestion that has reached it, if any.
+"""
+from datetime import datetime
+
+from sqlalchemy import delete, func, select, update
+
+from .database import toggle
+from .models import Book, BookVote, Club, Member
+
+
+def votes_needed(members: int, percentage: int) -> int:
+    """Upvotes that reach percentage of the members, at least one"""
+    return max(1, -(-members * percentage // 100))
+
+
+def lock_club(db, club_id: int):
+    """Serialize the club's upvotes on its row; a no-op on SQLite, where the first write takes the write lock"""
+    db.execute(select(Club.id).where(Club.id == club_id).with_for_update())
+
+
+def start(db, club_id: int, book_id: int, now: datetime = None):
+    """Complete the book being read, start this one and clear the round's upvotes; the completed book's id"""
+    now = now or datetime.utcnow()
+    completed_id = db.execute(
+        update(Book)
+        .where(Book.club_id == club_id, Book.status == "reading")
+        .values(status="completed", completed_at=now)
+        .returning(Book.id)
+    ).scalars().first()
+    db.execute(update(Book).where(Book.id == book_id).values(status="reading", selected_at=now))
+
+    # The other suggestions start the next round from nothing
+    remaining = select(Book.id).where(Book.club_id == club_id, Book.status == "suggested")
+    db.execute(delete(BookVote).where(BookVote.vote_type == "upvote", BookVote.book_id.in_(remaining)))
+    db.execute(
+        update(Book)
+        .where(Book.club_id == club_id, Book.status == "suggested", Book.upvotes != 0)
+        .values(upvotes=0)
+    )
+    return completed_id
+
+
+def upvote(db, book_id: int, member_id: int) -> dict:
+    """Upvote a suggestion, or take the upvote back; starts the book if it reached the threshold
+
+    Returns {"upvoted", "upvotes", "needed", "selected", "completed_book_id"};
+    ValueError if the club does not vote or the book is not an open suggestion.
+    On PostgreSQL voters wait on the club's row lock. On SQLite that lock is
+    a no-op and the write lock toggle() takes serializes them instead.
+    """
+    club_id = db.scalar(select(Book.club_id).where(Book.id == book_id))
+    lock_club(db, club_id)
+    upvoted = toggle(db, BookVote, book_id=book_id, member_id=member_id, vote_type="upvote")
+
+    # Read after the lock (or toggle's write) so a book started by the upvote before this one is seen
+    book = db.execute(
+        select(Book.status, Book.vetoed, Club.book_selection_method, Club.voting_percentage)
+        .join(Club, Club.id == Book.club_id)
+        .where(Book.id == book_id)
+    ).one()
+    if book.book_selection_method != "voting":
+        raise ValueError("This club does not vote on books")
+    if book.status != "suggested" or book.vetoed:
+        raise ValueError("This book is no longer open for votes")
+
+    upvotes = db.scalar(
+        update(Book)
+        .where(Book.id == book_id)
+        .values(upvotes=Book.upvotes + (1 if upvoted else -1))
+        .returning(Book.upvotes)
+    )
+    members = db.scalar(select(func.count(Member.id)).where(Member.club_id == club_id))
+    needed = votes_needed(members, book.voting_percentage)
+
+    selected = upvoted and upvotes >= needed
+    completed_book_id = start(db, club_id, book_id) if selected else None
+    return {
+        "upvoted": upvoted,
+        "upvotes": upvotes,
+        "needed": needed,
+        "selected": selected,
+        "completed_book_id": completed_book_id,
+    }
+
+
+def withdraw(db, club_id: int, member_id: int):
+    """Take back a leaving member's upvotes on open suggestions and drop their votes; before deleting them"""
+    lock_club(db, club_id)
+    upvoted = select(BookVote.book_id).where(BookVote.member_id == member_id, BookVote.vote_type == "upvote")
+    db.execute(
+        update(Book)
+        .where(Book.id.in_(upvoted), Book.status == "suggested")
+        .values(upvotes=Book.upvotes - 1)
+    )
+    db.execute(delete(BookVote).where(BookVote.member_id == member_id))
+
+
+def check_threshold(db, club_id: int):
+    """Start a suggestion that has reached the threshold after the percentage or the members changed
+
+    Call in the transaction making the change, after it is flushed. The
+    suggestion with the most upvotes wins, the earliest suggested on a tie.
+    Returns {"book_id", "title", "author", "completed_book_id"}, or None if
+    nothing reached it.
+    """
+    lock_club(db, club_id)
+    club = db.execute(
+        select(Club.book_selection_method, Club.voting_percentage).where(Club.id == club_id)
+    ).one()
+    if club.book_selection_method != "voting":
+        return None
+    members = db.scalar(select(func.count(Member.id)).where(Member.club_id == club_id))
+    book = db.execute(
+        select(Book.id, Book.title, Book.author)
+        .where(
+            Book.club_id == club_id,
+            Book.status == "suggested",
+            Book.vetoed.isnot(True),
+            Book.upvotes >= votes_needed(members, club.voting_percentage)
+        )
+        .order_by(Book.upvotes.desc(), Book.id)
+        .limit(1)
+    ).first()
+    if book is None:
+        return None
+    return {
+        "book_id": book.id,
+        "title": book.title,
+        "author": book.author,
+        "completed_book_id": start(db, club_id, book.id),
+    }
@@ -0,0 +1,286 @@
+"""Production server: one preloaded master process and forked uvicorn workers.
+
+    python -m app.server --host 0.0.0.0 --port 8000
+
+The master imports the app (creating tables and compiling routes once), binds
+the listening socket, freezes everything it has allocated out of the garbage
+collector's reach and forks ``WEB_CONCURRENCY`` workers (default: one per
+CPU). Because the collector never touches those objects again, their memory
+pages stay shared between workers instead of being copied on first
+collection. Each worker drops the database connections inherited from the
+master and opens its own.
+
+Signals to the master:
+
+- ``SIGTERM``/``SIGINT``: stop accepting, let workers finish in-flight
+  requests (up to ``--graceful-timeout``), then exit
+- ``SIGHUP``: graceful reload. The master re-executes itself on the same
+  socket, preloads the new code, starts a fresh set of workers and only then
+  retires the old ones, so no connection is refused during a deploy
+- ``SIGTTIN``/``SIGTTOU``: add or remove a worker
+
+Workers that die are replaced. Caches stay coherent and live updates
+reach subscribers on every worker through the invalidation bus
+(``app/invalidation.py``). Workers share their metrics in ``METRICS_DIR``
+(a temporary directory unless set), so ``/metrics`` reports all of them
+whichever worker is scraped.
+"""
+import argparse
+import gc
+import logging
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+import uvicorn
+
+logger = logging.getLogger("bookclub.server")
+
+# Listening socket and retiring workers handed over across a SIGHUP re-exec
+LISTEN_FD_ENV = "BOOKCLUB_LISTEN_FD"
+RETIRING_ENV = "BOOKCLUB_RETIRING_WORKERS"
+
+# Set when the metrics directory is ours to remove on shutdown
+OWN_METRICS_DIR_ENV = "BOOKCLUB_OWN_METRICS_DIR"
+
+# New workers get this long to start before the old ones are told to stop
+RELOAD_WARMUP_SECONDS = 2.0
+
+
+def default_workers() -> int:
+    """WEB_CONCURRENCY, or one worker per CPU"""
+    configured = os.getenv("WEB_CONCURRENCY")
+    if configured:
+        return max(1, int(configured))
+    return os.cpu_count() or 1
+
+
+def listen_socket(host: str, port: int, backlog: int = 2048) -> socket.socket:
+    """The inherited socket after a reload, or a newly bound one"""
+    inherited = os.getenv(LISTEN_FD_ENV)
+    if inherited:
+        sock = socket.socket(fileno=int(inherited))
+    else:
+        family = socket.AF_INET6 if ":" in host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def preload():
+    """Import the app in the master so workers share its memory"""
+    from .main import app
+    from .database import engine
+
+    # Startup DDL opened connections; never hand them to a child
+    engine.dispose()
+    # Move everything allocated so far into the permanent generation, so
+    # collections in the workers never write to (and so copy) those pages
+    gc.collect()
+    gc.freeze()
+    gc.enable()
+    return app
+
+
+def run_worker(app, sock: socket.socket, args):
+    """Serve on the shared socket until told to stop; runs in the forked child"""
+    from .database import engine
+
+    for signum in (signal.SIGHUP, signal.SIGTTIN, signal.SIGTTOU):
+        signal.signal(signum, signal.SIG_DFL)
+    # Connections in the pool belong to the master; drop them without closing
+    engine.dispose(close=False)
+
+    config = uvicorn.Config(
+        app,
+        log_level=args.log_level,
+        access_log=args.access_log,
+        proxy_headers=True,
+        forwarded_allow_ips=args.forwarded_allow_ips,
+        timeout_keep_alive=args.keep_alive,
+        timeout_graceful_shutdown=args.graceful_timeout,
+        limit_max_requests=args.max_requests or None,
+    )
+    server = uvicorn.Server(config)
+    server.run(sockets=[sock])
+
+
+class Master:
+    """Forks workers, replaces the ones that die and handles reload and shutdown signals"""
+
+    def __init__(self, app, sock: socket.socket, args):
+        self.app = app
+        self.sock = sock
+        self.args = args
+        self.target = args.workers
+        self.workers: set[int] = set()
+        self.retiring: set[int] = {int(pid) for pid in os.getenv(RETIRING_ENV, "").split(",") if pid}
+        self.stopping = False
+        self.reloading = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                run_worker(self.app, self.sock, self.args)
+            except BaseException:
+                logger.exception("Worker %s crashed", os.getpid())
+                code = 1
+            finally:
+                os._exit(code)
+        self.workers.add(pid)
+        self.count_workers()
+        logger.info("Started worker %s", pid)
+
+    def count_workers(self, extra: int = 0):
+        """Tell the workers how many are serving, so they relay live events only while there are others"""
+        from .events import worker_count
+        worker_count.value = len(self.workers | self.retiring) + extra
+
+    def stop_worker(self, pid: int):
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    def reap(self):
+        """Collect exited children; return how many of the current workers died"""
+        died = 0
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return died
+            if pid == 0:
+                return died
+            if pid in self.workers:
+                self.workers.discard(pid)
+                died += 1
+                if not self.stopping:
+                    logger.warning("Worker %s exited with status %s", pid, os.waitstatus_to_exitcode(status))
+            self.retiring.discard(pid)
+
+    def handle(self, signum, frame):
+        if signum in (signal.SIGTERM, signal.SIGINT):
+            self.stopping = True
+        elif signum == signal.SIGHUP:
+            self.reloading = True
+        elif signum == signal.SIGTTIN:
+            self.target += 1
+        elif signum == signal.SIGTTOU:
+            self.target = max(1, self.target - 1)
+
+    def run(self):
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGTTIN, signal.SIGTTOU):
+            signal.signal(signum, self.handle)
+
+        logger.info("Listening on %s with %s workers (pid %s)",
+                    self.sock.getsockname(), self.target, os.getpid())
+        for _ in range(self.target):
+            self.spawn()
+
+        # Old workers from before a reload keep serving until the new ones are up
+        if self.retiring:
+            time.sleep(RELOAD_WARMUP_SECONDS)
+            for pid in self.retiring:
+                self.stop_worker(pid)
+
+        while not self.stopping:
+            if self.reloading:
+                self.reload()
+            self.reap()
+            while len(self.workers) < self.target and not self.stopping:
+                self.spawn()
+            for pid in sorted(self.workers)[:len(self.workers) - self.target]:
+                self.workers.discard(pid)
+                self.retiring.add(pid)
+                self.stop_worker(pid)
+            self.count_workers()
+            time.sleep(0.5)
+
+        self.shutdown()
+
+    def reload(self):
+        """Re-exec the master with fresh code, handing over the socket and the current workers"""
+        logger.info("Reloading")
+        os.environ[LISTEN_FD_ENV] = str(self.sock.fileno())
+        os.environ[RETIRING_ENV] = ",".join(str(pid) for pid in self.workers | self.retiring)
+        # The new master counts in its own memory; these workers keep relaying to the ones it starts
+        self.count_workers(extra=self.target)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # Same pid after exec, so the old workers remain our children
+        os.execv(sys.executable, [sys.executable, "-m", "app.server", *sys.argv[1:]])
+
+    def shutdown(self):
+        logger.info("Shutting down %s workers", len(self.workers))
+        for pid in self.workers | self.retiring:
+            self.stop_worker(pid)
+        # uvicorn waits graceful_timeout for in-flight requests; allow a little more
+        deadline = time.monotonic() + (self.args.graceful_timeout or 30) + 5
+        while (self.workers or self.retiring) and time.monotonic() < deadline:
+            self.reap()
+            self.workers &= self._alive(self.workers)
+            self.retiring &= self._alive(self.retiring)
+            time.sleep(0.1)
+        for pid in self.workers | self.retiring:
+            logger.warning("Killing worker %s", pid)
+            os.kill(pid, signal.SIGKILL)
+        self.reap()
+        if os.getenv(OWN_METRICS_DIR_ENV):
+            shutil.rmtree(os.environ["METRICS_DIR"], ignore_errors=True)
+
+    @staticmethod
+    def _alive(pids: set) -> set:
+        alive = set()
+        for pid in pids:
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                continue
+            alive.add(pid)
+        return alive
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run BookClub with preforked workers")
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=default_workers(),
+                        help="worker processes (default: WEB_CONCURRENCY or one per CPU)")
+    parser.add_argument("--graceful-timeout", type=int, default=30,
+                        help="seconds workers get to finish in-flight requests on shutdown or reload")
+    parser.add_argument("--keep-alive", type=int, default=5, help="idle keep-alive timeout in seconds")
+    parser.add_argument("--max-requests", type=int, default=int(os.getenv("WEB_MAX_REQUESTS", "0")),
+                        help="restart a worker after this many requests (0: never)")
+    parser.add_argument("--forwarded-allow-ips", default=os.getenv("FORWARDED_ALLOW_IPS", "127.0.0.1"))
+    parser.add_argument("--log-level", default="info")
+    parser.add_argument("--no-access-log", dest="access_log", action="store_false")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    # No collections while importing: objects created now are frozen below
+    gc.disable()
+
+    sock = listen_socket(args.host, args.port)
+    # Before the app is imported: workers read it to share their metrics
+    if not os.getenv("METRICS_DIR"):
+        os.environ["METRICS_DIR"] = tempfile.mkdtemp(prefix="bookclub-metrics-")
+        os.environ[OWN_METRICS_DIR_ENV] = "1"
+    app = preload()
+    Master(app, sock, args).run()
+
+
+if __name__ == "__main__":
+    main()
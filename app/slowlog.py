@@ -0,0 +1,316 @@
+"""Slow-query log: records statements over a threshold with their query plan.
+
+Under ``app.server`` each worker also leaves its slow statements next to its
+metrics in ``METRICS_DIR``, so the admin report sums every worker's (exited
+ones included) and resetting it clears them all.
+"""
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import re
+import threading
+import time
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+
+from sqlalchemy import event
+
+from .context import current_request
+from .metrics import METRICS_DIR, METRICS_SHARE_SECONDS, _alive, _read_snapshot, _write_snapshot
+
+# Statements slower than this are logged; a negative value disables the log
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+SLOW_QUERY_LOG = os.getenv("SLOW_QUERY_LOG", "./data/slow_queries.log")
+SLOW_QUERY_LOG_MAX_BYTES = int(os.getenv("SLOW_QUERY_LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+SLOW_QUERY_LOG_BACKUPS = int(os.getenv("SLOW_QUERY_LOG_BACKUPS", "5"))
+
+# Distinct statements tracked for the admin report
+MAX_TRACKED_STATEMENTS = 500
+
+# Where workers share their slow statements (set by app.server)
+SHARED_DIR = os.path.join(METRICS_DIR, "slow_queries") if METRICS_DIR else None
+
+logger = logging.getLogger("bookclub.slow_queries")
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_NAMED_PARAM = re.compile(r"%\(\w+\)s|:\w+|\$\d+|%s")
+_PARAM_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+_EXPLAINABLE = ("SELECT", "WITH", "UPDATE", "DELETE")
+
+
+def normalize_sql(statement: str) -> str:
+    """Reduce a statement to its shape so repeats group together"""
+    sql = _STRING_LITERAL.sub("?", statement)
+    sql = _NAMED_PARAM.sub("?", sql)
+    sql = _NUMBER_LITERAL.sub("?", sql)
+    sql = _WHITESPACE.sub(" ", sql).strip()
+    # IN lists of any length look the same
+    return _PARAM_LIST.sub("(?...)", sql)
+
+
+def parameters_shape(parameters, executemany: bool):
+    """Describe parameters by type only, never by value"""
+    if executemany:
+        rows = list(parameters or ())
+        return {"rows": len(rows), "row": parameters_shape(rows[0], False) if rows else None}
+    if isinstance(parameters, dict):
+        return {key: type(value).__name__ for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [type(value).__name__ for value in parameters]
+    return None
+
+
+def explain(conn, statement: str, parameters) -> list:
+    """Capture the query plan on a fresh cursor so no engine events fire; never fails the transaction"""
+    if not statement.lstrip().upper().startswith(_EXPLAINABLE):
+        return []
+
+    dialect = conn.dialect.name
+    if dialect == "sqlite":
+        prefix, column = "EXPLAIN QUERY PLAN ", -1
+    elif dialect == "postgresql":
+        prefix, column = "EXPLAIN ", 0
+    else:
+        return []
+
+    # A failed statement aborts a PostgreSQL transaction, so the plan is read
+    # in a savepoint the request's own transaction outlives
+    savepoint = dialect == "postgresql" and not getattr(conn.connection.dbapi_connection, "autocommit", False)
+    cursor = conn.connection.cursor()
+    try:
+        if savepoint:
+            cursor.execute("SAVEPOINT slowlog_explain")
+        cursor.execute(prefix + statement, parameters)
+        plan = [str(row[column]) for row in cursor.fetchall()]
+        if savepoint:
+            cursor.execute("RELEASE SAVEPOINT slowlog_explain")
+        return plan
+    except Exception as exc:
+        if savepoint:
+            try:
+                cursor.execute("ROLLBACK TO SAVEPOINT slowlog_explain")
+                cursor.execute("RELEASE SAVEPOINT slowlog_explain")
+            except Exception:
+                pass
+        return [f"EXPLAIN failed: {exc}"]
+    finally:
+        cursor.close()
+
+
+class SlowQueryStats:
+    """Aggregate of slow statements, ranked by total time"""
+
+    def __init__(self, max_statements: int = MAX_TRACKED_STATEMENTS):
+        self.max_statements = max_statements
+        self._entries: dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def record(self, sql: str, duration_ms: float, route: str, plan: list):
+        with self._lock:
+            entry = self._entries.get(sql)
+            if entry is None:
+                if len(self._entries) >= self.max_statements:
+                    # Forget the statement costing the least overall
+                    cheapest = min(self._entries, key=lambda key: self._entries[key]["total_ms"])
+                    del self._entries[cheapest]
+                entry = self._entries[sql] = {
+                    "sql": sql,
+                    "count": 0,
+                    "total_ms": 0.0,
+                    "max_ms": 0.0,
+                    "routes": {},
+                    "plan": plan,
+                }
+            entry["count"] += 1
+            entry["total_ms"] += duration_ms
+            entry["max_ms"] = max(entry["max_ms"], duration_ms)
+            entry["routes"][route] = entry["routes"].get(route, 0) + 1
+            entry["last_seen"] = datetime.utcnow().isoformat()
+
+    def entries(self) -> list:
+        """A copy of every tracked statement"""
+        with self._lock:
+            return [dict(entry, routes=dict(entry["routes"])) for entry in self._entries.values()]
+
+    def top(self, limit: int = 20, shared: list = ()) -> list:
+        """Statements with the highest total time, summed with other workers' shared entries"""
+        entries = sorted(combine([self.entries(), *shared]), key=lambda entry: entry["total_ms"], reverse=True)
+        return [
+            dict(entry, total_ms=round(entry["total_ms"], 2), max_ms=round(entry["max_ms"], 2),
+                 mean_ms=round(entry["total_ms"] / entry["count"], 2))
+            for entry in entries[:limit]
+        ]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+stats = SlowQueryStats()
+
+
+def combine(snapshots: list, limit: int = None) -> list:
+    """Several lists of entries summed statement by statement; the limit costing the most if given"""
+    combined = {}
+    for entries in snapshots:
+        for entry in entries:
+            total = combined.get(entry["sql"])
+            if total is None:
+                combined[entry["sql"]] = dict(entry, routes=dict(entry["routes"]))
+                continue
+            total["count"] += entry["count"]
+            total["total_ms"] += entry["total_ms"]
+            total["max_ms"] = max(total["max_ms"], entry["max_ms"])
+            for route, count in entry["routes"].items():
+                total["routes"][route] = total["routes"].get(route, 0) + count
+            # The most recent plan wins
+            if entry.get("last_seen", "") > total.get("last_seen", ""):
+                total["last_seen"] = entry["last_seen"]
+                total["plan"] = entry["plan"]
+    entries = list(combined.values())
+    if limit is not None:
+        entries = sorted(entries, key=lambda entry: entry["total_ms"], reverse=True)[:limit]
+    return entries
+
+
+def _retire(directory: str, paths: list):
+    """Fold exited workers' statements into exited.json and drop their files; hold the lock"""
+    exited_path = os.path.join(directory, "exited.json")
+    snapshots = [_read_snapshot(path) or [] for path in [exited_path, *paths]]
+    _write_snapshot(exited_path, combine(snapshots, MAX_TRACKED_STATEMENTS))
+    for path in paths:
+        os.remove(path)
+
+
+_shared_pid = None
+_seen_reset = None
+
+
+def _catch_up(directory: str):
+    """Clear this worker's statements if another worker reset the report since; hold the lock"""
+    global _seen_reset
+    generation = _read_snapshot(os.path.join(directory, "reset.json")) or 0
+    if _seen_reset is not None and generation != _seen_reset:
+        stats.clear()
+    _seen_reset = generation
+
+
+def share(directory: str = SHARED_DIR):
+    """Leave this worker's slow statements in the shared directory"""
+    global _shared_pid
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{os.getpid()}.json")
+    with open(os.path.join(directory, ".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if _shared_pid != os.getpid():
+            # A worker that had this pid before us left its statements behind
+            if os.path.exists(path):
+                _retire(directory, [path])
+            _shared_pid = os.getpid()
+        # Under the lock, so a reset never misses what is written here
+        _catch_up(directory)
+        _write_snapshot(path, stats.entries())
+
+
+def shared_top(limit: int = 20, directory: str = SHARED_DIR) -> list:
+    """The statements with the highest total time across every worker, exited ones included"""
+    os.makedirs(directory, exist_ok=True)
+    snapshots = []
+    with open(os.path.join(directory, ".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        _catch_up(directory)
+        exited = []
+        for entry in os.listdir(directory):
+            worker, extension = os.path.splitext(entry)
+            if extension != ".json" or not worker.isdigit() or int(worker) == os.getpid():
+                continue
+            path = os.path.join(directory, entry)
+            if not _alive(int(worker)):
+                exited.append(path)
+                continue
+            snapshot = _read_snapshot(path)
+            if snapshot is not None:
+                snapshots.append(snapshot)
+        if exited:
+            _retire(directory, exited)
+        snapshots.append(_read_snapshot(os.path.join(directory, "exited.json")) or [])
+    return stats.top(limit, snapshots)
+
+
+def reset_shared(directory: str = SHARED_DIR):
+    """Clear every worker's slow statements; each one drops its own the next time it shares"""
+    global _seen_reset
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, ".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        generation = (_read_snapshot(os.path.join(directory, "reset.json")) or 0) + 1
+        for entry in os.listdir(directory):
+            worker, extension = os.path.splitext(entry)
+            if extension == ".json" and (worker.isdigit() or worker == "exited"):
+                os.remove(os.path.join(directory, entry))
+        _write_snapshot(os.path.join(directory, "reset.json"), generation)
+        _seen_reset = generation
+        stats.clear()
+
+
+async def share_periodically(directory: str = SHARED_DIR, interval: float = METRICS_SHARE_SECONDS):
+    """Share this worker's slow statements every interval seconds"""
+    while True:
+        share(directory)
+        await asyncio.sleep(interval)
+
+
+def _configure_logger():
+    """Write one JSON object per line to a size-rotated file"""
+    if logger.handlers:
+        return
+    directory = os.path.dirname(SLOW_QUERY_LOG)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    handler = RotatingFileHandler(
+        SLOW_QUERY_LOG,
+        maxBytes=SLOW_QUERY_LOG_MAX_BYTES,
+        backupCount=SLOW_QUERY_LOG_BACKUPS
+    )
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+
+def install(engine, threshold_ms: float = SLOW_QUERY_MS):
+    """Start logging statements slower than threshold_ms on an engine"""
+    if threshold_ms < 0:
+        return
+    _configure_logger()
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info["slowlog_query_start"] = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        duration_ms = (time.perf_counter() - conn.info.pop("slowlog_query_start")) * 1000
+        if duration_ms < threshold_ms:
+            return
+
+        request = current_request()
+        route = request.route if request else "background"
+        sql = normalize_sql(statement)
+        plan = [] if executemany else explain(conn, statement, parameters)
+
+        stats.record(sql, duration_ms, route, plan)
+        logger.info(json.dumps({
+            "timestamp": datetime.utcnow().isoformat(),
+            "duration_ms": round(duration_ms, 2),
+            "route": route,
+            "method": request.method if request else None,
+            "request_id": request.request_id if request else None,
+            "sql": sql,
+            "parameters": parameters_shape(parameters, executemany),
+            "plan": plan,
+        }))
@@ -57,3 +57,94 @@ function copyClubCode(code) {
         showNotification('Failed to copy code', 'error');
     });
 }
+
+// Listen for live updates on a page and offer a refresh when something changes
+function subscribeToUpdates(url) {
+    if (!window.EventSource) {
+        return;
+    }
+    
+    const source = new EventSource(url);
+    let banner = null;
+    
+    const showRefreshBanner = (message) => {
+        if (!banner) {
+            banner = document.createElement('button');
+            banner.type = 'button';
+            banner.className = 'fixed bottom-4 right-4 px-6 py-3 rounded-lg shadow-lg z-50 bg-indigo-600 hover:bg-indigo-700 text-white';
+            banner.addEventListener('click', () => window.location.reload());
+            document.body.appendChild(banner);
+        }
+        banner.innerHTML = `<i class="fas fa-sync-alt mr-2"></i>${message} Click to refresh.`;
+    };
+    
+    source.addEventListener('post', () => showRefreshBanner('New posts are available.'));
+    source.addEventListener('rating', (event) => {
+        const removed = JSON.parse(event.data).rating === null;
+        showRefreshBanner(removed ? 'A review was removed.' : 'New reviews are available.');
+    });
+    source.addEventListener('comment', () => showRefreshBanner('New comments are available.'));
+    source.addEventListener('like', () => showRefreshBanner('Likes have changed.'));
+    source.addEventListener('evicted', () => {
+        // The server dropped us for falling behind; reconnect from scratch
+        source.close();
+        setTimeout(() => subscribeToUpdates(url), 5000);
+    });
+    
+    window.addEventListener('beforeunload', () => source.close());
+}
+
+// Follow live veto and upvote tallies and book selections for a club
+function subscribeToClub(code) {
+    if (!window.WebSocket) {
+        return;
+    }
+    
+    const scheme = window.location.protocol === 'https:' ? 'wss' : 'ws';
+    const socket = new WebSocket(`${scheme}://${window.location.host}/clubs/${code}/ws`);
+    
+    const setVetoCount = (bookId, count) => {
+        const counter = document.getElementById(`veto-count-${bookId}`);
+        if (counter) {
+            counter.textContent = count > 0 ? `(${count})` : '';
+        }
+    };
+    
+    const setUpvoteCount = (bookId, count, needed) => {
+        const counter = document.getElementById(`upvote-count-${bookId}`);
+        if (counter) {
+            counter.textContent = `${count}/${needed}`;
+        }
+    };
+    
+    socket.addEventListener('message', (e) => {
+        const { event, data } = JSON.parse(e.data);
+        
+        if (event === 'snapshot') {
+            Object.entries(data.veto_counts).forEach(([bookId, count]) => setVetoCount(bookId, count));
+            Object.entries(data.upvote_counts).forEach(([bookId, count]) => setUpvoteCount(bookId, count, data.upvotes_needed));
+        } else if (event === 'veto') {
+            setVetoCount(data.book_id, data.veto_count);
+        } else if (event === 'upvote') {
+            setUpvoteCount(data.book_id, data.upvotes, data.needed);
+        } else if (event === 'vetoed') {
+            const card = document.getElementById(`suggestion-${data.book_id}`);
+            if (card) {
+                card.classList.add('opacity-50', 'line-through');
+            }
+            showNotification(`"${data.title}" has been vetoed`, 'error');
+        } else if (event === 'selected') {
+            showNotification(`Next up: "${data.title}" by ${data.author}`, 'success');
+            setTimeout(() => window.location.reload(), 3000);
+        }
+    });
+    
+    socket.addEventListener('close', () => {
+        // Reconnect after a pause unless the page is going away
+        setTimeout(() => {
+            if (document.visibilityState !== 'hidden') {
+                subscribeToClub(code);
+            }
+        }, 5000);
+    });
+}
@@ -0,0 +1,69 @@
+from fastapi.templating import Jinja2Templates
+from starlette.responses import StreamingResponse
+
+from . import tracing
+from .assets import asset_url
+
+# Rendered output is sent once this much has built up
+STREAM_FLUSH_BYTES = 16 * 1024
+
+
+class Templates(Jinja2Templates):
+    """Jinja2 templates shared by every router, with render timing in traces"""
+
+    def TemplateResponse(self, *args, **kwargs):
+        # Accept both (name, context) and (request, name, context) call styles
+        name = kwargs.get("name")
+        if name is None:
+            name = args[0] if isinstance(args[0], str) else args[1]
+
+        with tracing.span("render", template=name):
+            return super().TemplateResponse(*args, **kwargs)
+
+    def TemplateStream(self, request, name: str, context: dict, status_code: int = 200, headers: dict = None,
+                       background=None):
+        """Render a template while sending it, so the head leaves before the body is built
+
+        Rendering runs in the threadpool as the client reads, after the endpoint
+        has returned, so anything the template loads needs a session that stays
+        open until the response finishes (close it from ``background``). Errors
+        after the first flush can only abort the connection.
+        """
+        context.setdefault("request", request)
+        for processor in self.context_processors:
+            context.update(processor(request))
+        template = self.get_template(name)
+        return StreamingResponse(
+            self._generate(template, context),
+            status_code=status_code,
+            headers=headers,
+            media_type="text/html",
+            background=background
+        )
+
+    def _generate(self, template, context):
+        span = tracing.start_span("render", template=template.name, streaming=True)
+        buffer, size, head_sent = [], 0, False
+        try:
+            for chunk in template.generate(context):
+                buffer.append(chunk)
+                size += len(chunk)
+                # Flush the head right away so the browser can start on CSS and JS
+                if size >= STREAM_FLUSH_BYTES or (not head_sent and "</head>" in chunk):
+                    head_sent = True
+                    yield "".join(buffer).encode("utf-8")
+                    buffer, size = [], 0
+            if buffer:
+                yield "".join(buffer).encode("utf-8")
+        except BaseException as exc:
+            if span is not None:
+                span.error = repr(exc)
+            raise
+        finally:
+            if span is not None:
+                span.end()
+
+
+# One environment for the whole app, so compiled templates are cached once
+templates = Templates(directory="app/templates")
+templates.env.globals["asset_url"] = asset_url
@@ -0,0 +1,321 @@
+"""Request tracing: request IDs, sampled span trees and span exporters."""
+import json
+import logging
+import os
+import queue
+import random
+import secrets
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+from .context import current_request
+
+# Fraction of requests that record spans (request IDs are always assigned)
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+# "file" writes JSON lines to TRACE_FILE, "otlp" posts to TRACE_OTLP_ENDPOINT
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "file")
+TRACE_FILE = os.getenv("TRACE_FILE", "./data/traces.jsonl")
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+
+SERVICE_NAME = "bookclub"
+
+logger = logging.getLogger("bookclub.tracing")
+
+
+class Span:
+    """A timed operation within a trace"""
+    __slots__ = ("trace", "span_id", "parent_id", "name", "attributes", "start_ns", "end_ns", "error")
+
+    def __init__(self, trace, name: str, parent_id: str = None, attributes: dict = None):
+        self.trace = trace
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes or {}
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = None
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def end(self):
+        self.end_ns = time.time_ns()
+        self.trace.spans.append(self)
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "request_id": self.trace.request_id,
+            "name": self.name,
+            "start_ns": self.start_ns,
+            "duration_ms": round((self.end_ns - self.start_ns) / 1e6, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class Trace:
+    """All spans recorded for one sampled request"""
+    __slots__ = ("trace_id", "request_id", "spans")
+
+    def __init__(self, trace_id: str, request_id: str):
+        self.trace_id = trace_id
+        self.request_id = request_id
+        self.spans = []
+
+
+_current_span: ContextVar = ContextVar("current_span", default=None)
+
+
+def current_span() -> Span:
+    return _current_span.get()
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Record a child span of the current span; a no-op when not sampled"""
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+
+    child = Span(parent.trace, name, parent.span_id, attributes)
+    token = _current_span.set(child)
+    try:
+        yield child
+    except BaseException as exc:
+        child.error = repr(exc)
+        raise
+    finally:
+        _current_span.reset(token)
+        child.end()
+
+
+def start_span(name: str, **attributes):
+    """Start a child span without making it current, for work that outlives the caller's frame; call end()"""
+    parent = _current_span.get()
+    if parent is None:
+        return None
+    return Span(parent.trace, name, parent.span_id, attributes)
+
+
+class FileExporter:
+    """Append finished spans to a JSON-lines file"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def export(self, trace: Trace):
+        lines = "".join(json.dumps(span.to_dict()) + "\n" for span in trace.spans)
+        with self._lock, open(self.path, "a") as handle:
+            handle.write(lines)
+
+
+class OtlpExporter:
+    """Post finished traces to an OTLP/HTTP JSON collector from a background thread"""
+
+    def __init__(self, endpoint: str, max_pending: int = 1000):
+        self.endpoint = endpoint
+        self._queue = queue.Queue(max_pending)
+        self._thread = threading.Thread(target=self._run, name="otlp-exporter", daemon=True)
+        self._thread.start()
+
+    def export(self, trace: Trace):
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            # Drop rather than slow requests down when the collector lags
+            pass
+
+    def _run(self):
+        while True:
+            trace = self._queue.get()
+            body = json.dumps(self._payload(trace)).encode()
+            request = urllib.request.Request(
+                self.endpoint, data=body, headers={"Content-Type": "application/json"}
+            )
+            try:
+                urllib.request.urlopen(request, timeout=5).close()
+            except Exception as exc:
+                logger.warning("Trace export to %s failed: %s", self.endpoint, exc)
+
+    @staticmethod
+    def _payload(trace: Trace) -> dict:
+        def attribute(key, value):
+            if isinstance(value, bool):
+                typed = {"boolValue": value}
+            elif isinstance(value, int):
+                typed = {"intValue": str(value)}
+            elif isinstance(value, float):
+                typed = {"doubleValue": value}
+            else:
+                typed = {"stringValue": str(value)}
+            return {"key": key, "value": typed}
+
+        spans = []
+        for span in trace.spans:
+            attributes = dict(span.attributes, request_id=trace.request_id)
+            spans.append({
+                "traceId": trace.trace_id,
+                "spanId": span.span_id,
+                "parentSpanId": span.parent_id or "",
+                "name": span.name,
+                "startTimeUnixNano": str(span.start_ns),
+                "endTimeUnixNano": str(span.end_ns),
+                "attributes": [attribute(key, value) for key, value in attributes.items()],
+                "status": {"code": 2, "message": span.error} if span.error else {"code": 1},
+            })
+        return {"resourceSpans": [{
+            "resource": {"attributes": [attribute("service.name", SERVICE_NAME)]},
+            "scopeSpans": [{"scope": {"name": "bookclub.tracing"}, "spans": spans}],
+        }]}
+
+
+_exporter = None
+
+
+def get_exporter():
+    global _exporter
+    if _exporter is None:
+        if TRACE_EXPORTER == "otlp":
+            _exporter = OtlpExporter(TRACE_OTLP_ENDPOINT)
+        else:
+            _exporter = FileExporter(TRACE_FILE)
+    return _exporter
+
+
+def _parse_traceparent(header: str):
+    """Return (trace_id, parent_span_id, sampled) from a W3C traceparent header"""
+    parts = header.split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    return parts[1], parts[2], parts[3] == "01"
+
+
+class TracingMiddleware:
+    """ASGI middleware assigning request IDs and recording a root span per sampled request"""
+
+    def __init__(self, app, sample_rate: float = TRACE_SAMPLE_RATE):
+        self.app = app
+        self.sample_rate = sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope["headers"])
+        request_id = headers.get(b"x-request-id", b"").decode("latin-1")[:64] or secrets.token_hex(8)
+        request = current_request()
+        if request is not None:
+            request.request_id = request_id
+
+        # Honour an upstream sampling decision, otherwise roll the dice
+        trace_id, parent_id, sampled = secrets.token_hex(16), None, random.random() < self.sample_rate
+        traceparent = _parse_traceparent(headers.get(b"traceparent", b"").decode("latin-1"))
+        if traceparent:
+            trace_id, parent_id, sampled = traceparent
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [(b"x-request-id", request_id.encode())]
+                if root is not None:
+                    root.set_attribute("http.status_code", message["status"])
+            await send(message)
+
+        if not sampled:
+            root = None
+            await self.app(scope, receive, send_wrapper)
+            return
+
+        trace = Trace(trace_id, request_id)
+        root = Span(trace, "request", parent_id, {
+            "http.method": scope["method"],
+            "http.target": scope["path"],
+        })
+        token = _current_span.set(root)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except BaseException as exc:
+            root.error = repr(exc)
+            raise
+        finally:
+            _current_span.reset(token)
+            route = scope.get("route")
+            if route is not None:
+                root.set_attribute("http.route", route.path)
+                root.name = f"{scope['method']} {route.path}"
+            root.end()
+            get_exporter().export(trace)
+
+
+def instrument_engine(engine, session_factory):
+    """Record a span for each SQL statement and for pool checkout"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        parent = _current_span.get()
+        conn.info["tracing_span"] = parent and Span(parent.trace, "db.query", parent.span_id, {
+            "db.system": conn.dialect.name,
+            "db.statement": statement[:2000],
+        })
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        query_span = conn.info.pop("tracing_span", None)
+        if query_span is not None:
+            query_span.set_attribute("db.rowcount", cursor.rowcount)
+            query_span.end()
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(exception_context):
+        if exception_context.connection is None:
+            return
+        query_span = exception_context.connection.info.pop("tracing_span", None)
+        if query_span is not None:
+            query_span.error = repr(exception_context.original_exception)
+            query_span.end()
+
+    @event.listens_for(session_factory, "after_transaction_create")
+    def after_transaction_create(session, transaction):
+        parent = _current_span.get()
+        if transaction.parent is None and parent is not None:
+            session.info["tracing_checkout"] = Span(parent.trace, "db.checkout", parent.span_id)
+
+    @event.listens_for(session_factory, "after_begin")
+    def after_begin(session, transaction, connection):
+        checkout = session.info.pop("tracing_checkout", None)
+        if checkout is not None:
+            checkout.end()
+
+
+class RequestIdFilter(logging.Filter):
+    """Add the current request ID to every log record"""
+
+    def filter(self, record):
+        request = current_request()
+        record.request_id = getattr(request, "request_id", None) or "-"
+        return True
+
+
+def configure_logging(level: int = logging.INFO):
+    """Log with the request ID in every line"""
+    logging.basicConfig(
+        level=level,
+        format="%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s"
+    )
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(RequestIdFilter())
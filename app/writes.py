@@ -0,0 +1,168 @@
+"""Group commit: one writer thread per worker that commits many writes at once.
+
+With ``WRITE_QUEUE=on`` a handler passes its changes to ``write(db, fn)``
+as a function of a session instead of committing them itself. A writer
+thread takes every write waiting in the queue (up to
+``WRITE_QUEUE_MAX_BATCH``), runs them one after another in a single
+transaction and commits once. On SQLite that turns a burst of small writes
+into one fsync and one turn of the write lock, instead of each request
+queueing for the lock. Callers wait on a future that resolves only after
+the commit holding their write, so nothing is acknowledged before it is
+durable.
+
+If any write in a batch raises, the batch is rolled back and its writes
+are run again one transaction each, so only the failing write fails.
+
+Writes run on the writer's session in another thread. They must take
+plain values (ids, form fields) rather than rows loaded by the request's
+session, and return plain values. With the queue off (the default) the
+same function runs on the request's session and is committed there.
+"""
+import asyncio
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from sqlalchemy import inspect
+
+from .database import SessionLocal
+from .metrics import registry
+
+logger = logging.getLogger("bookclub.writes")
+
+WRITE_QUEUE = os.getenv("WRITE_QUEUE", "off").lower() in ("1", "on", "true", "yes")
+WRITE_QUEUE_MAX_BATCH = int(os.getenv("WRITE_QUEUE_MAX_BATCH", "64"))
+# How long the writer waits for more writes after the first; 0 batches only what is already queued
+WRITE_QUEUE_LINGER_MS = float(os.getenv("WRITE_QUEUE_LINGER_MS", "0"))
+
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+batch_sizes = registry.histogram(
+    "bookclub_write_queue_batch_size", "Writes committed together by the write queue",
+    buckets=BATCH_SIZE_BUCKETS
+)
+write_wait = registry.histogram(
+    "bookclub_write_queue_wait_seconds", "Time from queueing a write to the commit that included it"
+)
+batch_failures = registry.counter(
+    "bookclub_write_queue_batch_failures_total", "Batches rolled back and retried one write at a time"
+)
+
+
+class WriteQueue:
+    """Runs submitted writes on a single thread, committing each batch once"""
+
+    def __init__(self, session_factory=SessionLocal, max_batch: int = WRITE_QUEUE_MAX_BATCH,
+                 linger: float = WRITE_QUEUE_LINGER_MS / 1000):
+        self.session_factory = session_factory
+        self.max_batch = max_batch
+        self.linger = linger
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def submit(self, fn) -> Future:
+        """Queue fn(session); the future holds its result once the batch is committed"""
+        self._ensure_started()
+        future = Future()
+        self._queue.put((fn, future, time.perf_counter()))
+        return future
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def _ensure_started(self):
+        # Threads do not survive fork, so each worker starts its own writer
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, name="write-queue", daemon=True).start()
+
+    def _take(self) -> list:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.linger
+        while len(batch) < self.max_batch:
+            try:
+                remaining = deadline - time.monotonic()
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._take()
+            try:
+                self._commit(batch)
+            except Exception:
+                logger.exception("Write queue batch failed")
+
+    def _commit(self, batch: list):
+        db = self.session_factory()
+        try:
+            results = [fn(db) for fn, _, _ in batch]
+            db.commit()
+        except Exception as exc:
+            db.rollback()
+            db.close()
+            if len(batch) == 1:
+                batch[0][1].set_exception(exc)
+                return
+            # Find the write that failed by running each on its own
+            batch_failures.inc()
+            for item in batch:
+                self._commit([item])
+            return
+        db.close()
+
+        batch_sizes.observe(len(batch))
+        committed = time.perf_counter()
+        for (_, future, queued), result in zip(batch, results):
+            write_wait.observe(committed - queued)
+            future.set_result(result)
+
+
+writer = WriteQueue()
+
+registry.gauge(
+    "bookclub_write_queue_depth", "Writes waiting for the write queue's next batch",
+    callback=writer.depth
+)
+
+
+def add(instance):
+    """A write that inserts a new row with the instance's column values and returns its id
+
+    Each run inserts a fresh copy, so a write retried after its batch was
+    rolled back does not reinsert a row holding the id that batch flushed.
+    """
+    model = type(instance)
+    values = {
+        attribute.key: getattr(instance, attribute.key)
+        for attribute in inspect(model).column_attrs
+        if attribute.key in instance.__dict__
+    }
+
+    def write(db):
+        row = model(**values)
+        db.add(row)
+        db.flush()
+        return row.id
+    return write
+
+
+async def write(db, fn):
+    """Run fn(session) and commit it, through the write queue when it is on; returns fn's result"""
+    if not WRITE_QUEUE:
+        result = fn(db)
+        db.commit()
+        return result
+    # End the request's own transaction so it holds no connection (or SQLite lock) while it waits
+    db.commit()
+    return await asyncio.wrap_future(writer.submit(fn))
@@ -0,0 +1,6 @@
+"""Benchmark suite: synthetic dataset generation and load drivers.
+
+    python -m benchmarks.seed --profile medium --database-url sqlite:///./data/bench.db
+    python -m benchmarks.load --database-url sqlite:///./data/bench.db --output results.json
+    python -m benchmarks.compare baseline.json results.json
+"""
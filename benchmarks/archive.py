@@ -0,0 +1,352 @@
+"""Archiving finished books' threads on a seeded database.
+
+Seeds a database, then:
+
+- times thread and review pages of completed books while their rows are live;
+- archives every completed book, reporting the time, the rows that left the
+  live tables and the bytes before and after compression;
+- times the same pages again, now served from the archives;
+- restores every book and checks the club export matches the one taken
+  before archiving, row for row;
+- races threads liking posts of one book (each like restoring the book if
+  it is archived) against a loop archiving that book again and again, and
+  checks no like was lost or counted twice;
+- has a new member post, comment and like in a finished book's thread,
+  archives the book, lets the member leave and restores it, checking that
+  no restored row names a member who is gone;
+- posts and comments in a finished book's thread, archives the book, posts
+  and comments in a thread still being read and restores the book, checking
+  the new rows did not take the archived rows' ids.
+
+    python -m benchmarks.archive
+    python -m benchmarks.archive --profile small --database-url postgresql://localhost/bookclub_test
+
+``--database-url`` runs against another (empty, disposable) database
+instead of a temporary SQLite file; every table in it is dropped first.
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import create_engine, func, select
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+def club_rows(export, club_id: int) -> dict:
+    """{table: sorted rows} of the club's export, leaving out the archive itself"""
+    tables = {}
+    for chunk in export.export_jsonl(club_id, "BENCH"):
+        for line in chunk.splitlines():
+            record = json.loads(line)
+            if record["table"] in ("export", "book_archives"):
+                continue
+            record["row"].pop("archived_at", None)
+            tables.setdefault(record["table"], []).append(json.dumps(record["row"], sort_keys=True))
+    return {table: sorted(rows) for table, rows in tables.items()}
+
+
+def time_pages(client, paths: list, cookie: str) -> float:
+    """Milliseconds per page, rendering each path once"""
+    async def run():
+        for path in paths:
+            status = await client.request("GET", path, None, cookie)
+            if status != 200:
+                raise RuntimeError(f"{path}: HTTP {status}")
+
+    started = time.perf_counter()
+    asyncio.run(run())
+    return (time.perf_counter() - started) * 1000 / len(paths)
+
+
+def race(SessionLocal, archive, models, book_id: int, post_id: int, member_ids: list, toggles: int) -> int:
+    """Members like and unlike a post while the book is archived over and over; returns the likes left"""
+    from app.database import toggle
+
+    stop = threading.Event()
+    errors = []
+
+    def liker(member_id: int):
+        try:
+            for _ in range(toggles):
+                with SessionLocal() as db:
+                    book = db.get(models.Book, book_id)
+                    write = archive.live(book, lambda session: toggle(
+                        session, models.DiscussionPostLike, post_id=post_id, member_id=member_id
+                    ))
+                    write(db)
+                    db.commit()
+        except Exception as exc:
+            errors.append(exc)
+
+    def archiver():
+        while not stop.is_set():
+            with SessionLocal() as db:
+                archive.archive_book(db, book_id, after_days=0)
+            time.sleep(0.005)
+
+    threads = [threading.Thread(target=liker, args=(member_id,)) for member_id in member_ids]
+    background = threading.Thread(target=archiver)
+    background.start()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stop.set()
+    background.join()
+    if errors:
+        raise errors[0]
+
+    with SessionLocal() as db:
+        archive.restore(db, book_id)
+        db.commit()
+        return db.scalar(select(func.count(models.DiscussionPostLike.id)).where(
+            models.DiscussionPostLike.post_id == post_id, models.DiscussionPostLike.member_id.in_(member_ids)
+        ))
+
+
+def leave_and_restore(SessionLocal, archive, models, book_id: int, discussion_id: int, other_id: int) -> list:
+    """Restore a book after a member who wrote in its thread left; the (table, id) pairs naming a row that is gone"""
+    with SessionLocal() as db:
+        club_id = db.get(models.Book, book_id).club_id
+        member = models.Member(club_id=club_id, display_name="Leaving Soon", session_id="leaving-soon")
+        db.add(member)
+        db.flush()
+        post = models.DiscussionPost(discussion_id=discussion_id, author_id=member.id, content="Goodbye, all")
+        db.add(post)
+        db.flush()
+        comment = models.DiscussionComment(post_id=post.id, author_id=member.id, content="One more thing")
+        db.add(comment)
+        db.flush()
+        # Another member's reply and like hang off the leaving member's rows
+        db.add(models.DiscussionComment(
+            post_id=post.id, parent_comment_id=comment.id, author_id=other_id, content="Take care"
+        ))
+        db.add(models.DiscussionPostLike(post_id=post.id, member_id=other_id))
+        db.commit()
+        member_id = member.id
+        if archive.archive_book(db, book_id, after_days=0) is None:
+            raise RuntimeError(f"book {book_id} was not archived")
+
+    with SessionLocal() as db:
+        db.delete(db.get(models.Member, member_id))
+        db.commit()
+        archive.restore(db, book_id)
+        db.commit()
+
+        members = set(db.scalars(select(models.Member.id)))
+        dangling = []
+        for model, column in (
+            (models.DiscussionPost, "author_id"), (models.DiscussionComment, "author_id"),
+            (models.DiscussionPostLike, "member_id"), (models.DiscussionCommentLike, "member_id"),
+            (models.ReviewLike, "member_id"), (models.ReviewComment, "member_id"),
+            (models.ReviewCommentLike, "member_id"),
+        ):
+            dangling.extend(
+                (model.__tablename__, value) for value in db.scalars(select(getattr(model, column)).distinct())
+                if value not in members
+            )
+        # The other member's reply went with the comment it answered
+        comments = set(db.scalars(select(models.DiscussionComment.id)))
+        dangling.extend(
+            ("discussion_comments", parent_id)
+            for parent_id in db.scalars(select(models.DiscussionComment.parent_comment_id).distinct())
+            if parent_id is not None and parent_id not in comments
+        )
+        return dangling
+
+
+def post_and_restore(SessionLocal, archive, models, book_id: int, discussion_id: int, live_id: int,
+                     member_id: int) -> list:
+    """Restore a book after rows were added elsewhere while it was archived; the problems found"""
+    with SessionLocal() as db:
+        # The archived rows hold the highest ids, which SQLite would otherwise hand out again
+        post = models.DiscussionPost(discussion_id=discussion_id, author_id=member_id, content="Last word")
+        db.add(post)
+        db.flush()
+        db.add(models.DiscussionComment(post_id=post.id, author_id=member_id, content="And another"))
+        db.commit()
+        archived_id = post.id
+        if archive.archive_book(db, book_id, after_days=0) is None:
+            raise RuntimeError(f"book {book_id} was not archived")
+
+    with SessionLocal() as db:
+        post = models.DiscussionPost(discussion_id=live_id, author_id=member_id, content="Meanwhile")
+        db.add(post)
+        db.flush()
+        db.add(models.DiscussionComment(post_id=post.id, author_id=member_id, content="Still reading"))
+        db.commit()
+        live_post = post.id
+
+    problems = []
+    with SessionLocal() as db:
+        try:
+            archive.restore(db, book_id)
+            db.commit()
+        except Exception as exc:
+            db.rollback()
+            return [f"restore failed: {type(exc).__name__}"]
+        for post_id, discussion in ((archived_id, discussion_id), (live_post, live_id)):
+            post = db.get(models.DiscussionPost, post_id)
+            if post is None or post.discussion_id != discussion:
+                problems.append(f"post {post_id} is not in discussion {discussion}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", help="disposable database to use instead of a temporary SQLite file")
+    parser.add_argument("--profile", default="medium", help="benchmarks.seed profile to generate")
+    parser.add_argument("--pages", type=int, default=40, help="thread and review pages timed each way")
+    parser.add_argument("--likers", type=int, default=8, help="threads liking posts during the race")
+    parser.add_argument("--toggles", type=int, default=25, help="likes or unlikes each racing thread makes")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="bookclub-archive-")
+    database_url = args.database_url or f"sqlite:///{directory}/archive.db"
+    os.environ["DATABASE_URL"] = database_url
+    os.environ["JOBS_ENABLED"] = "off"
+    os.environ["SLOW_QUERY_MS"] = "-1"
+    os.chdir(ROOT)
+
+    from benchmarks.seed import PROFILES, seed
+    from benchmarks.load import InProcessClient, member_token
+    from app import models
+    from app.database import Base
+
+    if args.database_url:
+        engine = create_engine(database_url)
+        Base.metadata.drop_all(engine)
+        engine.dispose()
+    started = time.perf_counter()
+    seed(database_url, PROFILES[args.profile], args.seed)
+    print(f"seeded the {args.profile} profile in {time.perf_counter() - started:.1f}s")
+
+    from app.main import app
+    from app import archive, export
+    from app.database import SessionLocal, engine
+
+    def live_rows() -> dict:
+        with SessionLocal() as db:
+            return {
+                model.__tablename__: db.scalar(select(func.count(model.id)))
+                for model, _, _ in archive.ARCHIVED_TABLES
+            }
+
+    failed = False
+    try:
+        with SessionLocal() as db:
+            club = db.query(models.Club).order_by(models.Club.id).first()
+            club_id = club.id
+            cookie = member_token(next(member for member in club.members if member.is_admin))
+            completed = db.query(models.Book).filter(
+                models.Book.club_id == club_id, models.Book.status == "completed"
+            ).order_by(models.Book.id).all()
+            paths = []
+            for book in completed:
+                paths.append(f"/ratings/book/{book.id}")
+                paths.extend(f"/discussions/{discussion.id}" for discussion in book.discussions)
+            paths = paths[:args.pages]
+            race_book = completed[0]
+            race_post = db.scalar(
+                select(models.DiscussionPost.id).join(models.Discussion)
+                .where(models.Discussion.book_id == race_book.id).order_by(models.DiscussionPost.id)
+            )
+            race_members = [member.id for member in club.members][-args.likers:]
+            race_book_id = race_book.id
+            race_discussion = race_book.discussions[0].id
+            live_discussion = db.scalar(
+                select(models.Discussion.id).join(models.Book)
+                .where(models.Book.club_id == club_id, models.Book.status != "completed")
+                .order_by(models.Discussion.id)
+            )
+        before = club_rows(export, club_id)
+        rows_before = live_rows()
+
+        client = InProcessClient(app)
+        time_pages(client, paths, cookie)
+        live_ms = time_pages(client, paths, cookie)
+
+        started = time.perf_counter()
+        with SessionLocal() as db:
+            stats = archive.archive_due_books(db, datetime.utcnow(), after_days=0)
+        archive_seconds = time.perf_counter() - started
+        rows_after = live_rows()
+
+        time_pages(client, paths, cookie)
+        archived_ms = time_pages(client, paths, cookie)
+
+        print(f"archived {stats['books']} books in {archive_seconds:.2f}s: {stats['rows']} rows, "
+              f"{stats['bytes'] // 1024} KiB of JSON stored as {stats['stored'] // 1024} KiB")
+        print(f"{'table':26} {'live before':>12} {'live after':>11}")
+        for table, count in rows_before.items():
+            print(f"{table:26} {count:>12} {rows_after[table]:>11}")
+        print(f"{'pages':26} {'live ms':>12} {'archived ms':>11}")
+        print(f"{f'{len(paths)} thread and review':26} {live_ms:>12.1f} {archived_ms:>11.1f}")
+
+        if any(rows_after.values()):
+            # The club's current book keeps its rows
+            reading = sum(rows_after.values())
+            print(f"    {reading} rows left live for books still being read")
+
+        started = time.perf_counter()
+        with SessionLocal() as db:
+            book_ids = db.scalars(select(models.Book.id).where(models.Book.archived_at.isnot(None))).all()
+            for book_id in book_ids:
+                archive.restore(db, book_id)
+                db.commit()
+        print(f"restored {len(book_ids)} books in {time.perf_counter() - started:.2f}s")
+        if live_rows() != rows_before:
+            print("    the live tables do not hold the same rows after restoring")
+            failed = True
+        if club_rows(export, club_id) != before:
+            print("    the club export differs after archiving and restoring")
+            failed = True
+
+        with SessionLocal() as db:
+            liked_before = db.scalar(select(func.count(models.DiscussionPostLike.id)).where(
+                models.DiscussionPostLike.post_id == race_post,
+                models.DiscussionPostLike.member_id.in_(race_members)
+            ))
+        started = time.perf_counter()
+        likes = race(SessionLocal, archive, models, race_book_id, race_post, race_members, args.toggles)
+        expected = liked_before if args.toggles % 2 == 0 else len(race_members) - liked_before
+        print(f"race: {len(race_members)} threads x {args.toggles} likes against the archiver "
+              f"in {time.perf_counter() - started:.2f}s, {likes} likes left (expected {expected})")
+        if likes != expected:
+            failed = True
+
+        dangling = leave_and_restore(SessionLocal, archive, models, race_book_id, race_discussion, race_members[0])
+        print(f"leave and restore: {len(dangling)} restored rows name a member or comment that is gone")
+        if dangling:
+            failed = True
+
+        if live_discussion is not None:
+            problems = post_and_restore(
+                SessionLocal, archive, models, race_book_id, race_discussion, live_discussion, race_members[0]
+            )
+            print(f"post and restore: {len(problems)} problems")
+            for problem in problems:
+                print(f"    {problem}")
+            if problems:
+                failed = True
+    finally:
+        engine.dispose()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""Compare two load results and flag regressions.
+
+    python -m benchmarks.compare baseline.json results.json --threshold 10
+
+Exits non-zero when any endpoint's p95 latency grew by more than the
+threshold percentage, or it started issuing more SQL statements per request.
+"""
+import argparse
+import json
+import sys
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> list:
+    """Return (endpoint, metric, before, after, regressed) rows"""
+    rows = []
+    for endpoint, now in current["endpoints"].items():
+        before = baseline["endpoints"].get(endpoint)
+        if before is None:
+            continue
+        for metric in ("p50_ms", "p95_ms", "p99_ms"):
+            regressed = metric == "p95_ms" and now[metric] > before[metric] * (1 + threshold / 100)
+            rows.append((endpoint, metric, before[metric], now[metric], regressed))
+        if before["queries_per_request"] is not None and now["queries_per_request"] is not None:
+            regressed = now["queries_per_request"] > before["queries_per_request"] + 0.5
+            rows.append((endpoint, "queries", before["queries_per_request"], now["queries_per_request"], regressed))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--threshold", type=float, default=10.0, help="allowed p95 growth in percent")
+    args = parser.parse_args()
+
+    with open(args.baseline) as handle:
+        baseline = json.load(handle)
+    with open(args.current) as handle:
+        current = json.load(handle)
+
+    print(f"baseline {baseline['version']} ({baseline['git_revision']}): {baseline['throughput_rps']} req/s")
+    print(f"current  {current['version']} ({current['git_revision']}): {current['throughput_rps']} req/s")
+    print()
+
+    regressions = 0
+    for endpoint, metric, before, after, regressed in compare(baseline, current, args.threshold):
+        change = f"{(after - before) / before * 100:+.1f}%" if before else "n/a"
+        flag = "  REGRESSION" if regressed else ""
+        print(f"{endpoint:44} {metric:8} {before:>10} -> {after:<10} {change:>8}{flag}")
+        regressions += regressed
+
+    if regressions:
+        print(f"\n{regressions} regression(s) found")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
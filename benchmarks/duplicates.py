@@ -0,0 +1,217 @@
+"""Duplicate suggestion lookups on a large backlog.
+
+Seeds one club with thousands of open suggestions (half with an ISBN, and
+titles and authors drawn from a few thousand made-up words), then
+looks up suggestions that are variants of ones already there (other case,
+a subtitle, a leading article, "Last, First" authors, a typo, the ISBN-10
+of the same edition) and suggestions that are new, and times:
+
+- building the club's trigram index from scratch;
+- a lookup in the index, with and without the query for suggestions added
+  since it last looked;
+- against folding and comparing every open suggestion for each lookup.
+
+Every lookup must find the same books both ways.
+
+    python -m benchmarks.duplicates
+    python -m benchmarks.duplicates --suggestions 20000 --database-url postgresql://localhost/bookclub_test
+
+``--database-url`` runs against another (empty, disposable) database
+instead of a temporary SQLite file; every table in it is dropped first.
+"""
+import argparse
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+from sqlalchemy import bindparam, create_engine, select, update
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+SYLLABLES = (
+    "ka lo mi ra ne su ta vi do re an el or is un ber cal den fin gar hol mar nor pel ros tam ver wyn"
+).split()
+
+
+def word(rng: random.Random) -> str:
+    return "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 3)))
+
+
+def made_up_title(rng: random.Random, words: list) -> str:
+    """A title from a vocabulary about as varied as real ones"""
+    return " ".join(rng.choice(words) for _ in range(rng.randint(1, 5))).title()
+
+
+def isbn13(rng: random.Random) -> str:
+    digits = "978" + "".join(str(rng.randint(0, 9)) for _ in range(9))
+    return digits + str(-sum(int(char) * (3 if position % 2 else 1) for position, char in enumerate(digits)) % 10)
+
+
+def isbn10(isbn: str) -> str:
+    """The ISBN-10 of a 978 ISBN-13"""
+    digits = isbn[3:12]
+    check = -sum((10 - position) * int(char) for position, char in enumerate(digits)) % 11
+    return digits + ("X" if check == 10 else str(check))
+
+
+def typo(text: str, rng: random.Random) -> str:
+    """The text with one letter dropped or doubled"""
+    positions = [index for index, char in enumerate(text) if char.isalpha()]
+    index = rng.choice(positions)
+    return text[:index] + (text[index] * 2 if rng.random() < 0.5 else "") + text[index + 1:]
+
+
+def variant(title: str, author: str, isbn: str, rng: random.Random) -> tuple:
+    """Another way of suggesting the same book"""
+    kinds = ["case", "subtitle", "article", "last first", "typo"] + (["isbn-10"] if isbn else [])
+    kind = rng.choice(kinds)
+    if kind == "case":
+        return kind, title.upper(), author.lower(), None
+    if kind == "subtitle":
+        return kind, f"{title}: A Novel", author, None
+    if kind == "article":
+        return kind, f"The {title}", author, None
+    if kind == "last first":
+        given, _, last = author.rpartition(" ")
+        return kind, title, f"{last}, {given}", None
+    if kind == "typo":
+        return kind, typo(title, rng), author, None
+    return kind, "Some Other Title", "Someone Else", isbn10(isbn)
+
+
+def median_us(timings: list) -> float:
+    return statistics.median(timings) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", help="disposable database to use instead of a temporary SQLite file")
+    parser.add_argument("--suggestions", type=int, default=5000, help="open suggestions in the backlog")
+    parser.add_argument("--lookups", type=int, default=200, help="variants and new suggestions looked up, each")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="bookclub-duplicates-")
+    database_url = args.database_url or f"sqlite:///{directory}/duplicates.db"
+    os.environ["DATABASE_URL"] = database_url
+    os.environ["JOBS_ENABLED"] = "off"
+    os.environ["SLOW_QUERY_MS"] = "-1"
+    os.chdir(ROOT)
+
+    from benchmarks.seed import FIRST_NAMES, PROFILES, seed
+    from app import models
+    from app.database import Base
+
+    if args.database_url:
+        engine = create_engine(database_url)
+        Base.metadata.drop_all(engine)
+        engine.dispose()
+    seed(database_url, dict(PROFILES["small"], clubs=1, members=50, suggestions=args.suggestions), args.seed)
+
+    from app import duplicates
+    from app.database import SessionLocal, engine
+
+    rng = random.Random(args.seed)
+    failed = False
+    try:
+        with SessionLocal() as db:
+            club_id = db.scalar(select(models.Club.id).order_by(models.Club.id))
+            open_books = db.execute(
+                select(models.Book.id, models.Book.title, models.Book.author)
+                .where(models.Book.club_id == club_id, models.Book.status == "suggested",
+                       models.Book.vetoed == False)
+            ).all()
+
+            # Titles and authors from a realistic vocabulary, and half the suggestions with an ISBN
+            words = sorted({word(rng) for _ in range(3000)})
+            surnames = sorted({word(rng).title() for _ in range(1000)})
+
+            def made_up_author() -> str:
+                return f"{rng.choice(FIRST_NAMES)} {rng.choice(surnames)}"
+
+            books = {book.id: (made_up_title(rng, words), made_up_author()) for book in open_books}
+            isbns = {book.id: isbn13(rng) for book in open_books if rng.random() < 0.5}
+            db.execute(
+                update(models.Book.__table__).where(models.Book.__table__.c.id == bindparam("book_id")),
+                [{"book_id": book_id, "title": title, "author": author, "isbn": isbns.get(book_id)}
+                 for book_id, (title, author) in books.items()],
+            )
+            db.commit()
+
+            lookups = []
+            for book_id in rng.sample(sorted(books), min(args.lookups, len(books))):
+                kind, *query = variant(*books[book_id], isbns.get(book_id), rng)
+                lookups.append((kind, book_id, *query))
+            for _ in range(args.lookups):
+                isbn = isbn13(rng) if rng.random() < 0.5 else None
+                lookups.append(("new", None, made_up_title(rng, words), made_up_author(), isbn))
+
+            def naive(query_title: str, author: str, isbn: str) -> list:
+                """Fold and compare every open suggestion of the club"""
+                query = duplicates.key(query_title, author, isbn)
+                return [
+                    book_id for book_id, book_title, book_author, book_isbn in db.execute(
+                        select(models.Book.id, models.Book.title, models.Book.author, models.Book.isbn)
+                        .where(models.Book.club_id == club_id, models.Book.status == "suggested",
+                               models.Book.vetoed == False)
+                    )
+                    if duplicates.same_book(query, duplicates.key(book_title, book_author, book_isbn))
+                ]
+
+            started = time.perf_counter()
+            duplicates.matches(db, club_id, "", "")
+            build_ms = (time.perf_counter() - started) * 1000
+            index, _ = duplicates.indexes.get(club_id)
+
+            queries = [(query_title, author, duplicates.canonical_isbn(isbn))
+                       for _, _, query_title, author, isbn in lookups]
+
+            def timed_pass(fn) -> tuple:
+                """fn's result for every lookup, and how long each took"""
+                results, timings = [], []
+                for query in queries:
+                    started = time.perf_counter()
+                    results.append(fn(*query))
+                    timings.append(time.perf_counter() - started)
+                return results, timings
+
+            # Each way in a pass of its own, so none runs in the wake of another's garbage
+            indexed, indexed_timings = timed_pass(lambda *query: duplicates.matches(db, club_id, *query))
+            _, in_memory_timings = timed_pass(lambda *query: index.matches(duplicates.key(*query)))
+            expected, naive_timings = timed_pass(naive)
+
+            found = {}
+            for (kind, book_id, query_title, author, _), matches, naive_matches in zip(lookups, indexed, expected):
+                if set(matches) != set(naive_matches):
+                    print(f"    {kind} {query_title!r} by {author!r}: index found {sorted(matches)}, "
+                          f"comparing every suggestion found {sorted(naive_matches)}")
+                    failed = True
+                hits, total = found.get(kind, (0, 0))
+                found[kind] = (hits + (book_id in matches if book_id else bool(matches)), total + 1)
+
+            print(f"{len(open_books)} open suggestions, {len(isbns)} with an ISBN, "
+                  f"{len(index.grams)} distinct trigrams; index built in {build_ms:.1f} ms")
+            print(f"{'lookup':40} {'median us':>10}")
+            print(f"{'index, with the new suggestions query':40} {median_us(indexed_timings):>10.1f}")
+            print(f"{'index, in memory':40} {median_us(in_memory_timings):>10.1f}")
+            print(f"{'comparing every open suggestion':40} {median_us(naive_timings):>10.1f}")
+            for kind, (hits, total) in found.items():
+                label = "new suggestions matching one already there" if kind == "new" else f"{kind} variants found"
+                print(f"    {label}: {hits}/{total}")
+    finally:
+        engine.dispose()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
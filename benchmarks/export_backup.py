@@ -0,0 +1,173 @@
+"""Club export and online backup on a seeded database.
+
+Seeds a SQLite database, then:
+
+- exports the largest club as JSON lines and as a zip, reporting time,
+  size, rows and the peak Python memory the export allocated, and checks
+  the zip's manifest against the rows it holds;
+- backs the database up with ``app.backup`` while writer threads commit
+  small writes, reporting the writers' latency before and during the
+  backup, and checks the backup passes an integrity check.
+
+    python -m benchmarks.export_backup
+    python -m benchmarks.export_backup --profile medium --writers 4
+"""
+import argparse
+import io
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zipfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+def consume(chunks) -> io.BytesIO:
+    """The whole output of an export, to check it"""
+    output = io.BytesIO()
+    for chunk in chunks:
+        output.write(chunk)
+    output.seek(0)
+    return output
+
+
+def measure_export(exporter, club_id: int, club_code: str) -> dict:
+    started = time.perf_counter()
+    size = sum(len(chunk) for chunk in exporter(club_id, club_code))
+    elapsed = time.perf_counter() - started
+    # A second pass for memory; tracing allocations slows the export down several times
+    tracemalloc.start()
+    for _ in exporter(club_id, club_code):
+        pass
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"seconds": round(elapsed, 2), "bytes": size, "peak_memory_kb": peak // 1024}
+
+
+def write_load(path: str, writers: int, stop: threading.Event, latencies: list):
+    """Writer threads that each commit one small insert at a time until stopped"""
+    def run():
+        db = sqlite3.connect(path, timeout=30, isolation_level=None)
+        while not stop.is_set():
+            started = time.perf_counter()
+            db.execute("BEGIN IMMEDIATE")
+            db.execute(
+                "INSERT INTO jobs (kind, payload, status, attempts, max_attempts, run_at) "
+                "VALUES ('bench.noop', '{}', 'done', 0, 1, CURRENT_TIMESTAMP)"
+            )
+            db.execute("COMMIT")
+            latencies.append((time.perf_counter(), time.perf_counter() - started))
+            time.sleep(0.002)
+        db.close()
+
+    threads = [threading.Thread(target=run) for _ in range(writers)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def summarize(latencies: list) -> dict:
+    values = sorted(latency for _, latency in latencies)
+    if not values:
+        return {"writes": 0, "p50_ms": None, "p99_ms": None, "max_ms": None}
+    return {
+        "writes": len(values),
+        "p50_ms": round(values[len(values) // 2] * 1000, 2),
+        "p99_ms": round(values[min(len(values) - 1, int(len(values) * 0.99))] * 1000, 2),
+        "max_ms": round(values[-1] * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--profile", default="large", help="benchmarks.seed profile to generate")
+    parser.add_argument("--writers", type=int, default=2, help="threads writing during the backup")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="bookclub-export-")
+    path = os.path.join(directory, "bookclub.db")
+    os.environ["DATABASE_URL"] = f"sqlite:///{path}"
+    os.chdir(ROOT)
+
+    from sqlalchemy import func, select
+    from benchmarks.seed import PROFILES, seed
+    from app import export
+    from app.backup import backup
+    from app.database import SessionLocal, engine
+    from app.models import Member
+
+    failed = False
+    try:
+        seed(f"sqlite:///{path}", PROFILES[args.profile], args.seed)
+        with SessionLocal() as db:
+            # The app's engine turns on WAL when it connects
+            club_id, members = db.execute(
+                select(Member.club_id, func.count(Member.id)).group_by(Member.club_id).order_by(func.count(Member.id).desc())
+            ).first()
+            club_code = db.scalar(select(export.Club.code).where(export.Club.id == club_id))
+        print(f"largest club {club_code}: {members} members, database {os.path.getsize(path) // 1024} KiB")
+
+        print(f"{'export':>8} {'seconds':>8} {'bytes':>11} {'peak KiB':>9}")
+        for name, (exporter, _) in sorted(export.EXPORTERS.items()):
+            result = measure_export(exporter, club_id, club_code)
+            print(f"{name:>8} {result['seconds']:>8} {result['bytes']:>11} {result['peak_memory_kb']:>9}")
+
+        # Both formats hold the same rows
+        jsonl = consume(export.export_jsonl(club_id, club_code))
+        lines = jsonl.getvalue().splitlines()
+        archive = consume(export.export_zip(club_id, club_code))
+        with zipfile.ZipFile(archive) as bundle:
+            counts = json.loads(bundle.read("export.json"))["counts"]
+            for table, count in counts.items():
+                if len(bundle.read(f"{table}.jsonl").splitlines()) != count:
+                    print(f"    {table}.jsonl does not hold the {count} rows in the manifest")
+                    failed = True
+        if len(lines) - 1 != sum(counts.values()):
+            print(f"    JSON lines export has {len(lines) - 1} rows, the zip {sum(counts.values())}")
+            failed = True
+
+        stop, latencies = threading.Event(), []
+        threads = write_load(path, args.writers, stop, latencies)
+        time.sleep(2)
+        backup_started = time.perf_counter()
+        result = backup(path, os.path.join(directory, "backup.db"))
+        backup_ended = time.perf_counter()
+        time.sleep(0.5)
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+        before = summarize([sample for sample in latencies if sample[0] < backup_started])
+        during = summarize([sample for sample in latencies if backup_started <= sample[0] <= backup_ended])
+        print(f"backup: {result['bytes'] // 1024} KiB in {result['seconds']}s")
+        print(f"{'writes':>8} {'count':>6} {'p50 ms':>7} {'p99 ms':>7} {'max ms':>7}")
+        for label, row in (("before", before), ("during", during)):
+            print(f"{label:>8} {row['writes']:>6} {row['p50_ms']:>7} {row['p99_ms']:>7} {row['max_ms']:>7}")
+        if not during["writes"] and result["seconds"] > 0.1:
+            print("    no write committed while the backup ran")
+            failed = True
+
+        copy = sqlite3.connect(os.path.join(directory, "backup.db"))
+        if copy.execute("PRAGMA integrity_check").fetchone()[0] != "ok":
+            print("    the backup failed its integrity check")
+            failed = True
+        copy.close()
+    finally:
+        engine.dispose()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""Genre tags on a large backlog.
+
+Seeds one club with thousands of tagged suggestions and years of reading
+history, then times, each against the straightforward version it replaces:
+
+- facet counts per tag (one grouped query over ``book_tags``) against
+  loading every book with its tags and counting them;
+- a member's best-matching suggestions from their stored affinity vector
+  against working the affinity out from their ratings and readers first;
+- the club page, plain, filtered by a tag and ordered by fit;
+- rebuilding every member's affinity vector.
+
+Facet counts and affinity must match the straightforward versions.
+
+    python -m benchmarks.genres
+    python -m benchmarks.genres --suggestions 20000 --database-url postgresql://localhost/bookclub_test
+
+``--database-url`` runs against another (empty, disposable) database
+instead of a temporary SQLite file; every table in it is dropped first.
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import urllib.parse
+from collections import Counter
+
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import selectinload
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+def median_ms(fn, runs: int) -> float:
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", help="disposable database to use instead of a temporary SQLite file")
+    parser.add_argument("--members", type=int, default=200, help="members in the club")
+    parser.add_argument("--suggestions", type=int, default=2000, help="open suggestions in the backlog")
+    parser.add_argument("--years", type=int, default=3, help="years of books read")
+    parser.add_argument("--runs", type=int, default=10, help="times each read is repeated")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="bookclub-genres-")
+    database_url = args.database_url or f"sqlite:///{directory}/genres.db"
+    os.environ["DATABASE_URL"] = database_url
+    os.environ["JOBS_ENABLED"] = "off"
+    os.environ["SLOW_QUERY_MS"] = "-1"
+    os.chdir(ROOT)
+
+    from benchmarks.seed import PROFILES, seed
+    from benchmarks.load import InProcessClient, member_token
+    from app import models
+    from app.database import Base
+
+    if args.database_url:
+        engine = create_engine(database_url)
+        Base.metadata.drop_all(engine)
+        engine.dispose()
+    profile = dict(PROFILES["small"], clubs=1, members=args.members, suggestions=args.suggestions, years=args.years)
+    seed(database_url, profile, args.seed)
+
+    from app.main import app
+    from app import genres
+    from app.database import SessionLocal, engine
+
+    failed = False
+    try:
+        with SessionLocal() as db:
+            club = db.query(models.Club).order_by(models.Club.id).first()
+            club_id, club_code = club.id, club.code
+            member = max(club.members, key=lambda member: member.id % 7)
+            member_id, cookie = member.id, member_token(member)
+            book_count, member_count = len(club.books), len(club.members)
+
+            def naive_facets():
+                """Every book of the club with its tags, counted here"""
+                counts = Counter()
+                books = db.scalars(
+                    select(models.Book)
+                    .where(models.Book.club_id == club_id)
+                    .options(selectinload(models.Book.tags).selectinload(models.BookTag.tag))
+                ).all()
+                for book in books:
+                    for book_tag in book.tags:
+                        if book.status == "suggested" and not book.vetoed:
+                            counts[book_tag.tag.name, "suggested"] += 1
+                        elif book.status == "completed":
+                            counts[book_tag.tag.name, "completed"] += 1
+                db.expunge_all()
+                return {name: (counts[name, "suggested"], counts[name, "completed"]) for name, _ in counts}
+
+            def naive_fit():
+                """The member's affinity from their readers and ratings, then each tagged book's match"""
+                scores = Counter()
+                for (tag_id,) in db.execute(
+                    select(models.BookTag.tag_id)
+                    .join(models.BookReader, models.BookReader.book_id == models.BookTag.book_id)
+                    .where(models.BookReader.member_id == member_id)
+                ):
+                    scores[tag_id] += 1.0
+                for tag_id, stars in db.execute(
+                    select(models.BookTag.tag_id, models.Rating.rating)
+                    .join(models.Rating, models.Rating.book_id == models.BookTag.book_id)
+                    .where(models.Rating.member_id == member_id)
+                ):
+                    scores[tag_id] += (stars - 3) * 0.5
+                fit = Counter()
+                for book_id, tag_id in db.execute(
+                    select(models.BookTag.book_id, models.BookTag.tag_id).where(models.BookTag.club_id == club_id)
+                ):
+                    if scores.get(tag_id):
+                        fit[book_id] += scores[tag_id]
+                return dict(fit)
+
+            facets = genres.facets(db, club_id)
+            if {name: (suggested, read) for name, suggested, read in facets} != naive_facets():
+                print("    facet counts differ from counting every book")
+                failed = True
+            fit = genres.fit(db, member_id, club_id)
+            naive = naive_fit()
+            if {book: round(score, 6) for book, score in fit.items() if score} != \
+                    {book: round(score, 6) for book, score in naive.items()}:
+                print("    stored affinity differs from working it out")
+                failed = True
+            tag = facets[0][0]
+
+            tagged_books = db.query(models.BookTag).filter(models.BookTag.club_id == club_id).count()
+            print(f"{book_count} books ({args.suggestions} suggested) with {tagged_books} tags, "
+                  f"{member_count} members")
+            print(f"{'read':40} {'ms':>8}")
+            print(f"{'facets, one grouped query':40} {median_ms(lambda: genres.facets(db, club_id), args.runs):>8.2f}")
+            print(f"{'facets, counting every book':40} {median_ms(naive_facets, args.runs):>8.2f}")
+            print(f"{'fit, stored affinity vector':40} "
+                  f"{median_ms(lambda: genres.fit(db, member_id, club_id), args.runs):>8.2f}")
+            print(f"{'fit, affinity from ratings and readers':40} {median_ms(naive_fit, args.runs):>8.2f}")
+
+        client = InProcessClient(app)
+
+        async def club_page(query: str):
+            path = f"/clubs/{club_code}{query}"
+            status = await client.request("GET", path, None, cookie)
+            if status != 200:
+                raise RuntimeError(f"{path}: HTTP {status}")
+
+        runs = max(3, args.runs // 4)
+        for label, query in (
+            ("club page", ""),
+            (f"club page, tagged {tag}", "?tag=" + urllib.parse.quote(tag)),
+            ("club page, best matches first", "?sort=fit"),
+        ):
+            print(f"{label:40} {median_ms(lambda: asyncio.run(club_page(query)), runs):>8.2f}")
+
+        with SessionLocal() as db:
+            started = time.perf_counter()
+            rows = genres.refresh(db)
+            db.commit()
+            print(f"rebuilt {rows} affinity rows for every member in {time.perf_counter() - started:.2f}s")
+    finally:
+        engine.dispose()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
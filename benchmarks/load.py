@@ -0,0 +1,465 @@
+"""End-to-end load driver.
+
+Replays a weighted mix of page views and writes against a seeded database
+(see ``benchmarks/seed.py``), either straight through the ASGI app in this
+process or over HTTP against ``app.server`` workers, and reports throughput,
+p50/p95/p99 latency and SQL statements per request for each endpoint.
+
+    python -m benchmarks.load --database-url sqlite:///./data/bench.db --mode inprocess
+    python -m benchmarks.load --database-url sqlite:///./data/bench.db --mode uvicorn --concurrency 16
+
+Query counts come from the app's own ``/metrics`` histograms, so they cover
+every statement the request issued. ``--output`` writes the results as JSON
+for ``benchmarks/compare.py``.
+"""
+import argparse
+import asyncio
+import http.client
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+from datetime import datetime
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from app.version import __version__  # noqa: E402
+
+# (endpoint, weight); writes are added on top according to --write-ratio
+READ_MIX = [
+    ("GET /", 5),
+    ("GET /clubs/{code}", 25),
+    ("GET /discussions/book/{book_id}", 10),
+    ("GET /discussions/{discussion_id}", 25),
+    ("GET /ratings/book/{book_id}", 15),
+    ("GET /meetings/club/{club_code}", 10),
+    ("GET /meetings/{meeting_id}/rsvp", 10),
+]
+WRITE_MIX = [
+    ("POST /discussions/post/{post_id}/like", 4),
+    ("POST /discussions/post/{post_id}/comment", 2),
+    ("POST /meetings/{meeting_id}/rsvp", 3),
+    ("POST /books/{book_id}/veto", 1),
+]
+
+_HISTOGRAM_SAMPLE = re.compile(r'^bookclub_http_request_db_queries_(sum|count)\{route="([^"]*)"\} (\S+)$')
+
+
+def member_token(member) -> str:
+    """Cookie header value signing in as one member"""
+    from app import auth
+
+    return f"{auth.COOKIE_NAME}={auth.encode_token([auth.Membership.from_member(member)])}"
+
+
+class Targets:
+    """Ids from the seeded database that requests are built from"""
+
+    def __init__(self, database_url: str, clubs: int, rng: random.Random):
+        from app import models
+
+        engine = create_engine(database_url)
+        self.rng = rng
+        self.clubs = []
+        with Session(engine) as db:
+            for club in db.query(models.Club).order_by(models.Club.id).limit(clubs):
+                books = db.query(models.Book).filter(models.Book.club_id == club.id).all()
+                book_ids = [book.id for book in books if book.status != "suggested"]
+                if not club.members or not book_ids:
+                    continue
+                discussion_ids = [
+                    row.id for row in db.query(models.Discussion.id).filter(models.Discussion.book_id.in_(book_ids))
+                ]
+                self.clubs.append({
+                    "code": club.code,
+                    "member_tokens": [member_token(member) for member in club.members],
+                    "book_ids": book_ids,
+                    "suggestion_ids": [book.id for book in books if book.status == "suggested"],
+                    "discussion_ids": discussion_ids,
+                    "post_ids": [
+                        row.id for row in db.query(models.DiscussionPost.id).filter(
+                            models.DiscussionPost.discussion_id.in_(discussion_ids)
+                        )
+                    ],
+                    "meeting_ids": [
+                        row.id for row in db.query(models.Meeting.id).filter(models.Meeting.club_id == club.id)
+                    ],
+                })
+        engine.dispose()
+        if not self.clubs:
+            raise SystemExit("No seeded clubs found; run `python -m benchmarks.seed` first")
+
+    def request(self, endpoint: str):
+        """Build (method, path, form, cookie) for one call to an endpoint"""
+        rng = self.rng
+        club = rng.choice(self.clubs)
+        method, template = endpoint.split(" ", 1)
+        values = {
+            "code": club["code"],
+            "club_code": club["code"],
+            "book_id": rng.choice(club["book_ids"]),
+            "discussion_id": rng.choice(club["discussion_ids"] or [0]),
+            "post_id": rng.choice(club["post_ids"] or [0]),
+            "meeting_id": rng.choice(club["meeting_ids"] or [0]),
+        }
+        form = None
+        if endpoint == "POST /books/{book_id}/veto" and club["suggestion_ids"]:
+            values["book_id"] = rng.choice(club["suggestion_ids"])
+        elif endpoint == "POST /discussions/post/{post_id}/comment":
+            form = {"content": "Benchmark comment"}
+        elif endpoint == "POST /meetings/{meeting_id}/rsvp":
+            form = {"status": rng.choice(("yes", "maybe", "no"))}
+        cookie = rng.choice(club["member_tokens"])
+        return method, template.format(**values), form, cookie
+
+
+class InProcessClient:
+    """Calls the ASGI app directly, skipping the network and the server"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def request(self, method: str, path: str, form: dict = None, cookie: str = None) -> int:
+        body = urllib.parse.urlencode(form).encode() if form else b""
+        headers = [(b"host", b"bench")]
+        if form is not None:
+            headers.append((b"content-type", b"application/x-www-form-urlencoded"))
+            headers.append((b"content-length", str(len(body)).encode()))
+        if cookie:
+            headers.append((b"cookie", cookie.encode()))
+        path, _, query = path.partition("?")
+        scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+            "method": method, "scheme": "http", "path": path, "raw_path": path.encode(),
+            "query_string": query.encode(), "root_path": "", "headers": headers,
+            "client": ("127.0.0.1", 50000), "server": ("bench", 80),
+        }
+        status = 0
+        done = asyncio.Event()
+        request_sent = False
+
+        async def receive():
+            nonlocal request_sent
+            if not request_sent:
+                request_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            # Only report a disconnect once the response is complete, like a real client
+            await done.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body" and not message.get("more_body", False):
+                done.set()
+
+        await self.app(scope, receive, send)
+        done.set()
+        return status
+
+    async def metrics(self) -> str:
+        chunks = []
+
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            if message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+
+        scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+            "scheme": "http", "path": "/metrics", "raw_path": b"/metrics", "query_string": b"",
+            "root_path": "", "headers": [(b"host", b"bench")], "client": ("127.0.0.1", 50000),
+            "server": ("bench", 80),
+        }
+        await self.app(scope, receive, send)
+        return b"".join(chunks).decode()
+
+
+class HttpClient:
+    """Keep-alive HTTP/1.1 connection per worker thread"""
+
+    def __init__(self, base_url: str):
+        parsed = urllib.parse.urlparse(base_url)
+        self.host, self.port = parsed.hostname, parsed.port
+        self._local = threading.local()
+
+    def _connection(self) -> http.client.HTTPConnection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        return conn
+
+    def request(self, method: str, path: str, form: dict = None, cookie: str = None) -> int:
+        headers = {}
+        body = None
+        if form is not None:
+            body = urllib.parse.urlencode(form)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        if cookie:
+            headers["Cookie"] = cookie
+        conn = self._connection()
+        try:
+            conn.request(method, path, body, headers)
+            response = conn.getresponse()
+            response.read()
+            return response.status
+        except (http.client.HTTPException, OSError):
+            conn.close()
+            self._local.conn = None
+            return 0
+
+    def metrics(self) -> str:
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        conn.request("GET", "/metrics")
+        text = conn.getresponse().read().decode()
+        conn.close()
+        return text
+
+
+def query_totals(metrics_text: str) -> dict:
+    """{route: [statements, requests]} from the per-request query histogram"""
+    totals = {}
+    for line in metrics_text.splitlines():
+        match = _HISTOGRAM_SAMPLE.match(line)
+        if match:
+            kind, route, value = match.groups()
+            totals.setdefault(route, [0.0, 0.0])[0 if kind == "sum" else 1] = float(value)
+    return totals
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def summarize(samples: dict, elapsed: float, before: dict, after: dict) -> dict:
+    """Per-endpoint latency figures plus SQL statements per request"""
+    endpoints = {}
+    for endpoint, calls in sorted(samples.items()):
+        latencies = sorted(latency for latency, _ in calls)
+        errors = sum(1 for _, status in calls if status == 0 or status >= 500)
+        route = endpoint.split(" ", 1)[1]
+        statements, requests = (
+            after.get(route, [0, 0])[0] - before.get(route, [0, 0])[0],
+            after.get(route, [0, 0])[1] - before.get(route, [0, 0])[1],
+        )
+        endpoints[endpoint] = {
+            "count": len(calls),
+            "errors": errors,
+            "throughput_rps": round(len(calls) / elapsed, 2),
+            "mean_ms": round(sum(latencies) / len(latencies) * 1000, 2),
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+            "max_ms": round(latencies[-1] * 1000, 2),
+            # GET and POST on one route template share this figure
+            "queries_per_request": round(statements / requests, 2) if requests else None,
+        }
+    return endpoints
+
+
+def build_plan(targets: Targets, total: int, write_ratio: float, rng: random.Random) -> list:
+    reads = rng.choices([name for name, _ in READ_MIX], [weight for _, weight in READ_MIX], k=total)
+    plan = []
+    for endpoint in reads:
+        if rng.random() < write_ratio:
+            endpoint = rng.choices([name for name, _ in WRITE_MIX], [weight for _, weight in WRITE_MIX])[0]
+        plan.append((endpoint,) + targets.request(endpoint))
+    return plan
+
+
+async def run_inprocess(client: InProcessClient, plan: list, concurrency: int, samples: dict):
+    queue = iter(plan)
+
+    async def worker():
+        for endpoint, method, path, form, cookie in queue:
+            started = time.perf_counter()
+            status = await client.request(method, path, form, cookie)
+            samples.setdefault(endpoint, []).append((time.perf_counter() - started, status))
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+
+def run_http(client: HttpClient, plan: list, concurrency: int, samples: dict):
+    lock = threading.Lock()
+    queue = iter(plan)
+
+    def worker():
+        while True:
+            with lock:
+                item = next(queue, None)
+            if item is None:
+                return
+            endpoint, method, path, form, cookie = item
+            started = time.perf_counter()
+            status = client.request(method, path, form, cookie)
+            elapsed = time.perf_counter() - started
+            with lock:
+                samples.setdefault(endpoint, []).append((elapsed, status))
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(database_url: str, port: int, workers: int) -> subprocess.Popen:
+    """Start the production launcher (app.server) and wait until it accepts connections"""
+    env = dict(os.environ, DATABASE_URL=database_url)
+    process = subprocess.Popen(
+        [sys.executable, "-m", "app.server", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning", "--no-access-log"],
+        cwd=ROOT, env=env,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process
+        except OSError:
+            if process.poll() is not None:
+                raise SystemExit("server exited during startup")
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit("server did not start in time")
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args) -> dict:
+    rng = random.Random(args.seed)
+    targets = Targets(args.database_url, args.clubs, rng)
+    warmup = build_plan(targets, args.warmup, args.write_ratio, rng)
+    plan = build_plan(targets, args.requests, args.write_ratio, rng)
+    samples = {}
+
+    if args.mode == "inprocess":
+        os.chdir(ROOT)
+        from app.main import app
+
+        client = InProcessClient(app)
+
+        async def drive():
+            await run_inprocess(client, warmup, args.concurrency, {})
+            before = query_totals(await client.metrics())
+            started = time.perf_counter()
+            await run_inprocess(client, plan, args.concurrency, samples)
+            elapsed = time.perf_counter() - started
+            return elapsed, before, query_totals(await client.metrics())
+
+        elapsed, before, after = asyncio.run(drive())
+    else:
+        process = None
+        base_url = args.url
+        if base_url is None:
+            port = free_port()
+            process = start_server(args.database_url, port, args.workers)
+            base_url = f"http://127.0.0.1:{port}"
+        try:
+            client = HttpClient(base_url)
+            run_http(client, warmup, args.concurrency, {})
+            # With several workers each scrape only sees one of them, so counts are approximate
+            before = query_totals(client.metrics())
+            started = time.perf_counter()
+            run_http(client, plan, args.concurrency, samples)
+            elapsed = time.perf_counter() - started
+            after = query_totals(client.metrics())
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait()
+
+    total = sum(len(calls) for calls in samples.values())
+    endpoints = summarize(samples, elapsed, before, after)
+    return {
+        "version": __version__,
+        "git_revision": git_revision(),
+        "timestamp": datetime.utcnow().isoformat() + "Z",
+        "mode": args.mode,
+        "concurrency": args.concurrency,
+        "write_ratio": args.write_ratio,
+        "database": args.database_url.split("://", 1)[0],
+        "requests": total,
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(total / elapsed, 2),
+        "errors": sum(endpoint["errors"] for endpoint in endpoints.values()),
+        "endpoints": endpoints,
+    }
+
+
+def print_report(results: dict):
+    print(f"{results['requests']} requests in {results['seconds']}s "
+          f"({results['throughput_rps']} req/s, {results['errors']} errors, mode={results['mode']})")
+    header = f"{'endpoint':44} {'count':>6} {'rps':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'queries':>8}"
+    print(header)
+    print("-" * len(header))
+    for endpoint, row in results["endpoints"].items():
+        queries = "-" if row["queries_per_request"] is None else row["queries_per_request"]
+        print(f"{endpoint:44} {row['count']:>6} {row['throughput_rps']:>8} {row['p50_ms']:>8} "
+              f"{row['p95_ms']:>8} {row['p99_ms']:>8} {queries:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=os.getenv("DATABASE_URL", "sqlite:///./data/bench.db"))
+    parser.add_argument("--mode", choices=("inprocess", "uvicorn"), default="inprocess")
+    parser.add_argument("--url", help="target an already running server (uvicorn mode)")
+    parser.add_argument("--workers", type=int, default=1, help="server workers to start")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--warmup", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--write-ratio", type=float, default=0.1, help="fraction of requests that write")
+    parser.add_argument("--clubs", type=int, default=10, help="seeded clubs to spread traffic over")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write JSON results to this file")
+    parser.add_argument("--fail-on-error", action="store_true", help="exit non-zero if any request failed")
+    args = parser.parse_args()
+
+    if args.database_url.startswith("sqlite:///") and not args.database_url.startswith("sqlite:////"):
+        # Resolve relative SQLite paths before the in-process mode changes directory
+        args.database_url = "sqlite:///" + os.path.abspath(args.database_url[len("sqlite:///"):])
+
+    # The app binds its engine at import time, so set this before importing any of it
+    os.environ["DATABASE_URL"] = args.database_url
+    results = run(args)
+    print_report(results)
+    if args.output:
+        with open(args.output, "w") as handle:
+            json.dump(results, handle, indent=2)
+    if args.fail_on_error and results["errors"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+"""Poll tallying.
+
+- Instant-runoff tallies of 1,000 to 100,000 ranked ballots, against a
+  straightforward version that recounts lists of option ids every round;
+  both must agree on every round.
+- Members of one club vote, change and withdraw ballots on a single-choice,
+  an approval and a ranked poll from several threads at once; afterwards
+  every running tally must match a recount of the ballots.
+- The ranked poll's page with its results worked out, then served from
+  the cache.
+
+    python -m benchmarks.polls
+    python -m benchmarks.polls --members 500 --database-url postgresql://localhost/bookclub_test
+
+``--database-url`` runs against another (empty, disposable) database
+instead of a temporary SQLite file; every table in it is dropped first.
+"""
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from sqlalchemy import create_engine, select
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+def ranked_ballots(count: int, options: int, rng: random.Random) -> list:
+    """Ballots ranking part of the options, skewed so the runoff takes several rounds"""
+    popularity = [1 + position for position in range(options)]
+    ballots = []
+    for _ in range(count):
+        ranked = []
+        remaining = list(range(options))
+        weights = list(popularity)
+        for _ in range(rng.randint(1, options)):
+            index = rng.choices(range(len(remaining)), weights=weights)[0]
+            ranked.append(remaining.pop(index))
+            weights.pop(index)
+        ballots.append(ranked)
+    return ballots
+
+
+def naive_runoff(ballots: list, options: int) -> list:
+    """Rounds of vote counts, recounting every ballot's full list each round"""
+    eliminated = set()
+    rounds = []
+    while True:
+        counts = [0] * options
+        for ranked in ballots:
+            remaining = [option for option in ranked if option not in eliminated]
+            if remaining:
+                counts[remaining[0]] += 1
+        rounds.append([None if position in eliminated else counts[position] for position in range(options)])
+        running = [position for position in range(options) if position not in eliminated]
+        active = sum(counts)
+        if len(running) == 1 or max(counts[position] for position in running) * 2 > active:
+            return rounds
+        fewest = min(counts[position] for position in running)
+        if all(counts[position] == fewest for position in running):
+            return rounds
+        last = min(
+            (position for position in running if counts[position] == fewest),
+            key=lambda position: ([earlier[position] for earlier in reversed(rounds)], -position)
+        )
+        eliminated.add(last)
+
+
+def timed(fn):
+    started = time.perf_counter()
+    result = fn()
+    return result, (time.perf_counter() - started) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", help="disposable database to use instead of a temporary SQLite file")
+    parser.add_argument("--options", type=int, default=8, help="options on each ranked poll")
+    parser.add_argument("--members", type=int, default=300, help="members voting in the club")
+    parser.add_argument("--threads", type=int, default=8, help="threads casting ballots at once")
+    parser.add_argument("--changes", type=int, default=3, help="times each member votes, changes or withdraws")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="bookclub-polls-")
+    database_url = args.database_url or f"sqlite:///{directory}/polls.db"
+    os.environ["DATABASE_URL"] = database_url
+    os.environ["JOBS_ENABLED"] = "off"
+    os.environ["SLOW_QUERY_MS"] = "-1"
+    os.chdir(ROOT)
+
+    from benchmarks.seed import PROFILES, seed
+    from benchmarks.load import InProcessClient, member_token
+    from app import models, polls
+    from app.database import Base
+
+    rng = random.Random(args.seed)
+    failed = False
+
+    print(f"{'ranked ballots':>14} {'distinct':>9} {'rounds':>7} {'runoff ms':>10} {'recount ms':>11}")
+    for count in (1000, 10000, 100000):
+        ballots = ranked_ballots(count, args.options, rng)
+        encoded = [bytes(ranked) for ranked in ballots]
+        result, fast_ms = timed(lambda: polls.instant_runoff(encoded, args.options))
+        rounds, slow_ms = timed(lambda: naive_runoff(ballots, args.options))
+        print(f"{count:>14} {len(set(encoded)):>9} {len(result['rounds']):>7} {fast_ms:>10.1f} {slow_ms:>11.1f}")
+        if result["rounds"] != rounds:
+            print("    the runoff and the recount disagree")
+            failed = True
+
+    if args.database_url:
+        engine = create_engine(database_url)
+        Base.metadata.drop_all(engine)
+        engine.dispose()
+    seed(database_url, dict(PROFILES["small"], clubs=1, members=args.members), args.seed)
+
+    from app.main import app
+    from app.database import SessionLocal, engine
+
+    try:
+        with SessionLocal() as db:
+            club = db.query(models.Club).order_by(models.Club.id).first()
+            cookie = member_token(club.members[0])
+            member_ids = [member.id for member in club.members]
+            poll_ids = {
+                poll.kind: poll.id for poll in db.query(models.Poll).filter(models.Poll.club_id == club.id)
+            }
+            option_counts = {
+                poll_id: len(db.get(models.Poll, poll_id).options) for poll_id in poll_ids.values()
+            }
+
+        def voter(member_ids: list, seed_value: int):
+            voter_rng = random.Random(seed_value)
+            for member_id in member_ids:
+                for _ in range(args.changes):
+                    for kind, poll_id in poll_ids.items():
+                        options = option_counts[poll_id]
+                        with SessionLocal() as db:
+                            if voter_rng.random() < 0.15:
+                                polls.retract(db, poll_id, member_id)
+                            else:
+                                count = 1 if kind == "single" else voter_rng.randint(1, options)
+                                polls.cast(db, poll_id, member_id, bytes(voter_rng.sample(range(options), count)))
+                            db.commit()
+
+        threads = [
+            threading.Thread(target=voter, args=(member_ids[index::args.threads], args.seed + index))
+            for index in range(args.threads)
+        ]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        writes = len(member_ids) * args.changes * len(poll_ids)
+        print(f"{writes} ballots cast, changed or withdrawn from {args.threads} threads in {elapsed:.2f}s "
+              f"({writes / elapsed:.0f}/s)")
+
+        with SessionLocal() as db:
+            for kind, poll_id in poll_ids.items():
+                poll = db.get(models.Poll, poll_id)
+                ballots = [bytes(choices) for choices in db.scalars(
+                    select(models.PollBallot.choices).where(models.PollBallot.poll_id == poll_id)
+                )]
+                votes = [0] * len(poll.options)
+                for choices in ballots:
+                    for position in polls.counted(kind, choices):
+                        votes[position] += 1
+                tally = [option.votes for option in poll.options]
+                ok = votes == tally and poll.ballots == len(ballots)
+                print(f"    {kind:>8}: {poll.ballots} ballots, tally {tally}: {'ok' if ok else f'recount {votes}'}")
+                failed = failed or not ok
+
+        client = InProcessClient(app)
+
+        async def page(path: str):
+            status = await client.request("GET", path, None, cookie)
+            if status != 200:
+                raise RuntimeError(f"{path}: HTTP {status}")
+
+        # The first page compiles the template
+        asyncio.run(page(f"/polls/{poll_ids['single']}"))
+        path = f"/polls/{poll_ids['ranked']}"
+        _, cold_ms = timed(lambda: asyncio.run(page(path)))
+        _, warm_ms = timed(lambda: asyncio.run(page(path)))
+        print(f"ranked poll page: {cold_ms:.1f} ms working out the runoff, {warm_ms:.1f} ms from the cache")
+    finally:
+        engine.dispose()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""Reading progress for one big club with a long history.
+
+Seeds one club, has every member report progress on the current book
+several times a day for weeks, then:
+
+- times the club's progress histogram, read from each reader's latest
+  position, against working it out from the raw report history, and checks
+  both agree;
+- times the club page;
+- rolls up reports older than a week into daily rows, reporting the rows
+  before and after, and checks each daily row holds that day's last report
+  and the histogram did not change.
+
+    python -m benchmarks.progress
+    python -m benchmarks.progress --members 250 --days 90 --database-url postgresql://localhost/bookclub_test
+
+``--database-url`` runs against another (empty, disposable) database
+instead of a temporary SQLite file; every table in it is dropped first.
+"""
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, func, insert, select
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+def median_ms(fn, runs: int) -> float:
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+
+def history(book_id: int, member_ids: list, days: int, reports: int, now: datetime, rng: random.Random) -> list:
+    """Rows of reading_progress: each member moving through the book a few reports a day"""
+    rows = []
+    started = now - timedelta(days=days)
+    for member_id in member_ids:
+        pages = rng.choice((192, 256, 320, 384, 416, 512))
+        page = 0
+        for day in range(days):
+            for report in range(reports):
+                page = min(pages, page + rng.randint(0, 2 * pages // (days * reports) + 1))
+                rows.append({
+                    "book_id": book_id, "member_id": member_id, "page": page, "pages": pages,
+                    "permille": page * 1000 // pages,
+                    "created_at": started + timedelta(days=day, hours=8 + 12 * report / reports,
+                                                      minutes=rng.randint(0, 59)),
+                })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", help="disposable database to use instead of a temporary SQLite file")
+    parser.add_argument("--members", type=int, default=100, help="members in the club, all reading")
+    parser.add_argument("--days", type=int, default=60, help="days of history")
+    parser.add_argument("--reports", type=int, default=4, help="progress reports per member a day")
+    parser.add_argument("--runs", type=int, default=50, help="times each read is repeated")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="bookclub-progress-")
+    database_url = args.database_url or f"sqlite:///{directory}/progress.db"
+    os.environ["DATABASE_URL"] = database_url
+    os.environ["JOBS_ENABLED"] = "off"
+    os.environ["SLOW_QUERY_MS"] = "-1"
+    os.chdir(ROOT)
+
+    from benchmarks.seed import PROFILES, seed
+    from benchmarks.load import InProcessClient, member_token
+    from app import models
+    from app.database import Base
+
+    if args.database_url:
+        engine = create_engine(database_url)
+        Base.metadata.drop_all(engine)
+        engine.dispose()
+    seed(database_url, dict(PROFILES["small"], clubs=1, members=args.members), args.seed)
+
+    from app.main import app
+    from app import progress
+    from app.database import SessionLocal, engine
+
+    def naive_histogram(db, book_id: int) -> list:
+        """The histogram from each reader's last raw report, as it would be without book_readers"""
+        last = (
+            select(func.max(models.ReadingProgress.id))
+            .where(models.ReadingProgress.book_id == book_id)
+            .group_by(models.ReadingProgress.member_id)
+        )
+        positions = db.scalars(select(models.ReadingProgress.permille).where(models.ReadingProgress.id.in_(last))).all()
+        counts = {}
+        for value in positions:
+            counts[value // 100] = counts.get(value // 100, 0) + 1
+        readers = db.scalar(select(func.count(models.BookReader.id)).where(models.BookReader.book_id == book_id))
+        counts[progress.NOT_STARTED] = readers - len(positions)
+        return [(progress.BUCKET_LABELS[key], counts.get(key, 0)) for key in sorted(progress.BUCKET_LABELS)]
+
+    now = datetime.utcnow()
+    failed = False
+    try:
+        with SessionLocal() as db:
+            club = db.query(models.Club).order_by(models.Club.id).first()
+            club_code = club.code
+            cookie = member_token(club.members[0])
+            book_id = db.scalar(select(models.Book.id).where(
+                models.Book.club_id == club.id, models.Book.status == "reading"
+            ))
+            member_ids = [member.id for member in club.members]
+            # A clean slate: only the generated history below
+            db.query(models.ReadingProgress).delete()
+            db.query(models.BookReader).filter(models.BookReader.book_id == book_id).delete()
+            db.commit()
+
+            rows = history(book_id, member_ids, args.days, args.reports, now, random.Random(args.seed))
+            started = time.perf_counter()
+            for start in range(0, len(rows), 5000):
+                db.execute(insert(models.ReadingProgress), rows[start:start + 5000])
+            db.commit()
+            # The last report of each member also moves their latest position
+            latest = {row["member_id"]: row for row in rows}
+            for member_id, row in latest.items():
+                progress.record(db, book_id, member_id, row["page"], row["pages"], now)
+            db.commit()
+            print(f"{len(member_ids)} members, {len(rows) + len(latest)} reports over {args.days} days "
+                  f"written in {time.perf_counter() - started:.1f}s")
+
+            # Each reader's day as the rollup should keep it: the last report and how many there were
+            expected_days = {}
+            cutoff = datetime.combine((now - timedelta(days=progress.PROGRESS_KEEP_DAYS)).date(), datetime.min.time())
+            for row in rows:
+                if row["created_at"] < cutoff:
+                    key = (row["member_id"], row["created_at"].date())
+                    events = expected_days.get(key, (None, 0))[1]
+                    expected_days[key] = (row["page"], events + 1)
+
+            histogram = progress.histogram(db, book_id)
+            if histogram != naive_histogram(db, book_id):
+                print("    the histogram from book_readers differs from the one from the history")
+                failed = True
+            fast_ms = median_ms(lambda: progress.histogram(db, book_id), args.runs)
+            slow_ms = median_ms(lambda: naive_histogram(db, book_id), args.runs)
+            print(f"{'histogram':32} {'ms':>8}")
+            print(f"{'latest positions (book_readers)':32} {fast_ms:>8.2f}")
+            print(f"{'raw history (reading_progress)':32} {slow_ms:>8.2f}")
+
+        client = InProcessClient(app)
+
+        async def club_page():
+            status = await client.request("GET", f"/clubs/{club_code}", None, cookie)
+            if status != 200:
+                raise RuntimeError(f"/clubs/{club_code}: HTTP {status}")
+
+        page_ms = median_ms(lambda: asyncio.run(club_page()), max(5, args.runs // 5))
+        print(f"{'club page':32} {page_ms:>8.2f}")
+
+        with SessionLocal() as db:
+            started = time.perf_counter()
+            stats = progress.rollup(db, now)
+            elapsed = time.perf_counter() - started
+            raw_left = db.scalar(select(func.count(models.ReadingProgress.id)))
+            daily = {
+                (row.member_id, row.day): (row.page, row.events)
+                for row in db.scalars(select(models.ReadingProgressDaily))
+            }
+            print(f"rollup in {elapsed:.2f}s: {stats['events']} reports into {stats['days']} daily rows, "
+                  f"{raw_left} reports from the last {progress.PROGRESS_KEEP_DAYS} days kept")
+            if daily != expected_days:
+                print("    the daily rows do not hold each day's last report and count")
+                failed = True
+            if progress.histogram(db, book_id) != histogram:
+                print("    the histogram changed after the rollup")
+                failed = True
+    finally:
+        engine.dispose()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""Per-endpoint SQL statement budgets.
+
+Seeds a fixed synthetic dataset into a temporary SQLite database, renders
+every page of each route as a club member, counts the statements each
+request issues through engine events, and exits non-zero when a route goes
+over its budget. Because the dataset is fixed, an N+1 introduced by touching
+a relationship in a template shows up as a jump in the count.
+
+    python -m benchmarks.query_budgets
+    python -m benchmarks.query_budgets --raise-on-lazy-load
+    python -m benchmarks.query_budgets --database-url postgresql://localhost/bookclub_test
+
+``--raise-on-lazy-load`` turns on the ``SQL_RAISE_ON_LAZY_LOAD`` guard and
+lists the first lazy load on each route with the template line behind it.
+``--database-url`` runs against another (empty, disposable) database
+instead; every table in it is dropped first. Every other completed book is
+archived first, so the pages of archived books are counted too.
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+from datetime import datetime
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+# Most statements any single page of the route may issue on the budget dataset.
+# Every page loads its relationships up front, a statement per relationship, so
+# these do not grow with the rows on the page; one that does is an N+1.
+# Lower these as pages get cheaper; raise one only with a reason in the commit.
+BUDGETS = {
+    "GET /": 1,
+    # Club, members, books with their ratings, votes and readers, genre tags and
+    # favorites, the reading histogram and the next meeting with its RSVPs
+    "GET /clubs/{code}": 12,
+    "GET /clubs/{code}/admin": 2,
+    "GET /discussions/book/{book_id}": 4,
+    "GET /discussions/{discussion_id}": 8,
+    "GET /ratings/book/{book_id}": 6,
+    "GET /meetings/club/{club_code}": 5,
+    "GET /meetings/{meeting_id}/rsvp": 4,
+    "GET /polls/club/{club_code}": 4,
+    "GET /polls/{poll_id}": 5,
+}
+
+# Dataset the budgets are calibrated against
+BUDGET_PROFILE = "small"
+BUDGET_SEED = 42
+
+
+def pages(database_url: str, member_token) -> dict:
+    """{route: [(path, cookie)]} covering every club, book, discussion, meeting and poll"""
+    from app import models
+
+    engine = create_engine(database_url)
+    routes = {route: [] for route in BUDGETS}
+    with Session(engine) as db:
+        for club in db.query(models.Club).order_by(models.Club.id):
+            admin = next(member for member in club.members if member.is_admin)
+            cookie = member_token(admin)
+            routes["GET /"].append(("/", cookie))
+            routes["GET /clubs/{code}"].append((f"/clubs/{club.code}", cookie))
+            routes["GET /clubs/{code}/admin"].append((f"/clubs/{club.code}/admin", cookie))
+            routes["GET /meetings/club/{club_code}"].append((f"/meetings/club/{club.code}", cookie))
+            for book in club.books:
+                if book.status == "suggested":
+                    continue
+                routes["GET /discussions/book/{book_id}"].append((f"/discussions/book/{book.id}", cookie))
+                routes["GET /ratings/book/{book_id}"].append((f"/ratings/book/{book.id}", cookie))
+                for discussion in book.discussions:
+                    routes["GET /discussions/{discussion_id}"].append((f"/discussions/{discussion.id}", cookie))
+            for meeting in club.meetings:
+                routes["GET /meetings/{meeting_id}/rsvp"].append((f"/meetings/{meeting.id}/rsvp", cookie))
+            routes["GET /polls/club/{club_code}"].append((f"/polls/club/{club.code}", cookie))
+            for poll in db.query(models.Poll).filter(models.Poll.club_id == club.id):
+                routes["GET /polls/{poll_id}"].append((f"/polls/{poll.id}", cookie))
+    engine.dispose()
+    return routes
+
+
+async def measure(client, engine, routes: dict) -> dict:
+    """{route: (max statements, worst path, failures)}"""
+    counter = {"statements": 0}
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def count(conn, cursor, statement, parameters, context, executemany):
+        counter["statements"] += 1
+
+    results = {}
+    for route, calls in routes.items():
+        worst, worst_path, failures = 0, None, []
+        for path, cookie in calls:
+            try:
+                # Warm per-process caches (member token epochs) so the count is the steady state
+                await client.request("GET", path, None, cookie)
+                counter["statements"] = 0
+                status = await client.request("GET", path, None, cookie)
+            except Exception as exc:
+                failures.append(f"{path}: {exc}")
+                continue
+            if status != 200:
+                failures.append(f"{path}: HTTP {status}")
+            if counter["statements"] > worst:
+                worst, worst_path = counter["statements"], path
+        results[route] = (worst, worst_path, failures)
+
+    event.remove(engine, "before_cursor_execute", count)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--raise-on-lazy-load", action="store_true",
+                        help="fail on any lazy load and report where it happened")
+    parser.add_argument("--database-url", help="disposable database to use instead of a temporary SQLite file")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="bookclub-budgets-")
+    database_url = args.database_url or f"sqlite:///{directory}/budgets.db"
+    # The app binds its engine at import time, so configure it first
+    os.environ["DATABASE_URL"] = database_url
+    os.environ["SLOW_QUERY_MS"] = "-1"
+    os.chdir(ROOT)
+
+    from benchmarks.seed import PROFILES, seed
+    from benchmarks.load import InProcessClient, member_token
+    from app.database import Base
+
+    if args.database_url:
+        # Start from the same fixed dataset every time
+        engine = create_engine(database_url)
+        Base.metadata.drop_all(engine)
+        engine.dispose()
+    seed(database_url, PROFILES[BUDGET_PROFILE], BUDGET_SEED)
+    routes = pages(database_url, member_token)
+
+    from app.main import app
+    from app.database import engine, SessionLocal
+    from app import archive, lazyload
+
+    # Archive every other completed book, so pages served from archives are measured too
+    with SessionLocal() as db:
+        for book_id in archive.due_books(db, datetime.utcnow(), after_days=0)[::2]:
+            archive.archive_book(db, book_id, after_days=0)
+
+    if args.raise_on_lazy_load:
+        lazyload.install(SessionLocal)
+
+    results = asyncio.run(measure(InProcessClient(app), engine, routes))
+    engine.dispose()
+    shutil.rmtree(directory, ignore_errors=True)
+
+    failed = False
+    print(f"{'route':36} {'pages':>6} {'max':>6} {'budget':>7}  worst page")
+    for route, (worst, worst_path, failures) in results.items():
+        budget = BUDGETS[route]
+        over = worst > budget
+        print(f"{route:36} {len(routes[route]):>6} {worst:>6} {budget:>7}  {worst_path or '-'}"
+              f"{'  OVER BUDGET' if over else ''}")
+        for failure in failures[:1 if args.raise_on_lazy_load else 5]:
+            print(f"    {failure}")
+        failed = failed or over or bool(failures)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+"""Meeting reminder throughput against a local mail (or webhook) stand-in.
+
+Fills a database with ``--clubs`` clubs, each with ``--members`` members and
+a meeting starting within the next day (plus some later, cancelled or
+declined ones that must not be reminded), then runs the reminder scheduler
+once against a local SMTP sink or webhook sink and reports how long finding,
+claiming and sending took. Some members share an email address across
+clubs (one digest for both) and some addresses are refused by the sink
+(released for the next run). A second run must send nothing.
+
+    python -m benchmarks.reminders
+    python -m benchmarks.reminders --clubs 10000 --transport webhook
+    python -m benchmarks.reminders --database-url postgresql://localhost/bookclub_test
+
+``--database-url`` runs against another (empty, disposable) database
+instead of a temporary SQLite file; every table in it is dropped first.
+"""
+import argparse
+import http.server
+import json
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import socketserver
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, func, insert, select
+from sqlalchemy.orm import Session
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+# Addresses the sinks refuse, to exercise releasing undelivered reminders
+REFUSED_DOMAIN = "bounce.test"
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    """Just enough SMTP to accept messages and count them"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, messages):
+        super().__init__(("127.0.0.1", 0), SMTPHandler)
+        self.messages = messages
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line: str):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        self.reply("220 sink ESMTP")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors="replace").strip()
+            verb = command[:4].upper()
+            if verb == "EHLO":
+                self.wfile.write(b"250-sink\r\n250 8BITMIME\r\n")
+            elif verb == "RCPT" and REFUSED_DOMAIN in command:
+                self.reply("550 No such user")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                while self.rfile.readline() not in (b".\r\n", b""):
+                    pass
+                with self.server.messages.get_lock():
+                    self.server.messages.value += 1
+                self.reply("250 Queued")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                # HELO, MAIL, RCPT, RSET, NOOP
+                self.reply("250 OK")
+
+
+class WebhookSink(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, messages):
+        super().__init__(("127.0.0.1", 0), WebhookHandler)
+        self.messages = messages
+
+
+class WebhookHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with self.server.messages.get_lock():
+            self.server.messages.value += len(body["reminders"])
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(sink_class, messages, ready):
+    """Run a sink in its own process, like a real mail relay or webhook receiver"""
+    sink = sink_class(messages)
+    ready.put(sink.server_address[1])
+    sink.serve_forever()
+
+
+def fill(engine, models, clubs: int, members: int, now: datetime, rng: random.Random) -> int:
+    """Add the clubs, members, meetings and RSVPs; returns the reminders a first run should send"""
+    club_rows, member_rows, meeting_rows, rsvp_rows = [], [], [], []
+    expected = 0
+    member_id = meeting_id = 0
+    for club_id in range(1, clubs + 1):
+        club_rows.append({"id": club_id, "name": f"Club {club_id}", "code": f"R{club_id:07d}"})
+        first_member = member_id + 1
+        for index in range(members):
+            member_id += 1
+            if index == 1 and club_id > 1:
+                # The same person in the previous club too: one digest for both meetings
+                email = f"member{first_member - members + 1}@example.com"
+            elif index == 2 and club_id % 50 == 0:
+                email = f"member{member_id}@{REFUSED_DOMAIN}"
+            elif index == 3:
+                email = None
+            else:
+                email = f"member{member_id}@example.com"
+            member_rows.append({
+                "id": member_id, "club_id": club_id, "display_name": f"Member {member_id}",
+                "email": email, "session_id": f"reminders-{member_id}", "is_admin": index == 0,
+            })
+
+        meeting_id += 1
+        meeting_rows.append({
+            "id": meeting_id, "club_id": club_id, "host_id": first_member, "title": f"Meeting {meeting_id}",
+            "meeting_datetime": now + timedelta(minutes=rng.randint(10, 23 * 60)), "status": "scheduled",
+        })
+        # One member said no; everyone else with an address is reminded
+        declined = first_member + members - 1
+        rsvp_rows.append({"meeting_id": meeting_id, "member_id": declined, "status": "no"})
+        rsvp_rows.append({"meeting_id": meeting_id, "member_id": first_member, "status": "yes"})
+        expected += members - 2
+
+        # Later, cancelled and past meetings are never reminded
+        for offset, status in ((timedelta(days=3), "scheduled"), (timedelta(hours=5), "cancelled"),
+                               (timedelta(hours=-2), "scheduled")):
+            if rng.random() < 0.3:
+                meeting_id += 1
+                meeting_rows.append({
+                    "id": meeting_id, "club_id": club_id, "host_id": first_member, "title": f"Meeting {meeting_id}",
+                    "meeting_datetime": now + offset, "status": status,
+                })
+
+    with engine.begin() as connection:
+        for model, rows in ((models.Club, club_rows), (models.Member, member_rows),
+                            (models.Meeting, meeting_rows), (models.MeetingRSVP, rsvp_rows)):
+            for start in range(0, len(rows), 5000):
+                connection.execute(insert(model), rows[start:start + 5000])
+    return expected
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", help="disposable database to use instead of a temporary SQLite file")
+    parser.add_argument("--clubs", type=int, default=10000)
+    parser.add_argument("--members", type=int, default=8, help="members per club")
+    parser.add_argument("--transport", choices=("smtp", "webhook"), default="smtp")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="bookclub-reminders-")
+    database_url = args.database_url or f"sqlite:///{directory}/reminders.db"
+    os.environ["DATABASE_URL"] = database_url
+    os.chdir(ROOT)
+
+    from app import models, reminders
+    from app.database import Base
+
+    # Refusals are expected here; the table below counts them
+    logging.getLogger("bookclub.reminders").setLevel(logging.ERROR)
+
+    engine = create_engine(database_url)
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    now = datetime.utcnow()
+    started = time.perf_counter()
+    expected = fill(engine, models, args.clubs, args.members, now, random.Random(args.seed))
+    print(f"filled {args.clubs} clubs in {time.perf_counter() - started:.1f}s")
+
+    messages, ready = multiprocessing.Value("i", 0), multiprocessing.Queue()
+    sink = multiprocessing.Process(
+        target=serve, args=(SMTPSink if args.transport == "smtp" else WebhookSink, messages, ready), daemon=True
+    )
+    sink.start()
+    port = ready.get(timeout=10)
+    if args.transport == "smtp":
+        transport = reminders.SMTPTransport(host="127.0.0.1", port=port)
+    else:
+        transport = reminders.WebhookTransport(f"http://127.0.0.1:{port}/reminders")
+        # Every member is reminded, with or without an address
+        expected += args.clubs
+
+    failed = False
+    try:
+        print(f"{'run':>5} {'seconds':>8} {'reminders':>10} {'messages':>9} {'failed':>7}")
+        for run in (1, 2):
+            before = messages.value
+            started = time.perf_counter()
+            with Session(engine) as db:
+                stats = reminders.send_due_reminders(db, transport, now=now)
+            elapsed = time.perf_counter() - started
+            print(f"{run:>5} {elapsed:>8.2f} {stats['sent']:>10} {messages.value - before:>9} {stats['failed']:>7}")
+
+            if messages.value - before != stats["digests"]:
+                print(f"    the sink received {messages.value - before} messages, {stats['digests']} were sent")
+                failed = True
+            if run == 1 and stats["sent"] + stats["failed"] != expected:
+                print(f"    expected {expected} reminders due")
+                failed = True
+            if run == 2 and stats["sent"]:
+                print("    a second run sent reminders again")
+                failed = True
+
+        with Session(engine) as db:
+            claimed = db.scalar(select(func.count(models.MeetingReminder.id)))
+        if claimed != expected - stats["failed"]:
+            print(f"    {claimed} reminders recorded, expected {expected - stats['failed']}")
+            failed = True
+    finally:
+        sink.terminate()
+        engine.dispose()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
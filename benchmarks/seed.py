@@ -0,0 +1,391 @@
+"""Synthetic dataset generator.
+
+Bulk-inserts realistic clubs straight into the tables: thousands of members,
+years of reading history, deep discussion and review comment trees, likes,
+veto votes, readers, genre tags, meetings and RSVPs. Rows get explicit ids so a whole
+club is written with a handful of multi-row INSERTs.
+
+Every seeded member's secret is ``bench-<member id>``, so runs over the
+same seed produce the same member tokens.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, func, select
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from app.database import Base  # noqa: E402
+from app import models  # noqa: E402
+
+PROFILES = {
+    "small": {
+        "clubs": 3, "members": 20, "years": 1, "discussions_per_book": 1,
+        "posts_per_discussion": 4, "comments_per_post": 6, "suggestions": 8, "meetings_per_year": 12,
+    },
+    "medium": {
+        "clubs": 10, "members": 150, "years": 3, "discussions_per_book": 1,
+        "posts_per_discussion": 8, "comments_per_post": 12, "suggestions": 20, "meetings_per_year": 12,
+    },
+    "large": {
+        "clubs": 25, "members": 250, "years": 5, "discussions_per_book": 2,
+        "posts_per_discussion": 12, "comments_per_post": 20, "suggestions": 40, "meetings_per_year": 24,
+    },
+}
+
+# Parent tables first so PostgreSQL foreign keys are satisfied
+TABLE_ORDER = [
+    models.Club, models.Member, models.Book, models.BookVote, models.BookReader, models.ReadingProgress,
+    models.Tag, models.BookTag, models.MemberTagAffinity,
+    models.Discussion, models.DiscussionPost, models.DiscussionPostLike,
+    models.DiscussionComment, models.DiscussionCommentLike,
+    models.Rating, models.ReviewLike, models.ReviewComment, models.ReviewCommentLike,
+    models.MeetingSchedule, models.Meeting, models.MeetingRSVP, models.Poll, models.PollOption, models.PollBallot,
+]
+
+# Readers of earlier books never reported progress; every row of a multi-row INSERT needs the same keys
+NO_PROGRESS = {"page": None, "pages": None, "permille": None, "progress_at": None}
+
+WORDS = (
+    "shadow river glass winter garden silent empire ember hollow crown salt night "
+    "orchard lantern iron paper storm wild quiet golden harbor stone echo violet "
+    "north fever letter island mirror forest ashes clock summer ghost tide"
+).split()
+GENRES = (
+    "mystery", "science fiction", "fantasy", "historical fiction", "literary fiction", "romance", "thriller",
+    "horror", "biography", "memoir", "history", "science", "poetry", "classics", "young adult", "humor",
+)
+FIRST_NAMES = (
+    "Ada Ben Cleo Dev Eli Fay Gus Hana Ivo June Kai Lena Milo Nia Otto Pia Quin "
+    "Rosa Sami Tess Uma Vik Wren Xan Yara Zed"
+).split()
+SENTENCES = [
+    "I did not see that twist coming at all.",
+    "The middle section dragged for me, but the ending made up for it.",
+    "Does anyone else think the narrator is unreliable?",
+    "The prose is gorgeous; I kept rereading paragraphs.",
+    "Chapter twelve changed how I read everything before it.",
+    "I'm only halfway through, no spoilers please!",
+    "The side characters were more interesting than the lead.",
+    "This reminded me of what we read last spring.",
+]
+
+
+def title(rng: random.Random) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 4))).title()
+
+
+def text(rng: random.Random, sentences: int = 2) -> str:
+    return " ".join(rng.choice(SENTENCES) for _ in range(sentences))
+
+
+class Seeder:
+    """Builds rows with explicit ids and writes them in dependency order"""
+
+    def __init__(self, connection, rng: random.Random, now: datetime):
+        self.connection = connection
+        self.rng = rng
+        self.now = now
+        self.rows = {model: [] for model in TABLE_ORDER}
+        self.counts = {model.__tablename__: 0 for model in TABLE_ORDER}
+        self.next_ids = {}
+        for model in TABLE_ORDER:
+            current = connection.execute(select(func.max(model.id))).scalar()
+            self.next_ids[model] = (current or 0) + 1
+        # Tags are shared by every club
+        self.tag_ids = dict(connection.execute(select(models.Tag.name, models.Tag.id)).all())
+        for name in GENRES:
+            if name not in self.tag_ids:
+                self.tag_ids[name] = self.add(models.Tag, name=name, created_at=now)
+
+    def add(self, model, **values) -> int:
+        row_id = self.next_ids[model]
+        self.next_ids[model] += 1
+        values["id"] = row_id
+        self.rows[model].append(values)
+        return row_id
+
+    def flush(self):
+        for model in TABLE_ORDER:
+            rows = self.rows[model]
+            for start in range(0, len(rows), 5000):
+                self.connection.execute(model.__table__.insert(), rows[start:start + 5000])
+            self.counts[model.__tablename__] += len(rows)
+            rows.clear()
+
+    def sample_members(self, member_ids: list, upper: int) -> list:
+        """A random subset of members, skewed toward small groups"""
+        count = min(len(member_ids), int(self.rng.paretovariate(1.5)) - 1, upper)
+        return self.rng.sample(member_ids, max(0, count))
+
+    def comment_tree(self, model, parent_key: str, parent_id: int, author_key: str, member_ids: list,
+                     count: int, started: datetime, like_model, extra: dict = None):
+        """Insert a comment thread where most replies continue the latest branch, so trees get deep"""
+        comment_ids = []
+        for index in range(count):
+            parent = None
+            if comment_ids and self.rng.random() < 0.75:
+                # Mostly reply to one of the latest comments, building long chains
+                parent = comment_ids[-1] if self.rng.random() < 0.6 else self.rng.choice(comment_ids)
+            comment_id = self.add(
+                model,
+                **{parent_key: parent_id, author_key: self.rng.choice(member_ids)},
+                parent_comment_id=parent,
+                content=text(self.rng, self.rng.randint(1, 3)),
+                created_at=started + timedelta(minutes=17 * index),
+                **(extra or {})
+            )
+            comment_ids.append(comment_id)
+            for member_id in self.sample_members(member_ids, 15):
+                self.add(like_model, comment_id=comment_id, member_id=member_id,
+                         created_at=started + timedelta(minutes=17 * index + 5))
+        return comment_ids
+
+    def reading_progress(self, book_id: int, member_id: int, started: datetime) -> dict:
+        """A few progress reports on the current book; returns the reader's latest position"""
+        # A generator of its own, so the rest of the dataset does not change with it
+        rng = random.Random(book_id * 100003 + member_id)
+        pages = rng.choice((192, 256, 320, 384, 416, 512))
+        position, reported = dict(NO_PROGRESS), started
+        for _ in range(rng.randint(0, 12)):
+            reported += timedelta(hours=rng.randint(6, 60))
+            if reported > self.now:
+                break
+            page = min(pages, (position["page"] or 0) + rng.randint(5, 60))
+            position = {"page": page, "pages": pages, "permille": page * 1000 // pages}
+            self.add(models.ReadingProgress, book_id=book_id, member_id=member_id, created_at=reported, **position)
+            position["progress_at"] = reported
+        return position
+
+    def book_tags(self, book_id: int, club_id: int) -> list:
+        """Tag one to three genres on the book; their ids"""
+        rng = random.Random(book_id * 31337)
+        tag_ids = [self.tag_ids[name] for name in rng.sample(GENRES, rng.randint(1, 3))]
+        for tag_id in tag_ids:
+            self.add(models.BookTag, book_id=book_id, tag_id=tag_id, club_id=club_id)
+        return tag_ids
+
+    def upvoters(self, book_id: int, member_ids: list, voting: bool) -> list:
+        """Members upvoting a suggestion in a voting club, short of the 50% that would select it"""
+        if not voting:
+            return []
+        rng = random.Random(book_id * 104729)
+        return rng.sample(member_ids, rng.randint(0, max(0, (len(member_ids) - 1) // 2)))
+
+    def poll(self, club_id: int, member_ids: list, kind: str, meeting_id: int = None):
+        """A poll with ballots from most of the club and running tallies to match"""
+        rng = random.Random(club_id * 7919 + len(kind))
+        options = rng.randint(3, 6)
+        poll_id = self.next_ids[models.Poll]
+        ballots = 0
+        votes = [0] * options
+        for member_id in member_ids:
+            if rng.random() < 0.4:
+                continue
+            if kind == "single":
+                choices = [rng.randrange(options)]
+            else:
+                # Approved options, or a ranking in order of preference
+                choices = rng.sample(range(options), rng.randint(1, options))
+            for position in (choices if kind == "approval" else choices[:1]):
+                votes[position] += 1
+            ballots += 1
+            self.add(models.PollBallot, poll_id=poll_id, member_id=member_id, choices=bytes(choices),
+                     created_at=self.now, updated_at=self.now)
+        self.add(
+            models.Poll, club_id=club_id, meeting_id=meeting_id, created_by=member_ids[0],
+            question=f"{title(rng)}?", kind=kind, closed=False, ballots=ballots, version=ballots,
+            created_at=self.now,
+        )
+        for position in range(options):
+            self.add(models.PollOption, poll_id=poll_id, position=position, label=title(rng),
+                     votes=votes[position])
+
+    def club(self, index: int, profile: dict):
+        rng, now = self.rng, self.now
+        founded = now - timedelta(days=365 * profile["years"] + 30)
+        club_id = self.add(
+            models.Club, name=f"{title(rng)} Readers", code=f"B{index:07d}"[-8:],
+            description=text(rng), created_at=founded, veto_enabled=True, veto_percentage=50,
+            book_selection_method="voting" if index % 2 else "random", voting_percentage=50,
+        )
+
+        member_ids = []
+        for member_index in range(profile["members"]):
+            member_id = self.next_ids[models.Member]
+            self.add(
+                models.Member, club_id=club_id, session_id=f"bench-{member_id}",
+                display_name=f"{rng.choice(FIRST_NAMES)} {member_index}",
+                joined_at=founded + timedelta(days=rng.randint(0, 365 * profile["years"])),
+                is_admin=member_index < 2,
+            )
+            member_ids.append(member_id)
+
+        # One completed book a month, then the current book and open suggestions
+        months = profile["years"] * 12
+        book_ids = []
+        # Each member's genre affinity, as the genres.affinity job would compute it
+        affinity = {}
+        for month in range(months + 1 + profile["suggestions"]):
+            if month < months:
+                status = "completed"
+            elif month == months:
+                status = "reading"
+            else:
+                status = "suggested"
+            selected = founded + timedelta(days=30 * month)
+            upvoters = self.upvoters(self.next_ids[models.Book], member_ids, index % 2 and status == "suggested")
+            book_id = self.add(
+                models.Book, club_id=club_id, title=title(rng), author=f"{rng.choice(FIRST_NAMES)} {title(rng)}",
+                description=text(rng), suggested_by=rng.choice(member_ids), suggested_at=selected - timedelta(days=20),
+                status=status, weight=1.0, vetoed=False, upvotes=len(upvoters),
+                selected_at=selected if status != "suggested" else None,
+                completed_at=selected + timedelta(days=30) if status == "completed" else None,
+            )
+            book_ids.append((book_id, status, selected))
+            tag_ids = self.book_tags(book_id, club_id)
+
+            if status == "suggested":
+                for member_id in self.sample_members(member_ids, len(member_ids) // 3):
+                    self.add(models.BookVote, book_id=book_id, member_id=member_id, vote_type="veto",
+                             created_at=selected)
+                for member_id in upvoters:
+                    self.add(models.BookVote, book_id=book_id, member_id=member_id, vote_type="upvote",
+                             created_at=selected)
+                continue
+
+            readers = rng.sample(member_ids, max(1, int(len(member_ids) * rng.uniform(0.3, 0.8))))
+            for member_id in readers:
+                position = self.reading_progress(book_id, member_id, selected) if status == "reading" else NO_PROGRESS
+                self.add(models.BookReader, book_id=book_id, member_id=member_id, joined_at=selected, **position)
+                for tag_id in tag_ids:
+                    affinity[member_id, tag_id] = affinity.get((member_id, tag_id), 0) + 1.0
+
+            for _ in range(profile["discussions_per_book"]):
+                discussion_id = self.add(models.Discussion, book_id=book_id, title=title(rng), created_at=selected)
+                for post_index in range(profile["posts_per_discussion"]):
+                    posted = selected + timedelta(hours=6 * post_index)
+                    post_id = self.add(
+                        models.DiscussionPost, discussion_id=discussion_id, author_id=rng.choice(readers),
+                        content=text(rng, 3), is_spoiler=rng.random() < 0.2, created_at=posted,
+                    )
+                    for member_id in self.sample_members(readers, 25):
+                        self.add(models.DiscussionPostLike, post_id=post_id, member_id=member_id, created_at=posted)
+                    self.comment_tree(
+                        models.DiscussionComment, "post_id", post_id, "author_id", readers,
+                        rng.randint(0, profile["comments_per_post"] * 2), posted, models.DiscussionCommentLike,
+                        extra={"is_spoiler": False},
+                    )
+
+            for member_id in rng.sample(readers, max(1, len(readers) // 2)):
+                rated = selected + timedelta(days=rng.randint(20, 40))
+                stars = rng.randint(1, 5)
+                rating_id = self.add(
+                    models.Rating, book_id=book_id, member_id=member_id, rating=stars,
+                    review=text(rng, 2), created_at=rated, updated_at=rated,
+                )
+                for tag_id in tag_ids:
+                    affinity[member_id, tag_id] += (stars - 3) * 0.5
+                for liker in self.sample_members(readers, 10):
+                    self.add(models.ReviewLike, rating_id=rating_id, member_id=liker, created_at=rated)
+                self.comment_tree(
+                    models.ReviewComment, "rating_id", rating_id, "member_id", readers,
+                    rng.randint(0, profile["comments_per_post"] // 2), rated, models.ReviewCommentLike,
+                )
+
+        for (member_id, tag_id), score in affinity.items():
+            if score:
+                self.add(models.MemberTagAffinity, member_id=member_id, tag_id=tag_id, score=score, updated_at=now)
+
+        self.add(
+            models.MeetingSchedule, club_id=club_id, current_host_id=member_ids[0],
+            recurrence_pattern="monthly_day", recurrence_details="2nd Tuesday",
+            default_duration_minutes=120, is_active=True, created_at=founded,
+        )
+        total_meetings = profile["years"] * profile["meetings_per_year"]
+        spacing = timedelta(days=365 / profile["meetings_per_year"])
+        for meeting_index in range(total_meetings + 3):
+            when = founded + spacing * (meeting_index + 1)
+            book_id, _, _ = book_ids[min(meeting_index * 12 // profile["meetings_per_year"], months)]
+            meeting_id = self.add(
+                models.Meeting, club_id=club_id, book_id=book_id, host_id=rng.choice(member_ids),
+                title=f"Meeting #{meeting_index + 1}", meeting_datetime=when, duration_minutes=120,
+                location="Library, room 2", description=text(rng),
+                status="completed" if when < now else "scheduled", created_at=when - timedelta(days=14),
+            )
+            for member_id in rng.sample(member_ids, len(member_ids) // 2):
+                self.add(
+                    models.MeetingRSVP, meeting_id=meeting_id, member_id=member_id,
+                    status=rng.choice(("yes", "yes", "maybe", "no")), bringing=rng.choice(("", "snacks", "wine")),
+                    notes="", created_at=when - timedelta(days=7), updated_at=when - timedelta(days=7),
+                )
+
+        for kind in ("single", "approval", "ranked"):
+            # The ranked poll is about the last meeting scheduled
+            self.poll(club_id, member_ids, kind, meeting_id if kind == "ranked" else None)
+
+        self.flush()
+
+
+def seed(database_url: str, profile: dict, seed_value: int = 42) -> dict:
+    """Create the schema if needed and add one dataset; return row counts"""
+    engine = create_engine(database_url)
+    Base.metadata.create_all(bind=engine)
+    rng = random.Random(seed_value)
+
+    started = time.perf_counter()
+    with engine.begin() as connection:
+        seeder = Seeder(connection, rng, datetime.utcnow())
+        first_club = seeder.next_ids[models.Club]
+        for index in range(profile["clubs"]):
+            seeder.club(first_club + index, profile)
+
+        if engine.dialect.name == "postgresql":
+            # Ids were assigned here, so move each sequence past them for the app's own inserts
+            for model in TABLE_ORDER:
+                table = model.__tablename__
+                connection.exec_driver_sql(
+                    f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), COALESCE(MAX(id), 0) + 1, false) "
+                    f"FROM {table}"
+                )
+    engine.dispose()
+
+    return {
+        "profile": profile,
+        "seconds": round(time.perf_counter() - started, 2),
+        "rows": seeder.counts,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=os.getenv("DATABASE_URL", "sqlite:///./data/bench.db"))
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="medium")
+    parser.add_argument("--seed", type=int, default=42, help="random seed, for reproducible datasets")
+    for key in PROFILES["small"]:
+        parser.add_argument(f"--{key.replace('_', '-')}", type=int, help=f"override the profile's {key}")
+    args = parser.parse_args()
+
+    profile = dict(PROFILES[args.profile])
+    for key in profile:
+        override = getattr(args, key)
+        if override is not None:
+            profile[key] = override
+
+    if args.database_url.startswith("sqlite:///"):
+        directory = os.path.dirname(args.database_url[len("sqlite:///"):])
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    print(json.dumps(seed(args.database_url, profile, args.seed), indent=2))
+
+
+if __name__ == "__main__":
+    main()
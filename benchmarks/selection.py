@@ -0,0 +1,187 @@
+"""Book selection by upvotes in one big club.
+
+Seeds one voting club, gives its suggestions many upvotes, then:
+
+- times an upvote (and taking it back) with the running count on the book,
+  against counting the club's upvote rows to find a winner after each vote;
+- has every member upvote several suggestions from several threads at once
+  until one reaches the threshold, and checks exactly one book was started
+  and every running count matches its rows.
+
+    python -m benchmarks.selection
+    python -m benchmarks.selection --members 2000 --database-url postgresql://localhost/bookclub_test
+
+``--database-url`` runs against another (empty, disposable) database
+instead of a temporary SQLite file; every table in it is dropped first.
+"""
+import argparse
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+from sqlalchemy import create_engine, func, insert, select
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+def median_ms(fn, runs: int) -> float:
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", help="disposable database to use instead of a temporary SQLite file")
+    parser.add_argument("--members", type=int, default=1000, help="members in the club")
+    parser.add_argument("--suggestions", type=int, default=40, help="open suggestions")
+    parser.add_argument("--threads", type=int, default=8, help="threads upvoting at once")
+    parser.add_argument("--runs", type=int, default=200, help="upvotes timed each way")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="bookclub-selection-")
+    database_url = args.database_url or f"sqlite:///{directory}/selection.db"
+    os.environ["DATABASE_URL"] = database_url
+    os.environ["JOBS_ENABLED"] = "off"
+    os.environ["SLOW_QUERY_MS"] = "-1"
+    os.chdir(ROOT)
+
+    from benchmarks.seed import PROFILES, seed
+    from app import models
+    from app.database import Base
+
+    if args.database_url:
+        engine = create_engine(database_url)
+        Base.metadata.drop_all(engine)
+        engine.dispose()
+    seed(database_url, dict(PROFILES["small"], clubs=2, members=args.members, suggestions=args.suggestions),
+         args.seed)
+
+    from app import selection
+    from app.database import SessionLocal, engine, toggle
+
+    rng = random.Random(args.seed)
+    failed = False
+
+    def counts_match(db) -> bool:
+        counted = dict(db.execute(
+            select(models.BookVote.book_id, func.count(models.BookVote.id))
+            .where(models.BookVote.vote_type == "upvote")
+            .group_by(models.BookVote.book_id)
+        ).all())
+        return all(
+            upvotes == counted.get(book_id, 0)
+            for book_id, upvotes in db.execute(
+                select(models.Book.id, models.Book.upvotes).where(models.Book.status == "suggested")
+            )
+        )
+
+    try:
+        with SessionLocal() as db:
+            club = db.query(models.Club).filter(models.Club.book_selection_method == "voting").first()
+            club_id = club.id
+            member_ids = [member.id for member in club.members]
+            book_ids = [book.id for book in club.books if book.status == "suggested"]
+            needed = selection.votes_needed(len(member_ids), club.voting_percentage)
+
+            # Fill every suggestion up to two votes short of the threshold
+            db.query(models.BookVote).filter(
+                models.BookVote.vote_type == "upvote", models.BookVote.book_id.in_(book_ids)
+            ).delete(synchronize_session=False)
+            rows, voters = [], {}
+            for book_id in book_ids:
+                voters[book_id] = rng.sample(member_ids, needed - 2)
+                rows.extend({"book_id": book_id, "member_id": member_id, "vote_type": "upvote"}
+                            for member_id in voters[book_id])
+            db.execute(insert(models.BookVote), rows)
+            for book_id in book_ids:
+                db.query(models.Book).filter(models.Book.id == book_id).update({"upvotes": needed - 2})
+            db.commit()
+            total = db.scalar(select(func.count(models.BookVote.id)))
+            print(f"{len(member_ids)} members, {len(book_ids)} suggestions at {needed - 2} of {needed} upvotes, "
+                  f"{total} book votes in the database")
+
+            # An upvote and taking it back, by a member who has not voted for the book
+            book_id = book_ids[0]
+            member_id = next(member for member in member_ids if member not in voters[book_id])
+
+            def counted_vote():
+                selection.upvote(db, book_id, member_id)
+                db.commit()
+
+            def naive_vote():
+                # The same vote, with the winner found by counting the club's upvote rows
+                toggle(db, models.BookVote, book_id=book_id, member_id=member_id, vote_type="upvote")
+                db.execute(
+                    select(models.BookVote.book_id, func.count(models.BookVote.id))
+                    .join(models.Book, models.Book.id == models.BookVote.book_id)
+                    .where(models.Book.club_id == club_id, models.Book.status == "suggested",
+                           models.BookVote.vote_type == "upvote")
+                    .group_by(models.BookVote.book_id)
+                    .having(func.count(models.BookVote.id) >= needed)
+                ).all()
+                db.commit()
+
+            # An even number of runs leaves the vote where it started
+            runs = args.runs + args.runs % 2
+            fast_ms = median_ms(counted_vote, runs)
+            slow_ms = median_ms(naive_vote, runs)
+            print(f"{'upvote':32} {'ms':>8}")
+            print(f"{'running count on the book':32} {fast_ms:>8.2f}")
+            print(f"{'counting the club upvotes':32} {slow_ms:>8.2f}")
+            if not counts_match(db):
+                print("    running counts differ from the upvote rows")
+                failed = True
+
+        def voter(member_ids: list):
+            for member_id in member_ids:
+                for book_id in book_ids[:4]:
+                    with SessionLocal() as db:
+                        try:
+                            selection.upvote(db, book_id, member_id)
+                            db.commit()
+                        except ValueError:
+                            # Already started by an earlier vote
+                            db.rollback()
+
+        threads = [threading.Thread(target=voter, args=(member_ids[index::args.threads],))
+                   for index in range(args.threads)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        writes = len(member_ids) * 4
+        print(f"{writes} upvotes on 4 suggestions from {args.threads} threads in {elapsed:.2f}s "
+              f"({writes / elapsed:.0f}/s)")
+
+        with SessionLocal() as db:
+            reading = db.scalars(select(models.Book.id).where(
+                models.Book.club_id == club_id, models.Book.status == "reading"
+            )).all()
+            matched = counts_match(db)
+            ok = len(reading) == 1 and matched
+            print(f"    book being read: {reading}, running counts match: {matched}")
+            failed = failed or not ok
+    finally:
+        engine.dispose()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""Throughput and memory per worker count for the production launcher.
+
+Starts ``app.server`` with each worker count in turn against a seeded
+database, drives the same request mix at it over HTTP, then reads every
+process's memory from ``/proc``. RSS counts pages shared with the master;
+PSS splits them between the processes sharing them and USS is what a worker
+holds alone, so a preloaded, frozen app shows up as a large RSS with a small
+USS per worker.
+
+    python -m benchmarks.workers --database-url sqlite:///./data/bench.db --workers 1,2,4
+
+Linux only (memory comes from ``/proc/<pid>/smaps_rollup``).
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from benchmarks.load import (  # noqa: E402
+    HttpClient, Targets, build_plan, free_port, git_revision, percentile, run_http, start_server
+)
+from app.version import __version__  # noqa: E402
+
+
+def memory(pid: int) -> dict:
+    """RSS, PSS and USS of one process in MiB"""
+    fields = {}
+    with open(f"/proc/{pid}/smaps_rollup") as handle:
+        for line in handle:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                fields[parts[0].rstrip(":")] = int(parts[1])
+    private = fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0)
+    return {
+        "rss_mb": round(fields.get("Rss", 0) / 1024, 1),
+        "pss_mb": round(fields.get("Pss", 0) / 1024, 1),
+        "uss_mb": round(private / 1024, 1),
+    }
+
+
+def children(pid: int) -> list:
+    with open(f"/proc/{pid}/task/{pid}/children") as handle:
+        return [int(child) for child in handle.read().split()]
+
+
+def measure(args, workers: int) -> dict:
+    rng = random.Random(args.seed)
+    targets = Targets(args.database_url, args.clubs, rng)
+    warmup = build_plan(targets, args.warmup, args.write_ratio, rng)
+    plan = build_plan(targets, args.requests, args.write_ratio, rng)
+
+    port = free_port()
+    process = start_server(args.database_url, port, workers)
+    try:
+        # Every worker must be up before the clock starts
+        deadline = time.monotonic() + 30
+        while len(children(process.pid)) < workers and time.monotonic() < deadline:
+            time.sleep(0.1)
+
+        client = HttpClient(f"http://127.0.0.1:{port}")
+        run_http(client, warmup, args.concurrency, {})
+        samples = {}
+        started = time.perf_counter()
+        run_http(client, plan, args.concurrency, samples)
+        elapsed = time.perf_counter() - started
+
+        master = memory(process.pid)
+        per_worker = [memory(pid) for pid in children(process.pid)]
+    finally:
+        process.terminate()
+        process.wait()
+
+    latencies = sorted(elapsed_s for calls in samples.values() for elapsed_s, _ in calls)
+    total = len(latencies)
+    errors = sum(1 for calls in samples.values() for _, status in calls if status >= 400)
+    return {
+        "workers": workers,
+        "requests": total,
+        "errors": errors,
+        "throughput_rps": round(total / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "master": master,
+        "per_worker": per_worker,
+        "worker_uss_mb": round(sum(row["uss_mb"] for row in per_worker) / max(1, len(per_worker)), 1),
+        "total_pss_mb": round(master["pss_mb"] + sum(row["pss_mb"] for row in per_worker), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=os.getenv("DATABASE_URL", "sqlite:///./data/bench.db"))
+    parser.add_argument("--workers", default=f"1,{os.cpu_count() or 1}",
+                        help="comma-separated worker counts to compare")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--warmup", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--write-ratio", type=float, default=0.1, help="fraction of requests that write")
+    parser.add_argument("--clubs", type=int, default=10, help="seeded clubs to spread traffic over")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write JSON results to this file")
+    args = parser.parse_args()
+
+    if args.database_url.startswith("sqlite:///") and not args.database_url.startswith("sqlite:////"):
+        args.database_url = "sqlite:///" + os.path.abspath(args.database_url[len("sqlite:///"):])
+
+    counts = sorted({int(count) for count in args.workers.split(",") if count})
+    runs = [measure(args, workers) for workers in counts]
+
+    print(f"{'workers':>7} {'req/s':>9} {'p50':>8} {'p95':>8} {'errors':>7} "
+          f"{'worker RSS':>11} {'worker USS':>11} {'total PSS':>10}")
+    for row in runs:
+        rss = sum(worker["rss_mb"] for worker in row["per_worker"]) / max(1, len(row["per_worker"]))
+        print(f"{row['workers']:>7} {row['throughput_rps']:>9} {row['p50_ms']:>8} {row['p95_ms']:>8} "
+              f"{row['errors']:>7} {rss:>10.1f}M {row['worker_uss_mb']:>10.1f}M {row['total_pss_mb']:>9.1f}M")
+
+    if args.output:
+        with open(args.output, "w") as handle:
+            json.dump({
+                "version": __version__,
+                "git_revision": git_revision(),
+                "cpus": os.cpu_count(),
+                "runs": runs,
+            }, handle, indent=2)
+
+
+if __name__ == "__main__":
+    main()
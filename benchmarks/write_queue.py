@@ -0,0 +1,129 @@
+"""Write throughput with and without the group-commit write queue.
+
+Seeds a SQLite database, then for each mode starts ``app.server`` on a
+fresh copy of it and sends nothing but writes (likes, comments, RSVPs,
+vetoes) from many connections at once. Reports writes per second, latency
+percentiles, failed requests and, with the queue on, the mean batch size
+one worker committed.
+
+    python -m benchmarks.write_queue
+    python -m benchmarks.write_queue --concurrency 64 --workers 2 --output data/bench-write-queue.json
+"""
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+_BATCH_SAMPLE = re.compile(r"^bookclub_write_queue_batch_size_(sum|count) (\S+)$")
+
+
+def batch_size(metrics_text: str):
+    """Mean writes per commit in the worker that served /metrics"""
+    totals = {}
+    for line in metrics_text.splitlines():
+        match = _BATCH_SAMPLE.match(line)
+        if match:
+            totals[match.group(1)] = float(match.group(2))
+    if not totals.get("count"):
+        return None
+    return round(totals["sum"] / totals["count"], 2)
+
+
+def measure(args, database_url: str, queue: bool) -> dict:
+    from benchmarks.load import HttpClient, Targets, build_plan, free_port, percentile, run_http, start_server
+
+    rng = random.Random(args.seed)
+    targets = Targets(database_url, args.clubs, rng)
+    warmup = build_plan(targets, args.warmup, 1.0, rng)
+    plan = build_plan(targets, args.requests, 1.0, rng)
+
+    os.environ["WRITE_QUEUE"] = "on" if queue else "off"
+    port = free_port()
+    process = start_server(database_url, port, args.workers)
+    try:
+        client = HttpClient(f"http://127.0.0.1:{port}")
+        run_http(client, warmup, args.concurrency, {})
+        samples = {}
+        started = time.perf_counter()
+        run_http(client, plan, args.concurrency, samples)
+        elapsed = time.perf_counter() - started
+        batches = batch_size(client.metrics())
+    finally:
+        process.terminate()
+        process.wait()
+
+    calls = [call for endpoint_calls in samples.values() for call in endpoint_calls]
+    latencies = sorted(latency for latency, _ in calls)
+    return {
+        "write_queue": queue,
+        "requests": len(calls),
+        "errors": sum(1 for _, status in calls if status == 0 or status >= 400),
+        "writes_per_second": round(len(calls) / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "mean_batch_size": batches,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--profile", default="small", help="benchmarks.seed profile to generate")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--warmup", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=1, help="server workers")
+    parser.add_argument("--clubs", type=int, default=10, help="seeded clubs to spread writes over")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write JSON results to this file")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="bookclub-write-queue-")
+    seeded = os.path.join(directory, "seeded.db")
+    os.environ["DATABASE_URL"] = f"sqlite:///{seeded}"
+    os.environ.setdefault("CACHE_BUS_URL", os.path.join(directory, "cache_bus.db"))
+    os.chdir(ROOT)
+
+    from benchmarks.seed import PROFILES, seed
+    from benchmarks.load import git_revision
+    from app.version import __version__
+
+    try:
+        seed(f"sqlite:///{seeded}", PROFILES[args.profile], args.seed)
+        runs = []
+        for queue in (False, True):
+            # Every mode starts from the same data
+            path = os.path.join(directory, f"queue-{'on' if queue else 'off'}.db")
+            shutil.copy(seeded, path)
+            runs.append(measure(args, f"sqlite:///{path}", queue))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    print(f"{'write queue':>11} {'writes/s':>9} {'p50':>8} {'p95':>8} {'p99':>8} {'errors':>7} {'batch':>6}")
+    for row in runs:
+        print(f"{'on' if row['write_queue'] else 'off':>11} {row['writes_per_second']:>9} {row['p50_ms']:>8} "
+              f"{row['p95_ms']:>8} {row['p99_ms']:>8} {row['errors']:>7} {row['mean_batch_size'] or '-':>6}")
+
+    if args.output:
+        with open(args.output, "w") as handle:
+            json.dump({
+                "version": __version__,
+                "git_revision": git_revision(),
+                "cpus": os.cpu_count(),
+                "concurrency": args.concurrency,
+                "workers": args.workers,
+                "runs": runs,
+            }, handle, indent=2)
+
+
+if __name__ == "__main__":
+    main()
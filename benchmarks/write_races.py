@@ -0,0 +1,271 @@
+"""Concurrency stress test for toggles and upserts.
+
+Seeds a small dataset, starts ``app.server`` with several workers and has
+several members each fire the same write many times at once: likes on
+posts, comments, reviews and review comments, ratings, RSVPs, joining and
+leaving the readers of a book, upvotes and vetoes. Afterwards it checks the
+database: every (entity, member) pair has at most one row, upserts keep one
+of the submitted values, and each toggle ended liked exactly when it was
+sent an odd number of times (with a book's running upvote count matching
+its rows). Then it runs an ``add()`` and a write that fails in one write
+queue batch, in process, and checks the add succeeds when retried on its
+own. Exits non-zero on any violation or failed request.
+
+    python -m benchmarks.write_races
+    python -m benchmarks.write_races --database-url postgresql://localhost/bookclub_test
+
+``--database-url`` runs against another (empty, disposable) database
+instead of a temporary SQLite file; every table in it is dropped first.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import urllib.parse
+
+from sqlalchemy import create_engine, func
+from sqlalchemy.orm import Session
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+def fire(base_url: str, calls: list) -> list:
+    """Send every (path, form, cookie) call at once, one connection each; return the statuses"""
+    import http.client
+
+    parsed = urllib.parse.urlparse(base_url)
+    barrier = threading.Barrier(len(calls))
+    statuses = [None] * len(calls)
+
+    def send(index, path, form, cookie):
+        conn = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=60)
+        body = urllib.parse.urlencode(form or {})
+        headers = {"Content-Type": "application/x-www-form-urlencoded", "Cookie": cookie}
+        try:
+            conn.connect()
+            barrier.wait()
+            conn.request("POST", path, body, headers)
+            response = conn.getresponse()
+            response.read()
+            statuses[index] = response.status
+        except Exception as exc:
+            statuses[index] = repr(exc)
+        finally:
+            conn.close()
+
+    threads = [threading.Thread(target=send, args=(index, *call)) for index, call in enumerate(calls)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return statuses
+
+
+def pick(db, models, member_count: int) -> dict:
+    """One club's members and one of each entity the cases write to"""
+    club = db.query(models.Club).order_by(models.Club.id).first()
+    members = (
+        db.query(models.Member)
+        .filter(models.Member.club_id == club.id)
+        .order_by(models.Member.id)
+        .limit(member_count)
+        .all()
+    )
+    books = {book.status: book for book in sorted(club.books, key=lambda book: book.id)}
+    completed = next(book for book in club.books if book.status == "completed" and book.ratings)
+    discussion = next(discussion for book in club.books for discussion in book.discussions if discussion.posts)
+    post = discussion.posts[0]
+    comment = db.query(models.DiscussionComment).filter(models.DiscussionComment.post_id == post.id).first() or \
+        db.query(models.DiscussionComment).first()
+    rating = completed.ratings[0]
+    review_comment = db.query(models.ReviewComment).first()
+    meeting = db.query(models.Meeting).filter(models.Meeting.club_id == club.id).first()
+    return {
+        "members": members,
+        "reading": books["reading"],
+        "suggested": books["suggested"],
+        "completed": completed,
+        "post": post,
+        "comment": comment,
+        "rating": rating,
+        "review_comment": review_comment,
+        "meeting": meeting,
+    }
+
+
+def cases(targets: dict, models) -> list:
+    """(name, model, {key: value} minus member_id, path, form per attempt, kind)
+
+    kind is "toggle" (liked iff sent an odd number of times), "once" (exactly
+    one row), "gone" (no row) or "upsert" (one row holding a submitted value).
+    """
+    return [
+        ("post like", models.DiscussionPostLike, {"post_id": targets["post"].id},
+         f"/discussions/post/{targets['post'].id}/like", lambda attempt: None, "toggle"),
+        ("discussion comment like", models.DiscussionCommentLike, {"comment_id": targets["comment"].id},
+         f"/discussions/comment/{targets['comment'].id}/like", lambda attempt: None, "toggle"),
+        ("review like", models.ReviewLike, {"rating_id": targets["rating"].id},
+         f"/ratings/{targets['rating'].id}/like", lambda attempt: None, "toggle"),
+        ("review comment like", models.ReviewCommentLike, {"comment_id": targets["review_comment"].id},
+         f"/ratings/comment/{targets['review_comment'].id}/like", lambda attempt: None, "toggle"),
+        ("rating", models.Rating, {"book_id": targets["completed"].id},
+         f"/ratings/book/{targets['completed'].id}/submit",
+         lambda attempt: {"rating": attempt % 5 + 1, "review": f"take {attempt}"}, "upsert"),
+        ("rsvp", models.MeetingRSVP, {"meeting_id": targets["meeting"].id},
+         f"/meetings/{targets['meeting'].id}/rsvp",
+         lambda attempt: {"status": ("yes", "no", "maybe")[attempt % 3], "notes": f"take {attempt}"}, "upsert"),
+        ("join reading", models.BookReader, {"book_id": targets["reading"].id},
+         f"/books/{targets['reading'].id}/join-reading", lambda attempt: None, "once"),
+        ("upvote", models.BookVote, {"book_id": targets["suggested"].id, "vote_type": "upvote"},
+         f"/books/{targets['suggested'].id}/upvote", lambda attempt: None, "toggle"),
+        ("veto", models.BookVote, {"book_id": targets["suggested"].id, "vote_type": "veto"},
+         f"/books/{targets['suggested'].id}/veto", lambda attempt: None, "once"),
+        ("leave reading", models.BookReader, {"book_id": targets["reading"].id},
+         f"/books/{targets['reading'].id}/leave-reading", lambda attempt: None, "gone"),
+    ]
+
+
+def batch_retry(engine, models, post_id: int, member_id: int) -> list:
+    """Run an add() and a failing write in one write queue batch; the problems found
+
+    Another worker commits a comment between the batch's rollback and the
+    retries, so an add() that inserts the row its batch flushed and rolled
+    back reuses an id that is taken by then.
+    """
+    from sqlalchemy.orm import sessionmaker
+    from app.writes import WriteQueue, add
+
+    sessions = sessionmaker(bind=engine)
+    opened = []
+
+    def session_factory():
+        opened.append(True)
+        if len(opened) == 2:
+            with sessions() as db:
+                db.add(models.DiscussionComment(post_id=post_id, author_id=member_id, content="in between"))
+                db.commit()
+        return sessions()
+
+    def fails(db):
+        raise RuntimeError("this write fails")
+
+    content = "retried on its own"
+    writes = WriteQueue(session_factory, max_batch=2, linger=5)
+    added = writes.submit(add(models.DiscussionComment(post_id=post_id, author_id=member_id, content=content)))
+    failing = writes.submit(fails)
+    problems = []
+    try:
+        comment_id = added.result(30)
+    except Exception as exc:
+        return [f"the add() failed on its retry: {exc!r}"[:300]]
+    if not isinstance(failing.exception(30), RuntimeError):
+        problems.append("the failing write did not fail")
+    with sessions() as db:
+        found = [comment.id for comment in db.query(models.DiscussionComment).filter_by(content=content)]
+    if found != [comment_id]:
+        problems.append(f"the add() returned {comment_id} and left rows {found}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", help="disposable database to use instead of a temporary SQLite file")
+    parser.add_argument("--workers", type=int, default=4, help="server workers")
+    parser.add_argument("--members", type=int, default=4, help="members writing at the same time")
+    parser.add_argument("--attempts", type=int, default=15, help="identical requests per member and case")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="bookclub-races-")
+    database_url = args.database_url or f"sqlite:///{directory}/races.db"
+    os.environ["DATABASE_URL"] = database_url
+    os.environ.setdefault("CACHE_BUS_URL", os.path.join(directory, "cache_bus.db"))
+    os.chdir(ROOT)
+
+    from app import models
+    from app.database import Base
+    from benchmarks.seed import PROFILES, seed
+    from benchmarks.load import free_port, member_token, start_server
+
+    engine = create_engine(database_url)
+    Base.metadata.drop_all(engine)
+    seed(database_url, PROFILES["small"], 7)
+
+    with Session(engine) as db:
+        # Upvotes count in clubs that vote; at 100% the racing members never select the book
+        club = db.query(models.Club).order_by(models.Club.id).first()
+        club.book_selection_method, club.voting_percentage = "voting", 100
+        db.commit()
+        targets = pick(db, models, args.members)
+        members = [(member.id, member_token(member)) for member in targets["members"]]
+        plan = cases(targets, models)
+        retry_target = (targets["post"].id, members[0][0])
+
+    def rows(db, model, keys, member_id):
+        return db.query(model).filter_by(member_id=member_id, **keys).all()
+
+    port = free_port()
+    server = start_server(database_url, port, args.workers)
+    failed = False
+    try:
+        print(f"{'case':26} {'requests':>9} {'failed':>7}  result")
+        for name, model, keys, path, form, kind in plan:
+            with Session(engine) as db:
+                before = {member_id: len(rows(db, model, keys, member_id)) for member_id, _ in members}
+
+            calls = [(path, form(attempt), cookie) for member_id, cookie in members for attempt in range(args.attempts)]
+            statuses = fire(f"http://127.0.0.1:{port}", calls)
+            errors = [status for status in statuses if not isinstance(status, int) or status >= 400]
+
+            problems = []
+            with Session(engine) as db:
+                for member_id, _ in members:
+                    found = rows(db, model, keys, member_id)
+                    if kind == "toggle":
+                        expected = before[member_id] ^ (args.attempts % 2)
+                    elif kind == "once" or kind == "upsert":
+                        expected = 1
+                    else:
+                        expected = 0
+                    if len(found) != expected:
+                        problems.append(f"member {member_id}: {len(found)} rows, expected {expected}")
+                    if kind == "upsert" and found:
+                        submitted = [form(attempt) for attempt in range(args.attempts)]
+                        value = {field: getattr(found[0], field) for field in submitted[0]}
+                        if value not in submitted:
+                            problems.append(f"member {member_id}: {value} was never submitted")
+                total = db.query(func.count(model.id)).filter_by(**keys).scalar()
+                if name == "upvote":
+                    upvotes = db.get(models.Book, keys["book_id"]).upvotes
+                    if upvotes != total:
+                        problems.append(f"the book counts {upvotes} upvotes for {total} rows")
+
+            ok = not problems and not errors
+            failed = failed or not ok
+            print(f"{name:26} {len(calls):>9} {len(errors):>7}  "
+                  f"{'ok' if ok else 'FAILED'} ({total} rows for the entity)")
+            for problem in problems[:5]:
+                print(f"    {problem}")
+            for error in sorted(set(map(str, errors)))[:3]:
+                print(f"    {error}")
+
+        problems = batch_retry(engine, models, *retry_target)
+        failed = failed or bool(problems)
+        print(f"{'batch retry':26} {2:>9} {1:>7}  {'FAILED' if problems else 'ok'} (one write failing, one add)")
+        for problem in problems:
+            print(f"    {problem}")
+    finally:
+        server.terminate()
+        server.wait()
+        engine.dispose()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
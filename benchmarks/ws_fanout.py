@@ -0,0 +1,142 @@
+"""Load test for the per-club WebSocket channel.
+
+Opens many concurrent connections to one club on a single uvicorn worker,
+casts a veto, and measures how long the broadcast takes to reach every
+socket.
+
+    python benchmarks/ws_fanout.py --connections 500
+
+Pass ``--url`` to target an already running server instead of starting one.
+"""
+import argparse
+import asyncio
+import http.client
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+
+import websockets
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def post_form(base_url: str, path: str, fields: dict, cookie: str = None):
+    """POST a form without following the redirect; return (location, session cookie)"""
+    parsed = urllib.parse.urlparse(base_url)
+    conn = http.client.HTTPConnection(parsed.hostname, parsed.port)
+    headers = {"Content-Type": "application/x-www-form-urlencoded"}
+    if cookie:
+        headers["Cookie"] = cookie
+    conn.request("POST", path, urllib.parse.urlencode(fields), headers)
+    response = conn.getresponse()
+    response.read()
+    cookies = [value.split(";", 1)[0] for name, value in response.getheaders() if name.lower() == "set-cookie"]
+    conn.close()
+    if response.status >= 400:
+        raise RuntimeError(f"POST {path} failed with {response.status}")
+    return response.getheader("Location"), "; ".join(cookies) or cookie
+
+
+def seed_club(base_url: str):
+    """Create a club with one suggestion; return (club code, member cookie)"""
+    location, cookie = post_form(base_url, "/clubs/create", {"name": "Load Test Club", "display_name": "Bench"})
+    code = location.rstrip("/").split("/")[-1]
+    post_form(base_url, "/books/suggest", {"club_code": code, "title": "Fan-out", "author": "Bench"}, cookie)
+    return code, cookie
+
+
+async def wait_for_server(base_url: str, timeout: float = 15):
+    parsed = urllib.parse.urlparse(base_url)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection(parsed.hostname, parsed.port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError("Server did not start in time")
+
+
+async def open_client(ws_url: str):
+    """Connect and consume the initial snapshot"""
+    socket = await websockets.connect(ws_url, max_queue=None, open_timeout=60)
+    message = json.loads(await socket.recv())
+    assert message["event"] == "snapshot"
+    return socket
+
+
+async def run(base_url: str, connections: int, batch: int):
+    code, cookie = await asyncio.to_thread(seed_club, base_url)
+    ws_url = base_url.replace("http", "ws", 1) + f"/clubs/{code}/ws"
+
+    # Connect in batches so the accept backlog is not the bottleneck
+    started = time.perf_counter()
+    sockets = []
+    for offset in range(0, connections, batch):
+        size = min(batch, connections - offset)
+        sockets.extend(await asyncio.gather(*(open_client(ws_url) for _ in range(size))))
+    connect_seconds = time.perf_counter() - started
+
+    async def receive_veto(socket):
+        while True:
+            message = json.loads(await socket.recv())
+            if message["event"] == "veto":
+                return time.perf_counter()
+
+    receivers = [asyncio.create_task(receive_veto(socket)) for socket in sockets]
+    sent = time.perf_counter()
+    await asyncio.to_thread(post_form, base_url, "/books/1/veto", {}, cookie)
+    arrivals = await asyncio.wait_for(asyncio.gather(*receivers), 60)
+    latencies = sorted((arrival - sent) * 1000 for arrival in arrivals)
+
+    await asyncio.gather(*(socket.close() for socket in sockets))
+
+    return {
+        "connections": connections,
+        "connect_seconds": round(connect_seconds, 3),
+        "fanout_ms": {
+            "p50": round(statistics.median(latencies), 2),
+            "p95": round(latencies[int(len(latencies) * 0.95) - 1], 2),
+            "max": round(latencies[-1], 2),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--connections", type=int, default=500)
+    parser.add_argument("--batch", type=int, default=100, help="connections opened concurrently")
+    parser.add_argument("--url", help="base URL of a running server (default: start one)")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    server = None
+    base_url = args.url
+    if not base_url:
+        base_url = f"http://127.0.0.1:{args.port}"
+        data_dir = tempfile.mkdtemp(prefix="bookclub-bench-")
+        env = dict(os.environ, DATABASE_URL=f"sqlite:///{data_dir}/bench.db")
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(args.port),
+             "--workers", "1", "--log-level", "warning", "--backlog", "4096"],
+            cwd=ROOT, env=env
+        )
+
+    try:
+        asyncio.run(wait_for_server(base_url))
+        result = asyncio.run(run(base_url, args.connections, args.batch))
+        print(json.dumps(result, indent=2))
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()